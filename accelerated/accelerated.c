@@ -6,6 +6,7 @@
 // author: Michael Cohen <scudette@gmail.com>
 
 
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
 
 // Number of bits used to hold type info in a proto tag.
@@ -29,6 +30,29 @@
 #define _WIRETYPE_MAX 5
 
 
+// Sets a grr.lib.rdfvalue.DecodeError, which the python implementation raises
+// for malformed buffers, so callers do not need to know which one decoded the
+// buffer. Falls back to a ValueError if the exception can not be found.
+static void set_decode_error(const char *message) {
+  PyObject *exception = NULL;
+  PyObject *module = PyImport_ImportModule("grr.lib.rdfvalue");
+
+  if (module) {
+    exception = PyObject_GetAttrString(module, "DecodeError");
+    Py_DECREF(module);
+  }
+
+  if (!exception) {
+    PyErr_Clear();
+    PyErr_SetString(PyExc_ValueError, message);
+    return;
+  }
+
+  PyErr_SetString(exception, message);
+  Py_DECREF(exception);
+}
+
+
 // Encode the value into the buffer as a Varint.  length contains the size of
 // the buffer, we set it to the total length of the written Varint.  Returns 1
 // on success and 0 if an error occurs. The only possible error is that value
@@ -98,7 +122,7 @@ int varint_decode(unsigned PY_LONG_LONG *result,
     }
 
     shift += 7;
-  } while (shift < 64);
+  }
 
   // Error decoding varint - buffer too short.
   return 0;
@@ -118,195 +142,357 @@ PyObject *py_varint_decode(PyObject *self, PyObject *args) {
     return Py_BuildValue("Kn", result, pos + length);
   }
 
-  PyErr_SetString(PyExc_RuntimeError, "Too many bytes when decoding varint.");
+  set_decode_error("Too many bytes when decoding varint.");
   return NULL;
 }
 
 
-PyObject *py_split_buffer(PyObject *self, PyObject *args, PyObject *kwargs) {
-  char *buffer;
-  Py_ssize_t buffer_len = 0;
-  Py_ssize_t length = 0;
-  Py_ssize_t index = 0;
-  static const char *kwlist[] = {"buffer", "index", "length", NULL};
-  PyObject *encoded_tag = NULL;
-
-  PyObject *result = PyList_New(0);
-  if (!result)
+// Reads a single tagged field off the buffer and returns it as a new tuple of
+// strings (encoded_tag, encoded_length, wire_format). The buffer is advanced
+// past the field and length is decremented accordingly. Returns NULL with an
+// exception set if the field can not be decoded.
+static PyObject *read_wire_entry(const char **buffer, Py_ssize_t *length) {
+  Py_ssize_t tag_length = 0;
+  Py_ssize_t length_length = 0;
+  Py_ssize_t data_length = 0;
+  unsigned PY_LONG_LONG tag;
+  const char *data;
+
+  // Read the tag off the buffer.
+  if (!varint_decode(&tag, *buffer, *length, &tag_length)) {
+    set_decode_error("Unable to decode tag.");
     return NULL;
+  }
 
-  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s#|nn", (char **)kwlist,
-                                   &buffer, &buffer_len, &index, &length))
+  data = *buffer + tag_length;
+
+  // Handle the tag depending on its type.
+  switch (tag & TAG_TYPE_MASK) {
+    case WIRETYPE_VARINT: {
+      unsigned PY_LONG_LONG value;
+
+      if (!varint_decode(&value, data, *length - tag_length, &data_length)) {
+        set_decode_error("Unable to decode varint.");
+        return NULL;
+      }
+      break;
+    }
+
+    case WIRETYPE_FIXED64:
+      data_length = 8;
+      break;
+
+    case WIRETYPE_FIXED32:
+      data_length = 4;
+      break;
+
+    case WIRETYPE_LENGTH_DELIMITED: {
+      unsigned PY_LONG_LONG data_size;
+
+      // Decode the length varint and position ourselves at the start of the
+      // data.
+      if (!varint_decode(&data_size, data, *length - tag_length,
+                         &length_length)) {
+        set_decode_error("Unable to decode length.");
+        return NULL;
+      }
+
+      // Check that we do not exceed the available buffer here.
+      if (data_size > (unsigned PY_LONG_LONG)(
+              *length - tag_length - length_length)) {
+        set_decode_error("Length tag exceeds available buffer.");
+        return NULL;
+      }
+
+      data_length = (Py_ssize_t)data_size;
+      break;
+    }
+
+    default:
+      set_decode_error("Unexpected Tag.");
+      return NULL;
+  }
+
+  if (tag_length + length_length + data_length > *length) {
+    set_decode_error("Field exceeds available buffer.");
     return NULL;
+  }
+
+  {
+    PyObject *entry = PyTuple_New(3);
+    PyObject *item = NULL;
+    Py_ssize_t i;
+    const char *starts[3] = {*buffer, data, data + length_length};
+    Py_ssize_t sizes[3] = {tag_length, length_length, data_length};
+
+    if (!entry)
+      return NULL;
 
-  if (index < 0 || length < 0 || index > buffer_len) {
+    // PyTuple_SET_ITEM steals the references to the new strings.
+    for (i = 0; i < 3; i++) {
+      item = PyString_FromStringAndSize(starts[i], sizes[i]);
+      if (!item) {
+        Py_DECREF(entry);
+        return NULL;
+      }
+      PyTuple_SET_ITEM(entry, i, item);
+    }
+
+    *buffer += tag_length + length_length + data_length;
+    *length -= tag_length + length_length + data_length;
+
+    return entry;
+  }
+}
+
+
+// Validates the buffer, index and length arguments and positions the buffer
+// at the start of the region to parse. Returns 1 on success and 0 with an
+// exception set on failure.
+static int prepare_buffer(const char **buffer, Py_ssize_t buffer_len,
+                          Py_ssize_t index, Py_ssize_t *length) {
+  if (index < 0 || *length < 0 || index > buffer_len) {
     PyErr_SetString(
         PyExc_ValueError, "Invalid parameters.");
-    return NULL;
+    return 0;
   }
 
   // Advance the buffer to the required start index.
-  buffer += index;
+  *buffer += index;
 
   // Determine the length we will be splitting.
-  if (length == 0 || length > buffer_len - index) {
-    length = buffer_len - index;
+  if (*length == 0 || *length > buffer_len - index) {
+    *length = buffer_len - index;
   }
 
+  return 1;
+}
+
+
+PyObject *py_split_buffer(PyObject *self, PyObject *args, PyObject *kwargs) {
+  const char *buffer;
+  Py_ssize_t buffer_len = 0;
+  Py_ssize_t length = 0;
+  Py_ssize_t index = 0;
+  static const char *kwlist[] = {"buffer", "index", "length", NULL};
+  PyObject *result = NULL;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s#|nn", (char **)kwlist,
+                                   &buffer, &buffer_len, &index, &length))
+    return NULL;
+
+  if (!prepare_buffer(&buffer, buffer_len, index, &length))
+    return NULL;
+
+  result = PyList_New(0);
+  if (!result)
+    return NULL;
+
   // We advance the buffer and decrement the length until there is no more
   // buffer space left.
   while (length > 0) {
-    Py_ssize_t decoded_length = 0;
-    unsigned PY_LONG_LONG tag;
-    int tag_type;
-
-    // Read the tag off the buffer.
-    varint_decode(&tag, buffer, length, &decoded_length);
-
-    // Prepare to pass the encoded tag into the result tuple.
-    encoded_tag = PyString_FromStringAndSize(buffer, decoded_length);
-    buffer += decoded_length;
-    length -= decoded_length;
-
-    // Handle the tag depending on its type.
-    tag_type = tag & TAG_TYPE_MASK;
-    switch (tag_type) {
-      case WIRETYPE_VARINT: {
-        // Decode the varint and position ourselves at the next tag.
-        Py_ssize_t tag_length = 0;
-        PyObject *entry = NULL;
-
-        varint_decode(&tag, buffer, length, &tag_length);
-
-        // Create an entry to add to the result set. Note: We use
-        // PyTuple_SetItem which steals the references here instead of
-        // PyTuple_Pack which does not (meaning its more involved to use).
-        entry = PyTuple_New(3);
-        PyTuple_SET_ITEM(
-            entry, 0, encoded_tag);
-
-        // Empty string "".
-        PyTuple_SET_ITEM(
-            entry, 1,
-            PyString_FromStringAndSize(buffer, 0));
-
-        PyTuple_SET_ITEM(
-            entry, 2,
-            PyString_FromStringAndSize(buffer, tag_length));
-
-        PyList_Append(result, entry);
-        Py_DECREF(entry);
+    PyObject *entry = read_wire_entry(&buffer, &length);
+    if (!entry)
+      goto error;
 
-        buffer += tag_length;
-        length -= tag_length;
-
-        break;
-      }
+    if (PyList_Append(result, entry) < 0) {
+      Py_DECREF(entry);
+      goto error;
+    }
+    Py_DECREF(entry);
+  }
 
-      case WIRETYPE_FIXED64: {
-        // Fixed size data.
-        Py_ssize_t tag_length = 8;
+  return result;
 
-        PyObject *entry = PyTuple_New(3);
-        PyTuple_SET_ITEM(
-            entry, 0, encoded_tag);
+error:
+  Py_DECREF(result);
+  return NULL;
+}
 
-        // Empty string "".
-        PyTuple_SET_ITEM(
-            entry, 1,
-            PyString_FromStringAndSize(buffer, 0));
 
-        PyTuple_SET_ITEM(
-            entry, 2,
-            PyString_FromStringAndSize(buffer, tag_length));
+// Decodes all the fields in the buffer straight into the raw data dict of a
+// struct.
+//
+// tag_table maps encoded tags to (name, type_descriptor, repeated) tuples.
+// Known non repeated fields are stored in raw_data as
+// (None, wire_format, type_descriptor) under their name, unknown fields are
+// stored as (None, wire_format, None) under an integer key so they are
+// serialized back unchanged. Repeated fields can not be stored directly since
+// they live in their own container, so they are returned as a list of
+// (name, wire_format) tuples in the order they were read.
+PyObject *py_decode_fields(PyObject *self, PyObject *args, PyObject *kwargs) {
+  const char *buffer;
+  Py_ssize_t buffer_len = 0;
+  Py_ssize_t length = 0;
+  Py_ssize_t index = 0;
+  Py_ssize_t unknown_count = 0;
+  PyObject *tag_table = NULL;
+  PyObject *raw_data = NULL;
+  static const char *kwlist[] = {
+    "buffer", "index", "length", "tag_table", "raw_data", NULL};
+  PyObject *repeated = NULL;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s#nnO!O!", (char **)kwlist,
+                                   &buffer, &buffer_len, &index, &length,
+                                   &PyDict_Type, &tag_table,
+                                   &PyDict_Type, &raw_data))
+    return NULL;
 
-        PyList_Append(result, entry);
-        Py_DECREF(entry);
+  if (!prepare_buffer(&buffer, buffer_len, index, &length))
+    return NULL;
 
-        buffer += tag_length;
-        length -= tag_length;
+  repeated = PyList_New(0);
+  if (!repeated)
+    return NULL;
 
-        break;
+  while (length > 0) {
+    PyObject *value = NULL;
+    PyObject *field = NULL;
+    int status = 0;
+    PyObject *entry = read_wire_entry(&buffer, &length);
+    if (!entry)
+      goto error;
+
+    // Borrowed reference.
+    field = PyDict_GetItem(tag_table, PyTuple_GET_ITEM(entry, 0));
+
+    if (field == NULL) {
+      // An unknown field, keep it under a unique key.
+      PyObject *key = PyInt_FromSsize_t(unknown_count++);
+      if (!key) {
+        Py_DECREF(entry);
+        goto error;
       }
 
-      case WIRETYPE_FIXED32: {
-        // Fixed size data.
-        Py_ssize_t tag_length = 4;
+      value = PyTuple_Pack(3, Py_None, entry, Py_None);
+      status = value ? PyDict_SetItem(raw_data, key, value) : -1;
+      Py_DECREF(key);
 
-        PyObject *entry = PyTuple_New(3);
-        PyTuple_SET_ITEM(
-            entry, 0, encoded_tag);
+    } else if (!PyTuple_Check(field) || PyTuple_GET_SIZE(field) != 3) {
+      PyErr_SetString(PyExc_TypeError,
+                      "tag_table values must be 3-tuples.");
+      status = -1;
 
-        // Empty string "".
-        PyTuple_SET_ITEM(
-            entry, 1,
-            PyString_FromStringAndSize(buffer, 0));
+    } else if (PyObject_IsTrue(PyTuple_GET_ITEM(field, 2))) {
+      value = PyTuple_Pack(2, PyTuple_GET_ITEM(field, 0), entry);
+      status = value ? PyList_Append(repeated, value) : -1;
 
-        PyTuple_SET_ITEM(
-            entry, 2,
-            PyString_FromStringAndSize(buffer, tag_length));
+    } else {
+      value = PyTuple_Pack(3, Py_None, entry, PyTuple_GET_ITEM(field, 1));
+      status = value ? PyDict_SetItem(
+          raw_data, PyTuple_GET_ITEM(field, 0), value) : -1;
+    }
 
-        PyList_Append(result, entry);
-        Py_DECREF(entry);
+    Py_XDECREF(value);
+    Py_DECREF(entry);
 
-        buffer += tag_length;
-        length -= tag_length;
+    if (status < 0)
+      goto error;
+  }
 
-        break;
-      }
+  return repeated;
 
-      case WIRETYPE_LENGTH_DELIMITED: {
-        // Decode the length varint and position ourselves at the start of the
-        // data.
-        Py_ssize_t decoded_length = 0;
-        unsigned PY_LONG_LONG data_size;
-        PyObject *entry = NULL;
+error:
+  Py_DECREF(repeated);
+  return NULL;
+}
 
-        varint_decode(&data_size, buffer, length, &decoded_length);
 
-        // Check that we do not exceed the available buffer here.
-        if (data_size + decoded_length > (unsigned int)length) {
-          PyErr_SetString(
-              PyExc_ValueError, "Length tag exceeds available buffer.");
+// Joins a sequence of wire formats (each itself a sequence of strings) into a
+// single string. The total size is computed first so the result is written
+// into one preallocated buffer.
+PyObject *py_join_wire_formats(PyObject *self, PyObject *args) {
+  PyObject *wire_formats = NULL;
+  PyObject *sequences = NULL;
+  PyObject *parts_list = NULL;
+  PyObject *flat = NULL;
+  PyObject *result = NULL;
+  Py_ssize_t total = 0;
+  Py_ssize_t i, j, count;
+  int all_strings = 1;
+  char *output;
+
+  if (!PyArg_ParseTuple(args, "O", &wire_formats))
+    return NULL;
 
-          goto error;
-        }
+  sequences = PySequence_Fast(wire_formats, "wire_formats must be iterable.");
+  if (!sequences)
+    return NULL;
 
-        entry = PyTuple_New(3);
-        PyTuple_SET_ITEM(
-            entry, 0, encoded_tag);
+  count = PySequence_Fast_GET_SIZE(sequences);
 
-        // Empty string "".
-        PyTuple_SET_ITEM(
-            entry, 1,
-            PyString_FromStringAndSize(buffer, decoded_length));
+  // Keep the fast sequences of every wire format for the second pass.
+  parts_list = PyList_New(count);
+  if (!parts_list)
+    goto exit;
 
-        PyTuple_SET_ITEM(
-            entry, 2,
-            PyString_FromStringAndSize(buffer + decoded_length, data_size));
+  for (i = 0; i < count; i++) {
+    PyObject *parts = PySequence_Fast(
+        PySequence_Fast_GET_ITEM(sequences, i),
+        "wire format must be a sequence of strings.");
+    if (!parts)
+      goto exit;
 
-        PyList_Append(result, entry);
-        Py_DECREF(entry);
+    PyList_SET_ITEM(parts_list, i, parts);
 
-        buffer += decoded_length + data_size;
-        length -= decoded_length + data_size;
+    for (j = 0; j < PySequence_Fast_GET_SIZE(parts); j++) {
+      PyObject *part = PySequence_Fast_GET_ITEM(parts, j);
 
-        break;
+      if (PyString_CheckExact(part)) {
+        total += PyString_GET_SIZE(part);
+      } else {
+        all_strings = 0;
       }
+    }
+  }
 
-      default:
-        PyErr_SetString(
-            PyExc_ValueError, "Unexpected Tag");
+  // Unicode (or other) parts can not be copied directly, let str.join() deal
+  // with the coercion rules in this rare case.
+  if (!all_strings) {
+    PyObject *empty = NULL;
+
+    flat = PyList_New(0);
+    if (!flat)
+      goto exit;
+
+    for (i = 0; i < count; i++) {
+      PyObject *extended = _PyList_Extend(
+          (PyListObject *)flat, PyList_GET_ITEM(parts_list, i));
+      if (!extended)
+        goto exit;
+      Py_DECREF(extended);
+    }
 
-        goto error;
+    empty = PyString_FromStringAndSize("", 0);
+    if (empty) {
+      result = _PyString_Join(empty, flat);
+      Py_DECREF(empty);
     }
+    goto exit;
   }
 
-  return result;
+  result = PyString_FromStringAndSize(NULL, total);
+  if (!result)
+    goto exit;
 
-error:
-  Py_DECREF(encoded_tag);
-  return NULL;
+  output = PyString_AS_STRING(result);
+  for (i = 0; i < count; i++) {
+    PyObject *parts = PyList_GET_ITEM(parts_list, i);
+
+    for (j = 0; j < PySequence_Fast_GET_SIZE(parts); j++) {
+      PyObject *part = PySequence_Fast_GET_ITEM(parts, j);
+      Py_ssize_t size = PyString_GET_SIZE(part);
+
+      memcpy(output, PyString_AS_STRING(part), size);
+      output += size;
+    }
+  }
+
+exit:
+  Py_XDECREF(flat);
+  Py_XDECREF(parts_list);
+  Py_DECREF(sequences);
+  return result;
 }
 
 /* Retrieves the semantic protobuf version
@@ -314,7 +500,7 @@ error:
  */
 PyObject *py_semantic_get_version(PyObject *self, PyObject *arguments) {
     const char *errors = NULL;
-    return(PyUnicode_DecodeUTF8("20150518", (Py_ssize_t) 8, errors));
+    return(PyUnicode_DecodeUTF8("20171010", (Py_ssize_t) 8, errors));
 }
 
 static PyMethodDef _semantic_methods[] = {
@@ -340,6 +526,16 @@ static PyMethodDef _semantic_methods[] = {
      METH_VARARGS | METH_KEYWORDS,
      "Split a buffer into tags and wire format data."},
 
+    {"decode_fields",
+     (PyCFunction)py_decode_fields,
+     METH_VARARGS | METH_KEYWORDS,
+     "Decode a buffer directly into a struct's raw data dict."},
+
+    {"join_wire_formats",
+     (PyCFunction)py_join_wire_formats,
+     METH_VARARGS,
+     "Join wire formats into a single preallocated string."},
+
     {NULL}  /* Sentinel */
 };
 
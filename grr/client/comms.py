@@ -374,7 +374,7 @@ class HTTPManager(object):
         if not timeout:
           timeout = config.CONFIG["Client.http_timeout"]
 
-        result = requests.request(**request_args)
+        result = requests.request(timeout=timeout, **request_args)
         # By default requests doesn't raise on HTTP error codes.
         result.raise_for_status()
 
@@ -1269,6 +1269,9 @@ class GRRHTTPClient(object):
     # The time we last checked with the foreman.
     self.last_foreman_check = 0
 
+    # The number of seconds the server held the last poll open for us.
+    self.long_poll_granted = 0
+
     # The client worker does all the real work here.
     if worker:
       self.client_worker = worker
@@ -1338,7 +1341,7 @@ class GRRHTTPClient(object):
       logging.info("Protobuf decode error: %s.", e)
       return False
 
-  def MakeRequest(self, data):
+  def MakeRequest(self, data, timeout=None):
     """Make a HTTP Post request to the server 'control' endpoint."""
     stats.STATS.IncrementCounter("grr_client_sent_bytes", len(data))
 
@@ -1347,7 +1350,8 @@ class GRRHTTPClient(object):
         path="control?api=%s" % config.CONFIG["Network.api"],
         verify_cb=self.VerifyServerControlResponse,
         data=data,
-        headers={"Content-Type": "binary/octet-stream"})
+        headers={"Content-Type": "binary/octet-stream"},
+        timeout=timeout)
 
     if response.code == 406:
       self.InitiateEnrolment()
@@ -1367,6 +1371,8 @@ class GRRHTTPClient(object):
     Returns:
       A Status() object indicating how the last POST went.
     """
+    self.long_poll_granted = 0
+
     # Attempt to fetch and load server certificate.
     if not self._FetchServerCertificate():
       self.timer.Wait()
@@ -1403,9 +1409,17 @@ class GRRHTTPClient(object):
       # the input queue.
       payload.queue_size = self.client_worker.InQueueSize()
 
+    # If we have nothing to do, the server may hold the request open until it
+    # has new work for us.
+    timeout = None
+    if self._CanLongPoll(message_list):
+      payload.long_poll_timeout = config.CONFIG["Client.long_poll_timeout"]
+      timeout = (
+          config.CONFIG["Client.http_timeout"] + payload.long_poll_timeout)
+
     nonce = self.communicator.EncodeMessages(message_list, payload)
     payload_data = payload.SerializeToString()
-    response = self.MakeRequest(payload_data)
+    response = self.MakeRequest(payload_data, timeout=timeout)
 
     # Unable to decode response or response not valid.
     if response.code != 200 or response.messages is None:
@@ -1446,6 +1460,12 @@ class GRRHTTPClient(object):
       response.code = 500
       return response
 
+    # The server tells us if it actually held the request open.
+    if payload.long_poll_timeout and not response.messages:
+      response_comms = rdf_flows.ClientCommunication.FromSerializedString(
+          response.data)
+      self.long_poll_granted = response_comms.long_poll_timeout
+
     # Check to see if any inbound messages want us to fastpoll. This means we
     # drop to fastpoll immediately on a new request rather than waiting for the
     # next beacon to report results.
@@ -1468,6 +1488,15 @@ class GRRHTTPClient(object):
 
     return response
 
+  def _CanLongPoll(self, message_list):
+    """Returns True if we are idle and long polling is enabled."""
+    return bool(config.CONFIG["Client.long_poll_timeout"] and
+                not message_list.job and
+                not self.client_worker.MemoryExceeded() and
+                not self.client_worker.IsActive() and
+                self.client_worker.InQueueSize() == 0 and
+                self.client_worker.OutQueueSize() == 0)
+
   def SendForemanRequest(self):
     self.client_worker.SendReply(
         rdf_protodict.DataBlob(),
@@ -1554,7 +1583,9 @@ class GRRHTTPClient(object):
         # And done for now.
         sys.exit(-1)
 
-      self.timer.Wait()
+      # A long poll which returned empty already waited on the server side.
+      if not self.long_poll_granted:
+        self.timer.Wait()
 
   def InitiateEnrolment(self):
     """Initiate the enrollment process.
@@ -67,6 +67,12 @@ config_lib.DEFINE_list("Client.control_urls", [],
 config_lib.DEFINE_integer("Client.http_timeout", 100,
                           "Timeout for HTTP requests.")
 
+config_lib.DEFINE_integer(
+    "Client.long_poll_timeout", 0,
+    "If set, an idle client asks the server to hold its poll open for up to "
+    "this many seconds until new work arrives, instead of polling again after "
+    "Client.poll_max. 0 disables long polling.")
+
 config_lib.DEFINE_string("Client.plist_path",
                          "/Library/LaunchDaemons/com.google.code.grrd.plist",
                          "Location of our launchctl plist.")
@@ -16,6 +16,49 @@ config_lib.DEFINE_integer("Dataserver.max_connections", 5,
                           ("Maximum number of connections to the data server "
                            "per process."))
 
+config_lib.DEFINE_integer("Dataserver.stream_chunk_bytes", 1024 * 1024,
+                          ("Results of prefix queries and scans are sent to "
+                           "protocol version 2 clients in chunks of about "
+                           "this many bytes."))
+
+config_lib.DEFINE_integer("Dataserver.compression_threshold", 64 * 1024,
+                          ("Responses to protocol version 2 clients of at "
+                           "least this many bytes are compressed. 0 disables "
+                           "compression."))
+
+config_lib.DEFINE_bool("Dataserver.auto_rebalance", False,
+                       "If set, the master logs a rebalance plan when the "
+                       "load or size of the data servers is uneven. Plans "
+                       "are not performed automatically since writes to the "
+                       "moving ranges are lost while files are copied.")
+
+config_lib.DEFINE_integer("Dataserver.rebalance_check_frequency", 600,
+                          ("Time interval in seconds between checks of the "
+                           "data server statistics for automatic "
+                           "rebalancing."))
+
+config_lib.DEFINE_float("Dataserver.rebalance_load_threshold", 1.5,
+                        "A data server whose load is this many times the "
+                        "average load triggers an automatic rebalance. 0 "
+                        "disables the check.")
+
+config_lib.DEFINE_float("Dataserver.rebalance_size_threshold", 1.5,
+                        "A data server whose database is this many times the "
+                        "average size triggers an automatic rebalance. 0 "
+                        "disables the check.")
+
+config_lib.DEFINE_integer("Dataserver.rebalance_max_move_bytes", 1024**3,
+                          ("Planned rebalances move at most about this many "
+                           "bytes across each range boundary, larger moves "
+                           "are split over several rebalances. 0 means no "
+                           "limit."))
+
+config_lib.DEFINE_integer("Dataserver.rebalance_copy_bandwidth",
+                          10 * 1024 * 1024,
+                          ("Maximum number of bytes per second a data server "
+                           "sends to the others while rebalancing. 0 means "
+                           "no limit."))
+
 config_lib.DEFINE_integer("Dataserver.port", 7000,
                           "Port for a specific data server.")
 
@@ -35,6 +35,25 @@ config_lib.DEFINE_string(
     help=("Location of the data store (usually a "
           "filesystem directory)"))
 
+config_lib.DEFINE_list(
+    "Datastore.subject_cache_patterns", [],
+    "Regular expressions matching the full subjects whose rows are kept in a "
+    "process local read-through cache, e.g. aff4:/C\\.[0-9a-fA-F]{16} or "
+    "aff4:/foreman. A pattern followed by =<seconds>, e.g. aff4:/foreman=60, "
+    "uses this ttl instead of Datastore.subject_cache_ttl, =0 excludes the "
+    "matching subjects. The first matching pattern is used. The cache is "
+    "disabled when this list is empty.")
+
+config_lib.DEFINE_integer(
+    "Datastore.subject_cache_size", 64 * 1024 * 1024,
+    "Maximum number of bytes of subject rows held in the subject cache.")
+
+config_lib.DEFINE_integer(
+    "Datastore.subject_cache_ttl", 10,
+    "Seconds a cached subject row may be served before it is read again, "
+    "unless its pattern sets a ttl of its own. Writes from other processes "
+    "can be invisible for this long.")
+
 # SQLite data store.
 config_lib.DEFINE_integer(
     "SqliteDatastore.vacuum_check",
@@ -154,6 +173,19 @@ config_lib.DEFINE_integer(
     help=("Number of seconds to wait in-between attempts"
           "to reconnect to the database."))
 
+config_lib.DEFINE_integer(
+    "HTTPDataStore.protocol_version",
+    2,
+    help=("Highest data server protocol version to use. Version 2 multiplexes "
+          "many requests over a connection and streams large results, "
+          "data servers which don't support it are spoken to in version 1."))
+
+config_lib.DEFINE_integer(
+    "HTTPDataStore.compression_threshold",
+    64 * 1024,
+    help=("Protocol version 2 requests of at least this many bytes are "
+          "compressed. 0 disables compression."))
+
 config_lib.DEFINE_string(
     "CloudBigtable.project_id",
     default=None,
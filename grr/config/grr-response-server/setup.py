@@ -94,6 +94,10 @@ setup_args = dict(
         # store support:
         # pip install grr-response[mysqldatastore]
         "mysqldatastore": ["MySQL-python==1.2.5"],
+        # This is an optional component. Install to get the Parquet instant
+        # output plugin:
+        # pip install grr-response[parquet]
+        "parquet": ["pyarrow==0.8.0"],
     },
     data_files=["version.ini"])
 
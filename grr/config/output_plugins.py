@@ -33,3 +33,33 @@ config_lib.DEFINE_integer("BigQuery.retry_multiplier", 2,
 config_lib.DEFINE_integer_list("BigQuery.retry_status_codes",
                                [404, 500, 502, 503, 504],
                                "HTTP status codes on which we should retry.")
+
+config_lib.DEFINE_integer("InstantOutput.conversion_threads", 4,
+                          "Number of threads converting values exported by "
+                          "instant output plugins. If 0, values are read, "
+                          "converted and written in the calling thread.")
+
+config_lib.DEFINE_integer("InstantOutput.conversion_processes", 0,
+                          "Number of forked processes converting values "
+                          "exported by instant output plugins. Each process "
+                          "opens its own data store connections. If 0, "
+                          "values are converted by "
+                          "InstantOutput.conversion_threads threads.")
+
+config_lib.DEFINE_integer("InstantOutput.max_batches_in_flight", 8,
+                          "Maximum number of batches of values that are read "
+                          "but not yet written by an instant output plugin.")
+
+config_lib.DEFINE_integer("InstantOutput.max_bytes_in_flight",
+                          256 * 1024 * 1024,
+                          "Maximum size of the values that are read but not "
+                          "yet written by an instant output plugin. Reading "
+                          "stops until the writer catches up.")
+
+config_lib.DEFINE_integer("Export.metadata_cache_size", 10000,
+                          "Maximum number of clients whose metadata is cached "
+                          "while exporting values.")
+
+config_lib.DEFINE_semantic(rdfvalue.Duration, "Export.metadata_cache_max_age",
+                           "10m", "Time after which cached clients metadata "
+                           "is looked up again.")
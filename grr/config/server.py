@@ -37,6 +37,51 @@ config_lib.DEFINE_integer("Worker.queue_shards", 5,
                           "Queue notifications will be sharded across "
                           "this number of datastore subjects.")
 
+config_lib.DEFINE_integer(
+    "Worker.flow_batch_size", 100,
+    "Workers lock and load up to this many flows together and read their "
+    "completed requests and responses in one go before processing them. 1 "
+    "processes every flow on its own.")
+
+config_lib.DEFINE_choice(
+    name="Worker.notification_wakeup",
+    default="InProcessNotificationWakeup",
+    choices=[
+        "InProcessNotificationWakeup", "LocalSocketNotificationWakeup",
+        "DataStoreNotificationWakeup"
+    ],
+    help="How workers waiting for notifications are woken up when new "
+    "notifications are written. InProcessNotificationWakeup only wakes up "
+    "workers in the writing process, LocalSocketNotificationWakeup all "
+    "processes on the same host and DataStoreNotificationWakeup processes on "
+    "all hosts. Must be the same for frontends and workers.")
+
+config_lib.DEFINE_string(
+    "Worker.notification_wakeup_socket_dir", "/tmp/grr_notification_wakeup",
+    "Directory holding the sockets of the LocalSocketNotificationWakeup.")
+
+config_lib.DEFINE_float(
+    "Worker.notification_wakeup_poll_interval", 0.2,
+    "How often in seconds waiting workers check for wakeups with the "
+    "DataStoreNotificationWakeup.")
+
+config_lib.DEFINE_integer(
+    "Worker.processes", 1,
+    "Number of worker processes to run. If more than one, the worker forks "
+    "this many children, each owning a disjoint set of the "
+    "Worker.queue_shards notification shards, and restarts children that "
+    "die. There can be at most Worker.queue_shards processes.")
+
+config_lib.DEFINE_integer(
+    "Worker.throughput_report_interval", 60,
+    "How often in seconds a multi-process worker logs the number of flows "
+    "each child processed.")
+
+config_lib.DEFINE_integer(
+    "Worker.shutdown_timeout", 600,
+    "How long in seconds a multi-process worker waits for its children to "
+    "finish the flows they hold leases on before killing them.")
+
 config_lib.DEFINE_list("Frontend.well_known_flows", ["TransferStore", "Stats"],
                        "Allow these well known flows to run directly on the "
                        "frontend. Other flows are scheduled as normal.")
@@ -100,6 +145,40 @@ config_lib.DEFINE_integer("Frontend.port_max", None,
                           "use ports between Frontend.bind_port and "
                           "Frontend.port_max.")
 
+config_lib.DEFINE_choice(
+    name="Frontend.server_mode",
+    default="threaded",
+    choices=["threaded", "async"],
+    help="The HTTP server the frontend runs. 'threaded' serves every "
+    "connection in its own thread, 'async' serves all connections from an "
+    "event loop and only uses Frontend.async_worker_threads threads to handle "
+    "complete requests.")
+
+config_lib.DEFINE_integer(
+    "Frontend.async_worker_threads", 50,
+    "Number of threads handling requests in the async server mode.")
+
+config_lib.DEFINE_integer(
+    "Frontend.async_max_connections", 20000,
+    "Maximum number of concurrent client connections in the async server mode. "
+    "Make sure the open files limit of the process allows for this.")
+
+config_lib.DEFINE_integer(
+    "Frontend.async_keep_alive_timeout", 60,
+    "Idle keep-alive connections are closed after this many seconds in the "
+    "async server mode.")
+
+config_lib.DEFINE_integer(
+    "Frontend.async_max_request_size", 64 * 1024 * 1024,
+    "Requests other than file uploads with larger bodies are answered with "
+    "a 413 in the async server mode. Should be larger than "
+    "Client.max_post_size.")
+
+config_lib.DEFINE_integer(
+    "Frontend.async_request_spool_size", 1024 * 1024,
+    "Request bodies larger than this are written to a temporary file while "
+    "they are received in the async server mode.")
+
 config_lib.DEFINE_integer("Frontend.max_queue_size", 500,
                           "Maximum number of messages to queue for the client.")
 
@@ -111,6 +190,71 @@ config_lib.DEFINE_integer("Frontend.message_expiry_time", 600,
                           "Maximum time messages remain valid within the "
                           "system.")
 
+config_lib.DEFINE_integer("Frontend.session_cipher_cache_size", 50000,
+                          "Maximum number of outbound session ciphers the "
+                          "frontend keeps, one per client.")
+
+config_lib.DEFINE_semantic(
+    rdfvalue.Duration,
+    "Frontend.session_cipher_lifetime",
+    default="1d",
+    description="How long an outbound session cipher is reused for messages "
+    "to the same client before a new session key is generated.")
+
+config_lib.DEFINE_bool(
+    "Frontend.passthrough_messages", True,
+    "If enabled, messages received from clients are written to the data store "
+    "using their original wire bytes. Only the fields needed to route them are "
+    "decoded.")
+
+config_lib.DEFINE_float(
+    "Frontend.write_coalescing_window", 0,
+    "If set, the data store writes of client polls arriving within this many "
+    "seconds of each other are flushed together. Clients are only "
+    "acknowledged once the write succeeded. 0 disables coalescing.")
+
+config_lib.DEFINE_integer(
+    "Frontend.write_coalescing_max_mutations", 1000,
+    "A coalesced write is flushed early once it holds this many changes.")
+
+config_lib.DEFINE_float(
+    "Frontend.drain_coalescing_window", 0,
+    "If set, the task queues of clients polling within this many seconds of "
+    "each other are leased together with one bulk claim. 0 disables "
+    "coalescing.")
+
+config_lib.DEFINE_integer(
+    "Frontend.drain_coalescing_max_clients", 500,
+    "A coalesced queue claim is started early once this many clients are "
+    "waiting for it.")
+
+config_lib.DEFINE_float(
+    "Frontend.empty_queue_cache_ttl", 0,
+    "If set, a client queue found empty is not leased from again for this "
+    "many seconds unless tasks are scheduled on it, which only costs a read of "
+    "the queue's version marker. Tasks whose lease ran out can be delayed by "
+    "up to this long, so keep it short. 0 disables the cache.")
+
+config_lib.DEFINE_integer(
+    "Frontend.long_poll_max_timeout", 0,
+    "The longest time in seconds a client request asking for long polling is "
+    "held open while its queue is empty. Each held request occupies a request "
+    "handler thread, see Frontend.long_poll_max_concurrent. 0 disables long "
+    "polling.")
+
+config_lib.DEFINE_float(
+    "Frontend.long_poll_check_interval", 10,
+    "How often in seconds a held long poll request checks the client queue. "
+    "Tasks scheduled by this process wake up the request right away, tasks "
+    "scheduled by other processes are found by these checks.")
+
+config_lib.DEFINE_integer(
+    "Frontend.long_poll_max_concurrent", 10,
+    "The maximum number of long poll requests held open at the same time. "
+    "Polls past this limit drain the client queue and return right away. Keep "
+    "this well below Frontend.async_worker_threads so held polls can not "
+    "starve other requests of handler threads. 0 means no limit.")
+
 config_lib.DEFINE_string("Frontend.upload_store", "FileUploadFileStore",
                          "The implementation of the upload file store.")
 
@@ -204,6 +348,32 @@ config_lib.DEFINE_integer(
     help="The number of bytes allowed for unbounded "
     "reads from a file object")
 
+config_lib.DEFINE_integer(
+    "AFF4.chunk_cache_max_bytes",
+    16 * 1024 * 1024,
+    help="The maximum number of bytes each open AFF4 image keeps in its "
+    "chunk cache.")
+
+config_lib.DEFINE_integer(
+    "AFF4.readahead_max_bytes",
+    8 * 1024 * 1024,
+    help="AFF4 images read ahead when read sequentially. The read ahead "
+    "window grows with every data store round trip up to this many bytes.")
+
+config_lib.DEFINE_integer(
+    "AFF4.multi_stream_prefetch_threads",
+    4,
+    help="Number of threads fetching chunks ahead of the consumer when "
+    "streaming many AFF4 files at once, e.g. for archive generation. If 0, "
+    "chunks are only fetched when needed.")
+
+config_lib.DEFINE_integer(
+    "AFF4.multi_stream_prefetch_max_bytes",
+    128 * 1024 * 1024,
+    help="Chunks prefetched for a multi-stream are held in memory until "
+    "consumed. No further chunks are fetched while more than this many "
+    "bytes are waiting.")
+
 # Data retention policies.
 config_lib.DEFINE_semantic(
     rdfvalue.Duration,
@@ -730,12 +730,10 @@ class ApiGetHuntClientCompletionStatsHandler(
         mode="r",
         token=token)
 
-    clients_by_status = hunt.GetClientsByStatus()
-    started_clients = clients_by_status["STARTED"]
-    completed_clients = clients_by_status["COMPLETED"]
+    times_by_status = hunt.GetClientTimesByStatus()
 
-    (start_stats, complete_stats) = self._SampleClients(started_clients,
-                                                        completed_clients)
+    (start_stats, complete_stats) = self._SampleClients(
+        times_by_status["STARTED"], times_by_status["COMPLETED"])
 
     if len(start_stats) > target_size:
       # start_stats and complete_stats are equally big, so resample both
@@ -745,21 +743,13 @@ class ApiGetHuntClientCompletionStatsHandler(
     return ApiGetHuntClientCompletionStatsResult().InitFromDataPoints(
         start_stats, complete_stats)
 
-  def _SampleClients(self, started_clients, completed_clients):
+  def _SampleClients(self, start_times, completion_times):
     # immediately return on empty client data
-    if not started_clients and not completed_clients:
+    if not start_times and not completion_times:
       return ([], [])
 
-    cdict = {}
-    for client in started_clients:
-      cdict.setdefault(client, []).append(client.age)
-
-    fdict = {}
-    for client in completed_clients:
-      fdict.setdefault(client, []).append(client.age)
-
-    cl_age = [int(min(x) / 1e6) for x in cdict.values()]
-    fi_age = [int(min(x) / 1e6) for x in fdict.values()]
+    cl_age = [int(x / 1e6) for x in start_times.values()]
+    fi_age = [int(x / 1e6) for x in completion_times.values()]
 
     cl_hist = {}
     fi_hist = {}
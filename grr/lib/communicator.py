@@ -261,6 +261,11 @@ class Communicator(object):
   """A class responsible for encoding and decoding comms."""
   server_name = None
 
+  # If set, decoded messages keep their original wire bytes so they can be
+  # written out again without being re-serialized. See
+  # GrrMessage.FromPassThroughString().
+  passthrough_messages = False
+
   def __init__(self, certificate=None, private_key=None):
     """Creates a communicator.
 
@@ -305,6 +310,11 @@ class Communicator(object):
     self.server_cipher_age = rdfvalue.RDFDatetime.Now()
     return self.server_cipher
 
+  def _GetDestinationCipher(self, destination):
+    """Returns a cipher for messages sent to the given destination CN."""
+    remote_public_key = self._GetRemotePublicKey(destination)
+    return Cipher(self.common_name, self.private_key, remote_public_key)
+
   def EncodeMessages(self,
                      message_list,
                      result,
@@ -349,8 +359,7 @@ class Communicator(object):
       # it's the only cipher it ever uses.
       cipher = self._GetServerCipher()
     else:
-      remote_public_key = self._GetRemotePublicKey(destination)
-      cipher = Cipher(self.common_name, self.private_key, remote_public_key)
+      cipher = self._GetDestinationCipher(destination)
 
     # Make a nonce for this transaction
     if timestamp is None:
@@ -506,12 +515,17 @@ class Communicator(object):
         remote_public_key)
     # pyformat: enable
 
+    if self.passthrough_messages:
+      messages = message_list.GetPassThroughJobs()
+    else:
+      messages = message_list.job
+
     # Mark messages as authenticated and where they came from.
-    for msg in message_list.job:
+    for msg in messages:
       msg.auth_state = auth_state
       msg.source = cipher.cipher_metadata.source
 
-    return (message_list.job, cipher.cipher_metadata.source,
+    return (messages, cipher.cipher_metadata.source,
             packed_message_list.timestamp)
 
   def VerifyMessageSignature(self, unused_response_comms, packed_message_list,
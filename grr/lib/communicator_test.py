@@ -135,6 +135,56 @@ class ClientCommsTest(test_lib.GRRBaseTest):
       self.assertEqual(decoded_messages[i].auth_state,
                        rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED)
 
+  def testServerReusesSessionCipher(self):
+    """Test that the server does not create a new cipher for every message."""
+    self.MakeClientAFF4Record()
+    client_cn = self.client_communicator.common_name
+
+    def EncodeForClient():
+      result = rdf_flows.ClientCommunication()
+      self.server_communicator.EncodeMessages(
+          rdf_flows.MessageList(), result, destination=client_cn)
+      return result
+
+    rsa_operations = stats.STATS.GetMetricValue("grr_rsa_operations")
+    first = EncodeForClient()
+    second = EncodeForClient()
+
+    # Only the first message required an RSA encryption of the session key.
+    self.assertEqual(
+        stats.STATS.GetMetricValue("grr_rsa_operations"), rsa_operations + 1)
+    self.assertEqual(first.encrypted_cipher, second.encrypted_cipher)
+    self.assertNotEqual(first.packet_iv, second.packet_iv)
+
+    # The client can decode both messages.
+    for comms_message in [first, second]:
+      self.client_communicator.timestamp = None
+      _, source, _ = self.client_communicator.DecodeMessages(comms_message)
+      self.assertEqual(source, self.server_communicator.common_name)
+
+    # Invalidating the client forces a new session key.
+    self.server_communicator.InvalidateClient(client_cn)
+    third = EncodeForClient()
+    self.assertNotEqual(first.encrypted_cipher, third.encrypted_cipher)
+
+  def testServerSessionCipherExpires(self):
+    """Test that cached session ciphers are only used for a limited time."""
+    self.MakeClientAFF4Record()
+    client_cn = self.client_communicator.common_name
+
+    with test_lib.FakeTime(1000):
+      first = rdf_flows.ClientCommunication()
+      self.server_communicator.EncodeMessages(
+          rdf_flows.MessageList(), first, destination=client_cn)
+
+    lifetime = config.CONFIG["Frontend.session_cipher_lifetime"].seconds
+    with test_lib.FakeTime(1000 + lifetime + 1):
+      second = rdf_flows.ClientCommunication()
+      self.server_communicator.EncodeMessages(
+          rdf_flows.MessageList(), second, destination=client_cn)
+
+    self.assertNotEqual(first.encrypted_cipher, second.encrypted_cipher)
+
   def testClientPingAndClockIsUpdated(self):
     """Check PING and CLOCK are updated, simulate bad client clock."""
     new_client = self.MakeClientAFF4Record()
@@ -591,6 +641,44 @@ class HTTPClientTests(test_lib.GRRBaseTest):
     """
     self._CheckFastPoll(True, config.CONFIG["Client.poll_min"])
 
+  def testLongPoll(self):
+    """Test that only idle clients ask the server to hold their poll open."""
+    request_timeouts = []
+
+    def LongPollServer(url=None, data=None, timeout=None, **kwargs):
+      request_timeouts.append(timeout)
+      response = self.UrlMock(num_messages=0, url=url, data=data, **kwargs)
+      if "server.pem" in url:
+        return response
+
+      # Grant the client the timeout it asked for.
+      response_comms = rdf_flows.ClientCommunication.FromSerializedString(
+          response.content)
+      response_comms.long_poll_timeout = (
+          self.client_communication.long_poll_timeout)
+      return MakeResponse(200, response_comms.SerializeToString())
+
+    with utils.Stubber(requests, "request", LongPollServer):
+      # Long polling is disabled by default.
+      self.client_communicator.RunOnce()
+      self.assertEqual(self.client_communication.long_poll_timeout, 0)
+      self.assertEqual(self.client_communicator.long_poll_granted, 0)
+
+      with test_lib.ConfigOverrider({"Client.long_poll_timeout": 300}):
+        # Pending messages are sent right away.
+        self.SendToServer()
+        self.client_communicator.RunOnce()
+        self.assertEqual(self.client_communication.long_poll_timeout, 0)
+        self.assertEqual(self.client_communicator.long_poll_granted, 0)
+
+        del request_timeouts[:]
+        self.client_communicator.RunOnce()
+        self.assertEqual(self.client_communication.long_poll_timeout, 300)
+        self.assertEqual(self.client_communicator.long_poll_granted, 300)
+        # The HTTP timeout has to cover the time the server holds the request.
+        self.assertEqual(request_timeouts,
+                         [config.CONFIG["Client.http_timeout"] + 300])
+
   def testCorruption(self):
     """Simulate corruption of the http payload."""
 
@@ -5,7 +5,10 @@
 
 from grr.lib import flags
 from grr.lib import type_info
+from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import flows as rdf_flows
+from grr.lib.rdfvalues import paths as rdf_paths
 from grr.lib.rdfvalues import structs as rdf_structs
 from grr.proto import jobs_pb2
 from grr.proto import knowledge_base_pb2
@@ -340,6 +343,70 @@ class RDFValueBenchmark(benchmark_test_lib.AverageMicroBenchmarks):
     self.TimeIt(RDFStructDecodeEncode)
     self.TimeIt(ProtoDecodeEncode)
 
+  def _TimeParseSerialize(self, name, callback):
+    """Times callback with the accelerated and pure python codecs."""
+    self.TimeIt(callback, name="%s (accelerated)" % name)
+
+    # pylint: disable=protected-access
+    with utils.MultiStubber(
+        (rdf_structs, "DecodeFields", rdf_structs._PythonDecodeFields),
+        (rdf_structs, "JoinWireFormats", rdf_structs._PythonJoinWireFormats)):
+      self.TimeIt(callback, name="%s (python)" % name)
+    # pylint: enable=protected-access
+
+  def _MakeStatEntry(self):
+    return rdf_client.StatEntry(
+        pathspec=rdf_paths.PathSpec(
+            path="/usr/lib/some/long/path/to/a/file.so",
+            pathtype=rdf_paths.PathSpec.PathType.OS),
+        st_mode=33188,
+        st_ino=1063090,
+        st_dev=64512,
+        st_nlink=1,
+        st_uid=139592,
+        st_gid=5000,
+        st_size=123456789,
+        st_atime=1336469177,
+        st_mtime=1336129892,
+        st_ctime=1336129892)
+
+  def testStatEntryParseSerialize(self):
+    """Parse and serialize throughput of a typical StatEntry."""
+    data = self._MakeStatEntry().SerializeToString()
+
+    def StatEntryParseSerialize():
+      new_s = rdf_client.StatEntry.FromSerializedString(data)
+      self.assertEqual(new_s.st_size, 123456789)
+      return len(new_s.SerializeToString())
+
+    self._TimeParseSerialize("StatEntry", StatEntryParseSerialize)
+
+  def testGrrMessageParseSerialize(self):
+    """Parse and serialize throughput of a GrrMessage carrying a StatEntry.
+
+    This is what the frontend and the workers spend most of their time on.
+    """
+    data = rdf_flows.GrrMessage(
+        session_id="aff4:/C.0000000000000001/flows/W:ABCDEF",
+        name="ListDirectory",
+        request_id=1,
+        response_id=2,
+        task_id=12345,
+        payload=self._MakeStatEntry()).SerializeToString()
+
+    def GrrMessageParseSerialize():
+      new_s = rdf_flows.GrrMessage.FromSerializedString(data)
+      self.assertEqual(new_s.payload.st_size, 123456789)
+      return len(new_s.SerializeToString())
+
+    def GrrMessagePassThrough():
+      new_s = rdf_flows.GrrMessage.FromSerializedString(data)
+      self.assertEqual(new_s.request_id, 1)
+      return len(new_s.SerializeToString())
+
+    self._TimeParseSerialize("GrrMessage", GrrMessageParseSerialize)
+    self._TimeParseSerialize("GrrMessage pass through", GrrMessagePassThrough)
+
 
 def main(argv):
   # Run the full test suite
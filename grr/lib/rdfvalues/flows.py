@@ -34,6 +34,10 @@ class GrrMessage(rdf_structs.RDFProtoStruct):
   # for this so there can't be more than 8 different levels of priority.
   max_priority = 7
 
+  # For messages created by FromPassThroughString(), a tuple of the original
+  # wire bytes and the raw data entries they decoded into.
+  _passthrough = None
+
   def __init__(self,
                initializer=None,
                age=None,
@@ -94,6 +98,68 @@ class GrrMessage(rdf_structs.RDFProtoStruct):
   def HasTaskID(self):
     return bool(self.Get("task_id"))
 
+  @classmethod
+  def FromPassThroughString(cls, value, age=None):
+    """Parses a message which keeps its original wire bytes.
+
+    Fields are decoded lazily as usual so only the fields which are read (e.g.
+    the headers needed for routing) are ever converted. When the message is
+    serialized again, the original bytes are reused and only fields which were
+    changed since parsing are encoded and appended. Later occurrences of a
+    field replace earlier ones when parsing, so the result decodes to the same
+    message.
+
+    Args:
+      value: The serialized GrrMessage.
+      age: The age of the message.
+
+    Returns:
+      A GrrMessage.
+    """
+    result = cls.FromSerializedString(value, age=age)
+    result._passthrough = (value, dict(result.GetRawData()))  # pylint: disable=protected-access
+    return result
+
+  def _SerializePassThrough(self):
+    """Returns the original bytes plus any changed fields, or None."""
+    value, original_data = self._passthrough
+    changed = []
+    for name, entry in self._data.iteritems():
+      original_entry = original_data.get(name)
+      python_format, wire_format, type_descriptor = entry
+
+      if (original_entry is None or wire_format is None or
+          wire_format is not original_entry[1] or
+          (python_format and type_descriptor.IsDirty(python_format))):
+        changed.append(entry)
+
+    # A field which was cleared can not be removed by appending.
+    if len(self._data) - len(changed) != len(original_data):
+      for name in original_data:
+        if name not in self._data:
+          return None
+
+    if not changed:
+      return value
+
+    return value + rdf_structs.SerializeEntries(changed)
+
+  def SerializeToString(self):
+    if self._passthrough is not None:
+      result = self._SerializePassThrough()
+      if result is not None:
+        return result
+
+    return super(GrrMessage, self).SerializeToString()
+
+  def Clear(self):
+    self._passthrough = None
+    super(GrrMessage, self).Clear()
+
+  def SetRawData(self, data):
+    self._passthrough = None
+    super(GrrMessage, self).SetRawData(data)
+
   @property
   def args(self):
     raise RuntimeError("Direct access to serialized args is not permitted! "
@@ -235,6 +301,22 @@ class MessageList(rdf_structs.RDFProtoStruct):
   def __len__(self):
     return len(self.job)
 
+  def GetPassThroughJobs(self):
+    """Returns the jobs as GrrMessages which keep their original wire bytes.
+
+    See GrrMessage.FromPassThroughString().
+
+    Returns:
+      A list of GrrMessages.
+    """
+    wrapped_list = self.job.wrapped_list
+    for i, (python_format, wire_format) in enumerate(wrapped_list):
+      if python_format is None:
+        python_format = GrrMessage.FromPassThroughString(wire_format[2])
+        wrapped_list[i] = (python_format, wire_format)
+
+    return [python_format for python_format, _ in wrapped_list]
+
 
 class CipherProperties(rdf_structs.RDFProtoStruct):
   """Contains information about a cipher and keys."""
@@ -5,6 +5,8 @@
 
 from grr.lib import flags
 from grr.lib import rdfvalue
+from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import test_base
 from grr.test_lib import test_lib
 
@@ -59,6 +61,75 @@ class SessionIDTest(test_base.RDFValueTestCase):
                       rdfvalue.RDFURN("aff4:/flows/A:1234567G%sdf"))
 
 
+class GrrMessagePassThroughTest(test_lib.GRRBaseTest):
+  """Test GrrMessages which keep their original wire bytes."""
+
+  def _MakeMessage(self):
+    return rdf_flows.GrrMessage(
+        session_id="aff4:/W:1234",
+        request_id=1,
+        response_id=2,
+        task_id=1234,
+        payload=rdf_client.StatEntry(st_size=1024))
+
+  def testUnmodifiedMessageIsPassedThrough(self):
+    data = self._MakeMessage().SerializeToString()
+
+    msg = rdf_flows.GrrMessage.FromPassThroughString(data)
+    self.assertEqual(msg.session_id, "aff4:/W:1234")
+    self.assertEqual(msg.request_id, 1)
+    self.assertEqual(msg.type, rdf_flows.GrrMessage.Type.MESSAGE)
+
+    self.assertIs(msg.SerializeToString(), data)
+
+  def testChangedHeadersAreAppended(self):
+    data = self._MakeMessage().SerializeToString()
+
+    msg = rdf_flows.GrrMessage.FromPassThroughString(data)
+    msg.source = "C.0000000000000001"
+    msg.request_id = 5
+
+    serialized = msg.SerializeToString()
+    self.assertTrue(serialized.startswith(data))
+
+    new_msg = rdf_flows.GrrMessage.FromSerializedString(serialized)
+    self.assertEqual(new_msg.source, "C.0000000000000001")
+    self.assertEqual(new_msg.request_id, 5)
+    self.assertEqual(new_msg.response_id, 2)
+    self.assertEqual(new_msg.payload.st_size, 1024)
+
+  def testClearedFieldsAreNotPassedThrough(self):
+    data = self._MakeMessage().SerializeToString()
+
+    msg = rdf_flows.GrrMessage.FromPassThroughString(data)
+    msg.response_id = None
+
+    new_msg = rdf_flows.GrrMessage.FromSerializedString(msg.SerializeToString())
+    self.assertFalse(new_msg.HasField("response_id"))
+    self.assertEqual(new_msg.request_id, 1)
+
+  def testMessageList(self):
+    message_list = rdf_flows.MessageList(
+        job=[self._MakeMessage() for _ in range(3)])
+    message_list = rdf_flows.MessageList.FromSerializedString(
+        message_list.SerializeToString())
+
+    messages = message_list.GetPassThroughJobs()
+    self.assertEqual(len(messages), 3)
+    for msg in messages:
+      msg.auth_state = rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED
+
+    # The message list holds the same message objects.
+    self.assertIs(message_list.job[0], messages[0])
+
+    for msg in messages:
+      new_msg = rdf_flows.GrrMessage.FromSerializedString(
+          msg.SerializeToString())
+      self.assertEqual(new_msg.auth_state,
+                       rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED)
+      self.assertEqual(new_msg.payload.st_size, 1024)
+
+
 def main(argv):
   # Run the full test suite
   test_lib.main(argv)
@@ -482,6 +482,96 @@ class ForemanIntegerClientRuleTest(test_base.RDFValueTestCase):
             client_id))
 
 
+class ForemanRuleIndexTest(test_lib.GRRBaseTest):
+  """Tests the compiled foreman rules."""
+
+  def _MakeRule(self, match_mode, *client_rules):
+    return rdf_foreman.ForemanRule(
+        client_rule_set=rdf_foreman.ForemanClientRuleSet(
+            match_mode=match_mode, rules=client_rules))
+
+  def _MakeRules(self):
+    match_mode = rdf_foreman.ForemanClientRuleSet.MatchMode
+    label_mode = rdf_foreman.ForemanLabelClientRule.MatchMode
+    operator = rdf_foreman.ForemanIntegerClientRule.Operator
+    rule_type = rdf_foreman.ForemanClientRule.Type
+
+    def Os(**kw):
+      return rdf_foreman.ForemanClientRule(
+          rule_type=rule_type.OS, os=rdf_foreman.ForemanOsClientRule(**kw))
+
+    def Label(names, mode):
+      return rdf_foreman.ForemanClientRule(
+          rule_type=rule_type.LABEL,
+          label=rdf_foreman.ForemanLabelClientRule(
+              label_names=names, match_mode=mode))
+
+    def Integer(name, op, value):
+      return rdf_foreman.ForemanClientRule(
+          rule_type=rule_type.INTEGER,
+          integer=rdf_foreman.ForemanIntegerClientRule(
+              attribute_name=name, operator=op, value=value))
+
+    def Regex(name, regex):
+      return rdf_foreman.ForemanClientRule(
+          rule_type=rule_type.REGEX,
+          regex=rdf_foreman.ForemanRegexClientRule(
+              attribute_name=name, attribute_regex=regex))
+
+    rules = rdf_foreman.ForemanRules()
+    for mode in [match_mode.MATCH_ALL, match_mode.MATCH_ANY]:
+      rules.Append(self._MakeRule(mode))
+      rules.Append(self._MakeRule(mode, Os(os_windows=True)))
+      rules.Append(self._MakeRule(mode, Os(os_linux=True, os_darwin=True)))
+      for label_match_mode in label_mode.enum_dict.values():
+        rules.Append(
+            self._MakeRule(mode,
+                           Label(["hello", "world"], label_match_mode),
+                           Os(os_linux=True)))
+        rules.Append(self._MakeRule(mode, Label(["hello"], label_match_mode)))
+      for op in [operator.LESS_THAN, operator.GREATER_THAN, operator.EQUAL]:
+        for value in [-1, 0, 1, 100]:
+          rules.Append(self._MakeRule(mode, Integer("size", op, value)))
+      rules.Append(self._MakeRule(mode, Integer("Host", operator.EQUAL, 1)))
+      rules.Append(
+          self._MakeRule(mode, Regex("type", "GRR"), Os(os_windows=True)))
+
+    return rules
+
+  def testMatchesTheSameRulesAsEvaluate(self):
+    rules = self._MakeRules()
+    index = rdf_foreman.ForemanRuleIndex(rules)
+
+    # Many rules share the same client rules, these are evaluated only once.
+    self.assertLess(len(index.conditions), len(rules))
+
+    systems = ["Windows", "Linux", "Darwin", "Linux"]
+    for i, client_id in enumerate(self.SetupClients(len(systems))):
+      objects = CollectAff4Objects(
+          index.GetPathsToCheck(index.rules), client_id, self.token)
+      client = objects[client_id]
+      client.Set(client.Schema.SYSTEM(systems[i]))
+      client.SetLabels(["hello", "world"][:i % 3], owner="GRR")
+
+      expected = [
+          rule for rule in rules
+          if rule.client_rule_set.Evaluate(objects, client_id)
+      ]
+      self.assertEqual(index.Match(index.rules, objects, client_id), expected)
+
+  def testRuleIndexIsCachedUntilRulesChange(self):
+    rules = self._MakeRules()
+    index = rdf_foreman.GetRuleIndex(rules)
+    self.assertIs(rdf_foreman.GetRuleIndex(rules), index)
+
+    rules.Append(
+        self._MakeRule(rdf_foreman.ForemanClientRuleSet.MatchMode.MATCH_ANY))
+    new_index = rdf_foreman.GetRuleIndex(rules)
+    self.assertIsNot(new_index, index)
+    self.assertEqual(len(new_index.rules), len(index.rules) + 1)
+
+
+
 def main(argv):
   # Run the full test suite
   test_lib.main(argv)
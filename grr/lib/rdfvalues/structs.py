@@ -72,7 +72,7 @@ def ReadTag(buf, pos):
     pos += 1
     return (buf[start:pos], pos)
   except IndexError:
-    raise ValueError("Invalid tag")
+    raise rdfvalue.DecodeError("Invalid tag")
 
 
 # This function is HOT.
@@ -159,68 +159,114 @@ def SplitBuffer(buff, index=0, length=None):
   Yields:
     Splits the buffer into tuples of strings:
         (encoded_tag, encoded_length, wire_format).
+
+  Raises:
+    rdfvalue.DecodeError: The buffer is truncated or malformed.
   """
-  buffer_len = length or len(buff)
+  buffer_len = min(length or len(buff), len(buff))
   while index < buffer_len:
-    # data_index is the index where the data begins (i.e. after the tag).
-    encoded_tag, data_index = ReadTag(buff, index)
-
-    tag_type = ORD_MAP[encoded_tag[0]] & TAG_TYPE_MASK
-    if tag_type == WIRETYPE_VARINT:
-      # new_index is the index of the next tag.
-      _, new_index = VarintReader(buff, data_index)
-      yield (encoded_tag, "", buff[data_index:new_index])
-      index = new_index
-
-    elif tag_type == WIRETYPE_FIXED64:
-      yield (encoded_tag, "", buff[data_index:data_index + 8])
-      index = 8 + data_index
-
-    elif tag_type == WIRETYPE_FIXED32:
-      yield (encoded_tag, "", buff[data_index:data_index + 4])
-      index = 4 + data_index
-
-    elif tag_type == WIRETYPE_LENGTH_DELIMITED:
-      # Start index of the string.
-      length, start = VarintReader(buff, data_index)
-      yield (
-          encoded_tag,
-          buff[data_index:start],  # Encoded length.
-          buff[start:start + length])  # Raw data of element.
-      index = start + length
+    try:
+      # data_index is the index where the data begins (i.e. after the tag).
+      encoded_tag, data_index = ReadTag(buff, index)
+
+      tag_type = ORD_MAP[encoded_tag[0]] & TAG_TYPE_MASK
+      if tag_type == WIRETYPE_VARINT:
+        # new_index is the index of the next tag.
+        _, new_index = VarintReader(buff, data_index)
+        entry = (encoded_tag, "", buff[data_index:new_index])
+
+      elif tag_type == WIRETYPE_FIXED64:
+        new_index = 8 + data_index
+        entry = (encoded_tag, "", buff[data_index:new_index])
+
+      elif tag_type == WIRETYPE_FIXED32:
+        new_index = 4 + data_index
+        entry = (encoded_tag, "", buff[data_index:new_index])
+
+      elif tag_type == WIRETYPE_LENGTH_DELIMITED:
+        # Start index of the string.
+        length, start = VarintReader(buff, data_index)
+        new_index = start + length
+        entry = (
+            encoded_tag,
+            buff[data_index:start],  # Encoded length.
+            buff[start:new_index])  # Raw data of element.
 
-    else:
-      raise rdfvalue.DecodeError("Unexpected Tag.")
+      else:
+        raise rdfvalue.DecodeError("Unexpected Tag.")
+
+    except IndexError:
+      raise rdfvalue.DecodeError("Buffer ends in the middle of a field.")
+
+    if new_index > buffer_len:
+      raise rdfvalue.DecodeError("Field exceeds available buffer.")
+
+    yield entry
+    index = new_index
+
+
+def JoinWireFormats(wire_formats):
+  """Joins a sequence of wire format tuples into a single string."""
+  output = []
+  for wire_format in wire_formats:
+    output.extend(wire_format)
+
+  return "".join(output)
 
 
 def SerializeEntries(entries):
   """Serializes given triplets of python and wire values and a descriptor."""
-  output = []
+  wire_formats = []
   for python_format, wire_format, type_descriptor in entries:
 
     if wire_format is None or (python_format and
                                type_descriptor.IsDirty(python_format)):
       wire_format = type_descriptor.ConvertToWireFormat(python_format)
 
-    output.extend(wire_format)
+    wire_formats.append(wire_format)
 
-  return "".join(output)
+  return JoinWireFormats(wire_formats)
 
 
-def ReadIntoObject(buff, index, value_obj, length=0):
-  """Reads all tags until the next end group and store in the value_obj."""
-  raw_data = value_obj.GetRawData()
+def CompileTagTable(type_infos_by_encoded_tag):
+  """Compiles a struct's field descriptors into a table for DecodeFields.
+
+  Args:
+    type_infos_by_encoded_tag: A dict of encoded tags to type descriptors.
+
+  Returns:
+    A dict mapping encoded tags to (name, type_descriptor, repeated) tuples.
+  """
+  return dict((encoded_tag, (type_info_obj.name, type_info_obj,
+                             type_info_obj.__class__ is ProtoList))
+              for encoded_tag, type_info_obj in
+              type_infos_by_encoded_tag.iteritems())
+
+
+def DecodeFields(buff, index, length, tag_table, raw_data):
+  """Decodes all tags in the buffer directly into the raw_data dict.
+
+  Args:
+    buff: The buffer to parse.
+    index: The position to start parsing.
+    length: The length to parse, 0 means until the end of the buffer.
+    tag_table: A table produced by CompileTagTable().
+    raw_data: The raw data dict of the struct to populate.
+
+  Returns:
+    A list of (name, wire_format) tuples for the repeated fields, in the order
+    they were read.
+  """
+  repeated = []
   count = 0
 
+  if length:
+    length += index
+
   # Split the buffer into tags and wire_format representations, then collect
   # these into the raw data cache.
-  for (encoded_tag, encoded_length, encoded_field) in SplitBuffer(
-      buff, index=index, length=length):
-
-    type_info_obj = value_obj.type_infos_by_encoded_tag.get(encoded_tag)
-
-    # Internal format to store parsed fields.
-    wire_format = (encoded_tag, encoded_length, encoded_field)
+  for wire_format in SplitBuffer(buff, index=index, length=length):
+    field = tag_table.get(wire_format[0])
 
     # If the tag is not found we need to skip it. Skipped fields are
     # inaccessible to this actual object, because they have no type info
@@ -231,7 +277,7 @@ def ReadIntoObject(buff, index, value_obj, length=0):
     # the application. In order to avoid having to worry about repeated fields
     # here, we just insert them into the raw data dict with a key which should
     # be unique.
-    if type_info_obj is None:
+    if field is None:
       # Record an unknown field. The key is unique and ensures we do not collide
       # the dict on repeated fields of the encoded tag. Note that this field is
       # not really accessible using Get() and does not have a python format
@@ -242,21 +288,48 @@ def ReadIntoObject(buff, index, value_obj, length=0):
       count += 1
 
     # Repeated fields are handled especially.
-    elif type_info_obj.__class__ is ProtoList:
-      value_obj.Get(type_info_obj.name).wrapped_list.append((None, wire_format))
+    elif field[2]:
+      repeated.append((field[0], wire_format))
 
     else:
       # Set the python_format as None so it gets converted lazily on access.
-      raw_data[type_info_obj.name] = (None, wire_format, type_info_obj)
+      raw_data[field[0]] = (None, wire_format, field[1])
+
+  return repeated
+
+
+def ReadIntoObject(buff, index, value_obj, length=0):
+  """Reads all tags until the next end group and store in the value_obj."""
+  raw_data = value_obj.GetRawData()
+
+  # The tag table is compiled once per class and dropped by AddDescriptor().
+  tag_table = value_obj.compiled_tag_table
+  if tag_table is None:
+    tag_table = CompileTagTable(value_obj.type_infos_by_encoded_tag)
+    value_obj.__class__.compiled_tag_table = tag_table
+
+  for name, wire_format in DecodeFields(buff, index, length, tag_table,
+                                        raw_data):
+    value_obj.Get(name).wrapped_list.append((None, wire_format))
 
   value_obj.SetRawData(raw_data)
 
 
+# The pure python implementations are kept around so the accelerated versions
+# can be benchmarked against them.
+_PythonDecodeFields = DecodeFields
+_PythonJoinWireFormats = JoinWireFormats
+
 # pylint: disable=invalid-name
 if _semantic:
   VarintEncode = _semantic.varint_encode
   VarintReader = _semantic.varint_decode
   SplitBuffer = _semantic.split_buffer
+
+  # Older builds of the accelerator do not have the one shot decoder/encoder.
+  if hasattr(_semantic, "decode_fields"):
+    DecodeFields = _semantic.decode_fields
+    JoinWireFormats = _semantic.join_wire_formats
 # pylint: enable=invalid-name
 
 
@@ -1479,6 +1552,9 @@ class RDFStructMetaclass(rdfvalue.RDFValueMetaclass):
     cls.type_infos_by_field_number = {}
     cls.type_infos_by_encoded_tag = {}
 
+    # Built lazily from type_infos_by_encoded_tag by ReadIntoObject().
+    cls.compiled_tag_table = None
+
     # Build the class by parsing an existing protobuf class.
     if cls.protobuf is not None:
       proto2.DefineFromProtobuf(cls, cls.protobuf)
@@ -2187,6 +2263,7 @@ class RDFProtoStruct(RDFStruct):
     # We store an index of the type info by tag values to speed up parsing.
     cls.type_infos_by_field_number[field_desc.field_number] = field_desc
     cls.type_infos_by_encoded_tag[field_desc.encoded_tag] = field_desc
+    cls.compiled_tag_table = None
 
     cls.type_infos.Append(field_desc)
     cls.late_bound_type_infos.pop(field_desc.name, None)
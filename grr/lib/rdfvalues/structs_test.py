@@ -363,6 +363,61 @@ class RDFStructsTest(test_base.RDFValueTestCase):
     # Check that nested fields are also preserved.
     self.assertEqual(decoded_tested.nested.foobar, "goodbye")
 
+  def testRepeatedAndUnknownFieldsKeepOrder(self):
+    tested = TestStruct(foobar="hello", repeated=["a", "b", "c"])
+    for i in range(3):
+      tested.repeat_nested.Append(foobar="Nest%s" % i)
+
+    data = tested.SerializeToString()
+
+    # Everything but "int" is unknown to PartialTest1 and must be written back
+    # without reordering the repeated elements.
+    data = PartialTest1.FromSerializedString(data).SerializeToString()
+
+    decoded_tested = TestStruct.FromSerializedString(data)
+    self.assertEqual(decoded_tested.foobar, "hello")
+    self.assertEqual(list(decoded_tested.repeated), ["a", "b", "c"])
+    self.assertEqual([x.foobar for x in decoded_tested.repeat_nested],
+                     ["Nest0", "Nest1", "Nest2"])
+
+  def testMalformedBuffersRaiseDecodeError(self):
+    data = TestStruct(foobar="hello", int=5).SerializeToString()
+    tag_table = structs.CompileTagTable(TestStruct.type_infos_by_encoded_tag)
+
+    malformed = [
+        data[:3],  # Truncated string.
+        data[:-1],  # Truncated varint.
+        "\x08",  # Varint tag without a value.
+        "\x09abc",  # Truncated fixed64.
+        "\x08" + "\xff" * 11,  # Varint that is too long.
+        "\x0b\x00",  # Unsupported group tag.
+        "\xff",  # Truncated tag.
+    ]
+
+    # The accelerated codec must raise the same errors as the python one.
+    codecs = set([structs._PythonDecodeFields, structs.DecodeFields])
+    for decode_fields in codecs:
+      for buff in malformed:
+        with self.assertRaises(rdfvalue.DecodeError):
+          decode_fields(buff, 0, 0, tag_table, {})
+
+  def testCompiledTagTableIsRebuiltWhenFieldsAreAdded(self):
+
+    class GrowingStruct(structs.RDFProtoStruct):
+      type_description = type_info.TypeDescriptorSet(
+          structs.ProtoString(name="first", field_number=1),)
+
+    data = TestStruct(foobar="hello", int=5).SerializeToString()
+
+    self.assertEqual(GrowingStruct.FromSerializedString(data).first, "hello")
+    self.assertIsNotNone(GrowingStruct.compiled_tag_table)
+
+    GrowingStruct.AddDescriptor(
+        structs.ProtoUnsignedInteger(name="second", field_number=2))
+    self.assertIsNone(GrowingStruct.compiled_tag_table)
+
+    self.assertEqual(GrowingStruct.FromSerializedString(data).second, 5)
+
   def testRDFStruct(self):
     tested = TestStruct()
 
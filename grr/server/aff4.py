@@ -27,6 +27,7 @@ from grr.lib.rdfvalues import paths as rdf_paths
 from grr.lib.rdfvalues import protodict as rdf_protodict
 from grr.server import access_control
 from grr.server import data_store
+from grr.server import threadpool
 
 # Factor to convert from seconds to microseconds
 MICROSECONDS = 1000000
@@ -566,6 +567,61 @@ class Factory(object):
         follow_symlinks=False,
         transaction=transaction)
 
+  def MultiOpenWithLock(self,
+                        urns,
+                        aff4_type=None,
+                        token=None,
+                        age=NEWEST_TIME,
+                        lease_time=100):
+    """Locks and opens many urns at once without blocking.
+
+    This is the batch version of OpenWithLock(blocking=False): all locks are
+    taken with one data store call and all objects are read with another.
+    Urns which are locked already are skipped. Each returned object releases
+    its lock when used in a 'with ...' statement or closed.
+
+    Args:
+      urns: The urns to open.
+      aff4_type: If set, we raise an InstantiationError if an object exists and
+          is not an instance of this type.
+      token: The Security Token to use for opening these items.
+      age: The age policy used to build these objects.
+      lease_time: Maximum time the objects stay locked.
+
+    Returns:
+      A list of AFF4 objects opened in "rw" mode, one per locked urn.
+    """
+    if token is None:
+      token = data_store.default_token
+
+    urns = [rdfvalue.RDFURN(urn) for urn in urns]
+    locks = data_store.DB.MultiDBSubjectLock(
+        urns, lease_time=lease_time, token=token)
+    locked_urns = [urn for urn in urns if urn in locks]
+    if not locked_urns:
+      return []
+
+    try:
+      local_cache = dict(self.GetAttributes(locked_urns, age=age, token=token))
+      result = []
+      for urn in locked_urns:
+        local_cache.setdefault(utils.SmartUnicode(urn), [])
+        result.append(
+            self.Open(
+                urn,
+                aff4_type=aff4_type,
+                mode="rw",
+                token=token,
+                local_cache=local_cache,
+                age=age,
+                follow_symlinks=False,
+                transaction=locks[urn]))
+      return result
+    except Exception:
+      for lock in locks.itervalues():
+        lock.Release()
+      raise
+
   def _AcquireLock(self,
                    urn,
                    token=None,
@@ -2728,17 +2784,156 @@ class AFF4UnversionedMemoryStream(AFF4MemoryStreamBase):
         versioned=False)
 
 
+def NewMultiStreamPrefetcher(fetch_fn):
+  """Returns a prefetcher used by MultiStream implementations.
+
+  MultiStream implementations read chunks in large batches. The prefetcher
+  fetches the following batches in the background while the caller processes
+  the current one (e.g. compresses it into an archive).
+
+  Args:
+    fetch_fn: A callable taking a batch and returning a tuple (result, size).
+
+  Returns:
+    A threadpool.BatchPrefetcher instance.
+  """
+  return threadpool.BatchPrefetcher(
+      fetch_fn,
+      threadpool_prefix="aff4_multi_stream",
+      threadpool_size=config.CONFIG["AFF4.multi_stream_prefetch_threads"],
+      max_pending_bytes=config.CONFIG["AFF4.multi_stream_prefetch_max_bytes"])
+
+
+class ImmutableChunk(object):
+  """A chunk of an AFF4 image as read from the data store.
+
+  Chunks which are only read are never modified, so we keep their content as
+  an immutable string instead of copying it into a StringIO. This class
+  provides the subset of the file interface that AFF4ImageBase uses on cached
+  chunks.
+  """
+
+  dirty = False
+
+  def __init__(self, chunk, data):
+    self.chunk = chunk
+    self.data = data
+    self.offset = 0
+
+  def seek(self, offset):  # pylint: disable=invalid-name
+    self.offset = offset
+
+  def read(self, length=None):  # pylint: disable=invalid-name
+    if length is None:
+      length = len(self.data) - self.offset
+
+    # Slicing the full string does not copy it, so reading whole chunks is
+    # free.
+    result = self.data[self.offset:self.offset + length]
+    self.offset += len(result)
+    return result
+
+  def getvalue(self):  # pylint: disable=invalid-name
+    return self.data
+
+
+class ReadAheadPolicy(object):
+  """Decides how many chunks an AFF4 image reads on a cache miss.
+
+  The window starts at a fixed number of chunks. Every cache miss during
+  sequential reading doubles the window, up to max_bytes worth of chunks.
+  Every cache miss after a seek halves it, down to a single chunk, so random
+  access (e.g. through FUSE) does not fetch data that is never read.
+  """
+
+  def __init__(self, initial_chunks, max_bytes):
+    self.window = max(1, initial_chunks)
+    self.max_bytes = max_bytes
+    self._last_chunk = None
+    self._sequential = False
+    self._seeked = False
+
+  def RecordAccess(self, chunk):
+    """Records that a chunk is about to be read."""
+    self._sequential = (self._last_chunk is not None and
+                        self._last_chunk <= chunk <= self._last_chunk + 1)
+    self._seeked = self._last_chunk is not None and not self._sequential
+    self._last_chunk = chunk
+
+  def GetWindow(self, chunksize):
+    """Returns the number of chunks to read for a cache miss."""
+    max_chunks = max(1, self.max_bytes // chunksize)
+    if self._sequential:
+      self.window *= 2
+    elif self._seeked:
+      self.window //= 2
+
+    self.window = min(max(1, self.window), max_chunks)
+    return self.window
+
+
 class ChunkCache(utils.FastStore):
-  """A cache which closes its objects when they expire."""
+  """A cache which closes its objects when they expire.
 
-  def __init__(self, kill_cb=None, *args, **kw):
+  The cache is bounded by the number of bytes it holds rather than by the
+  number of chunks. Chunks read from the data store count with their actual
+  size, writable chunks count as a full chunk since they may grow up to that.
+  """
+
+  def __init__(self, kill_cb=None, max_bytes=10 * 1024 * 1024,
+               chunksize=64 * 1024):
     self.kill_cb = kill_cb
-    super(ChunkCache, self).__init__(*args, **kw)
+    self.max_bytes = max_bytes
+    self.chunksize = chunksize
+    self.total_bytes = 0
+    self._sizes = {}
+    super(ChunkCache, self).__init__()
+
+  def _EntrySize(self, obj):
+    if isinstance(obj, ImmutableChunk):
+      return len(obj.data)
+    return self.chunksize
 
   def KillObject(self, obj):
     if self.kill_cb:
       self.kill_cb(obj)
 
+  @utils.Synchronized
+  def Put(self, key, obj):
+    """Adds the chunk to the cache, expiring old chunks if over budget."""
+    self.Pop(key)
+    size = self._EntrySize(obj)
+    self._sizes[key] = size
+    self.total_bytes += size
+    return super(ChunkCache, self).Put(key, obj)
+
+  @utils.Synchronized
+  def Expire(self):
+    """Expires the least recently used chunks while over the byte budget."""
+    # The most recently added chunk is always kept, even if it is larger than
+    # the whole budget, since the caller is about to use it.
+    while len(self._age) > 1 and self.total_bytes > self.max_bytes:
+      node = self._age.PopLeft()
+      self._hash.pop(node.key, None)
+      self.total_bytes -= self._sizes.pop(node.key, 0)
+      self.KillObject(node.data)
+
+  @utils.Synchronized
+  def ExpireObject(self, key):
+    self.total_bytes -= self._sizes.pop(key, 0)
+    return super(ChunkCache, self).ExpireObject(key)
+
+  @utils.Synchronized
+  def Pop(self, key):
+    self.total_bytes -= self._sizes.pop(key, 0)
+    return super(ChunkCache, self).Pop(key)
+
+  @utils.Synchronized
+  def Flush(self):
+    super(ChunkCache, self).Flush()
+    self._sizes = {}
+    self.total_bytes = 0
+
   def __getstate__(self):
     if self.kill_cb:
       raise NotImplementedError("Can't pickle callback.")
@@ -2762,7 +2957,8 @@ class AFF4ImageBase(AFF4Stream):
   # Subclasses should set the name of the type of stream to use for chunks.
   STREAM_TYPE = None
 
-  # How many chunks should be cached.
+  # How many chunks to read ahead initially. The read ahead window adapts to
+  # the access pattern, see ReadAheadPolicy.
   LOOK_AHEAD = 10
 
   class SchemaCls(AFF4Stream.SchemaCls):
@@ -2809,18 +3005,25 @@ class AFF4ImageBase(AFF4Stream):
       it's still possible to yield a truncated file.
     """
 
-    missing_chunks_by_fd = {}
-    for chunk_fd_pairs in utils.Grouper(
-        cls._GenerateChunkPaths(fds), cls.MULTI_STREAM_CHUNKS_READ_AHEAD):
+    token = fds[0].token
 
-      chunks_map = dict(chunk_fd_pairs)
+    def FetchChunks(chunk_fd_pairs):
       contents_map = {}
       for chunk_fd in FACTORY.MultiOpen(
-          chunks_map, mode="r", token=fds[0].token):
+          [chunk_urn for chunk_urn, _ in chunk_fd_pairs], mode="r",
+          token=token):
         if isinstance(chunk_fd, AFF4Stream):
-          fd = chunks_map[chunk_fd.urn]
           contents_map[chunk_fd.urn] = chunk_fd.read()
 
+      return contents_map, sum(len(data) for data in contents_map.values())
+
+    missing_chunks_by_fd = {}
+    for chunk_fd_pairs, contents_map in NewMultiStreamPrefetcher(
+        FetchChunks).Fetch(
+            utils.Grouper(
+                cls._GenerateChunkPaths(fds),
+                cls.MULTI_STREAM_CHUNKS_READ_AHEAD)):
+
       for chunk_urn, fd in chunk_fd_pairs:
         if chunk_urn not in contents_map or not contents_map[chunk_urn]:
           missing_chunks_by_fd.setdefault(fd, []).append(chunk_urn)
@@ -2841,8 +3044,6 @@ class AFF4ImageBase(AFF4Stream):
     """Build a cache for our chunks."""
     super(AFF4ImageBase, self).Initialize()
     self.offset = 0
-    # A cache for segments.
-    self.chunk_cache = ChunkCache(self._WriteChunk, 100)
 
     if "r" in self.mode:
       self.size = int(self.Get(self.Schema.SIZE))
@@ -2854,11 +3055,23 @@ class AFF4ImageBase(AFF4Stream):
       self.size = 0
       self.content_last = None
 
+    # A cache for segments.
+    self.chunk_cache = self._NewChunkCache()
+    self.readahead = ReadAheadPolicy(self.LOOK_AHEAD,
+                                     config.CONFIG["AFF4.readahead_max_bytes"])
+
+  def _NewChunkCache(self):
+    return ChunkCache(
+        self._WriteChunk,
+        max_bytes=config.CONFIG["AFF4.chunk_cache_max_bytes"],
+        chunksize=self.chunksize)
+
   def SetChunksize(self, chunksize):
     # pylint: disable=protected-access
     self.Set(self.Schema._CHUNKSIZE(chunksize))
     # pylint: enable=protected-access
     self.chunksize = int(chunksize)
+    self.chunk_cache.chunksize = self.chunksize
     self.Truncate(0)
 
   def Seek(self, offset, whence=0):
@@ -2899,10 +3112,8 @@ class AFF4ImageBase(AFF4Stream):
     for child in FACTORY.MultiOpen(
         chunk_names, mode="rw", token=self.token, age=self.age_policy):
       if isinstance(child, AFF4Stream):
-        fd = StringIO.StringIO(child.read())
-        fd.dirty = False
-        fd.chunk = chunk_names[child.urn]
-        self.chunk_cache.Put(fd.chunk, fd)
+        chunk = chunk_names[child.urn]
+        self.chunk_cache.Put(chunk, ImmutableChunk(chunk, child.read()))
 
   def _WriteChunk(self, chunk):
     if chunk.dirty:
@@ -2911,44 +3122,62 @@ class AFF4ImageBase(AFF4Stream):
           chunk_name, self.STREAM_TYPE, mode="rw", token=self.token) as fd:
         fd.write(chunk.getvalue())
 
+  def _NewWritableChunk(self, chunk, data=""):
+    """Caches a writable chunk holding data and returns it."""
+    fd = StringIO.StringIO(data)
+    fd.chunk = chunk
+    fd.dirty = True
+    self.chunk_cache.Put(chunk, fd)
+    return fd
+
   def _GetChunkForWriting(self, chunk):
     """Opens a chunk for writing, creating a new one if it doesn't exist yet."""
     try:
-      chunk = self.chunk_cache.Get(chunk)
-      chunk.dirty = True
-      return chunk
+      fd = self.chunk_cache.Get(chunk)
     except KeyError:
-      pass
+      try:
+        fd = self._ReadChunk(chunk)
+      except KeyError:
+        return self._NewWritableChunk(chunk)
 
-    try:
-      chunk = self._ReadChunk(chunk)
-      chunk.dirty = True
-      return chunk
-    except KeyError:
-      pass
+    if isinstance(fd, ImmutableChunk):
+      return self._NewWritableChunk(chunk, fd.getvalue())
 
-    fd = StringIO.StringIO()
-    fd.chunk = chunk
     fd.dirty = True
-    self.chunk_cache.Put(chunk, fd)
     return fd
 
+  def _GetCachedChunkForReading(self, chunk_id):
+    """Returns a chunk from the cache, keeping track of the hit ratio."""
+    try:
+      result = self.chunk_cache.Get(chunk_id)
+      stats.STATS.IncrementCounter("aff4_image_chunk_cache", fields=["hits"])
+      return result
+    except KeyError:
+      stats.STATS.IncrementCounter(
+          "aff4_image_chunk_cache", fields=["misses"])
+      raise
+
   def _GetChunkForReading(self, chunk):
     """Returns the relevant chunk from the datastore and reads ahead."""
+    self.readahead.RecordAccess(chunk)
     try:
-      return self.chunk_cache.Get(chunk)
+      return self._GetCachedChunkForReading(chunk)
     except KeyError:
       pass
 
     # We don't have this chunk already cached. The most common read
     # access pattern is contiguous reading so since we have to go to
     # the data store already, we read ahead to reduce round trips.
+    window = self.readahead.GetWindow(self.chunksize)
+    last_chunk = max(chunk + 1, self.size / self.chunksize + 1)
 
     missing_chunks = []
-    for chunk_number in range(chunk, chunk + self.LOOK_AHEAD):
+    for chunk_number in xrange(chunk, min(chunk + window, last_chunk)):
       if chunk_number not in self.chunk_cache:
         missing_chunks.append(chunk_number)
 
+    stats.STATS.IncrementCounter(
+        "aff4_image_chunks_fetched", delta=len(missing_chunks))
     self._ReadChunks(missing_chunks)
     # This should work now - otherwise we just give up.
     try:
@@ -2987,7 +3216,7 @@ class AFF4ImageBase(AFF4Stream):
 
   def Read(self, length):
     """Read a block of data from the file."""
-    result = ""
+    result = []
 
     # The total available size in the file
     length = int(length)
@@ -2999,8 +3228,10 @@ class AFF4ImageBase(AFF4Stream):
         break
 
       length -= len(data)
-      result += data
-    return result
+      result.append(data)
+
+    # Joining once keeps large reads linear in the amount of data read.
+    return "".join(result)
 
   def _WritePartial(self, data):
     """Writes at most one chunk of data."""
@@ -3061,7 +3292,7 @@ class AFF4ImageBase(AFF4Stream):
 
   def __setstate__(self, state):
     self.__dict__ = state
-    self.chunk_cache = ChunkCache(self._WriteChunk, 100)
+    self.chunk_cache = self._NewChunkCache()
 
 
 class AFF4Image(AFF4ImageBase):
@@ -3090,6 +3321,9 @@ class AFF4InitHook(registry.InitHook):
     # pylint: enable=unused-variable,global-statement,g-import-not-at-top
     stats.STATS.RegisterCounterMetric("aff4_cache_hits")
     stats.STATS.RegisterCounterMetric("aff4_cache_misses")
+    stats.STATS.RegisterCounterMetric(
+        "aff4_image_chunk_cache", fields=[("type", str)])
+    stats.STATS.RegisterCounterMetric("aff4_image_chunks_fetched")
 
 
 class AFF4Filter(object):
@@ -493,25 +493,37 @@ class GRRForeman(aff4.AFF4Object):
       self.Set(self.Schema.RULES, new_rules)
       self.Flush()
 
-  def _CheckIfHuntTaskWasAssigned(self, client_id, hunt_id):
-    """Will return True if hunt's task was assigned to this client before."""
-    for _ in aff4.FACTORY.Stat(
-        [client_id.Add("flows/%s:hunt" % rdfvalue.RDFURN(hunt_id).Basename())],
-        token=self.token):
-      return True
+  def _GetAssignedHunts(self, client_id, hunt_ids):
+    """Returns the subset of hunt_ids which were assigned to this client before.
 
-    return False
+    Args:
+      client_id: The ClientURN of the client.
+      hunt_ids: An iterable of hunt ids.
+
+    Returns:
+      A set of hunt ids.
+    """
+    urns = {}
+    for hunt_id in hunt_ids:
+      basename = rdfvalue.RDFURN(hunt_id).Basename()
+      urns[str(client_id.Add("flows/%s:hunt" % basename))] = hunt_id
+
+    if not urns:
+      return set()
 
-  def _EvaluateRules(self, objects, rule, client_id):
-    """Evaluates the rules."""
-    return rule.client_rule_set.Evaluate(objects, client_id)
+    # All the checks are done in a single data store round trip.
+    return set(
+        urns[str(stat["urn"])]
+        for stat in aff4.FACTORY.Stat(list(urns), token=self.token))
 
-  def _RunActions(self, rule, client_id):
+  def _RunActions(self, rule, client_id, assigned_hunts):
     """Run all the actions specified in the rule.
 
     Args:
       rule: Rule which actions are to be executed.
       client_id: Id of a client where rule's actions are to be executed.
+      assigned_hunts: The set of hunt ids which were assigned to this client
+          before. Hunts started here are added to it.
 
     Returns:
       Number of actions started.
@@ -525,7 +537,7 @@ class GRRForeman(aff4.AFF4Object):
         token.username = "Foreman"
 
         if action.HasField("hunt_id"):
-          if self._CheckIfHuntTaskWasAssigned(client_id, action.hunt_id):
+          if action.hunt_id in assigned_hunts:
             logging.info("Foreman: ignoring hunt %s on client %s: was started "
                          "here before", client_id, action.hunt_id)
           else:
@@ -534,6 +546,7 @@ class GRRForeman(aff4.AFF4Object):
 
             flow_cls = flow.GRRFlow.classes[action.hunt_name]
             flow_cls.StartClients(action.hunt_id, [client_id])
+            assigned_hunts.add(action.hunt_id)
             actions_count += 1
         else:
           flow.GRRFlow.StartFlow(
@@ -565,51 +578,64 @@ class GRRForeman(aff4.AFF4Object):
     if not rules:
       return 0
 
+    # The compiled rules are cached in-process until the rules change.
+    rule_index = rdf_foreman.GetRuleIndex(rules)
+
     client = aff4.FACTORY.Open(client_id, mode="rw", token=self.token)
     try:
-      last_foreman_run = client.Get(client.Schema.LAST_FOREMAN_TIME) or 0
+      last_foreman_run = int(client.Get(client.Schema.LAST_FOREMAN_TIME) or 0)
     except AttributeError:
       last_foreman_run = 0
 
-    latest_rule = max(rule.created for rule in rules)
+    latest_rule = max(compiled_rule.created
+                      for compiled_rule in rule_index.rules)
 
-    if latest_rule <= int(last_foreman_run):
+    if latest_rule <= last_foreman_run:
       return 0
 
-    # Update the latest checked rule on the client.
-    client.Set(client.Schema.LAST_FOREMAN_TIME(latest_rule))
-    client.Close()
-
-    # For efficiency we collect all the objects we want to open first and then
-    # open them all in one round trip.
-    object_urns = {}
     relevant_rules = []
     expired_rules = False
 
     now = time.time() * 1e6
 
-    for rule in rules:
-      if rule.expires < now:
+    for compiled_rule in rule_index.rules:
+      if compiled_rule.expires < now:
         expired_rules = True
         continue
-      if rule.created <= int(last_foreman_run):
+      if compiled_rule.created <= last_foreman_run:
         continue
 
-      relevant_rules.append(rule)
+      relevant_rules.append(compiled_rule)
 
-      for path in rule.client_rule_set.GetPathsToCheck():
-        aff4_object = client_id.Add(path)
+    # Most rules only need the client object we already have. Other objects
+    # are opened in one round trip.
+    objects = {client_id: client}
+    object_urns = {}
+    for path in rule_index.GetPathsToCheck(relevant_rules):
+      aff4_object = client_id.Add(path)
+      if aff4_object != client_id:
         object_urns[str(aff4_object)] = aff4_object
 
-    # Retrieve all aff4 objects we need.
-    objects = {}
-    for fd in aff4.FACTORY.MultiOpen(object_urns, token=self.token):
-      objects[fd.urn] = fd
+    if object_urns:
+      for fd in aff4.FACTORY.MultiOpen(object_urns, token=self.token):
+        objects[fd.urn] = fd
+
+    # Update the latest checked rule on the client.
+    client.Set(client.Schema.LAST_FOREMAN_TIME(latest_rule))
+    try:
+      matching_rules = rule_index.Match(relevant_rules, objects, client_id)
+    finally:
+      client.Close()
+
+    assigned_hunts = self._GetAssignedHunts(client_id, [
+        action.hunt_id
+        for rule in matching_rules for action in rule.actions
+        if action.HasField("hunt_id")
+    ])
 
     actions_count = 0
-    for rule in relevant_rules:
-      if self._EvaluateRules(objects, rule, client_id):
-        actions_count += self._RunActions(rule, client_id)
+    for rule in matching_rules:
+      actions_count += self._RunActions(rule, client_id, assigned_hunts)
 
     if expired_rules:
       self.ExpireRules()
@@ -100,6 +100,45 @@ class AFF4Benchmark(benchmark_test_lib.AverageMicroBenchmarks):
     self.TimeIt(
         ReadAVersionedAFF4Attribute, name="Read one versioned Attributes")
 
+  def testAFF4ImageRead(self):
+    """How fast can we read a large image in chunk sized pieces."""
+    chunksize = 64 * 1024
+    # 1 GB of data.
+    num_chunks = 16 * 1024
+    urn = rdf_client.ClientURN("C.1234567812345678").Add("fs/os/large_file")
+
+    # All chunks point to the same blob so the data store stays small while
+    # we still go through the full read path for every chunk.
+    blob_hash = data_store.DB.StoreBlob("A" * chunksize, token=self.token)
+    with aff4.FACTORY.Create(
+        urn, aff4_grr.VFSBlobImage, token=self.token) as fd:
+      fd.SetChunksize(chunksize)
+      for _ in xrange(num_chunks):
+        fd.AddBlob(blob_hash.decode("hex"), chunksize)
+
+    def ReadImage(read_size):
+      fd = aff4.FACTORY.Open(urn, token=self.token)
+      total = 0
+      while True:
+        data = fd.Read(read_size)
+        if not data:
+          break
+        total += len(data)
+
+      self.assertEqual(total, chunksize * num_chunks)
+
+    self.TimeIt(
+        ReadImage,
+        name="Read 1GB VFSBlobImage in 64KB reads",
+        repetitions=1,
+        read_size=chunksize)
+
+    self.TimeIt(
+        ReadImage,
+        name="Read 1GB VFSBlobImage in 16MB reads",
+        repetitions=1,
+        read_size=16 * 1024 * 1024)
+
 
 def main(argv):
   # Run the full test suite
@@ -5,6 +5,7 @@
 import StringIO
 
 from grr.lib import rdfvalue
+from grr.lib import stats
 from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import paths as rdf_paths
@@ -104,8 +105,8 @@ class BlobImage(aff4.AFF4ImageBase):
   # Size of a sha256 hash
   _HASH_SIZE = 32
 
-  # How many chunks we read ahead
-  _READAHEAD = 5
+  # How many chunks we read ahead initially.
+  LOOK_AHEAD = 5
 
   @classmethod
   def _GenerateChunkIds(cls, fds):
@@ -136,12 +137,20 @@ class BlobImage(aff4.AFF4ImageBase):
       possible to yield a truncated file.
     """
 
+    token = fds[0].token
+
+    def FetchBlobs(chunk_fd_pairs):
+      results_map = data_store.DB.ReadBlobs(
+          dict(chunk_fd_pairs).keys(), token=token)
+      return results_map, sum(len(blob or "") for blob in results_map.values())
+
     broken_fds = set()
     missing_blobs_fd_pairs = []
-    for chunk_fd_pairs in utils.Grouper(
-        cls._GenerateChunkIds(fds), cls.MULTI_STREAM_CHUNKS_READ_AHEAD):
-      results_map = data_store.DB.ReadBlobs(
-          dict(chunk_fd_pairs).keys(), token=fds[0].token)
+    for chunk_fd_pairs, results_map in aff4.NewMultiStreamPrefetcher(
+        FetchBlobs).Fetch(
+            utils.Grouper(
+                cls._GenerateChunkIds(fds),
+                cls.MULTI_STREAM_CHUNKS_READ_AHEAD)):
 
       for chunk_id, fd in chunk_fd_pairs:
         if chunk_id not in results_map or results_map[chunk_id] is None:
@@ -193,8 +202,9 @@ class BlobImage(aff4.AFF4ImageBase):
 
     chunk_name = self.index.read(self._HASH_SIZE).encode("hex")
 
+    self.readahead.RecordAccess(chunk)
     try:
-      return self.chunk_cache.Get(chunk_name)
+      return self._GetCachedChunkForReading(chunk_name)
     except KeyError:
       pass
 
@@ -204,11 +214,15 @@ class BlobImage(aff4.AFF4ImageBase):
     self.index.seek(offset)
     readahead = []
 
-    for _ in range(self._READAHEAD):
+    for _ in xrange(self.readahead.GetWindow(self.chunksize)):
       name = self.index.read(self._HASH_SIZE).encode("hex")
-      if name and name not in self.chunk_cache:
+      if not name:
+        break
+      if name not in self.chunk_cache and name not in readahead:
         readahead.append(name)
 
+    stats.STATS.IncrementCounter(
+        "aff4_image_chunks_fetched", delta=len(readahead))
     self._ReadChunks(readahead)
     try:
       return self.chunk_cache.Get(chunk_name)
@@ -218,10 +232,7 @@ class BlobImage(aff4.AFF4ImageBase):
   def _ReadChunks(self, chunks):
     res = data_store.DB.ReadBlobs(chunks, token=self.token)
     for blob_hash, content in res.iteritems():
-      fd = StringIO.StringIO(content)
-      fd.dirty = False
-      fd.chunk = blob_hash
-      self.chunk_cache.Put(blob_hash, fd)
+      self.chunk_cache.Put(blob_hash, aff4.ImmutableChunk(blob_hash, content))
 
   def _WriteChunk(self, chunk):
     if chunk.dirty:
@@ -313,8 +324,6 @@ class AFF4SparseImage(aff4.AFF4ImageBase):
 
   _HASH_SIZE = 32
 
-  _READAHEAD = 10
-
   chunksize = 512 * 1024
 
   class SchemaCls(aff4.AFF4ImageBase.SchemaCls):
@@ -344,10 +353,7 @@ class AFF4SparseImage(aff4.AFF4ImageBase):
     res = data_store.DB.ReadBlobs(chunk_hashes.values(), token=self.token)
     for blob_hash, content in res.iteritems():
       for chunk_nr in chunk_nrs[blob_hash]:
-        fd = StringIO.StringIO(content)
-        fd.dirty = False
-        fd.chunk = chunk_nr
-        self.chunk_cache.Put(chunk_nr, fd)
+        self.chunk_cache.Put(chunk_nr, aff4.ImmutableChunk(chunk_nr, content))
 
   def _WriteChunk(self, chunk):
     if chunk.dirty:
@@ -371,20 +377,25 @@ class AFF4SparseImage(aff4.AFF4ImageBase):
 
   def _GetChunkForReading(self, chunk):
     """Returns the relevant chunk from the datastore and reads ahead."""
+    self.readahead.RecordAccess(chunk)
     try:
-      return self.chunk_cache.Get(chunk)
+      return self._GetCachedChunkForReading(chunk)
     except KeyError:
       pass
 
     # We don't have this chunk already cached. The most common read
     # access pattern is contiguous reading so since we have to go to
     # the data store already, we read ahead to reduce round trips.
+    window = self.readahead.GetWindow(self.chunksize)
+    last_chunk = max(chunk, int(self.last_chunk)) + 1
 
     missing_chunks = []
-    for chunk_number in range(chunk, chunk + 10):
+    for chunk_number in xrange(chunk, min(chunk + window, last_chunk)):
       if chunk_number not in self.chunk_cache:
         missing_chunks.append(chunk_number)
 
+    stats.STATS.IncrementCounter(
+        "aff4_image_chunks_fetched", delta=len(missing_chunks))
     self._ReadChunks(missing_chunks)
     # This should work now - otherwise we just give up.
     try:
@@ -395,23 +406,20 @@ class AFF4SparseImage(aff4.AFF4ImageBase):
   def _GetChunkForWriting(self, chunk):
     """Returns the relevant chunk from the datastore."""
     try:
-      chunk = self.chunk_cache.Get(chunk)
-      chunk.dirty = True
-      return chunk
+      fd = self.chunk_cache.Get(chunk)
     except KeyError:
-      pass
-
-    try:
-      chunk = self._ReadChunk(chunk)
-      chunk.dirty = True
-      return chunk
-    except KeyError:
-      pass
-
-    fd = StringIO.StringIO()
-    fd.chunk = chunk
-    fd.dirty = True
-    self.chunk_cache.Put(chunk, fd)
+      try:
+        fd = self._ReadChunk(chunk)
+      except KeyError:
+        fd = None
+
+    if isinstance(fd, aff4.ImmutableChunk):
+      return self._NewWritableChunk(chunk, fd.getvalue())
+    elif fd is not None:
+      fd.dirty = True
+      return fd
+
+    fd = self._NewWritableChunk(chunk)
 
     # Keep track of the biggest chunk_number we've seen so far.
     if chunk > self.last_chunk:
@@ -4,6 +4,7 @@
 
 import itertools
 import os
+import StringIO
 import threading
 import time
 
@@ -1088,11 +1089,13 @@ class AFF4Test(aff4_test_lib.AFF4ObjectTest):
       for i in range(10):
         self.assertEqual(fd.Read(13), "Test%08X\n" % i)
 
-    with aff4.FACTORY.Create(
-        path, classname, mode="rw", token=self.token) as fd:
+    with test_lib.ConfigOverrider({"AFF4.chunk_cache_max_bytes": 1000}):
+      fd = aff4.FACTORY.Create(path, classname, mode="rw", token=self.token)
+
+    with fd:
       fd.Set(fd.Schema._CHUNKSIZE(10))
 
-      # Overflow the cache (Cache is 100 chunks, can hold 10*100 bytes).
+      # Overflow the cache (Cache can hold 1000 bytes).
       fd.Write("X" * 1100)
       self.assertEqual(fd.size, 1100)
       # Now rewind a bit and write something.
@@ -1183,6 +1186,67 @@ class AFF4Test(aff4_test_lib.AFF4ObjectTest):
     self.assertTrue("Hello World" in data)
     fd.Close()
 
+  def testAFF4ImageWriteAfterRead(self):
+    """Chunks cached by reads must become writable when written to."""
+    path = "/C.12345/aff4imagewriteafterread"
+
+    with aff4.FACTORY.Create(path, aff4.AFF4Image, token=self.token) as fd:
+      fd.SetChunksize(10)
+      fd.Write("X" * 100)
+
+    with aff4.FACTORY.Open(path, mode="rw", token=self.token) as fd:
+      self.assertEqual(fd.Read(100), "X" * 100)
+      fd.Seek(15)
+      fd.Write("Hello")
+      fd.Seek(10)
+      self.assertEqual(fd.Read(15), "XXXXXHelloXXXXX")
+
+    fd = aff4.FACTORY.Open(path, token=self.token)
+    self.assertEqual(fd.Read(100), "X" * 15 + "Hello" + "X" * 80)
+
+  def testAFF4ImageReadAheadAdaptsToAccessPattern(self):
+    policy = aff4.ReadAheadPolicy(10, 100)
+
+    # Sequential reads double the window up to the byte budget.
+    windows = []
+    next_miss = 0
+    for chunk in range(250):
+      policy.RecordAccess(chunk)
+      if chunk == next_miss:
+        windows.append(policy.GetWindow(1))
+        next_miss += windows[-1]
+    self.assertEqual(windows, [10, 20, 40, 80, 100])
+
+    # Seeking around halves it down to a single chunk.
+    windows = []
+    for chunk in [5000, 3, 900, 20000, 7, 7000, 10]:
+      policy.RecordAccess(chunk)
+      windows.append(policy.GetWindow(1))
+    self.assertEqual(windows, [50, 25, 12, 6, 3, 1, 1])
+
+  def testAFF4ImageChunkCacheIsBoundedByBytes(self):
+    written = []
+    cache = aff4.ChunkCache(written.append, max_bytes=100, chunksize=50)
+
+    for i in range(10):
+      cache.Put(i, aff4.ImmutableChunk(i, "X" * 20))
+    self.assertEqual(len(cache), 5)
+    self.assertEqual(cache.total_bytes, 100)
+
+    # Writable chunks count as a full chunk.
+    writable = StringIO.StringIO()
+    writable.dirty = True
+    cache.Put(10, writable)
+    self.assertEqual(len(cache), 3)
+    self.assertEqual(cache.total_bytes, 90)
+
+    # Expired chunks are passed to the callback.
+    self.assertEqual([c.chunk for c in written], range(8))
+
+    cache.Flush()
+    self.assertEqual(len(cache), 0)
+    self.assertEqual(cache.total_bytes, 0)
+
   def testAFF4ImageWithFlush(self):
     """Make sure the AFF4Image can survive with partial flushes."""
     path = "/C.12345/foo"
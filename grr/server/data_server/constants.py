@@ -10,6 +10,15 @@ REBALANCE_DIRECTORY = ".GRR_REBALANCE"
 TRANSACTION_FILENAME = ".TRANSACTION"
 REMOVE_FILENAME = ".TRANSACTION_REMOVE"
 
+# Data store protocol versions. Clients ask for version 2 with a header on
+# /client/start, servers which don't know the header answer with the version 1
+# acknowledgement.
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+PROTOCOL_HEADER = "X-GRR-Datastore-Protocol"
+PROTOCOL_V1_ACK = "OK\n"
+PROTOCOL_V2_ACK = "V2\n"
+
 # HTTP status codes.
 RESPONSE_OK = 200
 
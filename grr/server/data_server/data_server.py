@@ -10,6 +10,7 @@ import SocketServer
 import time
 import urlparse
 import uuid
+import zlib
 
 # pylint: disable=unused-import,g-bad-import-order,g-import-not-at-top
 from grr.lib import server_plugins
@@ -59,6 +60,12 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
   # Mapping information sent/created by the master.
   MAPPING = None
   CMDTABLE = None
+  # Commands whose results are streamed to protocol version 2 clients.
+  STREAMING_CMDTABLE = None
+  # Size of the chunks results are streamed in.
+  STREAM_CHUNK_BYTES = 1024 * 1024
+  # Protocol version 2 responses at least this large are compressed.
+  COMPRESSION_THRESHOLD = 64 * 1024
   # Nonce store used for authentication.
   NONCE_STORE = None
 
@@ -95,6 +102,7 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
         "/client/start": cls.HandleDataStoreService,
         "/client/handshake": cls.HandleClientHandshake,
         "/client/mapping": cls.HandleMapping,
+        "/rebalance/plan": cls.HandleRebalancePlan,
         "/rebalance/phase1": cls.HandleRebalancePhase1,
         "/rebalance/phase2": cls.HandleRebalancePhase2,
         "/rebalance/statistics": cls.HandleRebalanceStatistics,
@@ -121,7 +129,7 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
     num_components, avg_component = cls.SERVICE.GetComponentInformation()
     stat = rdf_data_server.DataServerState(
         size=cls.SERVICE.Size(),
-        load=0,
+        load=cls.SERVICE.GetLoad(),
         status=ok,
         num_components=num_components,
         avg_component=avg_component)
@@ -204,15 +212,97 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
     if perm in permissions:
       response = method(request)
     else:
-      status_desc = ("Operation not allowed: required %s but only have "
-                     "%s permissions" % (perm, permissions))
+      response = self._DeniedResponse(cmd, perm, permissions)
+
+    return sutils.SIZE_PACKER.pack(len(response)) + response
+
+  def _DeniedResponse(self, cmd, perm, permissions):
+    status_desc = ("Operation not allowed: required %s but only have "
+                   "%s permissions" % (perm, permissions))
+    resp = rdf_data_store.DataStoreResponse(
+        request=cmd.request,
+        status_desc=status_desc,
+        status=rdf_data_store.DataStoreResponse.Status.AUTHORIZATION_DENIED)
+    return resp.SerializeToString()
+
+  def _RunCommand(self, cmd, permissions):
+    """Runs a protocol version 2 command, yields the serialized responses."""
+    cmdinfo = self.CMDTABLE.get(cmd.command)
+    if not cmdinfo:
+      logging.error("Unrecognized command %d", cmd.command)
       resp = rdf_data_store.DataStoreResponse(
           request=cmd.request,
-          status_desc=status_desc,
-          status=rdf_data_store.DataStoreResponse.Status.AUTHORIZATION_DENIED)
-      response = resp.SerializeToString()
+          status_desc="Unrecognized command %d" % cmd.command,
+          status=rdf_data_store.DataStoreResponse.Status.DATA_STORE_ERROR)
+      yield resp.SerializeToString()
+      return
 
-    return sutils.SIZE_PACKER.pack(len(response)) + response
+    method, perm = cmdinfo
+    if perm not in permissions:
+      yield self._DeniedResponse(cmd, perm, permissions)
+      return
+
+    streaming_method = self.STREAMING_CMDTABLE.get(cmd.command)
+    if streaming_method:
+      for response in streaming_method(cmd.request, self.STREAM_CHUNK_BYTES):
+        yield response
+    else:
+      yield method(cmd.request)
+
+  def ServeProtocolV2(self, sock, permissions):
+    """Serves protocol version 2 requests until the client disconnects.
+
+    Every request is framed with its id, which the client uses to match the
+    responses to its requests, so it can keep many requests in flight on the
+    connection. Requests are still run in the order they arrive, which keeps
+    pipelined writes ahead of the reads which follow them. Results of prefix
+    queries and scans are sent back in chunks while they are being read.
+
+    Args:
+      sock: The client socket.
+      permissions: The permissions of the client.
+    """
+    while True:
+      # Use a long timeout while waiting for the next request.
+      sock.settimeout(self.CLIENT_TIMEOUT_TIME)
+      header = self._ReadExactlyFailAfterFirst(sock, sutils.FRAME_PACKER.size)
+      if not header:
+        return
+      length, request_id, flags = sutils.FRAME_PACKER.unpack(header)
+
+      # Full request must be here.
+      sock.settimeout(self.READ_TIMEOUT)
+      try:
+        cmd_str = sutils.UnpackFramePayload(
+            self._ReadExactly(sock, length), flags)
+      except (socket.timeout, socket.error, zlib.error):
+        return
+      cmd = rdf_data_server.DataStoreCommand.FromSerializedString(cmd_str)
+
+      try:
+        sock.settimeout(self.SEND_TIMEOUT)
+        # Hold back each response until the next one is known so the last one
+        # can be sent without FLAG_MORE.
+        previous = None
+        for response in self._RunCommand(cmd, permissions):
+          if previous is not None:
+            sock.sendall(
+                sutils.PackFrame(
+                    request_id,
+                    previous,
+                    flags=sutils.FLAG_MORE,
+                    compression_threshold=self.COMPRESSION_THRESHOLD))
+          previous = response
+
+        sock.sendall(
+            sutils.PackFrame(
+                request_id,
+                previous,
+                compression_threshold=self.COMPRESSION_THRESHOLD))
+      except (socket.error, socket.timeout):
+        # The client has to reconnect and send the requests again, see
+        # HandleDataStoreService().
+        return
 
   def HandleRegister(self):
     """Registers a data server in the master."""
@@ -299,17 +389,36 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
       self.close_connection = 1
       return
 
-    logging.info("Client %s has started using the data server",
-                 self.client_address)
+    # Clients which can speak protocol version 2 ask for it, older clients
+    # don't send the header.
+    try:
+      protocol = int(
+          self.headers.get(constants.PROTOCOL_HEADER, constants.PROTOCOL_V1))
+    except ValueError:
+      protocol = constants.PROTOCOL_V1
+    protocol = min(protocol, constants.PROTOCOL_V2)
+
+    logging.info("Client %s has started using the data server (protocol %d)",
+                 self.client_address, protocol)
     try:
       # Send handshake.
       sock.settimeout(self.LOGIN_TIMEOUT)  # 10 seconds to login.
-      sock.sendall("OK\n")
+      if protocol == constants.PROTOCOL_V2:
+        sock.sendall(constants.PROTOCOL_V2_ACK)
+      else:
+        sock.sendall(constants.PROTOCOL_V1_ACK)
     except (socket.error, socket.timeout):
       logging.warning("Could not login client %s", self.client_address)
       self.close_connection = 1
       return
 
+    if protocol == constants.PROTOCOL_V2:
+      self.ServeProtocolV2(sock, perms)
+      # Client probably died or there was an error in the connection.
+      sock.close()
+      self.close_connection = 1
+      return
+
     while True:
       # Handle requests
       replybody = self.HandleClient(sock, perms)
@@ -349,6 +458,18 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
     body = self.MAPPING.SerializeToString()
     self._Response(constants.RESPONSE_OK, body)
 
+  def HandleRebalancePlan(self):
+    """Returns the rebalance the master would do now, without running it."""
+    if not self.MASTER:
+      self._EmptyResponse(constants.RESPONSE_NOT_MASTER_SERVER)
+      return
+    plan = self.MASTER.PlanRebalance()
+    if not plan:
+      # The servers are balanced.
+      self._EmptyResponse(constants.RESPONSE_OK)
+      return
+    self._Response(constants.RESPONSE_OK, plan.SerializeToString())
+
   def HandleRebalancePhase1(self):
     """Call master to perform phase 1 of the rebalancing operation."""
     if not self.MASTER:
@@ -806,6 +927,14 @@ def Start(db,
       cmd.UNLOCK_SUBJECT: (reqhandler_cls.SERVICE.UnlockSubject, "w"),
       cmd.SCAN_ATTRIBUTES: (reqhandler_cls.SERVICE.ScanAttributes, "r")
   }
+  reqhandler_cls.STREAMING_CMDTABLE = {
+      cmd.MULTI_RESOLVE_PREFIX: reqhandler_cls.SERVICE.StreamMultiResolvePrefix,
+      cmd.SCAN_ATTRIBUTES: reqhandler_cls.SERVICE.StreamScanAttributes
+  }
+  reqhandler_cls.STREAM_CHUNK_BYTES = config.CONFIG[
+      "Dataserver.stream_chunk_bytes"]
+  reqhandler_cls.COMPRESSION_THRESHOLD = config.CONFIG[
+      "Dataserver.compression_threshold"]
 
   # Initialize nonce store for authentication.
   if not reqhandler_cls.NONCE_STORE:
@@ -156,6 +156,42 @@ class Manager(object):
     print
     self._DoRebalance(new_mapping)
 
+  def _Plan(self):
+    """Shows the rebalance the master plans for the uneven servers."""
+    print "Contacting master server...",
+    pool = None
+    try:
+      pool = urllib3.connectionpool.HTTPConnectionPool(
+          self.addr, port=self.port)
+      res = pool.urlopen("POST", "/rebalance/plan")
+    except urllib3.exceptions.MaxRetryError:
+      print "Unable to contact master..."
+      return
+    finally:
+      if pool:
+        pool.close()
+    if res.status != constants.RESPONSE_OK:
+      print "Could not plan re-sharding"
+      return
+    print "OK"
+    print
+    if not res.data:
+      print "The servers are balanced."
+      return
+    plan = rdf_data_server.DataServerRebalance.FromSerializedString(res.data)
+    print "The new ranges would be:"
+    self._ShowRange(plan.mapping)
+    print
+    for i, move in enumerate(list(plan.moving)):
+      print "Server %d would move about %dKB" % (i, move / 1024)
+    print
+    print "Writes to the moving ranges are lost during re-sharding."
+    print "Make sure all the frontends and workers are stopped."
+    answer = raw_input("Proceed with re-sharding? (y/n) ")
+    if answer != "y":
+      return
+    self._DoRebalance(plan.mapping)
+
   def _DoRebalance(self, new_mapping):
     """Performs a new rebalancing operation with the master server."""
     print "Contacting master server to start re-sharding...",
@@ -535,6 +571,7 @@ class Manager(object):
     print "servers\t\t\t\tDisplay server information."
     print "ranges\t\t\t\tDisplay server range information."
     print "rebalance\t\t\tRebalance server load."
+    print "plan\t\t\t\tPlan a rebalance from the server statistics."
     print "recover <transaction id>\tComplete a pending transaction."
     print "addserver <address> <port>\tAdd new server to the group."
     print("dropserver <address> <port>\tMove all the data from the server "
@@ -554,6 +591,8 @@ class Manager(object):
       self._ShowRanges()
     elif cmd == "rebalance":
       self._Rebalance()
+    elif cmd == "plan":
+      self._Plan()
     elif cmd == "recover":
       if len(args) != 1:
         print "Syntax: recover <transaction-id>"
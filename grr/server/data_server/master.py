@@ -4,6 +4,7 @@
 import logging
 import threading
 import urlparse
+import uuid
 
 
 import ipaddr
@@ -160,6 +161,14 @@ class DataMaster(object):
     # Holds current rebalance operation.
     self.rebalance = None
     self.rebalance_pool = []
+    # Start automatic rebalancing thread.
+    self.rebalance_thread = None
+    if config.CONFIG["Dataserver.auto_rebalance"]:
+      self.rebalance_thread = utils.InterruptableThread(
+          name="DataServer rebalancing thread",
+          target=self._AutoRebalance,
+          sleep_time=config.CONFIG["Dataserver.rebalance_check_frequency"])
+      self.rebalance_thread.start()
 
   def LoadMapping(self):
     return self.mapping
@@ -170,7 +179,7 @@ class DataMaster(object):
     num_components, avg_component = self.service.GetComponentInformation()
     state = rdf_data_server.DataServerState(
         size=self.service.Size(),
-        load=0,
+        load=self.service.GetLoad(),
         status=ok,
         num_components=num_components,
         avg_component=avg_component)
@@ -229,6 +238,61 @@ class DataMaster(object):
   def Stop(self):
     self.service.SaveServerMapping(self.mapping)
     self.periodic_thread.Stop()
+    if self.rebalance_thread:
+      self.rebalance_thread.Stop()
+
+  def PlanRebalance(self):
+    """Plans a rebalance step if the servers are uneven, without running it.
+
+    Returns:
+      A DataServerRebalance with the new mapping and the estimated number of
+      bytes each server has to move, or None if no rebalance is needed.
+    """
+    metric = rebalance.FindImbalance(
+        self.mapping, config.CONFIG["Dataserver.rebalance_load_threshold"],
+        config.CONFIG["Dataserver.rebalance_size_threshold"])
+    if not metric:
+      return None
+    logging.info("Data server %s is uneven, planning rebalance", metric)
+    return rebalance.PlanRebalance(
+        self.mapping, metric,
+        config.CONFIG["Dataserver.rebalance_max_move_bytes"])
+
+  def Rebalance(self, new_mapping):
+    """Rebalances the servers to the new mapping. Returns the final mapping."""
+    if self.IsRebalancing():
+      return None
+    reb = rdf_data_server.DataServerRebalance(
+        id=str(uuid.uuid4()), mapping=new_mapping)
+    if not self.SetRebalancing(reb):
+      logging.warning("Could not contact servers for rebalancing")
+      return None
+    if not self.FetchRebalanceInformation():
+      logging.warning("Could not contact servers for rebalancing statistics")
+      return None
+    if not self.CopyRebalanceFiles():
+      logging.warning("Could not copy files for rebalance %s", reb.id)
+      return None
+    return self.RebalanceCommit()
+
+  def _AutoRebalance(self):
+    """Periodically plans a rebalance when the servers are uneven.
+
+    The plan is only logged. Writes to the moving ranges are not frozen or
+    forwarded while the files are copied, so they would be lost if the plan was
+    performed while the cluster is serving.
+    """
+    if not self.AllRegistered() or self.IsRebalancing():
+      return
+    plan = self.PlanRebalance()
+    if not plan:
+      return
+    for i, serv in enumerate(list(plan.mapping.servers)):
+      logging.info("Rebalance plan: server %d [%s, %s[ moves %dKB", i,
+                   serv.interval.start, serv.interval.end,
+                   plan.moving[i] / 1024)
+    logging.warning("Data servers are uneven. Stop all writers and perform "
+                    "the plan with the manager's plan command.")
 
   def SetRebalancing(self, reb):
     """Sets a new rebalance operation and starts communication with servers."""
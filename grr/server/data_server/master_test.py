@@ -3,6 +3,7 @@
 
 
 import socket
+import time
 
 
 import ipaddr
@@ -18,6 +19,7 @@ from grr.server.data_server import constants
 from grr.server.data_server import data_server
 from grr.server.data_server import errors
 from grr.server.data_server import master
+from grr.server.data_server import rebalance
 from grr.server.data_server import utils
 from grr.test_lib import test_lib
 
@@ -43,6 +45,9 @@ class MockDataStoreService(object):
   def Size(self):
     return 0
 
+  def GetLoad(self):
+    return 0
+
 
 class MockResponse(object):
 
@@ -242,6 +247,107 @@ class MasterTest(test_lib.GRRBaseTest):
     self.assertEqual(
         utils._FindServerInMapping(mapping, constants.MAX_RANGE), 3)
 
+  def _SetStates(self, mapping, loads, sizes):
+    for serv, load, size in zip(mapping.servers, loads, sizes):
+      serv.state = rdf_data_server.DataServerState(load=load, size=size)
+
+  def testBalancedServersAreNotRebalanced(self):
+    m = master.DataMaster(7000, self.mock_service)
+    mapping = m.LoadMapping()
+    self._SetStates(mapping, [10, 12, 9, 11], [1000, 1100, 900, 1000])
+    self.assertIsNone(rebalance.FindImbalance(mapping, 1.5, 1.5))
+    self.assertIsNone(m.PlanRebalance())
+
+    self._SetStates(mapping, [10, 12, 9, 11], [1000, 1100, 900, 3000])
+    self.assertEqual(rebalance.FindImbalance(mapping, 1.5, 1.5), "size")
+    self.assertIsNone(rebalance.FindImbalance(mapping, 1.5, 0))
+
+  def testPlanRebalanceSplitsHotRange(self):
+    m = master.DataMaster(7000, self.mock_service)
+    mapping = m.LoadMapping()
+    old_intervals = [(serv.interval.start, serv.interval.end)
+                     for serv in mapping.servers]
+    self._SetStates(mapping, [10, 100, 10, 10], [1000] * 4)
+
+    self.assertEqual(rebalance.FindImbalance(mapping, 1.5, 1.5), "load")
+    plan = m.PlanRebalance()
+    self.assertTrue(plan)
+
+    # Planning is a dry run.
+    self.assertEqual(old_intervals, [(serv.interval.start, serv.interval.end)
+                                     for serv in m.LoadMapping().servers])
+
+    new_mapping = plan.mapping
+    self.assertEqual(new_mapping.version, mapping.version + 1)
+    servers = list(new_mapping.servers)
+    self.assertEqual(servers[0].interval.start, 0)
+    self.assertEqual(servers[-1].interval.end, constants.MAX_RANGE)
+    for prev, serv in zip(servers, servers[1:]):
+      self.assertEqual(prev.interval.end, serv.interval.start)
+
+    # The range of the hot server is split between its neighbours.
+    quarter = constants.MAX_RANGE / 4
+    hot = servers[1].interval
+    self.assertLess(hot.end - hot.start, quarter / 2)
+    self.assertGreater(servers[0].interval.end, quarter)
+    self.assertEqual(plan.moving[1], 675)
+
+  def testAutoRebalanceOnlyPlans(self):
+    m = master.DataMaster(7000, self.mock_service)
+    self._SetStates(m.LoadMapping(), [10, 100, 10, 10], [1000] * 4)
+    rebalances = []
+
+    with libutils.MultiStubber(
+        (m, "AllRegistered", lambda: True),
+        (m, "Rebalance", rebalances.append)):
+      m._AutoRebalance()
+
+    self.assertEqual(rebalances, [])
+    self.assertFalse(m.IsRebalancing())
+
+  def testPlanRebalanceLimitsMovedData(self):
+    m = master.DataMaster(7000, self.mock_service)
+    mapping = m.LoadMapping()
+    self._SetStates(mapping, [0] * 4, [4000, 1000, 1000, 1000])
+
+    plan = rebalance.PlanRebalance(mapping, "size", max_move_bytes=500)
+    # Each boundary moves across 500 bytes of data.
+    quarter = constants.MAX_RANGE / 4
+    self.assertEqual(
+        [serv.interval.start for serv in plan.mapping.servers],
+        [0, quarter / 8 * 7, quarter + quarter / 2, 2 * quarter + quarter / 2])
+    self.assertEqual(list(plan.moving), [500, 500, 500, 0])
+
+    # Without the limit all the servers get the same amount of data.
+    plan = rebalance.PlanRebalance(mapping, "size")
+    self.assertEqual(
+        [serv.interval.start for serv in plan.mapping.servers],
+        [0, quarter / 16 * 7, quarter / 8 * 7, 2 * quarter + quarter / 4])
+
+  def testCopyThrottle(self):
+    now = [1000.0]
+    sleeps = []
+
+    def Sleep(seconds):
+      sleeps.append(seconds)
+      now[0] += seconds
+
+    with libutils.MultiStubber((time, "time", lambda: now[0]),
+                               (time, "sleep", Sleep)):
+      throttle = rebalance.CopyThrottle(1000)
+      throttle.Wait(500)
+      self.assertEqual(sleeps, [0.5])
+      now[0] += 2
+      # We were idle, so there is no need to wait.
+      throttle.Wait(1000)
+      self.assertEqual(sleeps, [0.5])
+      throttle.Wait(2000)
+      self.assertEqual(sleeps, [0.5, 1.0])
+
+      unlimited = rebalance.CopyThrottle(0)
+      unlimited.Wait(10**9)
+      self.assertEqual(sleeps, [0.5, 1.0])
+
 
 def main(args):
   test_lib.main(args)
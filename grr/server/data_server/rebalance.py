@@ -6,10 +6,12 @@ import logging
 import os
 import shutil
 import StringIO
+import time
 import zlib
 
 from requests.packages import urllib3
 
+from grr import config
 from grr.lib import utils
 from grr.lib.rdfvalues import data_server as rdf_data_server
 from grr.server import data_store
@@ -28,6 +30,142 @@ MOVE_EXCEPTIONS = [constants.TRANSACTION_FILENAME, constants.REMOVE_FILENAME]
 COMPRESSION_LEVEL = 3
 
 
+def FindImbalance(mapping, load_threshold, size_threshold):
+  """Checks if the servers of the mapping need to be rebalanced.
+
+  Args:
+    mapping: DataServerMapping with the latest server states.
+    load_threshold: A server with this many times the average load is
+      overloaded. 0 disables the check.
+    size_threshold: A server with this many times the average size is
+      overloaded. 0 disables the check.
+
+  Returns:
+    The name of the DataServerState field ("load" or "size") that is uneven,
+    or None if the servers are balanced.
+  """
+  servers = list(mapping.servers)
+  if not servers:
+    return None
+  # Load is checked first since a hot range slows down the whole cluster.
+  for metric, threshold in [("load", load_threshold), ("size", size_threshold)]:
+    if not threshold:
+      continue
+    values = [getattr(serv.state, metric) for serv in servers]
+    average = float(sum(values)) / len(values)
+    if average and max(values) > average * threshold:
+      return metric
+  return None
+
+
+def _Accumulate(intervals, values, point):
+  """Sums the values of the intervals up to point.
+
+  Values are assumed to be spread uniformly over their interval.
+
+  Args:
+    intervals: Sorted list of contiguous (start, end) tuples.
+    values: The value of each interval.
+    point: Point of the hash range.
+
+  Returns:
+    The sum of the values before point.
+  """
+  total = 0.0
+  for (start, end), value in zip(intervals, values):
+    if point >= end:
+      total += value
+    else:
+      if point > start:
+        total += value * float(point - start) / float(end - start)
+      break
+  return total
+
+
+def _InverseAccumulate(intervals, values, amount):
+  """Returns the first point where _Accumulate() reaches amount."""
+  if amount <= 0:
+    return 0
+  for (start, end), value in zip(intervals, values):
+    if end <= start or not value:
+      continue
+    if amount <= value:
+      return min(start + int((end - start) * amount / value), end)
+    amount -= value
+  return constants.MAX_RANGE
+
+
+def PlanRebalance(mapping, metric, max_move_bytes=0):
+  """Plans new server intervals that even out the given metric.
+
+  The boundaries between server intervals are moved so that every server gets
+  the same share of the metric, assuming it is spread uniformly over each
+  interval. This splits the range of an overloaded server between its
+  neighbours. No boundary is moved across more than about max_move_bytes of
+  data, so large imbalances are fixed by several smaller rebalances.
+
+  Nothing is changed, so this can be used as a dry run.
+
+  Args:
+    mapping: DataServerMapping with the latest server states.
+    metric: The DataServerState field to even out, "load" or "size".
+    max_move_bytes: Maximum amount of data to move across each boundary. 0
+      means no limit.
+
+  Returns:
+    A DataServerRebalance with the new mapping and the estimated number of
+    bytes each server has to move, or None if nothing needs to move.
+  """
+  servers = list(mapping.servers)
+  intervals = [(serv.interval.start, serv.interval.end) for serv in servers]
+  values = [float(getattr(serv.state, metric)) for serv in servers]
+  sizes = [float(serv.state.size) for serv in servers]
+  total = sum(values)
+  if not total:
+    return None
+
+  boundaries = [0]
+  for i in xrange(1, len(servers)):
+    old = intervals[i][0]
+    new = _InverseAccumulate(intervals, values, total * i / len(servers))
+    if max_move_bytes:
+      old_size = _Accumulate(intervals, sizes, old)
+      new_size = _Accumulate(intervals, sizes, new)
+      if new_size > old_size + max_move_bytes:
+        new = _InverseAccumulate(intervals, sizes, old_size + max_move_bytes)
+      elif new_size < old_size - max_move_bytes:
+        new = _InverseAccumulate(intervals, sizes, old_size - max_move_bytes)
+    boundaries.append(max(new, boundaries[-1]))
+  boundaries.append(constants.MAX_RANGE)
+
+  if boundaries == [start for start, _ in intervals] + [constants.MAX_RANGE]:
+    return None
+
+  new_mapping = rdf_data_server.DataServerMapping(
+      version=mapping.version + 1,
+      num_servers=mapping.num_servers,
+      pathing=mapping.pathing)
+  moving = []
+  for i, serv in enumerate(servers):
+    start, end = boundaries[i], boundaries[i + 1]
+    new_mapping.servers.Append(
+        index=serv.index,
+        address=serv.address,
+        port=serv.port,
+        state=serv.state,
+        interval=rdf_data_server.DataServerInterval(start=start, end=end))
+    # Data of the old interval which is not part of the new one.
+    old_start, old_end = intervals[i]
+    kept = 0.0
+    if min(end, old_end) > max(start, old_start):
+      kept = (_Accumulate(intervals, sizes, min(end, old_end)) -
+              _Accumulate(intervals, sizes, max(start, old_start)))
+    moving.append(max(int(sizes[i] - kept), 0))
+
+  return rdf_data_server.DataServerRebalance(
+      mapping=new_mapping, moving=moving)
+
+
 def _RecComputeRebalanceSize(mapping, server_id, dspath, subpath):
   """Recursively compute the size of files that need to be moved."""
   total = 0
@@ -66,10 +204,28 @@ def ComputeRebalanceSize(mapping, server_id):
   return _RecComputeRebalanceSize(mapping, server_id, loc, "")
 
 
+class CopyThrottle(object):
+  """Limits the bandwidth used to send database files to other servers."""
+
+  def __init__(self, bandwidth):
+    self.bandwidth = bandwidth
+    self.start = time.time()
+    self.sent = 0
+
+  def Wait(self, size):
+    """Accounts for size bytes, sleeping while we are ahead of the limit."""
+    if not self.bandwidth:
+      return
+    self.sent += size
+    ahead = float(self.sent) / self.bandwidth - (time.time() - self.start)
+    if ahead > 0:
+      time.sleep(ahead)
+
+
 class FileCopyWrapper(object):
   """Wraps the database file for post'ing it to the server."""
 
-  def __init__(self, rebalance, directory, filename, fullpath):
+  def __init__(self, rebalance, directory, filename, fullpath, throttle=None):
     filesize = os.path.getsize(fullpath)
     filecopy = rdf_data_server.DataServerFileCopy(
         rebalance_id=rebalance.id,
@@ -90,6 +246,7 @@ class FileCopyWrapper(object):
     self.end_of_stream = False
     # Flag to indicate that we are going to read the header first.
     self.read_header = True
+    self.throttle = throttle
 
   def read(self, blocksize):  # pylint: disable=invalid-name
     """Returns data back to the HTTP post request."""
@@ -125,6 +282,8 @@ class FileCopyWrapper(object):
       # Once the data is exhausted, we mark the end of the stream
       # and we simply return the 0 marker.
       self.end_of_stream = True
+    elif self.throttle:
+      self.throttle.Wait(len(ret))
     # Return the size of the block plus the block itself.
     return sutils.SIZE_PACKER.pack(len(ret)) + ret
 
@@ -133,9 +292,10 @@ class FileCopyWrapper(object):
     self.header.close()
 
 
-def _SendFileToServer(pool, fullpath, subpath, basename, rebalance):
+def _SendFileToServer(pool, fullpath, subpath, basename, rebalance,
+                      throttle=None):
   """Sends a specific data store file to the server."""
-  fp = FileCopyWrapper(rebalance, subpath, basename, fullpath)
+  fp = FileCopyWrapper(rebalance, subpath, basename, fullpath, throttle=throttle)
 
   try:
     # Content-Length is 0 since we do not know the size of the compressed data.
@@ -173,7 +333,7 @@ def _FileWithRemoveList(database_dir, rebalance):
 
 
 def _RecCopyFiles(rebalance, server_id, dspath, subpath, pool_cache,
-                  removed_list):
+                  removed_list, throttle):
   """Recursively send files for moving to the required data server."""
   fulldir = utils.JoinPath(dspath, subpath)
   mapping = rebalance.mapping
@@ -187,7 +347,7 @@ def _RecCopyFiles(rebalance, server_id, dspath, subpath, pool_cache,
     if os.path.isdir(path):
       result = _RecCopyFiles(rebalance, server_id, dspath,
                              utils.JoinPath(subpath, comp), pool_cache,
-                             removed_list)
+                             removed_list, throttle)
       if not result:
         return False
       continue
@@ -206,7 +366,8 @@ def _RecCopyFiles(rebalance, server_id, dspath, subpath, pool_cache,
         pool = urllib3.connectionpool.HTTPConnectionPool(addr, port=port)
         pool_cache[key] = pool
       logging.info("Need to move %s from %d to %d", key, server_id, where)
-      if not _SendFileToServer(pool, path, subpath, comp, rebalance):
+      if not _SendFileToServer(
+          pool, path, subpath, comp, rebalance, throttle=throttle):
         return False
       removed_list.append(path)
     else:
@@ -223,7 +384,9 @@ def CopyFiles(rebalance, server_id):
     return True
   pool_cache = {}
   removed_list = []
-  ok = _RecCopyFiles(rebalance, server_id, loc, "", pool_cache, removed_list)
+  throttle = CopyThrottle(config.CONFIG["Dataserver.rebalance_copy_bandwidth"])
+  ok = _RecCopyFiles(rebalance, server_id, loc, "", pool_cache, removed_list,
+                     throttle)
   if not ok:
     return False
   # Write list of removed files to temporary directory
@@ -25,6 +25,31 @@ MAP_SUBJECT = "aff4:/" + BASE_MAP_SUBJECT
 MAP_VALUE_PREDICATE = "metadata:value"
 
 
+def _ErrorResponse(request, error):
+  """Converts an expected exception into a failed DataStoreResponse."""
+  # Attach a copy of the request to the response so the caller can tell why
+  # we failed the request.
+  response = rdf_data_store.DataStoreResponse(request=request)
+
+  if isinstance(error, access_control.UnauthorizedAccess):
+    response.status = (
+        rdf_data_store.DataStoreResponse.Status.AUTHORIZATION_DENIED)
+    if error.subject:
+      response.failed_subject = utils.SmartUnicode(error.subject)
+
+  elif isinstance(error, data_store.Error):
+    response.status = rdf_data_store.DataStoreResponse.Status.DATA_STORE_ERROR
+
+  else:
+    response.status = rdf_data_store.DataStoreResponse.Status.TIMEOUT_ERROR
+
+  response.status_desc = utils.SmartUnicode(error)
+
+  # Limit the size of the error report since it can be quite large.
+  logging.info("Failed: %s", utils.SmartStr(response)[:1000])
+  return response
+
+
 def RPCWrapper(f):
   """A decorator for converting exceptions to rpc status messages.
 
@@ -42,53 +67,64 @@ def RPCWrapper(f):
   @functools.wraps(f)
   def Wrapper(self, request):
     """Wrap the function can catch exceptions, converting them to status."""
-    failed = True
+    self.CountRequest()
     response = rdf_data_store.DataStoreResponse()
     response.status = rdf_data_store.DataStoreResponse.Status.OK
 
     try:
       f(self, request, response)
-      failed = False
-    except access_control.UnauthorizedAccess as e:
-      # Attach a copy of the request to the response so the caller can tell why
-      # we failed the request.
-      response.Clear()
-      response.request = request
-
-      response.status = (
-          rdf_data_store.DataStoreResponse.Status.AUTHORIZATION_DENIED)
-      if e.subject:
-        response.failed_subject = utils.SmartUnicode(e.subject)
-
-      response.status_desc = utils.SmartUnicode(e)
-
-    except data_store.Error as e:
-      # Attach a copy of the request to the response so the caller can tell why
-      # we failed the request.
-      response.Clear()
-      response.request = request
-
-      response.status = rdf_data_store.DataStoreResponse.Status.DATA_STORE_ERROR
-      response.status_desc = utils.SmartUnicode(e)
-
-    except access_control.ExpiryError as e:
-      # Attach a copy of the request to the response so the caller can tell why
-      # we failed the request.
-      response.Clear()
-      response.request = request
-
-      response.status = rdf_data_store.DataStoreResponse.Status.TIMEOUT_ERROR
-      response.status_desc = utils.SmartUnicode(e)
-
-    if failed:
-      # Limit the size of the error report since it can be quite large.
-      logging.info("Failed: %s", utils.SmartStr(response)[:1000])
+    except (access_control.UnauthorizedAccess, data_store.Error,
+            access_control.ExpiryError) as e:
+      response = _ErrorResponse(request, e)
+
     serialized_response = response.SerializeToString()
     return serialized_response
 
   return Wrapper
 
 
+def StreamingRPCWrapper(f):
+  """A decorator for service methods which stream their results.
+
+  The wrapped function yields ResultSets. The decorated function yields them in
+  serialized DataStoreResponses of about chunk_bytes each, so large results
+  can be sent while they are still being read. Expected exceptions are encoded
+  into the status of the last response.
+
+  Args:
+    f: The generator function to wrap.
+
+  Returns:
+    A decorator function.
+  """
+
+  @functools.wraps(f)
+  def Wrapper(self, request, chunk_bytes):
+    """Yields the serialized responses."""
+    self.CountRequest()
+    response = rdf_data_store.DataStoreResponse()
+    response.status = rdf_data_store.DataStoreResponse.Status.OK
+    size = 0
+
+    try:
+      for result in f(self, request):
+        response.results.Append(result)
+        size += len(result.serialized_result)
+        if size >= chunk_bytes:
+          yield response.SerializeToString()
+
+          response = rdf_data_store.DataStoreResponse()
+          response.status = rdf_data_store.DataStoreResponse.Status.OK
+          size = 0
+    except (access_control.UnauthorizedAccess, data_store.Error,
+            access_control.ExpiryError) as e:
+      response = _ErrorResponse(request, e)
+
+    yield response.SerializeToString()
+
+  return Wrapper
+
+
 class DataStoreService(object):
   """Class that responds to DataStore requests."""
 
@@ -96,6 +132,11 @@ class DataStoreService(object):
     self.db = db
     self.transaction_lock = threading.Lock()
     self.transactions = {}
+    # Number of requests served, used to compute the load of the server.
+    self.load_lock = threading.Lock()
+    self.request_count = 0
+    self.load_sample = (time.time(), 0)
+    self.load = 0
     old_pathing = config.CONFIG.Get("Datastore.pathing")
     # Need to add a fixed rule for the file where the server mapping is stored.
     new_pathing = [r"(?P<path>" + BASE_MAP_SUBJECT + ")"] + old_pathing
@@ -158,6 +199,15 @@ class DataStoreService(object):
   @RPCWrapper
   def MultiResolvePrefix(self, request, response):
     """Resolve multiple attributes for a given subject at once."""
+    for result in self._MultiResolvePrefixResults(request):
+      response.results.Append(result)
+
+  @StreamingRPCWrapper
+  def StreamMultiResolvePrefix(self, request):
+    """Like MultiResolvePrefix but yields the results in chunks."""
+    return self._MultiResolvePrefixResults(request)
+
+  def _MultiResolvePrefixResults(self, request):
     attribute_prefix = [utils.SmartUnicode(v.attribute) for v in request.values]
 
     timestamp = self.FromTimestampSpec(request.timestamp)
@@ -169,19 +219,40 @@ class DataStoreService(object):
         timestamp=timestamp,
         token=request.token,
         limit=request.limit):
-      response.results.Append(
+      yield rdf_data_store.ResultSet(
           subject=subject,
           payload=[(utils.SmartStr(attribute), self._Encode(value), int(ts))
                    for (attribute, value, ts) in values])
 
   @RPCWrapper
   def ScanAttributes(self, request, response):
+    for result in self._ScanAttributesResults(request):
+      response.results.Append(result)
+
+  @StreamingRPCWrapper
+  def StreamScanAttributes(self, request):
+    """Like ScanAttributes but yields the results in chunks."""
+    return self._ScanAttributesResults(request)
+
+  def _ScanAttributesResults(self, request):
     subject_prefix = request.subject[0]
     attributes = [utils.SmartUnicode(v.attribute) for v in request.values]
     after_urn = None
     if len(request.subject) > 1:
       after_urn = request.subject[1]
     max_records = request.limit
+    if request.keys_only:
+      # Keys only scans are made for a single attribute.
+      for subject, ts in self.db.ScanAttributeKeys(
+          subject_prefix,
+          attributes[0],
+          after_urn=after_urn,
+          max_records=max_records,
+          token=request.token):
+        yield rdf_data_store.ResultSet(
+            subject=subject, payload=[(attributes[0], (ts, None))])
+      return
+
     for (subject, results) in self.db.ScanAttributes(
         subject_prefix,
         attributes,
@@ -192,7 +263,7 @@ class DataStoreService(object):
       encoded_results = []
       for attribute, (ts, value) in results.iteritems():
         encoded_results.append((attribute, (ts, self._Encode(value))))
-      response.results.Append(subject=subject, payload=encoded_results)
+      yield rdf_data_store.ResultSet(subject=subject, payload=encoded_results)
 
   @RPCWrapper
   def DeleteAttributes(self, request, unused_response):
@@ -310,6 +381,22 @@ class DataStoreService(object):
   def Size(self):
     return self.db.Size()
 
+  def CountRequest(self):
+    with self.load_lock:
+      self.request_count += 1
+
+  def GetLoad(self):
+    """Returns the number of requests per second since the last sample."""
+    now = time.time()
+    with self.load_lock:
+      last_time, last_count = self.load_sample
+      # Statistics may be requested in quick succession (e.g. when a
+      # rebalance is performed), keep the last value for short intervals.
+      if now - last_time >= 1:
+        self.load = int((self.request_count - last_count) / (now - last_time))
+        self.load_sample = (now, self.request_count)
+      return self.load
+
   def LoadServerMapping(self):
     """Retrieve server mapping from database."""
     # TODO(user): this SetUID can likely be replaced with a read ACL.
@@ -4,6 +4,7 @@
 
 import hashlib
 import struct
+import zlib
 
 from grr.lib.rdfvalues import data_server as rdf_data_server
 from grr.server.data_server import constants
@@ -11,6 +12,43 @@ from grr.server.data_server import constants
 SIZE_PACKER = struct.Struct("I")
 PORT_PACKER = struct.Struct("I")
 
+# Version 2 of the data store protocol prefixes every message with its length,
+# the id of the request it belongs to and flags.
+FRAME_PACKER = struct.Struct("!IIB")
+# The payload is zlib compressed.
+FLAG_COMPRESSED = 1
+# More responses to the same request follow.
+FLAG_MORE = 2
+
+
+def PackFrame(request_id, payload, flags=0, compression_threshold=0):
+  """Frames a message for version 2 of the data store protocol.
+
+  Args:
+    request_id: The id of the request the message belongs to.
+    payload: The serialized message.
+    flags: FLAG_* bits for the frame.
+    compression_threshold: Payloads at least this large are compressed. 0
+      disables compression.
+
+  Returns:
+    The framed message.
+  """
+  if compression_threshold and len(payload) >= compression_threshold:
+    compressed = zlib.compress(payload, 1)
+    if len(compressed) < len(payload):
+      payload = compressed
+      flags |= FLAG_COMPRESSED
+
+  return FRAME_PACKER.pack(len(payload), request_id, flags) + payload
+
+
+def UnpackFramePayload(payload, flags):
+  """Returns the message of a frame read with FRAME_PACKER."""
+  if flags & FLAG_COMPRESSED:
+    return zlib.decompress(payload)
+  return payload
+
 
 def CreateStartInterval(index, total):
   """Create initial range given index of server and number of servers."""
@@ -37,10 +37,18 @@ able to filter it directly).
 
 import abc
 import atexit
+import collections
+import errno
 import logging
+import os
 import random
+import re
+import select
+import socket
 import sys
+import threading
 import time
+import types
 
 from grr import config
 from grr.lib import flags
@@ -118,6 +126,7 @@ class MutationPool(object):
     self.delete_attributes_requests = []
 
     self.new_notifications = []
+    self.collection_counters = {}
 
   def DeleteSubjects(self, subjects):
     self.delete_subject_requests.extend(subjects)
@@ -142,41 +151,27 @@ class MutationPool(object):
 
   def Flush(self):
     """Flushing actually applies all the operations in the pool."""
-    DB.DeleteSubjects(
-        self.delete_subject_requests, token=self.token, sync=False)
-
-    for req in self.delete_attributes_requests:
-      subject, attributes, start, end = req
-      DB.DeleteAttributes(
-          subject,
-          attributes,
-          start=start,
-          end=end,
-          token=self.token,
-          sync=False)
-
-    for req in self.set_requests:
-      subject, values, timestamp, replace, to_delete = req
-      DB.MultiSet(
-          subject,
-          values,
-          timestamp=timestamp,
-          replace=replace,
-          to_delete=to_delete,
-          token=self.token,
-          sync=False)
+    for key, count in self.collection_counters.iteritems():
+      collection_id, bucket, shard = key
+      self.Set(
+          collection_id,
+          DataStore.CollectionCounterAttribute(bucket, shard),
+          count,
+          replace=True)
+    self.collection_counters = {}
 
     if (self.delete_subject_requests or self.delete_attributes_requests or
-        self.set_requests):
-      DB.Flush()
+        self.set_requests or self.new_notifications):
+      DB.ApplyMutations(self, token=self.token)
 
-    for queue, notifications in self.new_notifications:
-      DB.CreateNotifications(queue, notifications, token=self.token)
-    self.new_notifications = []
+    if self.new_notifications:
+      NOTIFICATION_WAKEUP.Publish(
+          set(queue for queue, _ in self.new_notifications), token=self.token)
 
     self.delete_subject_requests = []
     self.set_requests = []
     self.delete_attributes_requests = []
+    self.new_notifications = []
 
   def __enter__(self):
     return self
@@ -186,7 +181,8 @@ class MutationPool(object):
 
   def Size(self):
     return (len(self.delete_subject_requests) + len(self.set_requests) +
-            len(self.delete_attributes_requests))
+            len(self.delete_attributes_requests) +
+            len(self.collection_counters))
 
   # Notification handling
   def CreateNotifications(self, queue, notifications):
@@ -217,6 +213,39 @@ class MutationPool(object):
         timestamp=timestamp,
         replace=True)
 
+  def CollectionUpdateCounter(self, collection_id, bucket, shard, count):
+    # Only the latest value of each counter needs to be written.
+    self.collection_counters[(collection_id, bucket, shard)] = count
+
+  def CollectionSetCount(self, collection_id, count, timestamp, counters):
+    """Stores the number of records before timestamp.
+
+    Args:
+      collection_id: The collection to store the count for.
+      count: The number of records older than timestamp.
+      timestamp: The time the count is valid for, counters of buckets starting
+        before it are not needed anymore.
+      counters: (bucket, shard) pairs of the counters to delete.
+    """
+    self.Set(
+        collection_id,
+        DataStore.COLLECTION_COUNT_ATTRIBUTE,
+        count,
+        timestamp=timestamp,
+        replace=True)
+    if counters:
+      self.DeleteAttributes(collection_id, [
+          DataStore.CollectionCounterAttribute(bucket, shard)
+          for bucket, shard in counters
+      ])
+
+  def CollectionDeleteCounters(self, collection_id, counters):
+    """Deletes the stored count and the given (bucket, shard) counters."""
+    attributes = [DataStore.COLLECTION_COUNT_ATTRIBUTE]
+    for bucket, shard in counters:
+      attributes.append(DataStore.CollectionCounterAttribute(bucket, shard))
+    self.DeleteAttributes(collection_id, attributes)
+
   def CollectionAddStoredTypeIndex(self, collection_id, stored_type):
     self.Set(
         collection_id,
@@ -458,6 +487,42 @@ class DataStore(object):
 
     raise DBSubjectLockError("Retry number exceeded.")
 
+  def MultiDBSubjectLock(self, subjects, lease_time=None, token=None):
+    """Locks many subjects at once without blocking.
+
+    Subjects which are locked already are skipped. Data stores which can lock
+    several subjects in one request should override this.
+
+    Args:
+      subjects: The subjects to lock.
+      lease_time: The minimum amount of time the locks should remain alive.
+      token: An ACL token.
+
+    Returns:
+      A dict mapping the locked subjects to their lock objects.
+    """
+    result = {}
+    for subject in subjects:
+      try:
+        result[subject] = self.DBSubjectLock(
+            subject, lease_time=lease_time, token=token)
+      except DBSubjectLockError:
+        pass
+    return result
+
+  def ReleaseDBSubjectLocks(self, locks):
+    """Releases many locks at once.
+
+    Data stores which can release several locks in one request should override
+    this.
+
+    Args:
+      locks: An iterable of DBSubjectLock objects, usually the values returned
+             by MultiDBSubjectLock().
+    """
+    for lock in locks:
+      lock.Release()
+
   @abc.abstractmethod
   def DBSubjectLock(self, subject, lease_time=None, token=None):
     """Returns a DBSubjectLock object for a subject.
@@ -505,6 +570,54 @@ class DataStore(object):
       token: An ACL token.
     """
 
+  def ApplyMutations(self, mutation_pool, sync=False, token=None):
+    """Applies all the mutations collected in a mutation pool.
+
+    Subjects are deleted first, then attributes, then new values are set and
+    finally notifications are written, so notifications never point at data
+    that has not been stored yet. This default implementation replays the
+    pool one call at a time, data stores that can batch writes across
+    subjects should override it.
+
+    Args:
+      mutation_pool: The MutationPool holding the operations to apply.
+      sync: If true we block until the data operations complete.
+      token: An ACL token.
+    """
+    if mutation_pool.delete_subject_requests:
+      self.DeleteSubjects(
+          mutation_pool.delete_subject_requests, sync=False, token=token)
+
+    for subject, attributes, start, end in (
+        mutation_pool.delete_attributes_requests):
+      self.DeleteAttributes(
+          subject, attributes, start=start, end=end, sync=False, token=token)
+
+    for subject, values, timestamp, replace, to_delete in (
+        mutation_pool.set_requests):
+      self.MultiSet(
+          subject,
+          values,
+          timestamp=timestamp,
+          replace=replace,
+          to_delete=to_delete,
+          sync=False,
+          token=token)
+
+    if (mutation_pool.delete_subject_requests or
+        mutation_pool.delete_attributes_requests or mutation_pool.set_requests
+        or sync):
+      self.Flush()
+
+    # Wakeups for these are published by the mutation pool.
+    for queue, notifications in mutation_pool.new_notifications:
+      self.MultiSet(
+          queue,
+          self._NotificationValues(notifications),
+          replace=False,
+          sync=True,
+          token=token)
+
   def MultiDeleteAttributes(self,
                             subjects,
                             attributes,
@@ -758,6 +871,36 @@ class DataStore(object):
       ts, v = r[attribute]
       yield (s, ts, v)
 
+  def ScanAttributeKeys(self,
+                        subject_prefix,
+                        attribute,
+                        after_urn=None,
+                        max_records=None,
+                        token=None):
+    """Scans for the subjects which have an attribute, without its values.
+
+    This base implementation reads the values and drops them, implementations
+    should override it to avoid reading or transferring the values at all.
+
+    Args:
+      subject_prefix: Returns subjects which begin with this prefix.
+      attribute: The attribute of interest.
+      after_urn: If set, only subjects after this urn are returned.
+      max_records: The maximum number of subjects to return.
+      token: An ACL token.
+
+    Yields:
+      Pairs (subject, timestamp) of the latest value of the attribute, ordered
+      by subject.
+    """
+    for subject, timestamp, _ in self.ScanAttribute(
+        subject_prefix,
+        attribute,
+        after_urn=after_urn,
+        max_records=max_records,
+        token=token):
+      yield (subject, timestamp)
+
   def ReadBlob(self, identifier, token=None):
     return self.ReadBlobs([identifier], token=token).values()[0]
 
@@ -785,13 +928,19 @@ class DataStore(object):
   def GetMutationPool(self, token=None):
     return self.mutation_pool_cls(token=token)
 
-  def CreateNotifications(self, queue_shard, notifications, token=None):
+  def _NotificationValues(self, notifications):
+    """Returns the MultiSet values storing the given notifications."""
     values = {}
     for notification in notifications:
       values[self.NOTIFY_PREDICATE_TEMPLATE % notification.session_id] = [
           (notification.SerializeToString(), notification.timestamp)
       ]
+    return values
+
+  def CreateNotifications(self, queue_shard, notifications, token=None):
+    values = self._NotificationValues(notifications)
     self.MultiSet(queue_shard, values, replace=False, sync=True, token=token)
+    NOTIFICATION_WAKEUP.Publish([queue_shard], token=token)
 
   def DeleteNotifications(self,
                           queue_shards,
@@ -908,6 +1057,57 @@ class DataStore(object):
         yield (rdf_flows.RequestState.FromSerializedString(serialized),
                rdf_flows.GrrMessage.FromSerializedString(status[request_id]))
 
+  def MultiReadCompletedRequests(self, timestamps, limit=None, token=None):
+    """Fetches the requests with a status message queued for many flows.
+
+    Args:
+      timestamps: A dict mapping session ids to the (start, end) time range to
+        read for this flow.
+      limit: The total number of requests and statuses to read.
+      token: A data store token.
+
+    Returns:
+      A dict mapping the session ids to lists of (request, status) tuples in
+      request id order.
+    """
+    subjects = {}
+    for session_id in timestamps:
+      subjects[utils.SmartUnicode(session_id.Add("state"))] = session_id
+
+    start = min(int(start) for start, _ in timestamps.itervalues())
+    end = max(int(end) for _, end in timestamps.itervalues())
+
+    result = {}
+    for subject, values in self.MultiResolvePrefix(
+        subjects, [self.FLOW_REQUEST_PREFIX, self.FLOW_STATUS_PREFIX],
+        timestamp=(start, end),
+        limit=limit,
+        token=token):
+      session_id = subjects[utils.SmartUnicode(subject)]
+      session_start, session_end = timestamps[session_id]
+
+      requests = {}
+      status = {}
+      for predicate, serialized, ts in values:
+        if not int(session_start) <= ts <= int(session_end):
+          continue
+
+        parts = predicate.split(":", 3)
+        request_id = parts[2]
+        if parts[1] == "status":
+          status[request_id] = serialized
+        else:
+          requests[request_id] = serialized
+
+      result[session_id] = [
+          (rdf_flows.RequestState.FromSerializedString(serialized),
+           rdf_flows.GrrMessage.FromSerializedString(status[request_id]))
+          for request_id, serialized in sorted(requests.items())
+          if request_id in status
+      ]
+
+    return result
+
   def ReadResponsesForRequestId(self,
                                 session_id,
                                 request_id,
@@ -1189,6 +1389,13 @@ class DataStore(object):
   # suffix is stored as the value.
   COLLECTION_INDEX_ATTRIBUTE_PREFIX = "index:sc_"
 
+  # An attribute named "index:count_<b>_<s>" holds the number of records with
+  # timestamps in the bucket starting at <b> that were added by the process
+  # using the shard id <s>. "index:count" holds the exact number of records
+  # older than its timestamp.
+  COLLECTION_COUNT_ATTRIBUTE = "index:count"
+  COLLECTION_COUNTER_PREFIX = "index:count_"
+
   # The attribute prefix to use when storing the index of stored types
   # for multi type collections.
   COLLECTION_VALUE_TYPE_PREFIX = "aff4:value_type_"
@@ -1206,6 +1413,15 @@ class DataStore(object):
     result_urn = urn.Add(subpath).Add("%016x.%06x" % (timestamp, suffix))
     return (result_urn, timestamp, suffix)
 
+  def _CollectionAfterURN(self, collection_id, after_timestamp, after_suffix):
+    if not after_timestamp:
+      return None
+    return utils.SmartStr(
+        self.CollectionMakeURN(
+            collection_id,
+            after_timestamp,
+            suffix=after_suffix or self.COLLECTION_MAX_SUFFIX)[0])
+
   def CollectionScanItems(self,
                           collection_id,
                           rdf_type,
@@ -1213,13 +1429,22 @@ class DataStore(object):
                           after_suffix=None,
                           limit=None,
                           token=None):
-    after_urn = None
-    if after_timestamp:
-      after_urn = utils.SmartStr(
-          self.CollectionMakeURN(
-              collection_id,
-              after_timestamp,
-              suffix=after_suffix or self.COLLECTION_MAX_SUFFIX)[0])
+    """Scans the items of a collection.
+
+    Args:
+      collection_id: ID of the collection to scan.
+      rdf_type: The type of the items. If None, the serialized items are
+                returned without decoding them.
+      after_timestamp: If set, only items after this timestamp are returned.
+      after_suffix: The suffix of the item at after_timestamp.
+      limit: The maximum number of items to return.
+      token: Datastore token.
+
+    Yields:
+      Tuples (item, timestamp, suffix).
+    """
+    after_urn = self._CollectionAfterURN(collection_id, after_timestamp,
+                                         after_suffix)
 
     for subject, timestamp, serialized_rdf_value in self.ScanAttribute(
         collection_id.Add("Results"),
@@ -1227,12 +1452,33 @@ class DataStore(object):
         after_urn=after_urn,
         max_records=limit,
         token=token):
-      item = rdf_type.FromSerializedString(serialized_rdf_value)
-      item.age = timestamp
+      if rdf_type is None:
+        item = serialized_rdf_value
+      else:
+        item = rdf_type.FromSerializedString(serialized_rdf_value)
+        item.age = timestamp
       # The urn is timestamp.suffix where suffix is 6 hex digits.
       suffix = int(subject[-6:], 16)
       yield (item, timestamp, suffix)
 
+  def CollectionScanKeys(self,
+                         collection_id,
+                         after_timestamp=None,
+                         after_suffix=None,
+                         limit=None,
+                         token=None):
+    """Like CollectionScanItems but yields (timestamp, suffix) tuples only."""
+    after_urn = self._CollectionAfterURN(collection_id, after_timestamp,
+                                         after_suffix)
+
+    for subject, timestamp in self.ScanAttributeKeys(
+        collection_id.Add("Results"),
+        self.COLLECTION_ATTRIBUTE,
+        after_urn=after_urn,
+        max_records=limit,
+        token=token):
+      yield (timestamp, int(subject[-6:], 16))
+
   def CollectionReadIndex(self, collection_id, token=None):
     """Reads all index entries for the given collection.
 
@@ -1249,6 +1495,36 @@ class DataStore(object):
       i = int(attr[len(self.COLLECTION_INDEX_ATTRIBUTE_PREFIX):], 16)
       yield (i, ts, int(value, 16))
 
+  @classmethod
+  def CollectionCounterAttribute(cls, bucket, shard):
+    return "%s%016x_%s" % (cls.COLLECTION_COUNTER_PREFIX, bucket, shard)
+
+  def CollectionReadCounters(self, collection_id, token=None):
+    """Reads the record counters of the given collection.
+
+    Args:
+      collection_id: ID of the collection for which the counters should be
+                     retrieved.
+      token: Datastore token.
+
+    Returns:
+      A tuple (count, timestamp, counters). count is the exact number of
+      records older than timestamp, or None if it was never stored. counters
+      is a list of (bucket, shard, count) tuples.
+    """
+    count = None
+    timestamp = 0
+    counters = []
+    for (attr, value, ts) in self.ResolvePrefix(
+        collection_id, self.COLLECTION_COUNT_ATTRIBUTE, token=token):
+      if attr == self.COLLECTION_COUNT_ATTRIBUTE:
+        count = int(value)
+        timestamp = ts
+      elif attr.startswith(self.COLLECTION_COUNTER_PREFIX):
+        bucket, shard = attr[len(self.COLLECTION_COUNTER_PREFIX):].split("_", 1)
+        counters.append((int(bucket, 16), shard, int(value)))
+    return count, timestamp, counters
+
   def CollectionReadStoredTypes(self, collection_id, token=None):
     for attribute, _, _ in self.ResolveRow(collection_id, token=token):
       if attribute.startswith(self.COLLECTION_VALUE_TYPE_PREFIX):
@@ -1327,6 +1603,600 @@ class DBSubjectLock(object):
       pass
 
 
+class SubjectCache(object):
+  """A process local cache of resolved subject rows.
+
+  Only subjects fully matching one of the configured patterns are cached. A
+  pattern can be followed by "=<seconds>" to set the ttl of its subjects, the
+  first matching pattern wins and a ttl of 0 excludes its subjects from the
+  cache. Rows are cached per subject, attribute prefix and timestamp, they
+  expire ttl seconds after they were read and the least recently used rows are
+  evicted once the cached rows exceed max_size bytes.
+  """
+
+  PATTERN_TTL_RE = re.compile(r"^(.*)=([0-9]+)$")
+
+  def __init__(self, patterns, max_size=64 * 1024 * 1024, ttl=10):
+    self.patterns = []
+    for pattern in patterns:
+      match = self.PATTERN_TTL_RE.match(pattern)
+      if match:
+        pattern, pattern_ttl = match.group(1), int(match.group(2))
+      else:
+        pattern_ttl = ttl
+      self.patterns.append((re.compile("(?:%s)$" % pattern), pattern_ttl))
+
+    self.max_size = max_size
+    self.size = 0
+    self.lock = threading.RLock()
+    # Maps (subject, attribute prefixes, timestamp) keys to (expiry time,
+    # values, size) tuples.
+    self._rows = collections.OrderedDict()
+    # Maps subjects to the keys of their cached rows.
+    self._keys = {}
+    # Subjects currently being read from the data store and whether they were
+    # written to while the read was in progress.
+    self._reading = {}
+    self._stale = set()
+
+  def GetTTL(self, subject):
+    """Returns the ttl of the rows of subject, 0 if they are not cached."""
+    for pattern, ttl in self.patterns:
+      if pattern.match(subject):
+        return ttl
+    return 0
+
+  def IsCacheable(self, subject):
+    return self.GetTTL(subject) > 0
+
+  @utils.Synchronized
+  def Get(self, subject, attribute_prefix, timestamp):
+    """Returns a copy of the cached values, raises KeyError on a miss."""
+    key = (subject, attribute_prefix, timestamp)
+    row = self._rows.get(key)
+    if row is None or row[0] < time.time():
+      self._Remove(key)
+      stats.STATS.IncrementCounter("datastore_subject_cache_misses")
+      raise KeyError(subject)
+
+    # Reinserting marks the row as the most recently used one.
+    del self._rows[key]
+    self._rows[key] = row
+    stats.STATS.IncrementCounter("datastore_subject_cache_hits")
+    return list(row[1])
+
+  @utils.Synchronized
+  def StartRead(self, subjects):
+    for subject in subjects:
+      self._reading[subject] = self._reading.get(subject, 0) + 1
+
+  @utils.Synchronized
+  def FinishRead(self, subjects):
+    for subject in subjects:
+      self._reading[subject] -= 1
+      if not self._reading[subject]:
+        del self._reading[subject]
+        self._stale.discard(subject)
+
+  @utils.Synchronized
+  def Put(self, subject, attribute_prefix, timestamp, values):
+    """Caches the values read for a subject since the last StartRead()."""
+    if subject in self._stale:
+      # The subject was written while we were reading it.
+      return
+
+    ttl = self.GetTTL(subject)
+    if not ttl:
+      return
+
+    key = (subject, attribute_prefix, timestamp)
+    self._Remove(key)
+    size = len(subject) + sum(len(prefix) for prefix in attribute_prefix)
+    for attribute, value, _ in values:
+      size += len(attribute) + 8
+      size += len(value) if isinstance(value, basestring) else 8
+    if size > self.max_size:
+      return
+
+    self._rows[key] = (time.time() + ttl, list(values), size)
+    self._keys.setdefault(subject, set()).add(key)
+    self.size += size
+    while self.size > self.max_size:
+      # The first row is the least recently used one.
+      self._Remove(next(iter(self._rows)))
+      stats.STATS.IncrementCounter("datastore_subject_cache_evictions")
+
+  @utils.Synchronized
+  def Invalidate(self, subjects):
+    for subject in subjects:
+      subject = utils.SmartUnicode(subject)
+      if subject in self._reading:
+        self._stale.add(subject)
+
+      keys = self._keys.get(subject)
+      if keys:
+        for key in list(keys):
+          self._Remove(key)
+        stats.STATS.IncrementCounter("datastore_subject_cache_invalidations")
+
+  def _Remove(self, key):
+    row = self._rows.pop(key, None)
+    if row is None:
+      return
+
+    self.size -= row[2]
+    subject_keys = self._keys[key[0]]
+    subject_keys.discard(key)
+    if not subject_keys:
+      del self._keys[key[0]]
+
+  @utils.Synchronized
+  def Flush(self):
+    self._rows.clear()
+    self._keys.clear()
+    self.size = 0
+
+
+class SubjectCachingDataStore(object):
+  """Wraps a data store with a read-through cache of subject rows.
+
+  MultiResolvePrefix() calls reading the newest or all values of cacheable
+  subjects are served from a SubjectCache. All writes made through this object
+  invalidate the rows of the subjects they modify once they return, so
+  asynchronous writes might only become visible after the cache ttl.
+
+  The generic DataStore methods the wrapped data store does not override, e.g.
+  CreateNotifications() or CollectionAddItem(), are run against this object
+  so the writes they make invalidate the cache as well. Everything else is
+  passed through to the wrapped data store.
+  """
+
+  # Generic methods that set up the wrapped data store itself.
+  _NOT_REBOUND = frozenset(
+      ["Initialize", "InitializeBlobstore", "InitializeMonitorThread"])
+
+  def __init__(self, db, subject_cache):
+    self.db = db
+    self.subject_cache = subject_cache
+
+  def __getattr__(self, name):
+    generic_method = DataStore.__dict__.get(name)
+    if isinstance(generic_method,
+                  types.FunctionType) and name not in self._NOT_REBOUND:
+      method = getattr(type(self.db), name, None)
+      if getattr(method, "im_func", None) is generic_method:
+        return generic_method.__get__(self, type(self))
+
+    return getattr(self.db, name)
+
+  def MultiResolvePrefix(self,
+                         subjects,
+                         attribute_prefix,
+                         timestamp=None,
+                         limit=None,
+                         token=None):
+    """Resolves prefixes, serving cacheable subjects from the cache."""
+    if limit or timestamp not in (None, self.db.NEWEST_TIMESTAMP):
+      return self.db.MultiResolvePrefix(
+          subjects,
+          attribute_prefix,
+          timestamp=timestamp,
+          limit=limit,
+          token=token)
+
+    return self._CachedMultiResolvePrefix(subjects, attribute_prefix, timestamp,
+                                          token)
+
+  def _CachedMultiResolvePrefix(self, subjects, attribute_prefix, timestamp,
+                                token):
+    """Yields rows from the cache and reads the missing ones."""
+    if isinstance(attribute_prefix, basestring):
+      prefix_key = (attribute_prefix,)
+    else:
+      prefix_key = tuple(attribute_prefix)
+
+    to_read = []
+    cacheable = {}
+    for subject in subjects:
+      unicode_subject = utils.SmartUnicode(subject)
+      if not self.subject_cache.IsCacheable(unicode_subject):
+        to_read.append(subject)
+        continue
+
+      try:
+        values = self.subject_cache.Get(unicode_subject, prefix_key, timestamp)
+        if values:
+          yield subject, values
+      except KeyError:
+        to_read.append(subject)
+        cacheable[unicode_subject] = subject
+
+    if not to_read:
+      return
+
+    reading = list(cacheable)
+    self.subject_cache.StartRead(reading)
+    try:
+      for subject, values in self.db.MultiResolvePrefix(
+          to_read, attribute_prefix, timestamp=timestamp, token=token):
+        unicode_subject = utils.SmartUnicode(subject)
+        if cacheable.pop(unicode_subject, None) is not None:
+          self.subject_cache.Put(unicode_subject, prefix_key, timestamp,
+                                 values)
+        yield subject, values
+
+      # Subjects that were not returned have no values at all.
+      for unicode_subject in cacheable:
+        self.subject_cache.Put(unicode_subject, prefix_key, timestamp, [])
+    finally:
+      self.subject_cache.FinishRead(reading)
+
+  def Set(self,
+          subject,
+          attribute,
+          value,
+          timestamp=None,
+          token=None,
+          replace=True,
+          sync=True):
+    try:
+      self.db.Set(
+          subject,
+          attribute,
+          value,
+          timestamp=timestamp,
+          token=token,
+          replace=replace,
+          sync=sync)
+    finally:
+      self.subject_cache.Invalidate([subject])
+
+  def MultiSet(self,
+               subject,
+               values,
+               timestamp=None,
+               replace=True,
+               sync=True,
+               to_delete=None,
+               token=None):
+    try:
+      self.db.MultiSet(
+          subject,
+          values,
+          timestamp=timestamp,
+          replace=replace,
+          sync=sync,
+          to_delete=to_delete,
+          token=token)
+    finally:
+      self.subject_cache.Invalidate([subject])
+
+  def DeleteAttributes(self,
+                       subject,
+                       attributes,
+                       start=None,
+                       end=None,
+                       sync=True,
+                       token=None):
+    try:
+      self.db.DeleteAttributes(
+          subject, attributes, start=start, end=end, sync=sync, token=token)
+    finally:
+      self.subject_cache.Invalidate([subject])
+
+  def MultiDeleteAttributes(self,
+                            subjects,
+                            attributes,
+                            start=None,
+                            end=None,
+                            sync=True,
+                            token=None):
+    try:
+      self.db.MultiDeleteAttributes(
+          subjects, attributes, start=start, end=end, sync=sync, token=token)
+    finally:
+      self.subject_cache.Invalidate(subjects)
+
+  def DeleteSubject(self, subject, sync=False, token=None):
+    try:
+      self.db.DeleteSubject(subject, sync=sync, token=token)
+    finally:
+      self.subject_cache.Invalidate([subject])
+
+  def DeleteSubjects(self, subjects, sync=False, token=None):
+    try:
+      self.db.DeleteSubjects(subjects, sync=sync, token=token)
+    finally:
+      self.subject_cache.Invalidate(subjects)
+
+  def ApplyMutations(self, mutation_pool, sync=False, token=None):
+    subjects = list(mutation_pool.delete_subject_requests)
+    subjects.extend(req[0] for req in mutation_pool.delete_attributes_requests)
+    subjects.extend(req[0] for req in mutation_pool.set_requests)
+    subjects.extend(queue for queue, _ in mutation_pool.new_notifications)
+    try:
+      self.db.ApplyMutations(mutation_pool, sync=sync, token=token)
+    finally:
+      self.subject_cache.Invalidate(subjects)
+
+
+class NotificationListener(object):
+  """Waits for wakeups of a set of queue shards.
+
+  Listeners receive all wakeups published after they were created, so they
+  have to be created before the shards are checked for notifications:
+
+    with NOTIFICATION_WAKEUP.Listen(queue_shards) as listener:
+      while True:
+        ...process notifications...
+        listener.Wait(timeout)
+  """
+
+  def __init__(self, queue_shards):
+    self.queue_shards = set(rdfvalue.RDFURN(shard) for shard in queue_shards)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.Close()
+
+  def Close(self):
+    pass
+
+  def Wait(self, timeout):
+    """Waits until one of the shards is woken up or the timeout passes.
+
+    Args:
+      timeout: The maximum number of seconds to wait.
+
+    Returns:
+      The set of queue shards woken up since the last call, empty on timeout.
+    """
+    raise NotImplementedError()
+
+
+class NotificationWakeup(object):
+  """Wakes up workers waiting for notifications on queue shards.
+
+  Data stores publish the queue shards they wrote notifications to once the
+  notifications are stored, so woken up workers always find them. Wakeups are
+  best effort, workers still poll their shards when waiting times out.
+  """
+
+  __metaclass__ = registry.MetaclassRegistry
+
+  def Publish(self, queue_shards, token=None):
+    """Signals that the given queue shards have new notifications."""
+    raise NotImplementedError()
+
+  def Listen(self, queue_shards, token=None):
+    """Returns a NotificationListener for the given queue shards."""
+    raise NotImplementedError()
+
+
+class _InProcessNotificationListener(NotificationListener):
+  """A listener of the InProcessNotificationWakeup."""
+
+  def __init__(self, wakeup, queue_shards):
+    super(_InProcessNotificationListener, self).__init__(queue_shards)
+    self.wakeup = wakeup
+    self.event = threading.Event()
+    self.lock = threading.Lock()
+    self.woken = set()
+    self.wakeup.Register(self)
+
+  def Close(self):
+    self.wakeup.Unregister(self)
+
+  def Wake(self, queue_shards):
+    with self.lock:
+      self.woken.update(queue_shards)
+      self.event.set()
+
+  def Wait(self, timeout):
+    self.event.wait(timeout)
+    with self.lock:
+      self.event.clear()
+      woken, self.woken = self.woken, set()
+    return woken
+
+
+class InProcessNotificationWakeup(NotificationWakeup):
+  """Wakes up listeners in the publishing process only."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.listeners = set()
+
+  def Register(self, listener):
+    with self.lock:
+      self.listeners.add(listener)
+
+  def Unregister(self, listener):
+    with self.lock:
+      self.listeners.discard(listener)
+
+  def Listen(self, queue_shards, token=None):
+    return _InProcessNotificationListener(self, queue_shards)
+
+  def Publish(self, queue_shards, token=None):
+    if not self.listeners:
+      return
+
+    queue_shards = set(rdfvalue.RDFURN(shard) for shard in queue_shards)
+    with self.lock:
+      listeners = list(self.listeners)
+
+    for listener in listeners:
+      woken = listener.queue_shards & queue_shards
+      if woken:
+        listener.Wake(woken)
+
+
+class _LocalSocketNotificationListener(NotificationListener):
+  """A listener of the LocalSocketNotificationWakeup."""
+
+  def __init__(self, socket_dir, queue_shards):
+    super(_LocalSocketNotificationListener, self).__init__(queue_shards)
+    self.path = os.path.join(socket_dir, self._SocketName())
+    # The name contains our pid, so a socket of that name was left behind by
+    # a crashed process that had the same pid and can be removed.
+    try:
+      os.unlink(self.path)
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+    self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self.socket.bind(self.path)
+    self.socket.setblocking(False)
+
+  def _SocketName(self):
+    return "%d.%x.sock" % (os.getpid(), id(self))
+
+  def Close(self):
+    self.socket.close()
+    try:
+      os.unlink(self.path)
+    except OSError:
+      pass
+
+  def _Receive(self):
+    """Returns the shards of all pending wakeups this listener cares about."""
+    woken = set()
+    while True:
+      try:
+        data = self.socket.recv(65536)
+      except socket.error as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+          break
+        raise
+      woken.update(rdfvalue.RDFURN(shard) for shard in data.split("\n"))
+
+    return woken & self.queue_shards
+
+  def Wait(self, timeout):
+    deadline = time.time() + timeout
+    while True:
+      woken = self._Receive()
+      remaining = deadline - time.time()
+      if woken or remaining <= 0:
+        return woken
+
+      try:
+        select.select([self.socket], [], [], remaining)
+      except select.error as e:
+        # A signal interrupted the wait.
+        if e.args[0] != errno.EINTR:
+          raise
+
+
+class LocalSocketNotificationWakeup(NotificationWakeup):
+  """Wakes up listeners of all processes on this host.
+
+  Every listener binds a unix datagram socket in
+  Worker.notification_wakeup_socket_dir and publishing sends the woken shards
+  to all of these sockets.
+  """
+
+  def __init__(self, socket_dir=None):
+    self.socket_dir = (socket_dir or
+                       config.CONFIG["Worker.notification_wakeup_socket_dir"])
+    if not os.path.isdir(self.socket_dir):
+      os.makedirs(self.socket_dir)
+
+    self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self.socket.setblocking(False)
+
+  def Listen(self, queue_shards, token=None):
+    return _LocalSocketNotificationListener(self.socket_dir, queue_shards)
+
+  def Publish(self, queue_shards, token=None):
+    message = "\n".join(utils.SmartStr(shard) for shard in queue_shards)
+    try:
+      names = os.listdir(self.socket_dir)
+    except OSError:
+      return
+
+    for name in names:
+      path = os.path.join(self.socket_dir, name)
+      try:
+        self.socket.sendto(message, path)
+      except socket.error as e:
+        if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+          # The listener is gone without cleaning up.
+          try:
+            os.unlink(path)
+          except OSError:
+            pass
+        # On EAGAIN the listener has not read earlier wakeups yet, it will
+        # look at all shards anyways.
+
+
+class _DataStoreNotificationListener(NotificationListener):
+  """A listener of the DataStoreNotificationWakeup."""
+
+  def __init__(self, queue_shards, poll_interval, token=None):
+    super(_DataStoreNotificationListener, self).__init__(queue_shards)
+    self.poll_interval = poll_interval
+    self.token = token
+    self.last_wakeups = self._ReadWakeups()
+
+  def _ReadWakeups(self):
+    result = dict.fromkeys(self.queue_shards, 0)
+    for subject, values in DB.MultiResolvePrefix(
+        self.queue_shards,
+        DataStoreNotificationWakeup.WAKEUP_ATTRIBUTE,
+        timestamp=DB.NEWEST_TIMESTAMP,
+        token=self.token):
+      for _, _, ts in values:
+        result[rdfvalue.RDFURN(subject)] = ts
+    return result
+
+  def Wait(self, timeout):
+    deadline = time.time() + timeout
+    while True:
+      wakeups = self._ReadWakeups()
+      woken = set(shard for shard, ts in wakeups.iteritems()
+                  if ts > self.last_wakeups[shard])
+      self.last_wakeups = wakeups
+
+      remaining = deadline - time.time()
+      if woken or remaining <= 0:
+        return woken
+
+      time.sleep(min(self.poll_interval, remaining))
+
+
+class DataStoreNotificationWakeup(NotificationWakeup):
+  """Wakes up listeners on any host through the data store.
+
+  Publishing writes a marker attribute to each woken queue shard. Listeners
+  read these markers every Worker.notification_wakeup_poll_interval seconds,
+  which is a single cell per shard instead of all its notifications.
+  """
+
+  WAKEUP_ATTRIBUTE = "metadata:notification_wakeup"
+
+  def Listen(self, queue_shards, token=None):
+    return _DataStoreNotificationListener(
+        queue_shards,
+        config.CONFIG["Worker.notification_wakeup_poll_interval"],
+        token=token)
+
+  def Publish(self, queue_shards, token=None):
+    # The markers have to be written right away, buffered writes only become
+    # visible to other hosts once the data store is flushed.
+    pool = DB.GetMutationPool(token=token)
+    for shard in queue_shards:
+      pool.Set(shard, self.WAKEUP_ATTRIBUTE, 1)
+    DB.ApplyMutations(pool, sync=True, token=token)
+
+
+# The wakeup channel used for new notifications, set up by DataStoreInit.
+NOTIFICATION_WAKEUP = InProcessNotificationWakeup()
+
+
 class DataStoreInit(registry.InitHook):
   """Initialize the data store.
 
@@ -1340,6 +2210,7 @@ class DataStoreInit(registry.InitHook):
   def Run(self):
     """Initialize the data_store."""
     global DB  # pylint: disable=global-statement
+    global NOTIFICATION_WAKEUP  # pylint: disable=global-statement
 
     if flags.FLAGS.list_storage:
       self._ListStorageOptions()
@@ -1357,7 +2228,21 @@ class DataStoreInit(registry.InitHook):
 
     DB = cls()  # pylint: disable=g-bad-name
     DB.Initialize()
+
+    cache_patterns = config.CONFIG["Datastore.subject_cache_patterns"]
+    if cache_patterns:
+      DB = SubjectCachingDataStore(DB,
+                                   SubjectCache(
+                                       cache_patterns,
+                                       max_size=config.CONFIG[
+                                           "Datastore.subject_cache_size"],
+                                       ttl=config.CONFIG[
+                                           "Datastore.subject_cache_ttl"]))
     atexit.register(DB.Flush)
+
+    NOTIFICATION_WAKEUP = NotificationWakeup.GetPlugin(
+        config.CONFIG["Worker.notification_wakeup"])()
+
     monitor_port = config.CONFIG["Monitoring.http_port"]
     if monitor_port != 0:
       stats.STATS.RegisterGaugeMetric(
@@ -1371,3 +2256,7 @@ class DataStoreInit(registry.InitHook):
     """Initialize some Varz."""
     stats.STATS.RegisterCounterMetric("grr_commit_failure")
     stats.STATS.RegisterCounterMetric("datastore_retries")
+    stats.STATS.RegisterCounterMetric("datastore_subject_cache_hits")
+    stats.STATS.RegisterCounterMetric("datastore_subject_cache_misses")
+    stats.STATS.RegisterCounterMetric("datastore_subject_cache_evictions")
+    stats.STATS.RegisterCounterMetric("datastore_subject_cache_invalidations")
@@ -881,6 +881,44 @@ class _DataStoreTest(test_lib.GRRBaseTest):
     ]
     self.assertEqual(sorted(values), ["h1", "h2", "h3", "h4", "h5", "h6", "h7"])
 
+  def testScanAttributeKeys(self):
+    data_store.DB.Set("aff4:/A", "aff4:foo", "A value", token=self.token)
+    for i in range(1, 10):
+      data_store.DB.Set(
+          "aff4:/B/" + str(i),
+          "aff4:foo",
+          "B " + str(i) + " value",
+          timestamp=2000 + i,
+          token=self.token)
+      data_store.DB.Set(
+          "aff4:/B/" + str(i),
+          "aff4:foo",
+          "B " + str(i) + " older value",
+          timestamp=1900,
+          token=self.token,
+          replace=False)
+    # Something with a different attribute, which should not be included.
+    data_store.DB.Set(
+        "aff4:/B/1.1",
+        "aff4:foo2",
+        "B 1.1 other value",
+        timestamp=2000,
+        token=self.token)
+
+    keys = list(
+        data_store.DB.ScanAttributeKeys(
+            "aff4:/B", "aff4:foo", token=self.token))
+    self.assertEqual(keys, [("aff4:/B/%d" % i, 2000 + i) for i in range(1, 10)])
+
+    keys = list(
+        data_store.DB.ScanAttributeKeys(
+            "aff4:/B",
+            "aff4:foo",
+            after_urn="aff4:/B/2",
+            max_records=2,
+            token=self.token))
+    self.assertEqual(keys, [("aff4:/B/3", 2003), ("aff4:/B/4", 2004)])
+
   def testScanAttributes(self):
     for i in range(0, 7):
       data_store.DB.Set(
@@ -1073,6 +1111,34 @@ class _DataStoreTest(test_lib.GRRBaseTest):
 
     t1.Release()
 
+  @DBSubjectLockTest
+  def testMultiDBSubjectLock(self):
+    subjects = [u"aff4:/metadata:rowÎñţér%d" % i for i in range(3)]
+
+    with data_store.DB.DBSubjectLock(
+        subjects[1], lease_time=100, token=self.token):
+      locks = data_store.DB.MultiDBSubjectLock(
+          subjects, lease_time=100, token=self.token)
+      # The subject which is locked already is skipped.
+      self.assertEqual(sorted(locks), [subjects[0], subjects[2]])
+
+      self.assertRaises(
+          data_store.DBSubjectLockError,
+          data_store.DB.DBSubjectLock,
+          subjects[0],
+          lease_time=100,
+          token=self.token)
+
+      for lock in locks.values():
+        lock.Release()
+
+    # Released locks can be taken again.
+    locks = data_store.DB.MultiDBSubjectLock(
+        subjects, lease_time=100, token=self.token)
+    self.assertEqual(sorted(locks), subjects)
+    for lock in locks.values():
+      lock.Release()
+
   @DBSubjectLockTest
   def testDBSubjectLockLease(self):
     # This needs to be current time or cloud bigtable server will reply with
@@ -1621,12 +1687,15 @@ class _DataStoreTest(test_lib.GRRBaseTest):
   def testApi(self):
     # pyformat: disable
     api = [
+        "ApplyMutations",
         "BlobExists",
         "BlobsExist",
         "CheckRequestsForCompletion",
+        "CollectionReadCounters",
         "CollectionReadIndex",
         "CollectionReadStoredTypes",
         "CollectionScanItems",
+        "CollectionScanKeys",
         "CreateNotifications",
         "DBSubjectLock",
         "DeleteAttributes",
@@ -1659,6 +1728,7 @@ class _DataStoreTest(test_lib.GRRBaseTest):
         "ResolveMulti",
         "ResolvePrefix",
         "ScanAttribute",
+        "ScanAttributeKeys",
         "ScanAttributes",
         "Set",
         "StoreBlob",
@@ -1670,6 +1740,9 @@ class _DataStoreTest(test_lib.GRRBaseTest):
         "CollectionAddIndex",
         "CollectionAddItem",
         "CollectionAddStoredTypeIndex",
+        "CollectionDeleteCounters",
+        "CollectionSetCount",
+        "CollectionUpdateCounter",
         "CreateNotifications",
         "DeleteAttributes",
         "DeleteSubject",
@@ -1792,6 +1865,51 @@ class _DataStoreTest(test_lib.GRRBaseTest):
         self.test_row, predicate, token=self.token)
     self.assertIsNone(stored)
 
+  @DeletionTest
+  def testPoolAppliesMutationsAcrossSubjects(self):
+    predicate = "metadata:predicate"
+    rows = [self.test_row + str(i) for i in range(4)]
+    for row in rows:
+      data_store.DB.Set(row, predicate, "old", token=self.token)
+
+    queue = rdfvalue.RDFURN("aff4:/notifications")
+    session_id = rdfvalue.SessionID(flow_name="test")
+
+    pool = data_store.DB.GetMutationPool(token=self.token)
+    pool.DeleteSubject(rows[0])
+    pool.DeleteAttributes(rows[1], [predicate])
+    pool.Set(rows[2], predicate, "first")
+    pool.Set(rows[2], predicate, "second")
+    pool.Set(rows[3], predicate, "added", timestamp=1000, replace=False)
+    pool.CreateNotifications(queue, [
+        rdf_flows.GrrNotification(session_id=session_id, timestamp=100)
+    ])
+    pool.Flush()
+
+    self.assertIsNone(
+        data_store.DB.Resolve(rows[0], predicate, token=self.token)[0])
+    self.assertIsNone(
+        data_store.DB.Resolve(rows[1], predicate, token=self.token)[0])
+
+    values = data_store.DB.ResolvePrefix(
+        rows[2],
+        predicate,
+        timestamp=data_store.DB.ALL_TIMESTAMPS,
+        token=self.token)
+    self.assertEqual([value for _, value, _ in values], ["second"])
+
+    values = data_store.DB.ResolvePrefix(
+        rows[3],
+        predicate,
+        timestamp=data_store.DB.ALL_TIMESTAMPS,
+        token=self.token)
+    self.assertItemsEqual([value for _, value, _ in values], ["old", "added"])
+
+    notifications = list(
+        data_store.DB.GetNotifications(queue, 200, token=self.token))
+    self.assertEqual(len(notifications), 1)
+    self.assertEqual(notifications[0].session_id, session_id)
+
   def testQueueManager(self):
     session_id = rdfvalue.SessionID(flow_name="test")
     client_id = rdf_client.ClientURN("C.1000000000000000")
@@ -2602,6 +2720,19 @@ class DataStoreBenchmarks(benchmark_test_lib.MicroBenchmarks):
 
     self.AddResult("Set attributes", (end_time - start_time) / self.n, self.n)
 
+    start_time = time.time()
+    for i in xrange(self.n):
+      data_store.DB.MultiSet(
+          subject_template % i, {"task:flow": [value],
+                                 "task:otherflow": [value]},
+          replace=True,
+          token=self.token)
+    data_store.DB.Flush()
+    end_time = time.time()
+
+    self.AddResult("Replace attributes", (end_time - start_time) / self.n,
+                   self.n)
+
     start_time = time.time()
     for i in xrange(self.n):
       data_store.DB.Set(
@@ -839,3 +839,41 @@ class CloudBigTableDataStore(data_store.DataStore):
         subject_results = self._ReOrderRowResults(row_data)
         results.append((subject, subject_results))
     return sorted(results, key=lambda x: x[0])
+
+  def ScanAttributeKeys(self,
+                        subject_prefix,
+                        attribute,
+                        after_urn=None,
+                        max_records=None,
+                        token=None):
+    subject_prefix = self._CleanSubjectPrefix(subject_prefix)
+    after_urn = self._CleanAfterURN(after_urn, subject_prefix)
+    # Turn subject prefix into an actual regex
+    subject_prefix += ".*"
+
+    # Subject AND attribute AND latest_value, without the values.
+    query_filter = row_filters.RowFilterChain([
+        row_filters.RowKeyRegexFilter(utils.SmartStr(subject_prefix)),
+        self._GetAttributeFilterUnion([attribute]),
+        row_filters.CellsColumnLimitFilter(1),
+        row_filters.StripValueTransformerFilter(True)
+    ])
+
+    if after_urn is not None:
+      after_urn += "\x00"
+
+    rows_data = self.CallWithRetry(
+        self.table.read_rows,
+        "read",
+        start_key=after_urn,
+        limit=max_records,
+        filter_=query_filter)
+    self.CallWithRetry(rows_data.consume_all, "read")
+
+    results = []
+    for subject, row_data in rows_data.rows.iteritems():
+      for column_dict in row_data.cells.itervalues():
+        for cells in column_dict.itervalues():
+          results.append(
+              (subject, self.DatetimeToMicroseconds(cells[0].timestamp)))
+    return sorted(results)
@@ -3,7 +3,14 @@
 
 
 
+import os
+import time
+
 from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import utils
+from grr.lib.rdfvalues import flows as rdf_flows
+from grr.server import data_store
 from grr.server import data_store_test
 from grr.test_lib import test_lib
 
@@ -15,6 +22,263 @@ class FakeDataStoreTest(data_store_test._DataStoreTest):
     """The fake datastore doesn't strictly conform to the api but this is ok."""
 
 
+class SubjectCachingDataStoreTest(test_lib.GRRBaseTest):
+  """Test the subject cache in front of the fake data store."""
+
+  client_row = "aff4:/C.0000000000000001"
+
+  def setUp(self):
+    super(SubjectCachingDataStoreTest, self).setUp()
+    self.cache = data_store.SubjectCache(
+        [r"aff4:/C\.[0-9]{16}"], max_size=1024, ttl=60)
+    self.db = data_store.SubjectCachingDataStore(data_store.DB, self.cache)
+    self.db_stubber = utils.Stubber(data_store, "DB", self.db)
+    self.db_stubber.Start()
+
+  def tearDown(self):
+    self.db_stubber.Stop()
+    super(SubjectCachingDataStoreTest, self).tearDown()
+
+  def _ReadSize(self, subject):
+    for _, values in self.db.MultiResolvePrefix(
+        [subject], "aff4:", token=self.token):
+      for attribute, value, _ in values:
+        if attribute == "aff4:size":
+          return value
+
+  def _ReadNotifications(self, subject):
+    result = []
+    for _, values in self.db.MultiResolvePrefix(
+        [subject], data_store.DataStore.NOTIFY_PREDICATE_PREFIX,
+        token=self.token):
+      result.extend(values)
+    return result
+
+  def _SetSizeUncached(self, subject, size):
+    self.db.db.Set(subject, "aff4:size", size, token=self.token)
+
+  def testReadsAreCached(self):
+    self._SetSizeUncached(self.client_row, 1)
+    self.assertEqual(self._ReadSize(self.client_row), 1)
+
+    # Writes bypassing the cache are not seen until the row expires.
+    self._SetSizeUncached(self.client_row, 2)
+    self.assertEqual(self._ReadSize(self.client_row), 1)
+
+    expired = time.time() + 61
+    with utils.Stubber(time, "time", lambda: expired):
+      self.assertEqual(self._ReadSize(self.client_row), 2)
+
+  def testMissingRowsAreCached(self):
+    self.assertIsNone(self._ReadSize(self.client_row))
+    self._SetSizeUncached(self.client_row, 1)
+    self.assertIsNone(self._ReadSize(self.client_row))
+
+  def testOtherSubjectsAreNotCached(self):
+    subject = self.client_row + "/fs/os"
+    self._SetSizeUncached(subject, 1)
+    self.assertEqual(self._ReadSize(subject), 1)
+    self._SetSizeUncached(subject, 2)
+    self.assertEqual(self._ReadSize(subject), 2)
+
+  def testWritesInvalidateCachedRows(self):
+    self._SetSizeUncached(self.client_row, 1)
+    self.assertEqual(self._ReadSize(self.client_row), 1)
+
+    self.db.Set(self.client_row, "aff4:size", 2, token=self.token)
+    self.assertEqual(self._ReadSize(self.client_row), 2)
+
+    with self.db.GetMutationPool(token=self.token) as pool:
+      pool.Set(self.client_row, "aff4:size", 3)
+    self.assertEqual(self._ReadSize(self.client_row), 3)
+
+    self.db.DeleteAttributes(self.client_row, ["aff4:size"], token=self.token)
+    self.assertIsNone(self._ReadSize(self.client_row))
+
+  def testGenericMethodWritesInvalidateCachedRows(self):
+    self.assertEqual(self._ReadNotifications(self.client_row), [])
+
+    self.db.CreateNotifications(
+        self.client_row, [
+            rdf_flows.GrrNotification(
+                session_id=rdfvalue.SessionID(flow_name="Test"),
+                timestamp=rdfvalue.RDFDatetime.Now())
+        ],
+        token=self.token)
+    self.assertEqual(len(self._ReadNotifications(self.client_row)), 1)
+
+  def testRowsAreCachedPerAttributePrefix(self):
+    self._SetSizeUncached(self.client_row, 1)
+    self.assertEqual(self._ReadSize(self.client_row), 1)
+    self.assertEqual(self._ReadNotifications(self.client_row), [])
+
+    # Reading another prefix did not evict the cached row.
+    self._SetSizeUncached(self.client_row, 2)
+    self.assertEqual(self._ReadSize(self.client_row), 1)
+
+  def testRowsAreCachedPerTimestamp(self):
+    self.db.db.MultiSet(
+        self.client_row, {"aff4:size": [(1, 1000), (2, 2000)]},
+        replace=False,
+        token=self.token)
+
+    for _ in range(2):
+      newest = dict(
+          self.db.MultiResolvePrefix(
+              [self.client_row],
+              "aff4:",
+              timestamp=data_store.DB.NEWEST_TIMESTAMP,
+              token=self.token))
+      self.assertEqual([v[1] for v in newest[self.client_row]], [2])
+
+      every = dict(
+          self.db.MultiResolvePrefix(
+              [self.client_row],
+              "aff4:",
+              timestamp=data_store.DB.ALL_TIMESTAMPS,
+              token=self.token))
+      self.assertEqual(sorted(v[1] for v in every[self.client_row]), [1, 2])
+
+  def testPatternTTLs(self):
+    cache = data_store.SubjectCache(
+        ["aff4:/foreman=60", r"aff4:/C\.0{16}=0", r"aff4:/C\.[0-9]{16}"],
+        ttl=10)
+    self.assertEqual(cache.GetTTL(u"aff4:/foreman"), 60)
+    self.assertEqual(cache.GetTTL(u"aff4:/C.0000000000000001"), 10)
+    self.assertEqual(cache.GetTTL(u"aff4:/C.0000000000000000"), 0)
+    self.assertFalse(cache.IsCacheable(u"aff4:/C.0000000000000000"))
+    self.assertFalse(cache.IsCacheable(u"aff4:/foreman/rules"))
+
+    self.db.subject_cache = cache
+    self._SetSizeUncached("aff4:/foreman", 1)
+    self.assertEqual(self._ReadSize("aff4:/foreman"), 1)
+    self._SetSizeUncached("aff4:/foreman", 2)
+
+    # The foreman row outlives the default ttl.
+    expired = time.time() + 30
+    with utils.Stubber(time, "time", lambda: expired):
+      self.assertEqual(self._ReadSize("aff4:/foreman"), 1)
+
+    expired = time.time() + 61
+    with utils.Stubber(time, "time", lambda: expired):
+      self.assertEqual(self._ReadSize("aff4:/foreman"), 2)
+
+  def testCacheSizeIsBounded(self):
+    for i in range(100):
+      subject = "aff4:/C.%016d" % i
+      self._SetSizeUncached(subject, i)
+      self.assertEqual(self._ReadSize(subject), i)
+
+    self.assertLessEqual(self.cache.size, 1024)
+    # The least recently read rows were evicted.
+    self._SetSizeUncached("aff4:/C.%016d" % 0, 1000)
+    self.assertEqual(self._ReadSize("aff4:/C.%016d" % 0), 1000)
+    self._SetSizeUncached("aff4:/C.%016d" % 99, 1000)
+    self.assertEqual(self._ReadSize("aff4:/C.%016d" % 99), 99)
+
+
+class NotificationWakeupTest(test_lib.GRRBaseTest):
+  """Test the notification wakeup channels."""
+
+  shard = rdfvalue.RDFURN("aff4:/W")
+  other_shard = rdfvalue.RDFURN("aff4:/W/1")
+
+  def _Notify(self, shard):
+    with data_store.DB.GetMutationPool(token=self.token) as pool:
+      pool.CreateNotifications(shard, [
+          rdf_flows.GrrNotification(
+              session_id=rdfvalue.SessionID(flow_name="Test"),
+              timestamp=rdfvalue.RDFDatetime.Now())
+      ])
+
+  def _TestWakeup(self, wakeup):
+    with utils.Stubber(data_store, "NOTIFICATION_WAKEUP", wakeup):
+      with wakeup.Listen([self.shard], token=self.token) as listener:
+        self.assertEqual(listener.Wait(0), set())
+
+        self._Notify(self.other_shard)
+        self.assertEqual(listener.Wait(0), set())
+
+        self._Notify(self.shard)
+        self.assertEqual(listener.Wait(5), set([self.shard]))
+        # Wakeups are only returned once.
+        self.assertEqual(listener.Wait(0), set())
+
+  def testInProcessWakeup(self):
+    self._TestWakeup(data_store.InProcessNotificationWakeup())
+
+  def testLocalSocketWakeup(self):
+    self._TestWakeup(
+        data_store.LocalSocketNotificationWakeup(
+            os.path.join(self.temp_dir, "wakeup")))
+
+  def testDataStoreWakeup(self):
+    with test_lib.ConfigOverrider({
+        "Worker.notification_wakeup_poll_interval": 0.01
+    }):
+      self._TestWakeup(data_store.DataStoreNotificationWakeup())
+
+  def testDataStoreWakeupIsWrittenWithoutFlush(self):
+    buffered = []
+    db_set = data_store.DB.Set
+
+    # Like most real data stores, only write unsynced values when flushed.
+    def BufferingSet(*args, **kwargs):
+      if kwargs.get("sync", True):
+        db_set(*args, **kwargs)
+      else:
+        buffered.append((args, kwargs))
+
+    def Flush():
+      while buffered:
+        args, kwargs = buffered.pop(0)
+        kwargs["sync"] = True
+        db_set(*args, **kwargs)
+
+    wakeup = data_store.DataStoreNotificationWakeup()
+    with utils.MultiStubber((data_store.DB, "Set", BufferingSet),
+                            (data_store.DB, "Flush", Flush)):
+      with wakeup.Listen([self.shard], token=self.token) as listener:
+        wakeup.Publish([self.shard], token=self.token)
+        self.assertEqual(listener.Wait(0), set([self.shard]))
+
+    self.assertEqual(buffered, [])
+
+  def testLocalSocketListenerReplacesStaleSocket(self):
+    wakeup = data_store.LocalSocketNotificationWakeup(
+        os.path.join(self.temp_dir, "wakeup"))
+
+    # A process that crashed without removing its socket.
+    stale = wakeup.Listen([self.shard])
+    stale.socket.close()
+    self.assertTrue(os.path.exists(stale.path))
+
+    # A new listener reusing the pid of the crashed process can still bind.
+    with utils.Stubber(data_store._LocalSocketNotificationListener,
+                       "_SocketName", lambda _: os.path.basename(stale.path)):
+      with wakeup.Listen([self.shard]) as listener:
+        self.assertEqual(listener.path, stale.path)
+        wakeup.Publish([self.shard])
+        self.assertEqual(listener.Wait(5), set([self.shard]))
+
+  def testLocalSocketPublishRemovesSocketsWithoutListener(self):
+    wakeup = data_store.LocalSocketNotificationWakeup(
+        os.path.join(self.temp_dir, "wakeup"))
+
+    stale = wakeup.Listen([self.shard])
+    stale.socket.close()
+
+    wakeup.Publish([self.shard])
+    self.assertFalse(os.path.exists(stale.path))
+
+  def testListenerWaitsForTimeout(self):
+    wakeup = data_store.InProcessNotificationWakeup()
+    with wakeup.Listen([self.shard]) as listener:
+      start = time.time()
+      self.assertEqual(listener.Wait(0.1), set())
+      self.assertGreaterEqual(time.time() - start, 0.1)
+
+
 def main(args):
   test_lib.main(args)
 
@@ -4,14 +4,17 @@
 
 import base64
 import binascii
+import collections
 import httplib
 import logging
+import Queue
 import random
 import re
 import socket
 import threading
 import time
 import urlparse
+import zlib
 
 from grr import config
 from grr.lib import rdfvalue
@@ -59,8 +62,29 @@ class HTTPDataStoreError(Error):
   pass
 
 
+class _PendingRequest(object):
+  """A protocol version 2 request waiting for its responses."""
+
+  def __init__(self, request_id, command, frame):
+    self.request_id = request_id
+    self.command = command
+    self.frame = frame
+    # (response, last) tuples, the response is None if the request failed.
+    self.responses = Queue.Queue()
+    # Set once the first response arrived. Such requests can't be replayed
+    # since their responses may have been handed out already.
+    self.received = False
+    self.error = None
+
+
 class DataServerConnection(object):
-  """Represents one connection to a data server."""
+  """Represents one connection to a data server.
+
+  Connections use protocol version 2 when the data server supports it. Many
+  requests, from any number of threads, can then be in flight at once. The
+  thread waiting for a response reads the replies from the socket and hands
+  the ones for other requests to their threads.
+  """
 
   def __init__(self, server):
     self.conn = None
@@ -70,6 +94,21 @@ class DataServerConnection(object):
     # Mark pending requests and subjects that are scheduled to change on
     # the database.
     self.requests = []
+
+    self.protocol = constants.PROTOCOL_V1
+    # Only one thread at a time reads replies from a version 2 connection.
+    self.read_lock = threading.Lock()
+    # Version 2 requests waiting for their responses by request id, in the
+    # order they were sent.
+    self.in_flight = collections.OrderedDict()
+    # Version 2 requests sent by MakeRequestAndContinue() which were not
+    # synced yet.
+    self.unsynced = []
+    self.next_request_id = 0
+    # Incremented every time the connection is reestablished.
+    self.generation = 0
+    self.compression_threshold = config.CONFIG[
+        "HTTPDataStore.compression_threshold"]
     self._DoConnection()
 
   def Address(self):
@@ -78,11 +117,12 @@ class DataServerConnection(object):
   def Port(self):
     return self.server.Port()
 
-  def _ReadExactly(self, n):
+  def _ReadExactly(self, n, sock=None):
+    sock = sock or self.sock
     ret = ""
     left = n
     while left:
-      data = self.sock.recv(left)
+      data = sock.recv(left)
       if not data:
         raise IOError("Expected %d bytes, got EOF after %d" % (n, len(ret)))
       ret += data
@@ -162,6 +202,11 @@ class DataServerConnection(object):
       token = rdf_token.SerializeToString()
       # We trick HTTP here and use the underlying socket to pipeline requests.
       headers = {"Content-Length": len(token)}
+      protocol = min(config.CONFIG["HTTPDataStore.protocol_version"],
+                     constants.PROTOCOL_V2)
+      if protocol >= constants.PROTOCOL_V2:
+        # Older data servers ignore this and answer in protocol version 1.
+        headers[constants.PROTOCOL_HEADER] = str(protocol)
       self.conn.request("POST", "/client/start", token, headers)
       self.sock = self.conn.sock
       # Confirm handshake.
@@ -170,10 +215,15 @@ class DataServerConnection(object):
       ack = self._ReadExactly(3)
       if ack == "IP\n":
         raise HTTPDataStoreError("Invalid data server username/password.")
-      if ack != "OK\n":
+      if ack == constants.PROTOCOL_V2_ACK:
+        self.protocol = constants.PROTOCOL_V2
+      elif ack == constants.PROTOCOL_V1_ACK:
+        self.protocol = constants.PROTOCOL_V1
+      else:
         return False
-      logging.info("Connected to data server %s:%d", self.Address(),
-                   self.Port())
+      self.generation += 1
+      logging.info("Connected to data server %s:%d (protocol %d)",
+                   self.Address(), self.Port(), self.protocol)
       return True
     except httplib.HTTPException as e:
       logging.warning("Httplib problem when connecting to %s:%d: %s",
@@ -187,6 +237,15 @@ class DataServerConnection(object):
 
   def _ReplaySync(self):
     """Send all the requests again."""
+    if self.protocol == constants.PROTOCOL_V2:
+      return self._ReplayInFlight()
+
+    if self.in_flight:
+      self._FailInFlight(
+          HTTPDataStoreError("Data server %s:%d does not support protocol "
+                             "version 2 anymore." % (self.Address(),
+                                                     self.Port())))
+
     if self.requests:
       logging.info("Replaying the failed requests")
     while self.requests:
@@ -204,6 +263,27 @@ class DataServerConnection(object):
       self.requests.pop()
     return True
 
+  def _ReplayInFlight(self):
+    """Sends the requests in flight again on a version 2 connection."""
+    # Requests sent in protocol version 1 before the reconnection.
+    while self.requests:
+      self._AddInFlight(self.requests.pop(), unsynced=True)
+
+    for pending in self.in_flight.values():
+      if pending.received:
+        del self.in_flight[pending.request_id]
+        self._FailRequest(
+            pending,
+            HTTPDataStoreError("Lost connection to %s:%d while receiving "
+                               "results." % (self.Address(), self.Port())))
+
+    if self.in_flight:
+      logging.info("Replaying the failed requests")
+    for pending in self.in_flight.itervalues():
+      if not self._SendFrame(pending.frame):
+        return False
+    return True
+
   def _DoConnection(self):
     """Cleanups the current connection and creates another one."""
     started = time.time()
@@ -217,25 +297,75 @@ class DataServerConnection(object):
         time.sleep(config.CONFIG["HTTPDataStore.retry_time"])
       if time.time(
       ) - started >= config.CONFIG["HTTPDataStore.reconnect_timeout"]:
-        raise HTTPDataStoreError("Could not connect to %s:%d. Giving up." %
-                                 (self.Address(), self.Port()))
+        error = HTTPDataStoreError("Could not connect to %s:%d. Giving up." %
+                                   (self.Address(), self.Port()))
+        self._FailInFlight(error)
+        raise error
 
   def _RedoConnection(self):
     logging.warning("Attempt to reconnect with %s:%d",
                     self.Address(), self.Port())
     self._DoConnection()
 
-  @utils.Synchronized
   def MakeRequestAndContinue(self, command, unused_subject):
     """Make request but do not sync with the data server."""
+    if self.protocol == constants.PROTOCOL_V2:
+      self._StartRequest(command, unsynced=True)
+    else:
+      self._MakeRequestAndContinueV1(command)
+    return None
+
+  @utils.Synchronized
+  def _MakeRequestAndContinueV1(self, command):
     while not self._SendRequest(command):
       self._RedoConnection()
     self.requests.insert(0, command)
-    return None
 
-  @utils.Synchronized
   def SyncAndMakeRequest(self, command):
     """Make a request to the data server and return the response."""
+    if self.protocol == constants.PROTOCOL_V2:
+      return self._MergeResponses(self._Responses(self._StartRequest(command)))
+    return self._SyncAndMakeRequestV1(command)
+
+  def MakeRequests(self, commands):
+    """Makes many requests and returns their responses in order.
+
+    On version 2 connections all the requests are sent before waiting for the
+    first response.
+
+    Args:
+      commands: The DataStoreCommands to send.
+
+    Returns:
+      A list with the DataStoreResponse of each command.
+    """
+    if self.protocol != constants.PROTOCOL_V2:
+      return [self._SyncAndMakeRequestV1(command) for command in commands]
+
+    pending = [self._StartRequest(command) for command in commands]
+    return [self._MergeResponses(self._Responses(p)) for p in pending]
+
+  def StreamRequest(self, command):
+    """Makes a request and yields the responses as they arrive.
+
+    Version 2 data servers send the results of prefix queries and scans in
+    several responses, older ones send a single response.
+
+    Args:
+      command: The DataStoreCommand to send.
+
+    Yields:
+      DataStoreResponses.
+    """
+    if self.protocol != constants.PROTOCOL_V2:
+      yield self._SyncAndMakeRequestV1(command)
+      return
+
+    for response in self._Responses(self._StartRequest(command)):
+      yield response
+
+  @utils.Synchronized
+  def _SyncAndMakeRequestV1(self, command):
     if not self._Sync():
       # Must reconnect and resend requests.
       self._RedoConnection()
@@ -255,15 +385,150 @@ class DataServerConnection(object):
           break
     return response
 
-  @utils.Synchronized
   def Sync(self):
+    """Waits for the replies to all requests made so far."""
+    if self.protocol == constants.PROTOCOL_V2:
+      with self.lock:
+        unsynced, self.unsynced = self.unsynced, []
+
+      # Raise the first error only once all the replies were read.
+      error = None
+      for pending in unsynced:
+        try:
+          for _ in self._Responses(pending):
+            pass
+        except data_store.Error as e:
+          error = error or e
+      if error is not None:
+        raise error  # pylint: disable=raising-bad-type
+      return True
+
+    return self._SyncV1()
+
+  @utils.Synchronized
+  def _SyncV1(self):
     if self._Sync():
       return True
     self._RedoConnection()
     return self._Sync()
 
+  def _AddInFlight(self, command, unsynced=False):
+    """Assigns a request id to the command. Must hold self.lock."""
+    self.next_request_id = (self.next_request_id + 1) % (2**32)
+    frame = sutils.PackFrame(
+        self.next_request_id,
+        command.SerializeToString(),
+        compression_threshold=self.compression_threshold)
+    pending = _PendingRequest(self.next_request_id, command, frame)
+    self.in_flight[pending.request_id] = pending
+    if unsynced:
+      self.unsynced.append(pending)
+    return pending
+
+  def _StartRequest(self, command, unsynced=False):
+    """Sends a command on a version 2 connection without waiting."""
+    with self.lock:
+      pending = self._AddInFlight(command, unsynced=unsynced)
+      if not self._SendFrame(pending.frame):
+        # Reconnecting sends all the requests in flight again.
+        self._RedoConnection()
+    return pending
+
+  def _SendFrame(self, frame):
+    self.sock.settimeout(config.CONFIG["HTTPDataStore.send_timeout"])
+    try:
+      self.sock.sendall(frame)
+      return True
+    except (socket.error, socket.timeout):
+      logging.warning("Could not send request to server %s:%d",
+                      self.Address(), self.Port())
+      return False
+
+  def _Responses(self, pending):
+    """Yields the responses to a version 2 request."""
+    while True:
+      response, last = self._NextResponse(pending)
+      if response is None:
+        raise pending.error  # pylint: disable=raising-bad-type
+
+      yield CheckResponseStatus(response)
+      if last:
+        return
+
+  def _NextResponse(self, pending):
+    """Returns the next (response, last) tuple for a version 2 request."""
+    while True:
+      try:
+        return pending.responses.get_nowait()
+      except Queue.Empty:
+        pass
+
+      with self.read_lock:
+        # Another thread may have read our response while we were waiting.
+        if not pending.responses.empty():
+          continue
+
+        # The socket is only replaced under self.lock once the new connection
+        # was fully set up.
+        with self.lock:
+          sock, generation = self.sock, self.generation
+
+        try:
+          sock.settimeout(config.CONFIG["HTTPDataStore.read_timeout"])
+          header = self._ReadExactly(sutils.FRAME_PACKER.size, sock=sock)
+          length, request_id, flags = sutils.FRAME_PACKER.unpack(header)
+          reply = sutils.UnpackFramePayload(
+              self._ReadExactly(length, sock=sock), flags)
+        except (socket.error, socket.timeout, IOError, zlib.error) as e:
+          logging.warning("Cannot read reply from server %s:%d : %s",
+                          self.Address(), self.Port(), e)
+          with self.lock:
+            # Only reconnect if nobody else did in the meantime.
+            if generation == self.generation:
+              self._RedoConnection()
+          continue
+
+        self._DispatchReply(request_id, flags, reply)
+
+  def _DispatchReply(self, request_id, flags, reply):
+    last = not flags & sutils.FLAG_MORE
+    with self.lock:
+      pending = self.in_flight.get(request_id)
+      if pending is not None:
+        pending.received = True
+        if last:
+          del self.in_flight[request_id]
+
+    if pending is None:
+      logging.warning("Dropping reply to unknown request %d from %s:%d",
+                      request_id, self.Address(), self.Port())
+      return
+
+    response = rdf_data_store.DataStoreResponse.FromSerializedString(reply)
+    pending.responses.put((response, last))
+
+  def _FailRequest(self, pending, error):
+    pending.error = error
+    pending.responses.put((None, True))
+
+  def _FailInFlight(self, error):
+    """Fails all version 2 requests in flight. Must hold self.lock."""
+    for pending in self.in_flight.itervalues():
+      self._FailRequest(pending, error)
+    self.in_flight.clear()
+
+  def _MergeResponses(self, responses):
+    """Merges the chunks of a streamed response into one."""
+    result = None
+    for response in responses:
+      if result is None:
+        result = response
+      else:
+        result.results.Extend(response.results)
+    return result
+
   def NumPendingRequests(self):
-    return len(self.requests)
+    return len(self.requests) + len(self.in_flight)
 
   def Close(self):
     self.conn.close()
@@ -525,7 +790,8 @@ class HTTPDataStore(data_store.DataStore):
   def _MakeRequestsForPrefix(self, prefix, typ, request):
     cmd = rdf_data_server.DataStoreCommand(command=typ, request=request)
     for server in self.GetServersForPrefix(prefix):
-      yield server.SyncAndMakeRequest(cmd)
+      for response in server.StreamRequest(cmd):
+        yield response
 
   def DeleteAttributes(self,
                        subject,
@@ -534,6 +800,19 @@ class HTTPDataStore(data_store.DataStore):
                        end=None,
                        sync=True,
                        token=None):
+    request = self._BuildDeleteAttributesRequest(
+        subject, attributes, start=start, end=end, sync=sync, token=token)
+    typ = rdf_data_server.DataStoreCommand.Command.DELETE_ATTRIBUTES
+    self._MakeRequestSyncOrAsync(request, typ, sync)
+
+  def _BuildDeleteAttributesRequest(self,
+                                    subject,
+                                    attributes,
+                                    start=None,
+                                    end=None,
+                                    sync=True,
+                                    token=None):
+    """Builds the request for a DELETE_ATTRIBUTES command."""
     request = rdf_data_store.DataStoreRequest(subject=[subject])
 
     if isinstance(attributes, basestring):
@@ -558,16 +837,19 @@ class HTTPDataStore(data_store.DataStore):
     for attr in attributes:
       request.values.Append(attribute=attr)
 
-    typ = rdf_data_server.DataStoreCommand.Command.DELETE_ATTRIBUTES
-    self._MakeRequestSyncOrAsync(request, typ, sync)
+    return request
 
   def DeleteSubject(self, subject, sync=False, token=None):
+    request = self._BuildDeleteSubjectRequest(subject, token=token)
+    typ = rdf_data_server.DataStoreCommand.Command.DELETE_SUBJECT
+    self._MakeRequestSyncOrAsync(request, typ, sync)
+
+  def _BuildDeleteSubjectRequest(self, subject, token=None):
+    """Builds the request for a DELETE_SUBJECT command."""
     request = rdf_data_store.DataStoreRequest(subject=[subject])
     if token:
       request.token = token
-
-    typ = rdf_data_server.DataStoreCommand.Command.DELETE_SUBJECT
-    self._MakeRequestSyncOrAsync(request, typ, sync)
+    return request
 
   def _MakeRequest(self,
                    subjects,
@@ -602,6 +884,10 @@ class HTTPDataStore(data_store.DataStore):
                          token=None):
     """MultiResolvePrefix."""
     typ = rdf_data_server.DataStoreCommand.Command.MULTI_RESOLVE_PREFIX
+    if not limit:
+      return self._PipelinedMultiResolvePrefix(
+          subjects, attribute_prefix, timestamp=timestamp, token=token)
+
     results = {}
     remaining_limit = limit
     for subject in subjects:
@@ -627,6 +913,31 @@ class HTTPDataStore(data_store.DataStore):
         results[subject] = values
     return results.iteritems()
 
+  def _PipelinedMultiResolvePrefix(self,
+                                   subjects,
+                                   attribute_prefix,
+                                   timestamp=None,
+                                   token=None):
+    """MultiResolvePrefix sending the requests for each server at once."""
+    typ = rdf_data_server.DataStoreCommand.Command.MULTI_RESOLVE_PREFIX
+    by_server = collections.OrderedDict()
+    for subject in subjects:
+      request = self._MakeRequest(
+          [subject], attribute_prefix, timestamp=timestamp, token=token)
+      cmd = rdf_data_server.DataStoreCommand(command=typ, request=request)
+      by_server.setdefault(self.cache.Get(subject), []).append((subject, cmd))
+
+    results = {}
+    for server, commands in by_server.iteritems():
+      responses = server.GetConnection().MakeRequests(
+          [cmd for _, cmd in commands])
+      for (subject, _), response in zip(commands, responses):
+        if response.results:
+          results[subject] = [(pred, self._Decode(value), ts)
+                              for (pred, value, ts) in
+                              response.results[0].payload]
+    return results.iteritems()
+
   def ScanAttributes(self,
                      subject_prefix,
                      attributes,
@@ -664,6 +975,34 @@ class HTTPDataStore(data_store.DataStore):
       for r in sorted(results, key=lambda x: x[0]):
         yield r
 
+  def ScanAttributeKeys(self,
+                        subject_prefix,
+                        attribute,
+                        after_urn=None,
+                        max_records=None,
+                        token=None):
+    """ScanAttributeKeys."""
+
+    subject_prefix = utils.SmartStr(rdfvalue.RDFURN(subject_prefix))
+    if subject_prefix[-1] != "/":
+      subject_prefix += "/"
+
+    typ = rdf_data_server.DataStoreCommand.Command.SCAN_ATTRIBUTES
+    subjects = [subject_prefix]
+    if after_urn:
+      subjects.append(after_urn)
+    request = self._MakeRequest(
+        subjects, [attribute], token=token, limit=max_records)
+    request.keys_only = True
+
+    results = []
+    for response in self._MakeRequestsForPrefix(subject_prefix, typ, request):
+      for result in response.results:
+        for _, (ts, _) in result.payload:
+          results.append((result.subject, ts))
+    for r in sorted(results):
+      yield r
+
   def MultiSet(self,
                subject,
                values,
@@ -673,6 +1012,26 @@ class HTTPDataStore(data_store.DataStore):
                to_delete=None,
                token=None):
     """MultiSet."""
+    request = self._BuildMultiSetRequest(
+        subject,
+        values,
+        timestamp=timestamp,
+        replace=replace,
+        sync=sync,
+        to_delete=to_delete,
+        token=token)
+    typ = rdf_data_server.DataStoreCommand.Command.MULTI_SET
+    self._MakeRequestSyncOrAsync(request, typ, sync)
+
+  def _BuildMultiSetRequest(self,
+                            subject,
+                            values,
+                            timestamp=None,
+                            replace=True,
+                            sync=True,
+                            to_delete=None,
+                            token=None):
+    """Builds the request for a MULTI_SET command."""
     request = rdf_data_store.DataStoreRequest(sync=sync)
     token = token or data_store.default_token
     if token:
@@ -714,8 +1073,75 @@ class HTTPDataStore(data_store.DataStore):
         if v is not None:
           new_value.value.SetValue(v)
 
-    typ = rdf_data_server.DataStoreCommand.Command.MULTI_SET
-    self._MakeRequestSyncOrAsync(request, typ, sync)
+    return request
+
+  def ApplyMutations(self, mutation_pool, sync=False, token=None):
+    """Applies a mutation pool pipelining the requests to each data server.
+
+    All the requests for a data server are sent over a single connection
+    without waiting for the individual replies, the connection is only
+    synchronized once all of them have been sent.
+
+    Args:
+      mutation_pool: The MutationPool holding the operations to apply.
+      sync: Unused, mutations are always written before returning.
+      token: An ACL token.
+    """
+    _ = sync
+    token = token or data_store.default_token
+    typ = rdf_data_server.DataStoreCommand.Command
+
+    commands = []
+    for subject in mutation_pool.delete_subject_requests:
+      request = self._BuildDeleteSubjectRequest(subject, token=token)
+      commands.append((subject, typ.DELETE_SUBJECT, request))
+
+    for subject, attributes, start, end in (
+        mutation_pool.delete_attributes_requests):
+      request = self._BuildDeleteAttributesRequest(
+          subject, attributes, start=start, end=end, sync=False, token=token)
+      commands.append((subject, typ.DELETE_ATTRIBUTES, request))
+
+    for subject, values, timestamp, replace, to_delete in (
+        mutation_pool.set_requests):
+      request = self._BuildMultiSetRequest(
+          subject,
+          values,
+          timestamp=timestamp,
+          replace=replace,
+          sync=False,
+          to_delete=to_delete,
+          token=token)
+      commands.append((subject, typ.MULTI_SET, request))
+
+    self._PipelineRequests(commands)
+
+    # Notifications must only become visible once the data has been written.
+    commands = []
+    for queue, notifications in mutation_pool.new_notifications:
+      request = self._BuildMultiSetRequest(
+          queue,
+          self._NotificationValues(notifications),
+          replace=False,
+          sync=False,
+          token=token)
+      commands.append((queue, typ.MULTI_SET, request))
+
+    self._PipelineRequests(commands)
+
+  def _PipelineRequests(self, commands):
+    """Sends (subject, command type, request) tuples and waits for replies."""
+    connections = collections.OrderedDict()
+    for subject, typ, request in commands:
+      server = self.cache.Get(subject)
+      if server not in connections:
+        # Using a single connection per server keeps the requests ordered.
+        connections[server] = server.GetConnection()
+      cmd = rdf_data_server.DataStoreCommand(command=typ, request=request)
+      connections[server].MakeRequestAndContinue(cmd, subject)
+
+    for connection in connections.itervalues():
+      connection.Sync()
 
   def ResolveMulti(self,
                    subject,
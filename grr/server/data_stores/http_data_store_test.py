@@ -17,9 +17,12 @@ import portpicker
 
 from grr.lib import flags
 from grr.lib import utils
+from grr.lib.rdfvalues import data_server as rdf_data_server
 from grr.server import data_store
 from grr.server import data_store_test
+from grr.server.data_server import constants
 from grr.server.data_server import data_server
+from grr.server.data_server import utils as sutils
 
 from grr.server.data_stores import http_data_store
 from grr.server.data_stores import sqlite_data_store
@@ -200,6 +203,66 @@ class HTTPDataStoreMixin(object):
 class HTTPDataStoreTest(HTTPDataStoreMixin, data_store_test._DataStoreTest):
   """Test the remote data store."""
 
+  def testConnectionsUseProtocolV2(self):
+    connection = data_store.DB.GetServer("aff4:/some_subject")
+    self.assertEqual(connection.protocol, constants.PROTOCOL_V2)
+
+  def testProtocolV1IsStillSupported(self):
+    subject = "aff4:/some_subject"
+    data_store.DB.Set(subject, "metadata:value", "hello", token=self.token)
+
+    with test_lib.ConfigOverrider({"HTTPDataStore.protocol_version": 1}):
+      connection = http_data_store.DataServerConnection(
+          data_store.DB.cache.Get(subject))
+    try:
+      self.assertEqual(connection.protocol, constants.PROTOCOL_V1)
+
+      request = data_store.DB._MakeRequest(
+          [subject], ["metadata:value"], token=self.token)
+      response = connection.SyncAndMakeRequest(
+          rdf_data_server.DataStoreCommand(
+              command=rdf_data_server.DataStoreCommand.Command.RESOLVE_MULTI,
+              request=request))
+      [(attribute, value, _)] = response.results[0].payload
+      self.assertEqual(attribute, "metadata:value")
+      self.assertEqual(data_store.DB._Decode(value), "hello")
+    finally:
+      connection.Close()
+
+  def testResultsAreStreamedInChunks(self):
+    subjects = ["aff4:/stream/%d" % i for i in range(20)]
+    for i, subject in enumerate(subjects):
+      data_store.DB.Set(subject, "metadata:value", str(i), token=self.token)
+
+    # Every result gets its own response.
+    with utils.MultiStubber((MockRequestHandler1, "STREAM_CHUNK_BYTES", 1),
+                            (MockRequestHandler2, "STREAM_CHUNK_BYTES", 1)):
+      scanned = dict((utils.SmartStr(subject), values)
+                     for subject, values in data_store.DB.ScanAttributes(
+                         "aff4:/stream", ["metadata:value"], token=self.token))
+      resolved = dict(
+          data_store.DB.MultiResolvePrefix(
+              subjects, "metadata:", token=self.token))
+
+    self.assertEqual(len(scanned), 20)
+    self.assertEqual(len(resolved), 20)
+    for i, subject in enumerate(subjects):
+      self.assertEqual(scanned[subject]["metadata:value"][1], str(i))
+      self.assertEqual(resolved[subject][0][1], str(i))
+
+  def testLargeFramesAreCompressed(self):
+    payload = "x" * 1000
+    frame = sutils.PackFrame(7, payload, compression_threshold=100)
+
+    header = frame[:sutils.FRAME_PACKER.size]
+    length, request_id, flags = sutils.FRAME_PACKER.unpack(header)
+    self.assertEqual(request_id, 7)
+    self.assertTrue(flags & sutils.FLAG_COMPRESSED)
+    self.assertLess(length, len(payload))
+    self.assertEqual(
+        sutils.UnpackFramePayload(frame[sutils.FRAME_PACKER.size:], flags),
+        payload)
+
 
 def main(args):
   test_lib.main(args)
@@ -2,6 +2,9 @@
 # -*- mode: python; encoding: utf-8 -*-
 """An implementation of a data store based on mysql."""
 
+import collections
+import hashlib
+import itertools
 import logging
 import os
 import Queue
@@ -153,6 +156,9 @@ class MySQLAdvancedDataStore(data_store.DataStore):
 
   POOL = None
 
+  # Maximum number of rows written or deleted by a single bulk statement.
+  BULK_SIZE = 1000
+
   def __init__(self, database_name=None):
     self.database_name = database_name or config.CONFIG["Mysql.database_name"]
     # Use the global connection pool.
@@ -213,6 +219,75 @@ class MySQLAdvancedDataStore(data_store.DataStore):
   def DBSubjectLock(self, subject, lease_time=None, token=None):
     return MySQLDBSubjectLock(self, subject, lease_time=lease_time, token=token)
 
+  def MultiDBSubjectLock(self, subjects, lease_time=None, token=None):
+    """Locks many subjects with two queries per BULK_SIZE subjects."""
+    if lease_time is None:
+      raise RuntimeError("Trying to lock without a lease time.")
+
+    lock_token = thread.get_ident()
+    result = {}
+    for batch in utils.Grouper(subjects, self.BULK_SIZE):
+      now = int(time.time() * 1e6)
+      expires = int((time.time() + lease_time) * 1e6)
+
+      # Only take over rows of locks which have expired. lock_owner has to be
+      # updated first since it checks the old lock_expiration.
+      query = ("INSERT INTO locks(subject_hash, lock_owner, lock_expiration) "
+               "VALUES %s ON DUPLICATE KEY UPDATE "
+               "lock_owner=IF(lock_expiration > %%s, lock_owner, "
+               "VALUES(lock_owner)), "
+               "lock_expiration=IF(lock_expiration > %%s, lock_expiration, "
+               "VALUES(lock_expiration))" %
+               ", ".join(["(unhex(md5(%s)), %s, %s)"] * len(batch)))
+      args = []
+      for subject in batch:
+        args.extend([utils.SmartStr(subject), lock_token, expires])
+      args.extend([now, now])
+      self.ExecuteQuery(query, args)
+
+      by_hash = {}
+      for subject in batch:
+        by_hash[hashlib.md5(utils.SmartStr(subject)).hexdigest().upper()] = (
+            subject)
+
+      query = ("SELECT hex(subject_hash) AS subject_hash FROM locks "
+               "WHERE lock_owner=%%s AND lock_expiration=%%s AND "
+               "subject_hash IN (%s)" %
+               ", ".join(["unhex(md5(%s))"] * len(batch)))
+      args = [lock_token, expires]
+      args.extend(utils.SmartStr(subject) for subject in batch)
+      rows, _ = self.ExecuteQuery(query, args)
+
+      for row in rows:
+        subject = by_hash[row["subject_hash"].upper()]
+        result[subject] = MySQLDBSubjectLock(
+            self,
+            subject,
+            lease_time=lease_time,
+            token=token,
+            acquired=(lock_token, expires))
+
+    return result
+
+  def ReleaseDBSubjectLocks(self, locks):
+    """Releases locks with one query per owner, expiry and BULK_SIZE locks."""
+    by_owner = {}
+    for lock in locks:
+      if lock.locked:
+        by_owner.setdefault((lock.lock_token, lock.expires), []).append(lock)
+
+    for (lock_token, expires), owned_locks in by_owner.iteritems():
+      for batch in utils.Grouper(owned_locks, self.BULK_SIZE):
+        query = ("UPDATE locks SET lock_expiration=0, lock_owner=0 "
+                 "WHERE lock_expiration=%%s AND lock_owner=%%s AND "
+                 "subject_hash IN (%s)" %
+                 ", ".join(["unhex(md5(%s))"] * len(batch)))
+        args = [expires, lock_token]
+        args.extend(utils.SmartStr(lock.subject) for lock in batch)
+        self.ExecuteQuery(query, args)
+        for lock in batch:
+          lock.locked = False
+
   def Size(self):
     query = ("SELECT table_schema, Sum(data_length + index_length) `size` "
              "FROM information_schema.tables "
@@ -328,14 +403,19 @@ class MySQLAdvancedDataStore(data_store.DataStore):
                      attribute,
                      after_urn=None,
                      limit=None,
-                     token=None):
+                     token=None,
+                     keys_only=False):
     subject_prefix = utils.SmartStr(rdfvalue.RDFURN(subject_prefix))
     if subject_prefix[-1] != "/":
       subject_prefix += "/"
     subject_prefix += "%"
 
+    columns = "aff4.timestamp, subjects.subject"
+    if not keys_only:
+      columns = "aff4.value, " + columns
+
     query = """
-    SELECT aff4.value, aff4.timestamp, subjects.subject
+    SELECT """ + columns + """
       FROM aff4
       JOIN subjects ON aff4.subject_hash=subjects.hash
       JOIN (
@@ -400,6 +480,26 @@ class MySQLAdvancedDataStore(data_store.DataStore):
       if max_records and result_count >= max_records:
         return
 
+  def ScanAttributeKeys(self,
+                        subject_prefix,
+                        attribute,
+                        after_urn=None,
+                        max_records=None,
+                        token=None):
+    if after_urn:
+      after_urn = utils.SmartStr(after_urn)
+    else:
+      after_urn = ""
+
+    for row in self._ScanAttribute(
+        subject_prefix,
+        attribute,
+        after_urn=after_urn,
+        limit=max_records,
+        token=token,
+        keys_only=True):
+      yield (row["subject"], row["timestamp"])
+
   def MultiSet(self,
                subject,
                values,
@@ -409,16 +509,33 @@ class MySQLAdvancedDataStore(data_store.DataStore):
                to_delete=None,
                token=None):
     """Set multiple attributes' values for this subject in one operation."""
-    to_delete = set(to_delete or [])
-
-    # Prepare a bulk insert operation.
     subject = utils.SmartUnicode(subject)
-    to_insert = []
-    to_replace = []
-    transaction = []
 
-    # Build a document for each unique timestamp.
+    # Replacing means to delete all versions of the attribute first.
+    cleared = set(utils.SmartUnicode(a) for a in to_delete or [])
+    if replace:
+      cleared.update(utils.SmartUnicode(a) for a in values)
+
+    rows = list(self._ExpandValues(subject, values, timestamp=timestamp))
+
+    if sync:
+      if cleared:
+        transaction = self._BuildReplaces([(subject, cleared, rows)])
+      else:
+        transaction = self._BuildInserts(rows) if rows else []
+      if transaction:
+        self._ExecuteTransaction(transaction)
+    else:
+      with self.buffer_lock:
+        if cleared:
+          self.to_replace.append((subject, cleared, rows))
+        else:
+          self.to_insert.extend(rows)
+
+  def _ExpandValues(self, subject, values, timestamp=None):
+    """Yields a [subject, attribute, data, timestamp] row per value."""
     for attribute, sequence in values.items():
+      attribute = utils.SmartUnicode(attribute)
       for value in sequence:
         if isinstance(value, tuple):
           value, entry_timestamp = value
@@ -433,47 +550,72 @@ class MySQLAdvancedDataStore(data_store.DataStore):
         else:
           entry_timestamp = time.time() * 1e6
 
-        attribute = utils.SmartUnicode(attribute)
-        data = self._Encode(value)
+        yield [subject, attribute, self._Encode(value), entry_timestamp]
 
-        # Replacing means to delete all versions of the attribute first.
-        if replace or attribute in to_delete:
-          existing = self._CountExistingRows(subject, attribute)
-          if existing:
-            to_replace.append([subject, attribute, data, entry_timestamp])
-          else:
-            to_insert.append([subject, attribute, data, entry_timestamp])
-          if attribute in to_delete:
-            to_delete.remove(attribute)
+  def ApplyMutations(self, mutation_pool, sync=False, token=None):
+    """Applies a mutation pool using multi-row statements.
 
-        else:
-          to_insert.append([subject, attribute, data, entry_timestamp])
+    All data changes are written in a single transaction. Replaced attributes
+    are deleted with one statement per subject and new values are inserted
+    with bulk INSERTs, so no per-attribute existence checks are needed.
+    Notifications are written in a second transaction afterwards.
 
-    if to_delete:
-      self.DeleteAttributes(subject, to_delete, token=token)
+    Args:
+      mutation_pool: The MutationPool holding the operations to apply.
+      sync: Unused, mutations are always written before returning.
+      token: An ACL token.
+    """
+    _ = sync
+    transaction = []
 
-    if sync:
-      if to_replace:
-        transaction.extend(self._BuildReplaces(to_replace))
-      if to_insert:
-        transaction.extend(self._BuildInserts(to_insert))
-      if transaction:
-        self._ExecuteTransaction(transaction)
-    else:
-      if to_replace:
-        with self.buffer_lock:
-          self.to_replace.extend(to_replace)
-      if to_insert:
-        with self.buffer_lock:
-          self.to_insert.extend(to_insert)
-
-  def _CountExistingRows(self, subject, attribute):
-    query = ("SELECT count(*) AS total FROM aff4 "
-             "WHERE subject_hash=unhex(md5(%s)) "
-             "AND attribute_hash=unhex(md5(%s))")
-    args = [subject, attribute]
-    result, _ = self.ExecuteQuery(query, args)
-    return int(result[0]["total"])
+    subjects = [
+        utils.SmartUnicode(subject)
+        for subject in mutation_pool.delete_subject_requests
+    ]
+    for batch in utils.Grouper(subjects, self.BULK_SIZE):
+      transaction.extend(self._BuildMultiSubjectDelete(batch))
+
+    for subject, attributes, start, end in (
+        mutation_pool.delete_attributes_requests):
+      if isinstance(attributes, basestring):
+        raise ValueError(
+            "String passed to DeleteAttributes (non string iterable "
+            "expected).")
+      attributes = [utils.SmartUnicode(attribute) for attribute in attributes]
+      if attributes:
+        transaction.extend(
+            self._BuildMultiAttributeDelete(
+                utils.SmartUnicode(subject), attributes,
+                self._MakeTimestamp(start, end)))
+
+    replaces = []
+    for subject, values, timestamp, replace, to_delete in (
+        mutation_pool.set_requests):
+      subject = utils.SmartUnicode(subject)
+      cleared = set(utils.SmartUnicode(a) for a in to_delete or [])
+      if replace:
+        cleared.update(utils.SmartUnicode(a) for a in values)
+      replaces.append((subject, cleared,
+                       self._ExpandValues(subject, values,
+                                          timestamp=timestamp)))
+
+    transaction.extend(self._BuildReplaces(replaces))
+
+    if transaction:
+      self._ExecuteTransaction(transaction)
+
+    notifications = []
+    for queue, queue_notifications in mutation_pool.new_notifications:
+      notifications.extend(
+          self._ExpandValues(
+              utils.SmartUnicode(queue),
+              self._NotificationValues(queue_notifications)))
+
+    transaction = []
+    for batch in utils.Grouper(notifications, self.BULK_SIZE):
+      transaction.extend(self._BuildInserts(batch))
+    if transaction:
+      self._ExecuteTransaction(transaction)
 
   @utils.Synchronized
   def Flush(self):
@@ -505,22 +647,46 @@ class MySQLAdvancedDataStore(data_store.DataStore):
     if transaction:
       self._ExecuteTransaction(transaction)
 
-  def _BuildReplaces(self, values):
+  def _BuildReplaces(self, replaces):
+    """Build the queries for a list of (subject, attributes, rows) writes.
+
+    Each write removes all versions of the given attributes of the subject
+    before inserting its rows. Instead of checking which attributes already
+    exist, the attributes are deleted with a single statement per subject and
+    all rows are inserted in bulk afterwards. Rows that a later write in the
+    list replaces again are never sent.
+
+    Args:
+      replaces: A list of (subject, attributes, rows) tuples, rows are
+        [subject, attribute, data, timestamp] lists.
+
+    Returns:
+      A list of queries to be executed in a single transaction.
+    """
+    cleared = collections.OrderedDict()
+    pending = collections.OrderedDict()
+    for subject, attributes, rows in replaces:
+      for attribute in attributes:
+        pending.pop((subject, attribute), None)
+      if attributes:
+        cleared.setdefault(subject, set()).update(attributes)
+
+      for row in rows:
+        pending.setdefault((row[0], row[1]), []).append(row)
+
     transaction = []
-    updates = {}
-    to_insert = []
-
-    for (subject, attribute, data, timestamp) in values:
-      updates.setdefault(subject, {})[attribute] = [data, timestamp]
-
-    for subject in updates:
-      for attribute in updates[subject]:
-        data = updates[subject][attribute][0]
-        timestamp = updates[subject][attribute][1]
-        to_insert.append([subject, attribute, data, timestamp])
-        delete_q = self._BuildDelete(subject, attribute)[0]
-        transaction.append(delete_q)
-    transaction.extend(self._BuildInserts(to_insert))
+    for subject, attributes in cleared.iteritems():
+      for batch in utils.Grouper(sorted(attributes), self.BULK_SIZE):
+        # Only the aff4 rows are deleted, the attributes are written again
+        # right away and orphaned attribute rows are left to the delete paths
+        # so replaces do not lock the shared attributes table.
+        transaction.append(
+            self._BuildMultiAttributeDelete(subject, batch, None)[0])
+
+    to_insert = itertools.chain.from_iterable(pending.itervalues())
+    for batch in utils.Grouper(to_insert, self.BULK_SIZE):
+      transaction.extend(self._BuildInserts(batch))
+
     return transaction
 
   def _BuildInserts(self, values):
@@ -759,6 +925,49 @@ class MySQLAdvancedDataStore(data_store.DataStore):
 
     return [aff4_q, locks_q, subjects_q]
 
+  def _BuildMultiSubjectDelete(self, subjects):
+    """Build the DELETE queries removing several subjects at once."""
+    hashes = ", ".join(["unhex(md5(%s))"] * len(subjects))
+    aff4_q = {
+        "query": "DELETE aff4 FROM aff4 WHERE subject_hash IN (%s)" % hashes,
+        "args": list(subjects)
+    }
+
+    locks_q = {
+        "query": "DELETE locks FROM locks WHERE subject_hash IN (%s)" % hashes,
+        "args": list(subjects)
+    }
+
+    subjects_q = {
+        "query": "DELETE subjects FROM subjects WHERE hash IN (%s)" % hashes,
+        "args": list(subjects)
+    }
+
+    return [aff4_q, locks_q, subjects_q]
+
+  def _BuildMultiAttributeDelete(self, subject, attributes, timestamp):
+    """Build the DELETE queries removing several attributes of a subject."""
+    hashes = ", ".join(["unhex(md5(%s))"] * len(attributes))
+    aff4_q = {
+        "query": "DELETE aff4 FROM aff4 WHERE subject_hash=unhex(md5(%s)) "
+                 "AND attribute_hash IN (" + hashes + ")",
+        "args": [subject] + list(attributes)
+    }
+
+    if isinstance(timestamp, (tuple, list)):
+      aff4_q["query"] += " AND aff4.timestamp >= %s AND aff4.timestamp <= %s"
+      aff4_q["args"].append(int(timestamp[0]))
+      aff4_q["args"].append(int(timestamp[1]))
+
+    attributes_q = {
+        "query": "DELETE attributes FROM attributes LEFT JOIN aff4 ON "
+                 "aff4.attribute_hash=attributes.hash "
+                 "WHERE attributes.hash IN (" + hashes + ") "
+                 "AND aff4.attribute_hash IS NULL",
+        "args": list(attributes)
+    }
+    return [aff4_q, attributes_q]
+
   def _MakeTimestamp(self, start=None, end=None):
     """Create a timestamp using a start and end time.
 
@@ -832,7 +1041,19 @@ class MySQLDBSubjectLock(data_store.DBSubjectLock):
   A lock is considered expired after a certain time.
   """
 
+  def __init__(self, store, subject, lease_time=None, token=None,
+               acquired=None):
+    # (lock_token, expires) of a lock already taken by MultiDBSubjectLock.
+    self.acquired = acquired
+    super(MySQLDBSubjectLock, self).__init__(
+        store, subject, lease_time=lease_time, token=token)
+
   def _Acquire(self, lease_time):
+    if self.acquired:
+      self.lock_token, self.expires = self.acquired
+      self.locked = True
+      return
+
     self.lock_token = thread.get_ident()
     self.expires = int((time.time() + lease_time) * 1e6)
 
@@ -44,6 +44,12 @@ class MysqlAdvancedDataStoreTest(MysqlAdvancedTestMixin,
         (int(version_major) == 5 and int(version_minor) <= 5)):
       self.fail("GRR needs MySQL >= 5.6")
 
+  def testReplacesDoNotDeleteAttributeRows(self):
+    transaction = data_store.DB._BuildReplaces(
+        [(u"aff4:/subject", set([u"aff4:a", u"aff4:b"]), [])])
+    self.assertEqual(len(transaction), 1)
+    self.assertTrue(transaction[0]["query"].startswith("DELETE aff4 FROM aff4"))
+
 
 def main(args):
   test_lib.main(args)
@@ -6,6 +6,7 @@ SQLite database files are created by taking the root of each AFF4 object.
 
 
 
+import collections
 import itertools
 import logging
 import os
@@ -658,32 +659,46 @@ class SqliteDataStore(data_store.DataStore):
     """Set multiple values at once."""
     # All operations are synchronized.
     _ = sync
+    with self.cache.Get(subject) as sqlite_connection:
+      self._MultiSet(
+          sqlite_connection,
+          subject,
+          values,
+          timestamp=timestamp,
+          replace=replace,
+          to_delete=to_delete)
+
+  def _MultiSet(self,
+                sqlite_connection,
+                subject,
+                values,
+                timestamp=None,
+                replace=True,
+                to_delete=None):
+    """Writes the values using an already acquired connection."""
     if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
       timestamp = time.time() * 1000000
 
     to_delete = set(to_delete or [])
-
-    with self.cache.Get(subject) as sqlite_connection:
-      if replace:
-        to_delete.update(values.keys())
-
-      # Delete attribute if needed.
-      if to_delete:
-        for attribute in to_delete:
-          sqlite_connection.DeleteAttribute(subject, attribute)
-
-      for attribute, seq in values.items():
-        for v in seq:
-          element_timestamp = None
-          if isinstance(v, (list, tuple)):
-            v, element_timestamp = v
-          if element_timestamp is None:
-            element_timestamp = timestamp
-
-          element_timestamp = long(element_timestamp)
-          value = self._Encode(v)
-          sqlite_connection.SetAttribute(subject, attribute, value,
-                                         element_timestamp)
+    if replace:
+      to_delete.update(values.keys())
+
+    # Delete attribute if needed.
+    for attribute in to_delete:
+      sqlite_connection.DeleteAttribute(subject, attribute)
+
+    for attribute, seq in values.items():
+      for v in seq:
+        element_timestamp = None
+        if isinstance(v, (list, tuple)):
+          v, element_timestamp = v
+        if element_timestamp is None:
+          element_timestamp = timestamp
+
+        element_timestamp = long(element_timestamp)
+        value = self._Encode(v)
+        sqlite_connection.SetAttribute(subject, attribute, value,
+                                       element_timestamp)
 
   def DeleteAttributes(self,
                        subject,
@@ -700,18 +715,28 @@ class SqliteDataStore(data_store.DataStore):
           "String passed to DeleteAttributes (non string iterable expected).")
 
     with self.cache.Get(subject) as sqlite_connection:
-      if start is None and end is None:
-        # This is done when we delete all attributes at once without
-        # caring about timestamps.
-        for attribute in list(attributes):
-          sqlite_connection.DeleteAttribute(subject, attribute)
-      else:
-        # This code path is taken when we have a timestamp range.
-        start = start or 0
-        if end is None:
-          end = (2**63) - 1  # sys.maxint
-        for attribute in list(attributes):
-          sqlite_connection.DeleteAttributeRange(subject, attribute, start, end)
+      self._DeleteAttributes(
+          sqlite_connection, subject, attributes, start=start, end=end)
+
+  def _DeleteAttributes(self,
+                        sqlite_connection,
+                        subject,
+                        attributes,
+                        start=None,
+                        end=None):
+    """Removes attributes using an already acquired connection."""
+    if start is None and end is None:
+      # This is done when we delete all attributes at once without
+      # caring about timestamps.
+      for attribute in list(attributes):
+        sqlite_connection.DeleteAttribute(subject, attribute)
+    else:
+      # This code path is taken when we have a timestamp range.
+      start = start or 0
+      if end is None:
+        end = (2**63) - 1  # sys.maxint
+      for attribute in list(attributes):
+        sqlite_connection.DeleteAttributeRange(subject, attribute, start, end)
 
   def DeleteSubject(self, subject, sync=False, token=None):
     _ = sync
@@ -719,6 +744,68 @@ class SqliteDataStore(data_store.DataStore):
     with self.cache.Get(subject) as sqlite_connection:
       sqlite_connection.DeleteSubject(subject)
 
+  def _DatabaseKey(self, subject):
+    filename, directory = common.ResolveSubjectDestination(
+        subject, self.cache.path_regexes)
+    return common.MakeDestinationKey(directory, filename)
+
+  def _ApplyGrouped(self, operations):
+    """Applies operations with a single transaction per database file.
+
+    Args:
+      operations: A list of (subject, function, args, kwargs) tuples. Each
+        function is called with the connection for the subject as the first
+        argument. Operations on the same file keep their relative order.
+    """
+    groups = collections.OrderedDict()
+    for operation in operations:
+      groups.setdefault(self._DatabaseKey(operation[0]), []).append(operation)
+
+    for group in groups.itervalues():
+      # Leaving the connection context commits the transaction.
+      with self.cache.Get(group[0][0]) as sqlite_connection:
+        for _, function, args, kwargs in group:
+          function(sqlite_connection, *args, **kwargs)
+
+  def ApplyMutations(self, mutation_pool, sync=False, token=None):
+    """Applies a mutation pool with one transaction per database file."""
+    _ = sync
+
+    operations = []
+    for subject in mutation_pool.delete_subject_requests:
+      operations.append((subject, SqliteConnection.DeleteSubject, (subject,),
+                         {}))
+
+    for subject, attributes, start, end in (
+        mutation_pool.delete_attributes_requests):
+      if isinstance(attributes, basestring):
+        raise ValueError(
+            "String passed to DeleteAttributes (non string iterable "
+            "expected).")
+      operations.append((subject, self._DeleteAttributes,
+                         (subject, attributes), dict(start=start, end=end)))
+
+    for subject, values, timestamp, replace, to_delete in (
+        mutation_pool.set_requests):
+      operations.append((subject, self._MultiSet, (subject, values),
+                         dict(
+                             timestamp=timestamp,
+                             replace=replace,
+                             to_delete=to_delete)))
+
+    self._ApplyGrouped(operations)
+
+    # Notifications are only written once all the data they refer to has been
+    # committed.
+    notification_operations = []
+    for queue, notifications in mutation_pool.new_notifications:
+      notification_operations.append(
+          (queue, self._MultiSet,
+           (queue, self._NotificationValues(notifications)),
+           dict(replace=False)))
+
+    self._ApplyGrouped(notification_operations)
+
   def MultiResolvePrefix(self,
                          subjects,
                          attribute_prefix,
@@ -12,6 +12,7 @@ import logging
 import re
 import time
 
+from grr import config
 from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib import utils
@@ -20,6 +21,7 @@ from grr.lib.rdfvalues import paths as rdf_paths
 from grr.lib.rdfvalues import structs as rdf_structs
 from grr.proto import export_pb2
 from grr.server import aff4
+from grr.server.aff4_objects import aff4_grr
 from grr.server.aff4_objects import filestore
 from grr.server.flows.general import collectors as flow_collectors
 
@@ -194,15 +196,18 @@ class ExportConverter(object):
   # Cache used for GetConvertersByValue() lookups.
   converters_cache = {}
 
-  def __init__(self, options=None):
+  def __init__(self, options=None, metadata_cache=None):
     """Constructor.
 
     Args:
       options: ExportOptions value, which contains settings that may or
                or may not affect this converter's behavior.
+      metadata_cache: ExportedMetadataCache to be used by converters that
+                      look up clients metadata.
     """
     super(ExportConverter, self).__init__()
     self.options = options or ExportOptions()
+    self.metadata_cache = metadata_cache
 
   def Convert(self, metadata, value, token=None):
     """Converts given RDFValue to other RDFValues.
@@ -880,9 +885,15 @@ class CollectionConverterBase(ExportConverter):
     if not collection:
       return
 
+    # Share the clients metadata between batches.
+    metadata_cache = self.metadata_cache or ExportedMetadataCache()
     for batch in utils.Grouper(collection, self.BATCH_SIZE):
       converted_batch = ConvertValues(
-          metadata, batch, token=token, options=self.options)
+          metadata,
+          batch,
+          token=token,
+          options=self.options,
+          metadata_cache=metadata_cache)
       for v in converted_batch:
         yield v
 
@@ -967,7 +978,8 @@ class GrrMessageConverter(ExportConverter):
 
   def __init__(self, *args, **kw):
     super(GrrMessageConverter, self).__init__(*args, **kw)
-    self.cached_metadata = {}
+    if self.metadata_cache is None:
+      self.metadata_cache = ExportedMetadataCache()
 
   def Convert(self, metadata, grr_message, token=None):
     """Converts GrrMessage into a set of RDFValues.
@@ -1002,31 +1014,13 @@ class GrrMessageConverter(ExportConverter):
     for metadata, msg in metadata_value_pairs:
       msg_dict.setdefault(msg.source, []).append((metadata, msg))
 
-    metadata_objects = []
-    metadata_to_fetch = []
-
-    # Open the clients we don't have metadata for and fetch metadata.
-    for client_urn in msg_dict.iterkeys():
-      try:
-        metadata_objects.append(self.cached_metadata[client_urn])
-      except KeyError:
-        metadata_to_fetch.append(client_urn)
-
-    if metadata_to_fetch:
-      client_fds = aff4.FACTORY.MultiOpen(
-          metadata_to_fetch, mode="r", token=token)
-
-      fetched_metadata = [
-          GetMetadata(client_fd, token=token) for client_fd in client_fds
-      ]
-      for metadata in fetched_metadata:
-        self.cached_metadata[metadata.client_urn] = metadata
-      metadata_objects.extend(fetched_metadata)
+    metadata_by_client = self.metadata_cache.GetMetadata(
+        msg_dict.iterkeys(), token=token)
 
     data_by_type = {}
-    for metadata in metadata_objects:
+    for client_urn, metadata in metadata_by_client.iteritems():
       try:
-        for original_metadata, message in msg_dict[metadata.client_urn]:
+        for original_metadata, message in msg_dict[client_urn]:
           # Get source_urn and annotations from the original metadata
           # provided and original_timestamp from the payload age.
           new_metadata = ExportedMetadata(metadata)
@@ -1041,7 +1035,10 @@ class GrrMessageConverter(ExportConverter):
             converters_classes = ExportConverter.GetConvertersByValue(
                 message.payload)
             data_by_type[cls_name] = {
-                "converters": [cls(self.options) for cls in converters_classes],
+                "converters": [
+                    cls(self.options, metadata_cache=self.metadata_cache)
+                    for cls in converters_classes
+                ],
                 "batch_data": [(new_metadata, message.payload)]
             }
           else:
@@ -1885,7 +1882,77 @@ def GetMetadata(client, token=None):
   return metadata
 
 
-def ConvertValuesWithMetadata(metadata_value_pairs, token=None, options=None):
+class ExportedMetadataCache(object):
+  """A cache of clients metadata.
+
+  Metadata of all the clients of a batch that are not in the cache is fetched
+  with a single MultiOpen. Entries are keyed by client urn and the age the
+  client was opened with. The least recently used entries are evicted when
+  the cache is full and entries expire after max_age seconds, so that
+  changes to the clients eventually show up.
+  """
+
+  def __init__(self, max_size=None, max_age=None):
+    if max_size is None:
+      max_size = config.CONFIG["Export.metadata_cache_size"]
+    if max_age is None:
+      max_age = config.CONFIG["Export.metadata_cache_max_age"].seconds
+
+    self.cache = utils.AgeBasedCache(max_size=max_size, max_age=max_age)
+
+  def GetMetadata(self, client_urns, age=aff4.NEWEST_TIME, token=None):
+    """Returns the metadata of the given clients.
+
+    Args:
+      client_urns: An iterable with client urns.
+      age: The age of the clients, see aff4.FACTORY.Open.
+      token: Security token.
+
+    Returns:
+      A dict with ExportedMetadata objects keyed by client urn. Clients that
+      don't exist are left out. The metadata objects are shared, callers
+      have to copy them before changing them.
+    """
+    result = {}
+    to_fetch = {}
+    for client_urn in client_urns:
+      try:
+        metadata = self.cache.Get((utils.SmartStr(client_urn), age))
+      except KeyError:
+        to_fetch[utils.SmartStr(client_urn)] = client_urn
+        continue
+
+      if metadata is not None:
+        result[client_urn] = metadata
+
+    if not to_fetch:
+      return result
+
+    for client_fd in aff4.FACTORY.MultiOpen(
+        to_fetch.values(),
+        mode="r",
+        aff4_type=aff4_grr.VFSGRRClient,
+        age=age,
+        token=token):
+      client_urn = to_fetch.pop(utils.SmartStr(client_fd.urn))
+      metadata = GetMetadata(client_fd, token=token)
+      self.cache.Put((utils.SmartStr(client_urn), age), metadata)
+      result[client_urn] = metadata
+
+    # Don't look up the missing clients again.
+    for key in to_fetch:
+      self.cache.Put((key, age), None)
+
+    return result
+
+  def Flush(self):
+    self.cache.Flush()
+
+
+def ConvertValuesWithMetadata(metadata_value_pairs,
+                              token=None,
+                              options=None,
+                              metadata_cache=None):
   """Converts a set of RDFValues into a set of export-friendly RDFValues.
 
   Args:
@@ -1895,6 +1962,8 @@ def ConvertValuesWithMetadata(metadata_value_pairs, token=None, options=None):
     token: Security token.
     options: rdfvalue.ExportOptions instance that will be passed to
              ExportConverters.
+    metadata_cache: ExportedMetadataCache to look up clients metadata with.
+                    If None, converters use caches of their own.
   Yields:
     Converted values. Converted values may be of different types.
 
@@ -1921,7 +1990,10 @@ def ConvertValuesWithMetadata(metadata_value_pairs, token=None, options=None):
           first_value)
       continue
 
-    converters = [cls(options) for cls in converters_classes]
+    converters = [
+        cls(options, metadata_cache=metadata_cache)
+        for cls in converters_classes
+    ]
     for converter in converters:
       for result in converter.BatchConvert(metadata_values_group, token=token):
         yield result
@@ -1930,7 +2002,11 @@ def ConvertValuesWithMetadata(metadata_value_pairs, token=None, options=None):
     raise NoConverterFound(no_converter_found_error)
 
 
-def ConvertValues(default_metadata, values, token=None, options=None):
+def ConvertValues(default_metadata,
+                  values,
+                  token=None,
+                  options=None,
+                  metadata_cache=None):
   """Converts a set of RDFValues into a set of export-friendly RDFValues.
 
   Args:
@@ -1941,6 +2017,7 @@ def ConvertValues(default_metadata, values, token=None, options=None):
     token: Security token.
     options: rdfvalue.ExportOptions instance that will be passed to
              ExportConverters.
+    metadata_cache: ExportedMetadataCache to look up clients metadata with.
   Returns:
     Converted values. Converted values may be of different types
     (unlike the source values which are all of the same type). This is due to
@@ -1952,4 +2029,5 @@ def ConvertValues(default_metadata, values, token=None, options=None):
   """
 
   batch_data = [(default_metadata, obj) for obj in values]
-  return ConvertValuesWithMetadata(batch_data, token=token, options=options)
+  return ConvertValuesWithMetadata(
+      batch_data, token=token, options=options, metadata_cache=metadata_cache)
@@ -651,6 +651,48 @@ class ExportTest(ExportTestBase):
     metadata = export.GetMetadata(self.client_id, token=self.token)
     self.assertFalse(metadata.usernames)
 
+  def _CreateClient(self, client_id, hostname):
+    with aff4.FACTORY.Create(
+        client_id, aff4_grr.VFSGRRClient, mode="w", token=self.token) as fd:
+      fd.Set(fd.Schema.HOSTNAME(hostname))
+
+  def testExportedMetadataCacheFetchesBatchesAtOnce(self):
+    client_ids = [rdf_client.ClientURN("C.%016X" % i) for i in range(3)]
+    self._CreateClient(client_ids[0], "host-0")
+    self._CreateClient(client_ids[1], "host-1")
+
+    cache = export.ExportedMetadataCache()
+    with test_lib.Instrument(aff4.FACTORY, "MultiOpen") as multi_open:
+      metadata = cache.GetMetadata(client_ids, token=self.token)
+      self.assertEqual(multi_open.call_count, 1)
+
+      # The missing client is not part of the result.
+      self.assertEqual(sorted(metadata), client_ids[:2])
+      self.assertEqual(metadata[client_ids[0]].hostname, "host-0")
+      self.assertEqual(metadata[client_ids[1]].hostname, "host-1")
+
+      # Neither the existing clients nor the missing one are fetched again.
+      metadata = cache.GetMetadata(client_ids, token=self.token)
+      self.assertEqual(multi_open.call_count, 1)
+      self.assertEqual(sorted(metadata), client_ids[:2])
+
+  def testExportedMetadataCacheEvictsLeastRecentlyUsedClients(self):
+    client_ids = [rdf_client.ClientURN("C.%016X" % i) for i in range(3)]
+    for i, client_id in enumerate(client_ids):
+      self._CreateClient(client_id, "host-%d" % i)
+
+    cache = export.ExportedMetadataCache(max_size=2)
+    cache.GetMetadata(client_ids[:2], token=self.token)
+    cache.GetMetadata(client_ids[:1], token=self.token)
+    # Evicts client 1, which was used least recently.
+    cache.GetMetadata(client_ids[2:], token=self.token)
+
+    self._CreateClient(client_ids[0], "new-host-0")
+    self._CreateClient(client_ids[1], "new-host-1")
+    metadata = cache.GetMetadata(client_ids[:2], token=self.token)
+    self.assertEqual(metadata[client_ids[0]].hostname, "host-0")
+    self.assertEqual(metadata[client_ids[1]].hostname, "new-host-1")
+
   def testClientSummaryToExportedClientConverter(self):
     client_summary = rdf_client.ClientSummary()
     metadata = export.ExportedMetadata(hostname="ahostname")
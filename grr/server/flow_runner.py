@@ -405,7 +405,10 @@ class FlowRunner(object):
           manager.QueueNotification(
               notification, timestamp=notification.timestamp + delay)
 
-  def ProcessCompletedRequests(self, notification, unused_thread_pool=None):
+  def ProcessCompletedRequests(self,
+                               notification,
+                               unused_thread_pool=None,
+                               prefetched=None):
     """Go through the list of requests and process the completed ones.
 
     We take a snapshot in time of all requests and responses for this flow. We
@@ -419,22 +422,30 @@ class FlowRunner(object):
 
     Args:
       notification: The notification object that triggered this processing.
+      prefetched: The completed requests and responses of this flow as returned
+        by QueueManager.MultiFetchCompletedResponses(). If not given they are
+        read here.
     """
     self.ScheduleKillNotification()
     try:
-      self._ProcessCompletedRequests(notification)
+      self._ProcessCompletedRequests(notification, prefetched=prefetched)
     finally:
       self.FinalizeProcessCompletedRequests(notification)
 
-  def _ProcessCompletedRequests(self, notification):
+  def _ProcessCompletedRequests(self, notification, prefetched=None):
     """Does the actual processing of the completed requests."""
     # First ensure that client messages are all removed. NOTE: We make a new
     # queue manager here because we want only the client messages to be removed
     # ASAP. This must happen before we actually run the flow to ensure the
     # client requests are removed from the client queues.
     with queue_manager.QueueManager(token=self.token) as manager:
-      for request, _ in manager.FetchCompletedRequests(
-          self.session_id, timestamp=(0, notification.timestamp)):
+      if prefetched is None:
+        completed_requests = manager.FetchCompletedRequests(
+            self.session_id, timestamp=(0, notification.timestamp))
+      else:
+        completed_requests = prefetched
+
+      for request, _ in completed_requests:
         # Requests which are not destined to clients have no embedded request
         # message.
         if request.HasField("request"):
@@ -450,9 +461,15 @@ class FlowRunner(object):
     while True:
       try:
         # Here we only care about completed requests - i.e. those requests with
-        # responses followed by a status message.
-        for request, responses in self.queue_manager.FetchCompletedResponses(
-            self.session_id, timestamp=(0, notification.timestamp)):
+        # responses followed by a status message. Prefetched responses are
+        # only good for the first pass.
+        if prefetched is None:
+          completed_responses = self.queue_manager.FetchCompletedResponses(
+              self.session_id, timestamp=(0, notification.timestamp))
+        else:
+          completed_responses, prefetched = prefetched, None
+
+        for request, responses in completed_responses:
 
           if request.id == 0:
             continue
@@ -45,6 +45,149 @@ class ForemanClientRuleBase(rdf_structs.RDFProtoStruct):
   def Validate(self):
     raise NotImplementedError
 
+  def Compile(self):
+    """Returns a condition evaluating this rule for a ForemanRuleIndex.
+
+    Rules which can be evaluated by looking at the client object only should
+    override this method.
+
+    Returns:
+      A ForemanCondition instance.
+    """
+    return ForemanRuleCondition(self)
+
+
+class ForemanCondition(object):
+  """A compiled foreman client rule.
+
+  Conditions with the same key give the same result, so a ForemanRuleIndex
+  evaluates each distinct condition only once per client.
+  """
+
+  def __init__(self, key):
+    self.key = key
+
+  def GetPathsToCheck(self):
+    return ["/"]
+
+  def Evaluate(self, objects, client_id, cache):
+    """Evaluates the condition.
+
+    Args:
+      objects: A dict that maps fd.urn to fd for all the paths returned by
+          GetPathsToCheck.
+      client_id: An aff4 client id object.
+      cache: A dict this condition can use to store values derived from the
+          client objects. It is shared by all conditions evaluated for the same
+          client.
+
+    Returns:
+      A bool value of the evaluation.
+    """
+    raise NotImplementedError
+
+
+class ForemanRuleCondition(ForemanCondition):
+  """Evaluates an arbitrary client rule on the opened objects."""
+
+  def __init__(self, rule):
+    super(ForemanRuleCondition, self).__init__(
+        (rule.__class__.__name__, rule.SerializeToString()))
+    self.rule = rule
+
+  def GetPathsToCheck(self):
+    return self.rule.GetPathsToCheck()
+
+  def Evaluate(self, objects, client_id, cache):
+    return self.rule.Evaluate(objects, client_id)
+
+
+class ForemanOsCondition(ForemanCondition):
+  """Matches the client's operating system against a set of prefixes."""
+
+  def __init__(self, prefixes):
+    prefixes = tuple(sorted(prefixes))
+    super(ForemanOsCondition, self).__init__(("os", prefixes))
+    self.prefixes = prefixes
+
+  def Evaluate(self, objects, client_id, cache):
+    try:
+      fd = objects[client_id]
+      attribute = aff4.Attribute.NAMES["System"]
+    except KeyError:
+      return False
+
+    return utils.SmartStr(fd.Get(attribute)).startswith(self.prefixes)
+
+
+class ForemanLabelCondition(ForemanCondition):
+  """Matches the client's labels against a set of label names."""
+
+  def __init__(self, match_mode, label_names):
+    label_names = frozenset(label_names)
+    super(ForemanLabelCondition, self).__init__(
+        ("label", int(match_mode), label_names))
+    self.match_mode = match_mode
+    self.label_names = label_names
+
+  def Evaluate(self, objects, client_id, cache):
+    try:
+      fd = objects[client_id]
+    except KeyError:
+      return False
+
+    client_label_names = cache.get("labels")
+    if client_label_names is None:
+      client_label_names = cache["labels"] = frozenset(fd.GetLabelsNames())
+
+    match_mode = ForemanLabelClientRule.MatchMode
+    if self.match_mode == match_mode.MATCH_ALL:
+      return self.label_names.issubset(client_label_names)
+    elif self.match_mode == match_mode.MATCH_ANY:
+      return not self.label_names.isdisjoint(client_label_names)
+    elif self.match_mode == match_mode.DOES_NOT_MATCH_ALL:
+      return not self.label_names.issubset(client_label_names)
+    elif self.match_mode == match_mode.DOES_NOT_MATCH_ANY:
+      return self.label_names.isdisjoint(client_label_names)
+    else:
+      raise ValueError("Unexpected match mode value: %s" % self.match_mode)
+
+
+class ForemanIntegerRangeCondition(ForemanCondition):
+  """Matches if an integer attribute lies within an inclusive range.
+
+  Either bound can be None for an open range. A range whose lower bound is
+  greater than the upper bound never matches.
+  """
+
+  def __init__(self, path, attribute_name, lower=None, upper=None):
+    super(ForemanIntegerRangeCondition, self).__init__(
+        ("integer", path, attribute_name, lower, upper))
+    self.path = path
+    self.attribute_name = attribute_name
+    self.lower = lower
+    self.upper = upper
+
+  def GetPathsToCheck(self):
+    return [self.path]
+
+  def Evaluate(self, objects, client_id, cache):
+    path = client_id.Add(self.path)
+    try:
+      fd = objects[path]
+      attribute = aff4.Attribute.NAMES[self.attribute_name]
+    except KeyError:
+      return False
+
+    try:
+      value = int(fd.Get(attribute))
+    except (ValueError, TypeError):
+      # Not an integer attribute.
+      return False
+
+    return ((self.lower is None or value >= self.lower) and
+            (self.upper is None or value <= self.upper))
+
 
 class ForemanOsClientRule(ForemanClientRuleBase):
   """This rule will fire if the client OS is marked as true in the proto."""
@@ -66,6 +209,16 @@ class ForemanOsClientRule(ForemanClientRuleBase):
   def Validate(self):
     pass
 
+  def Compile(self):
+    prefixes = []
+    if self.os_windows:
+      prefixes.append("Windows")
+    if self.os_linux:
+      prefixes.append("Linux")
+    if self.os_darwin:
+      prefixes.append("Darwin")
+    return ForemanOsCondition(prefixes)
+
 
 class ForemanLabelClientRule(ForemanClientRuleBase):
   """This rule will fire if the client has the selected label."""
@@ -95,6 +248,9 @@ class ForemanLabelClientRule(ForemanClientRuleBase):
   def Validate(self):
     pass
 
+  def Compile(self):
+    return ForemanLabelCondition(self.match_mode, self.label_names)
+
 
 class ForemanRegexClientRule(ForemanClientRuleBase):
   """The Foreman schedules flows based on these rules firing."""
@@ -170,6 +326,23 @@ class ForemanIntegerClientRule(ForemanClientRuleBase):
 
     self.attribute_name.Validate()
 
+  def Compile(self):
+    path = utils.SmartStr(self.path)
+    attribute_name = utils.SmartStr(self.attribute_name)
+    value = int(self.value)
+
+    op = self.operator
+    if op == ForemanIntegerClientRule.Operator.LESS_THAN:
+      return ForemanIntegerRangeCondition(path, attribute_name, upper=value - 1)
+    elif op == ForemanIntegerClientRule.Operator.GREATER_THAN:
+      return ForemanIntegerRangeCondition(path, attribute_name, lower=value + 1)
+    elif op == ForemanIntegerClientRule.Operator.EQUAL:
+      return ForemanIntegerRangeCondition(
+          path, attribute_name, lower=value, upper=value)
+    else:
+      # Unknown operator, this never matches.
+      return ForemanIntegerRangeCondition(path, attribute_name, lower=1, upper=0)
+
 
 class ForemanRuleAction(rdf_structs.RDFProtoStruct):
   protobuf = jobs_pb2.ForemanRuleAction
@@ -198,6 +371,9 @@ class ForemanClientRule(ForemanClientRuleBase):
   def Validate(self):
     self.UnionCast().Validate()
 
+  def Compile(self):
+    return self.UnionCast().Compile()
+
 
 class ForemanClientRuleSet(rdf_structs.RDFProtoStruct):
   """This proto holds rules and the strategy used to evaluate them."""
@@ -264,3 +440,103 @@ class ForemanRule(rdf_structs.RDFProtoStruct):
 class ForemanRules(rdf_protodict.RDFValueArray):
   """A list of rules that the foreman will apply."""
   rdf_type = ForemanRule
+
+
+class ForemanCompiledRule(object):
+  """A foreman rule with its client rules compiled to condition keys."""
+
+  def __init__(self, rule, match_mode, condition_keys):
+    self.rule = rule
+    self.created = int(rule.created)
+    self.expires = int(rule.expires)
+    self.match_mode = match_mode
+    self.condition_keys = condition_keys
+
+
+class ForemanRuleIndex(object):
+  """Foreman rules compiled for evaluating them against many clients.
+
+  Client rules which only look at the client object are compiled into set and
+  range lookups. Conditions shared by several rules, e.g. the label rules of
+  hunts started for the same labels, are evaluated once per client.
+  """
+
+  def __init__(self, rules):
+    self.conditions = {}
+    self.rules = []
+
+    for rule in rules:
+      condition_keys = []
+      for client_rule in rule.client_rule_set.rules:
+        condition = client_rule.Compile()
+        self.conditions.setdefault(condition.key, condition)
+        condition_keys.append(condition.key)
+
+      self.rules.append(
+          ForemanCompiledRule(rule, rule.client_rule_set.match_mode,
+                              condition_keys))
+
+  def GetPathsToCheck(self, compiled_rules):
+    """Returns the aff4 paths needed to evaluate the given rules."""
+    paths = set()
+    for compiled_rule in compiled_rules:
+      for key in compiled_rule.condition_keys:
+        paths.update(self.conditions[key].GetPathsToCheck())
+
+    return paths
+
+  def Match(self, compiled_rules, objects, client_id):
+    """Evaluates the given rules for a client.
+
+    Args:
+      compiled_rules: A list of ForemanCompiledRule objects of this index.
+      objects: A dict that maps fd.urn to fd for all the paths returned by
+          GetPathsToCheck.
+      client_id: An aff4 client id object.
+
+    Returns:
+      The list of ForemanRule objects which match the client.
+
+    Raises:
+      ValueError: The match mode of a rule set is of unknown value.
+    """
+    results = {}
+    cache = {}
+
+    def Evaluate(key):
+      try:
+        return results[key]
+      except KeyError:
+        result = results[key] = bool(self.conditions[key].Evaluate(
+            objects, client_id, cache))
+        return result
+
+    matching_rules = []
+    for compiled_rule in compiled_rules:
+      if compiled_rule.match_mode == ForemanClientRuleSet.MatchMode.MATCH_ALL:
+        quantifier = all
+      elif compiled_rule.match_mode == ForemanClientRuleSet.MatchMode.MATCH_ANY:
+        quantifier = any
+      else:
+        raise ValueError(
+            "Unexpected match mode value: %s" % compiled_rule.match_mode)
+
+      if quantifier(Evaluate(key) for key in compiled_rule.condition_keys):
+        matching_rules.append(compiled_rule.rule)
+
+    return matching_rules
+
+
+# Compiled indexes of recently used rule sets, keyed by their serialized form.
+_RULE_INDEX_CACHE = utils.FastStore(max_size=10)
+
+
+def GetRuleIndex(rules):
+  """Returns a ForemanRuleIndex for the rules, reusing a cached one."""
+  key = rules.SerializeToString()
+  try:
+    return _RULE_INDEX_CACHE.Get(key)
+  except KeyError:
+    index = ForemanRuleIndex(rules)
+    _RULE_INDEX_CACHE.Put(key, index)
+    return index
@@ -3,6 +3,7 @@
 
 import logging
 import operator
+import threading
 import time
 
 from grr import config
@@ -37,6 +38,12 @@ class ServerCommunicator(communicator.Communicator):
     super(ServerCommunicator, self).__init__(
         certificate=certificate, private_key=private_key)
     self.pub_key_cache = utils.FastStore(max_size=50000)
+    # Outbound session ciphers, keyed by client CN. Each entry holds the
+    # public key the cipher was encrypted for and the cipher itself.
+    self.session_cipher_cache = utils.AgeBasedCache(
+        max_size=config.CONFIG["Frontend.session_cipher_cache_size"],
+        max_age=config.CONFIG["Frontend.session_cipher_lifetime"].seconds)
+    self.passthrough_messages = config.CONFIG["Frontend.passthrough_messages"]
     # Our common name as an RDFURN.
     self.common_name = rdfvalue.RDFURN(self.certificate.GetCN())
 
@@ -72,6 +79,52 @@ class ServerCommunicator(communicator.Communicator):
     self.pub_key_cache.Put(common_name, pub_key)
     return pub_key
 
+  def _GetDestinationCipher(self, destination):
+    """Returns a session cipher for messages sent to a client.
+
+    Creating a cipher costs an RSA encryption of the session key, so just like
+    the client does for the server cipher, we reuse the cipher for each client
+    for up to Frontend.session_cipher_lifetime. A cached cipher is discarded
+    if the client's public key changes.
+
+    Args:
+      destination: The CN of the client the messages go to.
+
+    Returns:
+      A communicator.Cipher instance.
+
+    Raises:
+      communicator.UnknownClientCert: If we have no certificate for the client.
+    """
+    common_name = str(destination)
+    remote_public_key = self._GetRemotePublicKey(common_name)
+
+    try:
+      cached_key, cipher = self.session_cipher_cache.Get(common_name)
+      if (cached_key is remote_public_key or
+          cached_key.GetN() == remote_public_key.GetN()):
+        stats.STATS.IncrementCounter(
+            "grr_session_cipher_cache", fields=["hits"])
+        return cipher
+
+      self.session_cipher_cache.ExpireObject(common_name)
+      stats.STATS.IncrementCounter(
+          "grr_session_cipher_cache", fields=["invalidations"])
+    except KeyError:
+      stats.STATS.IncrementCounter(
+          "grr_session_cipher_cache", fields=["misses"])
+
+    cipher = communicator.Cipher(self.common_name, self.private_key,
+                                 remote_public_key)
+    self.session_cipher_cache.Put(common_name, (remote_public_key, cipher))
+    return cipher
+
+  def InvalidateClient(self, common_name):
+    """Drops all cached keys and ciphers for the client."""
+    common_name = str(common_name)
+    self.pub_key_cache.ExpireObject(common_name)
+    self.session_cipher_cache.ExpireObject(common_name)
+
   def VerifyMessageSignature(self, response_comms, packed_message_list, cipher,
                              cipher_verified, api_version, remote_public_key):
     """Verifies the message list signature.
@@ -154,6 +207,215 @@ class ServerCommunicator(communicator.Communicator):
     return rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED
 
 
+class _WriteBatch(object):
+  """The queue managers of the polls which are flushed together."""
+
+  def __init__(self):
+    self.managers = []
+    self.mutations = 0
+    # Set when the batch should be flushed before the window is over.
+    self.full = threading.Event()
+    # Set once the batch was written (or failed to be written).
+    self.done = threading.Event()
+    self.error = None
+
+
+class CoalescingWriteBuffer(object):
+  """Coalesces the queue manager writes of concurrent client polls.
+
+  Every poll handed to Submit() joins the current batch. The first poll in a
+  batch becomes its leader: it waits for the coalescing window to pass (or for
+  the batch to reach max_mutations), then writes the changes of all polls in
+  the batch as a single QueueManager flush. Submit() only returns once the
+  batch was written so a client is only acknowledged after its messages are
+  durable.
+  """
+
+  def __init__(self, window, max_mutations, store=None, token=None):
+    """Constructor.
+
+    Args:
+      window: The number of seconds a batch stays open for more polls.
+      max_mutations: A batch is flushed early once it holds this many changes.
+      store: The data store to write to.
+      token: The token to write with.
+    """
+    self.window = window
+    self.max_mutations = max_mutations
+    self.data_store = store or data_store.DB
+    self.token = token
+    self.lock = threading.Lock()
+    self.batch = _WriteBatch()
+
+  def Submit(self, manager):
+    """Writes the changes pending in the manager together with other polls.
+
+    Args:
+      manager: A QueueManager with pending changes.
+
+    Raises:
+      Exception: Whatever the data store raised when writing the batch.
+    """
+    mutations = manager.CountPending()
+    if not mutations:
+      return
+
+    with self.lock:
+      batch = self.batch
+      leader = not batch.managers
+      batch.managers.append(manager)
+      batch.mutations += mutations
+
+      # Later polls go into a new batch once this one is full.
+      if batch.mutations >= self.max_mutations:
+        batch.full.set()
+        self.batch = _WriteBatch()
+
+    if leader:
+      batch.full.wait(self.window)
+      with self.lock:
+        if self.batch is batch:
+          self.batch = _WriteBatch()
+
+      self._Flush(batch)
+    else:
+      batch.done.wait()
+
+    if batch.error is not None:
+      raise batch.error  # pylint: disable=raising-bad-type
+
+  def _Flush(self, batch):
+    try:
+      merged = queue_manager.QueueManager(
+          store=self.data_store, token=self.token)
+      for manager in batch.managers:
+        merged.MergePending(manager)
+      merged.Flush()
+
+      stats.STATS.IncrementCounter("grr_frontend_coalesced_flushes")
+      stats.STATS.IncrementCounter(
+          "grr_frontend_coalesced_polls", delta=len(batch.managers))
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Error writing coalesced batch: %s", e)
+      batch.error = e
+    finally:
+      batch.done.set()
+
+
+class CoalescingQueueManager(queue_manager.QueueManager):
+  """A QueueManager which flushes through a CoalescingWriteBuffer."""
+
+  def __init__(self, write_buffer, store=None, token=None):
+    super(CoalescingQueueManager, self).__init__(store=store, token=token)
+    self.write_buffer = write_buffer
+
+  def Flush(self):
+    """Blocks until the pending changes were written with the batch."""
+    try:
+      self.write_buffer.Submit(self)
+    finally:
+      self.ClearPending()
+
+
+class _DrainBatch(object):
+  """The client queues of the polls which are drained together."""
+
+  def __init__(self):
+    # Maps each client to the maximum number of tasks it can take.
+    self.max_counts = {}
+    # Set when the batch should be drained before the window is over.
+    self.full = threading.Event()
+    # Set once the queues were drained (or failed to be drained).
+    self.done = threading.Event()
+    self.results = {}
+    self.error = None
+
+
+class CoalescingQueueDrainer(object):
+  """Coalesces the task queue drains of concurrent client polls.
+
+  This works like the CoalescingWriteBuffer: the first poll in a batch waits
+  for the coalescing window to pass (or for the batch to reach max_clients),
+  then leases the tasks of all clients in the batch with a single call to
+  drain_func. Every poll gets back the tasks leased from its own queue.
+  """
+
+  def __init__(self, window, max_clients, drain_func):
+    """Constructor.
+
+    Args:
+      window: The number of seconds a batch stays open for more polls.
+      max_clients: A batch is drained early once it holds this many clients.
+      drain_func: Called with a dict mapping clients to the maximum number of
+                  tasks to lease for them, returns a dict mapping the clients
+                  to their tasks.
+    """
+    self.window = window
+    self.max_clients = max_clients
+    self.drain_func = drain_func
+    self.lock = threading.Lock()
+    self.batch = _DrainBatch()
+
+  def Drain(self, client, max_count):
+    """Leases tasks from the client's queue together with other polls.
+
+    Args:
+      client: The ClientURN of the polling client.
+      max_count: The maximum number of tasks to lease.
+
+    Returns:
+      The tasks leased for the client.
+
+    Raises:
+      Exception: Whatever the data store raised when draining the batch.
+    """
+    with self.lock:
+      batch = self.batch
+      if client in batch.max_counts:
+        # The same client is polling twice at once, the batch can only drain
+        # its queue once.
+        batch = None
+      else:
+        leader = not batch.max_counts
+        batch.max_counts[client] = max_count
+
+        # Later polls go into a new batch once this one is full.
+        if len(batch.max_counts) >= self.max_clients:
+          batch.full.set()
+          self.batch = _DrainBatch()
+
+    if batch is None:
+      return self.drain_func({client: max_count})[client]
+
+    if leader:
+      batch.full.wait(self.window)
+      with self.lock:
+        if self.batch is batch:
+          self.batch = _DrainBatch()
+
+      self._Drain(batch)
+    else:
+      batch.done.wait()
+
+    if batch.error is not None:
+      raise batch.error  # pylint: disable=raising-bad-type
+
+    return batch.results.get(client, [])
+
+  def _Drain(self, batch):
+    try:
+      batch.results = self.drain_func(batch.max_counts)
+
+      stats.STATS.IncrementCounter("grr_frontend_coalesced_drains")
+      stats.STATS.IncrementCounter(
+          "grr_frontend_coalesced_drain_polls", delta=len(batch.max_counts))
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Error draining coalesced batch: %s", e)
+      batch.error = e
+    finally:
+      batch.done.set()
+
+
 class FrontEndServer(object):
   """This is the front end server.
 
@@ -207,6 +469,43 @@ class FrontEndServer(object):
     self.well_known_flows_blacklist = set(
         config.CONFIG["Frontend.DEBUG_well_known_flows_blacklist"])
 
+    # Writes of concurrent polls can be coalesced into bulk writes.
+    self.write_buffer = None
+    if config.CONFIG["Frontend.write_coalescing_window"]:
+      self.write_buffer = CoalescingWriteBuffer(
+          config.CONFIG["Frontend.write_coalescing_window"],
+          config.CONFIG["Frontend.write_coalescing_max_mutations"],
+          store=self.data_store,
+          token=self.token)
+
+    # Task queues of concurrent polls can be leased with one bulk claim.
+    self.queue_drainer = None
+    if config.CONFIG["Frontend.drain_coalescing_window"]:
+      self.queue_drainer = CoalescingQueueDrainer(
+          config.CONFIG["Frontend.drain_coalescing_window"],
+          config.CONFIG["Frontend.drain_coalescing_max_clients"],
+          self.DrainTaskSchedulerQueues)
+
+    # Polls of clients whose queue was recently found empty skip the data
+    # store.
+    self.empty_queue_cache = None
+    if config.CONFIG["Frontend.empty_queue_cache_ttl"]:
+      self.empty_queue_cache = queue_manager.EmptyClientQueueCache(
+          config.CONFIG["Frontend.empty_queue_cache_ttl"])
+      queue_manager.CLIENT_QUEUE_NOTIFIER.AddCallback(
+          self.empty_queue_cache.Invalidate)
+
+    self.long_poll_max_timeout = config.CONFIG["Frontend.long_poll_max_timeout"]
+    self.long_poll_check_interval = config.CONFIG[
+        "Frontend.long_poll_check_interval"]
+
+    # Held polls occupy a request handler thread each, only this many of them
+    # may be held at the same time.
+    self.long_poll_slots = None
+    if config.CONFIG["Frontend.long_poll_max_concurrent"]:
+      self.long_poll_slots = threading.Semaphore(
+          config.CONFIG["Frontend.long_poll_max_concurrent"])
+
   @stats.Counted("grr_frontendserver_handle_num")
   @stats.Timed("grr_frontendserver_handle_time")
   def HandleMessageBundles(self, request_comms, response_comms):
@@ -243,7 +542,18 @@ class FrontEndServer(object):
     # Only give the client messages if we are able to receive them in a
     # reasonable time.
     if time.time() - now < 10:
-      tasks = self.DrainTaskSchedulerQueueForClient(source, required_count)
+      long_poll_timeout = min(request_comms.long_poll_timeout,
+                              self.long_poll_max_timeout)
+      if (long_poll_timeout and required_count and
+          self._AcquireLongPollSlot()):
+        try:
+          tasks = self.LongPollTaskSchedulerQueueForClient(
+              source, long_poll_timeout, max_count=required_count)
+        finally:
+          self._ReleaseLongPollSlot()
+        response_comms.long_poll_timeout = long_poll_timeout
+      else:
+        tasks = self.DrainTaskSchedulerQueueForClient(source, required_count)
       message_list.job = tasks
 
     # Encode the message_list in the response_comms using the same API version
@@ -260,6 +570,8 @@ class FrontEndServer(object):
       # client certificate - return them to the queue so we can try again later.
       with data_store.DB.GetMutationPool(token=self.token) as pool:
         queue_manager.QueueManager(token=self.token).Schedule(tasks, pool)
+      queue_manager.CLIENT_QUEUE_NOTIFIER.Notify(
+          set(task.queue for task in tasks))
       raise
 
     return source, len(messages)
@@ -291,41 +603,145 @@ class FrontEndServer(object):
 
     client = rdf_client.ClientURN(client)
 
+    # Queues known to be empty are skipped by QueryAndOwn() and
+    # MultiQueryAndOwn(), which read the version markers the cache checks.
+    if self.queue_drainer is not None:
+      return self.queue_drainer.Drain(client, max_count)
+
     start_time = time.time()
     # Drain the queue for this client
     new_tasks = queue_manager.QueueManager(token=self.token).QueryAndOwn(
         queue=client.Queue(),
         limit=max_count,
-        lease_seconds=self.message_expiry_time)
+        lease_seconds=self.message_expiry_time,
+        empty_cache=self.empty_queue_cache)
+
+    result = self._CheckLeasedTasks({client: new_tasks})[client]
+
+    stats.STATS.IncrementCounter("grr_messages_sent", len(result))
+    if result:
+      logging.debug("Drained %d messages for %s in %s seconds.",
+                    len(result), client, time.time() - start_time)
+
+    return result
+
+  def DrainTaskSchedulerQueues(self, max_counts):
+    """Drains the Task Scheduler queues of many clients at once.
+
+    This leases the tasks of all clients with a single
+    QueueManager.MultiQueryAndOwn() call and checks the retransmitted tasks of
+    all clients with a single MultiCheckStatus() call.
+
+    Args:
+       max_counts: A dict mapping ClientURNs to the maximum number of messages
+                   we will issue for the client.
+
+    Returns:
+       A dict mapping the clients to the tasks respresenting the messages
+       returned.
+    """
+    start_time = time.time()
+
+    limits = dict((client.Queue(), max_count)
+                  for client, max_count in max_counts.iteritems())
+    leased = queue_manager.QueueManager(token=self.token).MultiQueryAndOwn(
+        limits.keys(),
+        limit=limits,
+        lease_seconds=self.message_expiry_time,
+        empty_cache=self.empty_queue_cache)
+
+    result = self._CheckLeasedTasks(
+        dict((client, leased[client.Queue()]) for client in max_counts))
+
+    sent = sum(len(tasks) for tasks in result.itervalues())
+    stats.STATS.IncrementCounter("grr_messages_sent", sent)
+    if sent:
+      logging.debug("Drained %d messages for %d clients in %s seconds.", sent,
+                    len(max_counts), time.time() - start_time)
 
+    return result
+
+  def _CheckLeasedTasks(self, leased_tasks):
+    """Removes tasks which were leased before and are answered already.
+
+    Args:
+       leased_tasks: A dict mapping clients to the tasks leased from their
+                     queues.
+
+    Returns:
+       A dict mapping the clients to the tasks which should be sent.
+    """
     initial_ttl = rdf_flows.GrrMessage().task_ttl
     check_before_sending = []
-    result = []
-    for task in new_tasks:
-      if task.task_ttl < initial_ttl - 1:
-        # This message has been leased before.
-        check_before_sending.append(task)
-      else:
-        result.append(task)
+    result = {}
+    for client, tasks in leased_tasks.iteritems():
+      result[client] = []
+      for task in tasks:
+        if task.task_ttl < initial_ttl - 1:
+          # This message has been leased before.
+          check_before_sending.append((client, task))
+        else:
+          result[client].append(task)
 
     if check_before_sending:
       with queue_manager.QueueManager(token=self.token) as manager:
-        status_found = manager.MultiCheckStatus(check_before_sending)
+        status_found = manager.MultiCheckStatus(
+            [task for _, task in check_before_sending])
 
         # All messages that don't have a status yet should be sent again.
-        for task in check_before_sending:
+        for client, task in check_before_sending:
           if task not in status_found:
-            result.append(task)
+            result[client].append(task)
           else:
             manager.DeQueueClientRequest(client, task.task_id)
 
-    stats.STATS.IncrementCounter("grr_messages_sent", len(result))
-    if result:
-      logging.debug("Drained %d messages for %s in %s seconds.",
-                    len(result), client, time.time() - start_time)
-
     return result
 
+  def _AcquireLongPollSlot(self):
+    """Returns True if another request may be held open for long polling."""
+    if self.long_poll_slots is None:
+      return True
+
+    if self.long_poll_slots.acquire(False):
+      return True
+
+    stats.STATS.IncrementCounter("grr_frontend_long_polls_over_limit")
+    return False
+
+  def _ReleaseLongPollSlot(self):
+    if self.long_poll_slots is not None:
+      self.long_poll_slots.release()
+
+  def LongPollTaskSchedulerQueueForClient(self, client, timeout,
+                                          max_count=None):
+    """Drains the client's queue, waiting for tasks if there are none.
+
+    Args:
+       client: The ClientURN object specifying this client.
+       timeout: The maximum number of seconds to wait for tasks.
+       max_count: The maximum number of messages we will issue for the
+                  client. If not given, uses self.max_queue_size .
+
+    Returns:
+       The tasks respresenting the messages returned, an empty list if no tasks
+       were scheduled for the client before the timeout passed.
+    """
+    client = rdf_client.ClientURN(client)
+    stats.STATS.IncrementCounter("grr_frontend_long_polls")
+
+    deadline = time.time() + timeout
+    with queue_manager.CLIENT_QUEUE_NOTIFIER.Listen(client.Queue()) as listener:
+      while True:
+        tasks = self.DrainTaskSchedulerQueueForClient(client, max_count)
+        if tasks:
+          return tasks
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          stats.STATS.IncrementCounter("grr_frontend_long_poll_timeouts")
+          return tasks
+
+        listener.Wait(min(remaining, self.long_poll_check_interval))
 
   def ReceiveMessages(self, client_id, messages):
     """Receives and processes the messages from the source.
@@ -339,8 +755,14 @@ class FrontEndServer(object):
       messages: A list of GrrMessage RDFValues.
     """
     now = time.time()
-    with queue_manager.QueueManager(
-        token=self.token, store=self.data_store) as manager:
+    if self.write_buffer is None:
+      manager = queue_manager.QueueManager(
+          token=self.token, store=self.data_store)
+    else:
+      manager = CoalescingQueueManager(
+          self.write_buffer, token=self.token, store=self.data_store)
+
+    with manager:
       for session_id, msgs in utils.GroupBy(
           messages, operator.attrgetter("session_id")).iteritems():
 
@@ -525,6 +947,10 @@ class FrontendInit(registry.InitHook):
         "frontend_inactive_request_count", fields=[("source", str)])
     stats.STATS.RegisterEventMetric(
         "frontend_request_latency", fields=[("source", str)])
+    # Connections held by the event loop based HTTP server.
+    stats.STATS.RegisterGaugeMetric("frontend_open_connections", int)
+    stats.STATS.RegisterCounterMetric("frontend_rejected_connections")
+    stats.STATS.RegisterCounterMetric("frontend_rejected_requests")
 
     stats.STATS.RegisterEventMetric("grr_frontendserver_handle_time")
     stats.STATS.RegisterCounterMetric("grr_frontendserver_handle_num")
@@ -533,3 +959,12 @@ class FrontendInit(registry.InitHook):
 
     stats.STATS.RegisterCounterMetric(
         "grr_pub_key_cache", fields=[("type", str)])
+    stats.STATS.RegisterCounterMetric(
+        "grr_session_cipher_cache", fields=[("type", str)])
+    stats.STATS.RegisterCounterMetric("grr_frontend_coalesced_flushes")
+    stats.STATS.RegisterCounterMetric("grr_frontend_coalesced_polls")
+    stats.STATS.RegisterCounterMetric("grr_frontend_coalesced_drains")
+    stats.STATS.RegisterCounterMetric("grr_frontend_coalesced_drain_polls")
+    stats.STATS.RegisterCounterMetric("grr_frontend_long_polls")
+    stats.STATS.RegisterCounterMetric("grr_frontend_long_poll_timeouts")
+    stats.STATS.RegisterCounterMetric("grr_frontend_long_polls_over_limit")
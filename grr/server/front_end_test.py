@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 """Unittest for grr frontend server."""
 
+import threading
+import time
+
 from grr import config
 from grr.lib import communicator
 from grr.lib import flags
 from grr.lib import rdfvalue
+from grr.lib import stats
 from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import flows as rdf_flows
@@ -419,6 +423,100 @@ class GRRFEServerTest(GRRFEServerTestBase):
     # Since the server tried to send it, the ttl must be decremented
     self.assertEqual(tasks[0].task_ttl - new_tasks[0].task_ttl, 1)
 
+  def testLongPollReturnsTasksScheduledWhileWaiting(self):
+    client_queue = self.client_id.Queue()
+    notifier = queue_manager.CLIENT_QUEUE_NOTIFIER
+    # Only the notification can wake up the request in time.
+    self.server.long_poll_check_interval = 100
+
+    def ScheduleTask():
+      while client_queue not in notifier.listeners:
+        time.sleep(0.01)
+
+      flow.GRRFlow.StartFlow(
+          client_id=self.client_id,
+          flow_name=flow_test_lib.SendingFlow.__name__,
+          message_count=1,
+          token=self.token)
+
+    scheduler = threading.Thread(target=ScheduleTask)
+    scheduler.start()
+    try:
+      start = time.time()
+      tasks = self.server.LongPollTaskSchedulerQueueForClient(
+          self.client_id, 60)
+    finally:
+      scheduler.join()
+
+    self.assertEqual(len(tasks), 1)
+    self.assertLess(time.time() - start, 60)
+
+  def testEmptyQueueCacheIsInvalidatedByNewTasks(self):
+    with test_lib.ConfigOverrider({"Frontend.empty_queue_cache_ttl": 100}):
+      self.InitTestServer()
+
+    try:
+      hits = stats.STATS.GetMetricValue("grr_client_queue_empty_cache_hits")
+
+      self.assertEqual(
+          self.server.DrainTaskSchedulerQueueForClient(self.client_id, 5), [])
+      self.assertEqual(
+          self.server.DrainTaskSchedulerQueueForClient(self.client_id, 5), [])
+      self.assertEqual(
+          stats.STATS.GetMetricValue("grr_client_queue_empty_cache_hits"),
+          hits + 1)
+
+      # Tasks scheduled by this process are picked up right away.
+      flow.GRRFlow.StartFlow(
+          client_id=self.client_id,
+          flow_name=flow_test_lib.SendingFlow.__name__,
+          message_count=1,
+          token=self.token)
+      tasks = self.server.DrainTaskSchedulerQueueForClient(self.client_id, 5)
+      self.assertEqual(len(tasks), 1)
+    finally:
+      queue_manager.CLIENT_QUEUE_NOTIFIER.RemoveCallback(
+          self.server.empty_queue_cache.Invalidate)
+
+  def testLongPollTimeoutIsNegotiated(self):
+    client_id = self.client_id
+
+    class MockCommunicator(object):
+      """A fake that passes requests through unencrypted."""
+
+      def DecodeMessages(self, *unused_args):
+        return ([], client_id, 100)
+
+      def EncodeMessages(self, *unused_args, **unused_kw):
+        pass
+
+    self.server._communicator = MockCommunicator()
+    self.server.long_poll_check_interval = 0.1
+
+    # Long polling is disabled by default.
+    response_comms = rdf_flows.ClientCommunication()
+    self.server.HandleMessageBundles(
+        rdf_flows.ClientCommunication(long_poll_timeout=600), response_comms)
+    self.assertEqual(response_comms.long_poll_timeout, 0)
+
+    # The requested timeout is capped by the server.
+    self.server.long_poll_max_timeout = 1
+    response_comms = rdf_flows.ClientCommunication()
+    start = time.time()
+    self.server.HandleMessageBundles(
+        rdf_flows.ClientCommunication(long_poll_timeout=600), response_comms)
+    self.assertEqual(response_comms.long_poll_timeout, 1)
+    self.assertGreaterEqual(time.time() - start, 1)
+
+    # Past the concurrency limit, polls are answered right away.
+    self.server.long_poll_slots = threading.Semaphore(0)
+    response_comms = rdf_flows.ClientCommunication()
+    start = time.time()
+    self.server.HandleMessageBundles(
+        rdf_flows.ClientCommunication(long_poll_timeout=600), response_comms)
+    self.assertEqual(response_comms.long_poll_timeout, 0)
+    self.assertLess(time.time() - start, 1)
+
   def _ScheduleResponseAndStatus(self, client_id, flow_id):
     with queue_manager.QueueManager(token=self.token) as flow_manager:
       # Schedule a response.
@@ -504,6 +602,165 @@ class GRRFEServerTest(GRRFEServerTestBase):
         [True] * 2 + [False] * (rdf_flows.GrrMessage().task_ttl - 2))
 
 
+class CoalescingWriteBufferTest(GRRFEServerTestBase):
+  """Tests coalescing the writes of concurrent polls."""
+
+  def _MakeManager(self, session_id, response_id):
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.QueueResponse(
+        rdf_flows.GrrMessage(
+            request_id=1,
+            response_id=response_id,
+            session_id=session_id,
+            payload=rdfvalue.RDFInteger(response_id)))
+    return manager
+
+  def testConcurrentPollsAreFlushedTogether(self):
+    flow_obj = self.FlowSetup(flow_test_lib.FlowOrderTest.__name__)
+    write_buffer = front_end.CoalescingWriteBuffer(
+        window=60, max_mutations=5, token=self.token)
+
+    flushes = stats.STATS.GetMetricValue("grr_frontend_coalesced_flushes")
+    polls = stats.STATS.GetMetricValue("grr_frontend_coalesced_polls")
+
+    # The batch is flushed as soon as the fifth poll arrives, long before the
+    # window is over.
+    threads = [
+        threading.Thread(
+            target=write_buffer.Submit,
+            args=(self._MakeManager(flow_obj.session_id, i),))
+        for i in range(1, 6)
+    ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(
+        stats.STATS.GetMetricValue("grr_frontend_coalesced_flushes"),
+        flushes + 1)
+    self.assertEqual(
+        stats.STATS.GetMetricValue("grr_frontend_coalesced_polls"), polls + 5)
+
+    stored_messages = data_store.DB.ReadResponsesForRequestId(
+        flow_obj.session_id, 1, token=self.token)
+    self.assertEqual(
+        sorted(m.response_id for m in stored_messages), range(1, 6))
+
+  def testErrorsAreRaisedInEveryPoll(self):
+    write_buffer = front_end.CoalescingWriteBuffer(
+        window=0, max_mutations=5, token=self.token)
+
+    def Fail(_):
+      raise IOError("Data store is gone.")
+
+    with utils.Stubber(queue_manager.QueueManager, "Flush", Fail):
+      self.assertRaises(IOError, write_buffer.Submit,
+                        self._MakeManager("aff4:/W:1234", 1))
+
+  def testReceiveMessages(self):
+    with test_lib.ConfigOverrider({
+        "Frontend.write_coalescing_window": 0.01
+    }):
+      self.InitTestServer()
+
+    self.assertIsNotNone(self.server.write_buffer)
+
+    flow_obj = self.FlowSetup(flow_test_lib.FlowOrderTest.__name__)
+    messages = [
+        rdf_flows.GrrMessage(
+            request_id=1,
+            response_id=i,
+            session_id=flow_obj.session_id,
+            payload=rdfvalue.RDFInteger(i)) for i in range(1, 10)
+    ]
+
+    self.server.ReceiveMessages(self.client_id, messages)
+
+    stored_messages = data_store.DB.ReadResponsesForRequestId(
+        flow_obj.session_id, 1, token=self.token)
+    self.assertEqual(len(stored_messages), len(messages))
+
+
+class CoalescingQueueDrainerTest(GRRFEServerTestBase):
+  """Tests draining the queues of concurrent polls together."""
+
+  def testConcurrentPollsAreDrainedTogether(self):
+    calls = []
+
+    def Drain(max_counts):
+      calls.append(dict(max_counts))
+      return dict((client, range(max_count))
+                  for client, max_count in max_counts.iteritems())
+
+    drainer = front_end.CoalescingQueueDrainer(
+        window=60, max_clients=5, drain_func=Drain)
+
+    clients = [rdf_client.ClientURN("C.%016X" % i) for i in range(5)]
+    results = {}
+
+    def Poll(client, max_count):
+      results[client] = drainer.Drain(client, max_count)
+
+    # The batch is drained as soon as the fifth poll arrives, long before the
+    # window is over.
+    threads = [
+        threading.Thread(target=Poll, args=(client, i + 1))
+        for i, client in enumerate(clients)
+    ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(len(calls), 1)
+    self.assertEqual(sorted(calls[0]), sorted(clients))
+    for i, client in enumerate(clients):
+      self.assertEqual(results[client], range(i + 1))
+
+  def testErrorsAreRaisedInEveryPoll(self):
+
+    def Fail(_):
+      raise IOError("Data store is gone.")
+
+    drainer = front_end.CoalescingQueueDrainer(
+        window=0, max_clients=5, drain_func=Fail)
+    self.assertRaises(IOError, drainer.Drain, self.client_id, 5)
+
+  def testDrainTaskSchedulerQueues(self):
+    flow_obj = self.FlowSetup("SendingTestFlow")
+    other_client = rdf_client.ClientURN("C.1000000000000001")
+
+    manager = queue_manager.QueueManager(token=self.token)
+    with data_store.DB.GetMutationPool(token=self.token) as pool:
+      manager.Schedule([
+          rdf_flows.GrrMessage(
+              queue=other_client.Queue(),
+              session_id=flow_obj.session_id,
+              generate_task_id=True) for _ in range(3)
+      ], pool)
+
+    client_id = rdf_client.ClientURN(self.client_id)
+    result = self.server.DrainTaskSchedulerQueues({
+        client_id: 5,
+        other_client: 100
+    })
+
+    self.assertEqual(len(result[client_id]), 5)
+    for task in result[client_id]:
+      self.assertEqual(task.session_id, flow_obj.session_id)
+    self.assertEqual(len(result[other_client]), 3)
+
+  def testDrainTaskSchedulerQueueForClient(self):
+    with test_lib.ConfigOverrider({"Frontend.drain_coalescing_window": 0.01}):
+      self.InitTestServer()
+
+    self.assertIsNotNone(self.server.queue_drainer)
+
+    self.FlowSetup("SendingTestFlow")
+    tasks = self.server.DrainTaskSchedulerQueueForClient(self.client_id, 5)
+    self.assertEqual(len(tasks), 5)
+
 def main(args):
   test_lib.main(args)
 
@@ -31,6 +31,7 @@ from grr.server import grr_collections
 from grr.server import multi_type_collection
 from grr.server import output_plugin as output_plugin_lib
 from grr.server import queue_manager
+from grr.server import sequential_collection
 from grr.server.aff4_objects import aff4_grr
 from grr.server.aff4_objects import users as aff4_users
 from grr.server.hunts import results as hunts_results
@@ -118,7 +119,8 @@ class HuntRunner(object):
     # Populate the hunt object's urn with the session id.
     self.hunt_obj.urn = self.session_id = self.context.session_id
 
-  def ProcessCompletedRequests(self, notification, thread_pool):
+  def ProcessCompletedRequests(self, notification, thread_pool,
+                               prefetched=None):
     """Go through the list of requests and process the completed ones.
 
     We take a snapshot in time of all requests and responses for this hunt. We
@@ -128,14 +130,22 @@ class HuntRunner(object):
     Args:
       notification: The notification object that triggered this processing.
       thread_pool: The thread pool to process the responses on.
+      prefetched: The completed requests and responses of this hunt as returned
+        by QueueManager.MultiFetchCompletedResponses(). If not given they are
+        read here.
     """
     # First ensure that client messages are all removed. NOTE: We make a new
     # queue manager here because we want only the client messages to be removed
     # ASAP. This must happen before we actually run the hunt to ensure the
     # client requests are removed from the client queues.
     with queue_manager.QueueManager(token=self.token) as manager:
-      for request, _ in manager.FetchCompletedRequests(
-          self.session_id, timestamp=(0, notification.timestamp)):
+      if prefetched is None:
+        completed_requests = manager.FetchCompletedRequests(
+            self.session_id, timestamp=(0, notification.timestamp))
+      else:
+        completed_requests = prefetched
+
+      for request, _ in completed_requests:
         # Requests which are not destined to clients have no embedded request
         # message.
         if request.HasField("request"):
@@ -146,9 +156,15 @@ class HuntRunner(object):
     while True:
       try:
         # Here we only care about completed requests - i.e. those requests with
-        # responses followed by a status message.
-        for request, responses in self.queue_manager.FetchCompletedResponses(
-            self.session_id, timestamp=(0, notification.timestamp)):
+        # responses followed by a status message. Prefetched responses are
+        # only good for the first pass.
+        if prefetched is None:
+          completed_responses = self.queue_manager.FetchCompletedResponses(
+              self.session_id, timestamp=(0, notification.timestamp))
+        else:
+          completed_responses, prefetched = prefetched, None
+
+        for request, responses in completed_responses:
 
           if request.id == 0 or not responses:
             continue
@@ -1465,6 +1481,30 @@ class GRRHunt(flow.FlowBase):
         "OUTSTANDING": outstanding
     }
 
+  def GetClientTimesByStatus(self):
+    """Get the earliest time each client started and completed this hunt.
+
+    Only the timestamps of the collection records are needed, so the stored
+    client urns are not decoded.
+
+    Returns:
+      A dict {status: {client_urn: timestamp}} where status is one of
+      "STARTED" and "COMPLETED" and timestamps are in microseconds.
+    """
+    result = {}
+    for status, col in [
+        ("STARTED", self.AllClientsCollectionForHID(
+            self.session_id, token=self.token)),
+        ("COMPLETED", self.CompletedClientsCollectionForHID(
+            self.session_id, token=self.token)),
+    ]:
+      times = result[status] = {}
+      for timestamp, client_urn in col.Scan(
+          mode=sequential_collection.RAW_BYTES):
+        # Records are scanned in timestamp order.
+        times.setdefault(client_urn, timestamp)
+    return result
+
   def GetClientStates(self, client_list, client_chunk=50):
     """Take in a client list and return dicts with their age and hostname."""
     for client_group in utils.Grouper(client_list, client_chunk):
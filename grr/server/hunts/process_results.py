@@ -13,6 +13,7 @@ from grr.server import aff4
 
 from grr.server import aff4
 from grr.server import data_store
+from grr.server import export
 from grr.server import flow
 from grr.server import output_plugin
 from grr.server.aff4_objects import cronjobs
@@ -85,7 +86,9 @@ class ProcessHuntResultCollectionsCronFlow(cronjobs.SystemCronFlow):
       if not hasattr(plugin_def, "GetPluginForState"):
         logging.error("Invalid plugin_def: %s", plugin_def)
         continue
-      used_plugins.append((plugin_def, plugin_def.GetPluginForState(state)))
+      plugin = plugin_def.GetPluginForState(state)
+      plugin.metadata_cache = self.metadata_cache
+      used_plugins.append((plugin_def, plugin))
     return output_plugins, used_plugins
 
   def RunPlugins(self, hunt_urn, plugins, results, exceptions_by_plugin):
@@ -189,6 +192,8 @@ class ProcessHuntResultCollectionsCronFlow(cronjobs.SystemCronFlow):
   @flow.StateHandler()
   def Start(self):
     self.start_time = rdfvalue.RDFDatetime.Now()
+    # Shared by the output plugins of all the hunts processed by this run.
+    self.metadata_cache = export.ExportedMetadataCache()
 
     exceptions_by_hunt = {}
     if not self.args.max_running_time:
@@ -3,12 +3,18 @@
 
 
 
+import collections
 import itertools
+import multiprocessing
 import re
+import threading
+import time
 
+from grr import config
 from grr.lib import rdfvalue
 from grr.lib import registry
-from grr.lib import utils
+from grr.lib import stats
+from grr.server import data_store
 from grr.server import export
 
 
@@ -94,6 +100,304 @@ class InstantOutputPlugin(object):
     """
 
 
+class PipelineStageStats(object):
+  """Progress and throughput counters of a conversion pipeline stage."""
+
+  def __init__(self, name):
+    self.name = name
+    self.batches = 0
+    self.items = 0
+    self.bytes = 0
+    self.busy_time = 0.0
+    self.lock = threading.Lock()
+
+  def Record(self, items, size, busy_time):
+    with self.lock:
+      self.batches += 1
+      self.items += items
+      self.bytes += size
+      self.busy_time += busy_time
+
+    stats.STATS.IncrementCounter(
+        "instant_output_pipeline_items", delta=items, fields=[self.name])
+    stats.STATS.IncrementCounter(
+        "instant_output_pipeline_bytes", delta=size, fields=[self.name])
+    stats.STATS.RecordEvent(
+        "instant_output_pipeline_batch_latency", busy_time, fields=[self.name])
+
+  def Throughput(self):
+    """Returns the number of items processed per second of work."""
+    with self.lock:
+      if not self.busy_time:
+        return 0.0
+      return self.items / self.busy_time
+
+
+# The convert_fn of the ConversionPipeline that forked this process.
+_CONVERT_FN = None
+
+
+def _SerializeValues(values):
+  return [(value.__class__.__name__, value.SerializeToString())
+          for value in values]
+
+
+def _DeserializeValues(serialized_values):
+  return [
+      rdfvalue.RDFValue.classes[name].FromSerializedString(data)
+      for name, data in serialized_values
+  ]
+
+
+def _InitConversionProcess(convert_fn):
+  """Initializes a conversion process forked by a ConversionPipeline."""
+  global _CONVERT_FN  # pylint: disable=global-statement
+  _CONVERT_FN = convert_fn
+
+  # Data store connections of the parent must not be shared, so the process
+  # opens its own.
+  data_store.DataStoreInit().Run()
+
+
+def _ConvertInProcess(serialized_batch):
+  return _SerializeValues(_CONVERT_FN(_DeserializeValues(serialized_batch)))
+
+
+class ConversionPipeline(object):
+  """Reads, converts and writes values in concurrent stages.
+
+  The "read" stage groups the values into batches in a thread of its own, the
+  "convert" stage applies convert_fn to the batches on a pool of threads and
+  the "write" stage, i.e. the caller iterating over Run(), gets the converted
+  values in the original order.
+
+  Threads only overlap the data store reads of convert_fn. To convert on
+  several CPUs, the conversion threads can hand the batches to a pool of forked
+  processes instead, which open their own data store connections. Values are
+  passed to and from these processes serialized.
+
+  Batches that were read but not yet written are limited both in number and in
+  serialized size, so a slow writer stops the reader before too much data is
+  kept in memory.
+  """
+
+  STAGES = ["read", "convert", "write"]
+
+  def __init__(self,
+               convert_fn,
+               batch_size,
+               num_threads=None,
+               max_batches=None,
+               max_bytes=None,
+               num_processes=None):
+    """Constructor.
+
+    Args:
+      convert_fn: A function converting a list of values to an iterable of
+          converted values.
+      batch_size: Number of values passed to a single convert_fn call.
+      num_threads: Number of conversion threads. If 0, all stages run in the
+          calling thread. Defaults to InstantOutput.conversion_threads.
+      max_batches: Maximum number of batches in flight. Defaults to
+          InstantOutput.max_batches_in_flight.
+      max_bytes: Maximum size of the batches in flight. Defaults to
+          InstantOutput.max_bytes_in_flight.
+      num_processes: Number of conversion processes. If set, convert_fn runs in
+          this many forked processes instead of in num_threads threads.
+          Defaults to InstantOutput.conversion_processes.
+    """
+    if num_threads is None:
+      num_threads = config.CONFIG["InstantOutput.conversion_threads"]
+    if max_batches is None:
+      max_batches = config.CONFIG["InstantOutput.max_batches_in_flight"]
+    if max_bytes is None:
+      max_bytes = config.CONFIG["InstantOutput.max_bytes_in_flight"]
+    if num_processes is None:
+      num_processes = config.CONFIG["InstantOutput.conversion_processes"]
+
+    self.convert_fn = convert_fn
+    self.batch_size = batch_size
+    self.num_threads = num_threads
+    self.max_batches = max(max_batches, 1)
+    self.max_bytes = max_bytes
+    self.num_processes = num_processes
+    self.process_pool = None
+
+    self.stage_stats = dict(
+        (name, PipelineStageStats(name)) for name in self.STAGES)
+
+    self.cv = threading.Condition()
+    # Batches read but not yet picked up by a conversion thread.
+    self.pending = collections.deque()
+    # Converted batches by sequence number.
+    self.converted = {}
+    # Number and size of batches read but not yet written.
+    self.in_flight = 0
+    self.bytes_in_flight = 0
+    # Total number of batches, set once the reader is done.
+    self.num_batches = None
+    self.error = None
+    self.stopped = False
+
+  def _ReadBatches(self, values):
+    values = iter(values)
+    while True:
+      start = time.time()
+      batch = list(itertools.islice(values, self.batch_size))
+      if not batch:
+        return
+      size = sum(len(value.SerializeToString()) for value in batch)
+      self.stage_stats["read"].Record(len(batch), size, time.time() - start)
+      yield batch, size
+
+  def _Reader(self, values):
+    seq = 0
+    try:
+      for batch, size in self._ReadBatches(values):
+        with self.cv:
+          # A batch is always let through if nothing else is in flight, so
+          # batches bigger than max_bytes don't block forever.
+          while not self.stopped and self.in_flight and (
+              self.in_flight >= self.max_batches or
+              self.bytes_in_flight + size > self.max_bytes):
+            self.cv.wait()
+          if self.stopped:
+            return
+
+          self.pending.append((seq, batch, size))
+          self.in_flight += 1
+          self.bytes_in_flight += size
+          self.cv.notify_all()
+        seq += 1
+    except Exception as e:  # pylint: disable=broad-except
+      self._Fail(e)
+    finally:
+      with self.cv:
+        self.num_batches = seq
+        self.cv.notify_all()
+
+  def _Converter(self):
+    while True:
+      with self.cv:
+        while (not self.pending and not self.stopped and
+               self.num_batches is None):
+          self.cv.wait()
+        if self.stopped or not self.pending:
+          return
+        seq, batch, size = self.pending.popleft()
+
+      start = time.time()
+      try:
+        results = self._Convert(batch)
+      except Exception as e:  # pylint: disable=broad-except
+        self._Fail(e)
+        return
+      self.stage_stats["convert"].Record(len(batch), size, time.time() - start)
+
+      with self.cv:
+        self.converted[seq] = (results, size)
+        self.cv.notify_all()
+
+  def _Convert(self, batch):
+    if self.process_pool is None:
+      return list(self.convert_fn(batch))
+
+    return _DeserializeValues(
+        self.process_pool.apply(_ConvertInProcess,
+                                (_SerializeValues(batch),)))
+
+  def _Fail(self, error):
+    with self.cv:
+      if self.error is None:
+        self.error = error
+      self.stopped = True
+      self.cv.notify_all()
+
+  def _RunInCallingThread(self, values):
+    for batch, size in self._ReadBatches(values):
+      start = time.time()
+      results = list(self.convert_fn(batch))
+      self.stage_stats["convert"].Record(len(batch), size, time.time() - start)
+
+      start = time.time()
+      for result in results:
+        yield result
+      self.stage_stats["write"].Record(len(batch), size, time.time() - start)
+
+  def Run(self, values):
+    """Converts values, yielding the results in the order of values.
+
+    Args:
+      values: An iterable with the values to convert.
+
+    Yields:
+      Values produced by convert_fn.
+
+    Raises:
+      Exception: Any exception raised while reading or converting values is
+          raised again here.
+    """
+    num_converters = self.num_threads
+    if self.num_processes:
+      # Every conversion thread waits for one process at a time.
+      num_converters = self.num_processes
+      self.process_pool = multiprocessing.Pool(
+          self.num_processes,
+          initializer=_InitConversionProcess,
+          initargs=(self.convert_fn,))
+    elif not self.num_threads:
+      for result in self._RunInCallingThread(values):
+        yield result
+      return
+
+    threads = [
+        threading.Thread(
+            target=self._Reader, args=(values,), name="ExportPipelineReader")
+    ]
+    for i in range(num_converters):
+      threads.append(
+          threading.Thread(
+              target=self._Converter, name="ExportPipelineConverter%d" % i))
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+
+    try:
+      seq = 0
+      while True:
+        with self.cv:
+          while (self.error is None and seq not in self.converted and
+                 seq != self.num_batches):
+            self.cv.wait()
+          if self.error is not None:
+            raise self.error
+          if seq == self.num_batches:
+            return
+          results, size = self.converted.pop(seq)
+
+        start = time.time()
+        for result in results:
+          yield result
+        self.stage_stats["write"].Record(
+            len(results), size, time.time() - start)
+
+        with self.cv:
+          self.in_flight -= 1
+          self.bytes_in_flight -= size
+          self.cv.notify_all()
+        seq += 1
+    finally:
+      with self.cv:
+        self.stopped = True
+        self.cv.notify_all()
+      for thread in threads:
+        thread.join()
+      if self.process_pool is not None:
+        self.process_pool.terminate()
+        self.process_pool.join()
+        self.process_pool = None
+
+
 class InstantOutputPluginWithExportConversion(InstantOutputPlugin):
   """Instant output plugin that flattens data before exporting."""
 
@@ -101,6 +405,11 @@ class InstantOutputPluginWithExportConversion(InstantOutputPlugin):
 
   BATCH_SIZE = 5000
 
+  def __init__(self, *args, **kwargs):
+    super(InstantOutputPluginWithExportConversion, self).__init__(
+        *args, **kwargs)
+    self.metadata_cache = export.ExportedMetadataCache()
+
   def GetDefaultMetadata(self):
     """Returns metadata to be used by export converters."""
     return export.ExportedMetadata(source_urn=self.source_urn)
@@ -182,7 +491,9 @@ class InstantOutputPluginWithExportConversion(InstantOutputPlugin):
     """Generates converted values using given converter from given messages.
 
     Groups values in batches of BATCH_SIZE size and applies the converter
-    to each batch.
+    to each batch. Batches are converted concurrently by a ConversionPipeline,
+    values are yielded in the original order. Metadata of the clients the
+    messages come from is looked up in the plugin's metadata cache.
 
     Args:
       converter: ExportConverter instance.
@@ -194,19 +505,33 @@ class InstantOutputPluginWithExportConversion(InstantOutputPlugin):
     Raises:
       ValueError: if any of the GrrMessage objects doesn't have "source" set.
     """
-    for batch in utils.Grouper(grr_messages, self.BATCH_SIZE):
-      batch_with_metadata = []
+
+    def ConvertBatch(batch):
       for grr_message in batch:
         if not grr_message.source:
           raise ValueError("GrrMessage's source can't be empty")
 
+      metadata_by_client = self.metadata_cache.GetMetadata(
+          set(grr_message.source for grr_message in batch), token=self.token)
+
+      batch_with_metadata = []
+      for grr_message in batch:
         metadata = self.GetDefaultMetadata()
+        client_metadata = metadata_by_client.get(grr_message.source)
+        if client_metadata is not None:
+          default_metadata = metadata
+          metadata = export.ExportedMetadata(client_metadata)
+          metadata.source_urn = default_metadata.source_urn
+          metadata.annotations = default_metadata.annotations
+          metadata.timestamp = default_metadata.timestamp
         metadata.client_urn = grr_message.source
         batch_with_metadata.append((metadata, grr_message.payload))
 
-      for result in converter.BatchConvert(
-          batch_with_metadata, token=self.token):
-        yield result
+      return converter.BatchConvert(batch_with_metadata, token=self.token)
+
+    pipeline = ConversionPipeline(ConvertBatch, self.BATCH_SIZE)
+    for result in pipeline.Run(grr_messages):
+      yield result
 
   def ProcessValues(self, value_type, values_generator_fn):
     converter_classes = export.ExportConverter.GetConvertersByClass(value_type)
@@ -266,3 +591,14 @@ def ApplyPluginToMultiTypeCollection(plugin, output_collection,
 
   for chunk in plugin.Finish():
     yield chunk
+
+
+class InstantOutputPluginInit(registry.InitHook):
+
+  def RunOnce(self):
+    stats.STATS.RegisterCounterMetric(
+        "instant_output_pipeline_items", fields=[("stage", str)])
+    stats.STATS.RegisterCounterMetric(
+        "instant_output_pipeline_bytes", fields=[("stage", str)])
+    stats.STATS.RegisterEventMetric(
+        "instant_output_pipeline_batch_latency", fields=[("stage", str)])
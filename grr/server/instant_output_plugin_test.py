@@ -2,6 +2,8 @@
 """Tests for grr.lib.output_plugin."""
 
 
+import os
+
 from grr.lib import flags
 from grr.lib import rdfvalue
 from grr.lib.rdfvalues import client as rdf_client
@@ -126,6 +128,60 @@ class ApplyPluginToMultiTypeCollectionTest(test_lib.GRRBaseTest):
     ])  # pyformat: disable
 
 
+class ConversionPipelineTest(test_lib.GRRBaseTest):
+  """Tests for ConversionPipeline."""
+
+  def testKeepsOrderOfValues(self):
+    values = [rdfvalue.RDFInteger(i) for i in range(1000)]
+    pipeline = instant_output_plugin.ConversionPipeline(
+        lambda batch: [v * 2 for v in batch], 7, num_threads=4, max_batches=3)
+
+    self.assertEqual(list(pipeline.Run(values)), [i * 2 for i in range(1000)])
+    for stage in pipeline.STAGES:
+      self.assertEqual(pipeline.stage_stats[stage].items, 1000)
+      self.assertEqual(pipeline.stage_stats[stage].batches, 143)
+
+  def testConvertsInProcesses(self):
+    values = [rdfvalue.RDFInteger(i) for i in range(100)]
+    pipeline = instant_output_plugin.ConversionPipeline(
+        lambda batch: [rdfvalue.RDFInteger(os.getpid()) for _ in batch],
+        10,
+        num_processes=2)
+
+    pids = list(pipeline.Run(values))
+    self.assertEqual(len(pids), 100)
+    self.assertNotIn(os.getpid(), pids)
+    self.assertIsNone(pipeline.process_pool)
+
+  def testLimitsBytesInFlight(self):
+    values = [rdfvalue.RDFString("x" * 100) for _ in range(100)]
+    in_flight = []
+
+    def Convert(batch):
+      in_flight.append(pipeline.bytes_in_flight)
+      return batch
+
+    pipeline = instant_output_plugin.ConversionPipeline(
+        Convert, 2, num_threads=4, max_batches=100, max_bytes=500)
+
+    self.assertEqual(len(list(pipeline.Run(values))), 100)
+    self.assertLessEqual(max(in_flight), 500)
+
+  def testRaisesConversionErrors(self):
+
+    def Convert(batch):
+      if batch[0] >= 50:
+        raise ValueError("Conversion failed.")
+      return batch
+
+    values = [rdfvalue.RDFInteger(i) for i in range(1000)]
+    pipeline = instant_output_plugin.ConversionPipeline(
+        Convert, 10, num_threads=4)
+
+    with self.assertRaises(ValueError):
+      list(pipeline.Run(values))
+
+
 class DummySrcValue1(rdfvalue.RDFString):
   pass
 
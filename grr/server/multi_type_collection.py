@@ -88,7 +88,8 @@ class MultiTypeCollection(object):
                  type_name,
                  after_timestamp=None,
                  include_suffix=False,
-                 max_records=None):
+                 max_records=None,
+                 mode=sequential_collection.VALUES):
     """Scans for stored records.
 
     Scans through the collection, returning stored values ordered by timestamp.
@@ -105,6 +106,8 @@ class MultiTypeCollection(object):
       max_records: The maximum number of records to return. Defaults to
         unlimited.
 
+      mode: The scan mode, see SequentialCollection.Scan.
+
     Yields:
       Pairs (timestamp, rdf_value), indicating that rdf_value was stored at
       timestamp.
@@ -116,7 +119,8 @@ class MultiTypeCollection(object):
     for item in sub_collection.Scan(
         after_timestamp=after_timestamp,
         include_suffix=include_suffix,
-        max_records=max_records):
+        max_records=max_records,
+        mode=mode):
       yield item
 
   def LengthByType(self, type_name):
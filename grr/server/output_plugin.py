@@ -111,6 +111,10 @@ class OutputPlugin(object):
   description = ""
   args_type = None
 
+  # ExportedMetadataCache that plugins exporting values may use. Set by the
+  # code running the plugin to share clients metadata between plugins.
+  metadata_cache = None
+
   def __init__(self,
                source_urn=None,
                output_base_urn=None,
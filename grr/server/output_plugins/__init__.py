@@ -13,5 +13,11 @@ except ImportError:
 
 from grr.server.output_plugins import csv_plugin
 from grr.server.output_plugins import email_plugin
+
+try:
+  from grr.server.output_plugins import parquet_plugin
+except ImportError:
+  pass
+
 from grr.server.output_plugins import sqlite_plugin
 from grr.server.output_plugins import yaml_plugin
@@ -104,7 +104,8 @@ class BigQueryOutputPlugin(output_plugin.OutputPluginWithOutputStreams):
           default_metadata,
           responses,
           token=self.token,
-          options=self.args.export_options)
+          options=self.args.export_options,
+          metadata_cache=self.metadata_cache)
     else:
       converted_responses = responses
 
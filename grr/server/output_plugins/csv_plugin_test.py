@@ -65,16 +65,14 @@ class CSVInstantOutputPluginTest(test_plugins.InstantOutputPluginTestBase):
             zip_fd.open("%s/ExportedFile/from_StatEntry.csv" % prefix)))
     self.assertEqual(len(parsed_output), 10)
     for i in range(10):
-      # Only the client_urn is filled in by the plugin. Doing lookups for
-      # all the clients metadata is possible but expensive. It doesn't seem to
-      # be worth it.
       self.assertEqual(parsed_output[i]["metadata.client_urn"], self.client_id)
-      self.assertEqual(parsed_output[i]["metadata.hostname"], "")
-      self.assertEqual(parsed_output[i]["metadata.mac_address"], "")
+      self.assertEqual(parsed_output[i]["metadata.hostname"], "Host-0")
+      self.assertEqual(parsed_output[i]["metadata.mac_address"],
+                       "aabbccddee00\nbbccddeeff00")
       self.assertEqual(parsed_output[i]["metadata.source_urn"],
                        self.results_urn)
       self.assertEqual(parsed_output[i]["metadata.hardware_info.bios_version"],
-                       "")
+                       "Bios-Version-0")
 
       self.assertEqual(parsed_output[i]["urn"],
                        self.client_id.Add("/fs/os/foo/bar").Add(str(i)))
@@ -125,12 +123,10 @@ class CSVInstantOutputPluginTest(test_plugins.InstantOutputPluginTestBase):
             zip_fd.open("%s/ExportedFile/from_StatEntry.csv" % prefix)))
     self.assertEqual(len(parsed_output), 1)
 
-    # Only the client_urn is filled in by the plugin. Doing lookups for
-    # all the clients metadata is possible but expensive. It doesn't seem to
-    # be worth it.
     self.assertEqual(parsed_output[0]["metadata.client_urn"], self.client_id)
-    self.assertEqual(parsed_output[0]["metadata.hostname"], "")
-    self.assertEqual(parsed_output[0]["metadata.mac_address"], "")
+    self.assertEqual(parsed_output[0]["metadata.hostname"], "Host-0")
+    self.assertEqual(parsed_output[0]["metadata.mac_address"],
+                     "aabbccddee00\nbbccddeeff00")
     self.assertEqual(parsed_output[0]["metadata.source_urn"], self.results_urn)
     self.assertEqual(parsed_output[0]["urn"],
                      self.client_id.Add("/fs/os/foo/bar"))
@@ -141,8 +137,9 @@ class CSVInstantOutputPluginTest(test_plugins.InstantOutputPluginTestBase):
     self.assertEqual(len(parsed_output), 1)
 
     self.assertEqual(parsed_output[0]["metadata.client_urn"], self.client_id)
-    self.assertEqual(parsed_output[0]["metadata.hostname"], "")
-    self.assertEqual(parsed_output[0]["metadata.mac_address"], "")
+    self.assertEqual(parsed_output[0]["metadata.hostname"], "Host-0")
+    self.assertEqual(parsed_output[0]["metadata.mac_address"],
+                     "aabbccddee00\nbbccddeeff00")
     self.assertEqual(parsed_output[0]["metadata.source_urn"], self.results_urn)
     self.assertEqual(parsed_output[0]["pid"], "42")
 
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- mode: python; encoding: utf-8 -*-
+"""Tests for the Parquet instant output plugin."""
+
+import datetime
+import io
+import os
+import zipfile
+
+import pyarrow
+from pyarrow import parquet
+import yaml
+
+from grr.lib import flags
+from grr.lib import utils
+from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import paths as rdf_paths
+from grr.server import export
+from grr.server.output_plugins import parquet_plugin
+from grr.server.output_plugins import test_plugins
+from grr.test_lib import test_lib
+
+
+class ParquetInstantOutputPluginTest(test_plugins.InstantOutputPluginTestBase):
+  """Tests the Parquet instant output plugin."""
+
+  plugin_cls = parquet_plugin.ParquetInstantOutputPlugin
+
+  STAT_ENTRY_RESPONSES = [
+      rdf_client.StatEntry(
+          pathspec=rdf_paths.PathSpec(path="/foo/bar/%d" % i, pathtype="OS"),
+          st_mode=33184,  # octal = 100640 => u=rw,g=r,o= => -rw-r-----
+          st_ino=1063090,
+          st_dev=64512L,
+          st_nlink=1 + i,
+          st_uid=139592,
+          st_gid=5000,
+          st_size=0,
+          st_atime=1493596800,  # Midnight, 01.05.2017 UTC in seconds
+          st_mtime=1493683200,  # Midnight, 02.05.2017 UTC in seconds
+          st_ctime=1493683200) for i in range(10)
+  ]
+
+  def ProcessValuesToZip(self, values_by_cls):
+    fd_path = self.ProcessValues(values_by_cls)
+    file_basename, _ = os.path.splitext(os.path.basename(fd_path))
+    return zipfile.ZipFile(fd_path), file_basename
+
+  def ReadTable(self, zip_fd, path):
+    return parquet.read_table(io.BytesIO(zip_fd.read(path)))
+
+  def testExportedFilenamesAndManifestForValuesOfSameType(self):
+    zip_fd, prefix = self.ProcessValuesToZip({
+        rdf_client.StatEntry: self.STAT_ENTRY_RESPONSES
+    })
+    self.assertEqual(
+        set(zip_fd.namelist()),
+        {"%s/MANIFEST" % prefix,
+         "%s/ExportedFile/from_StatEntry.parquet" % prefix})
+    parsed_manifest = yaml.load(zip_fd.read("%s/MANIFEST" % prefix))
+    self.assertEqual(parsed_manifest,
+                     {"export_stats": {
+                         "StatEntry": {
+                             "ExportedFile": 10
+                         }
+                     }})
+
+  def testColumnsAreNamedAndTypedAfterExportedFields(self):
+    zip_fd, prefix = self.ProcessValuesToZip({
+        rdf_client.StatEntry: self.STAT_ENTRY_RESPONSES
+    })
+    table = self.ReadTable(zip_fd,
+                           "%s/ExportedFile/from_StatEntry.parquet" % prefix)
+    self.assertEqual(table.num_rows, 10)
+
+    schema = self.plugin._GetParquetSchema(export.ExportedFile)
+    self.assertEqual(table.schema.names, schema.keys())
+    self.assertIn("metadata.client_urn", table.schema.names)
+    self.assertIn("metadata.hardware_info.bios_version", table.schema.names)
+
+    self.assertEqual(table.schema.field_by_name("st_ino").type,
+                     pyarrow.uint64())
+    self.assertEqual(table.schema.field_by_name("st_atime").type,
+                     pyarrow.timestamp("us"))
+    self.assertEqual(table.schema.field_by_name("urn").type, pyarrow.string())
+
+  def testExportedRowsForValuesOfSameType(self):
+    zip_fd, prefix = self.ProcessValuesToZip({
+        rdf_client.StatEntry: self.STAT_ENTRY_RESPONSES
+    })
+    rows = self.ReadTable(
+        zip_fd, "%s/ExportedFile/from_StatEntry.parquet" % prefix).to_pydict()
+    for i in range(10):
+      self.assertEqual(rows["metadata.client_urn"][i], self.client_id)
+      self.assertEqual(rows["metadata.hostname"][i], "Host-0")
+      self.assertEqual(rows["metadata.source_urn"][i], self.results_urn)
+      self.assertEqual(rows["urn"][i],
+                       self.client_id.Add("/fs/os/foo/bar").Add(str(i)))
+      self.assertEqual(rows["st_mode"][i], "-rw-r-----")
+      self.assertEqual(rows["st_ino"][i], 1063090)
+      self.assertEqual(rows["st_nlink"][i], 1 + i)
+      self.assertEqual(rows["st_atime"][i], datetime.datetime(2017, 5, 1))
+      self.assertEqual(rows["st_mtime"][i], datetime.datetime(2017, 5, 2))
+      self.assertIsNone(rows["symlink"][i])
+
+  def testExportedFilenamesAndManifestForValuesOfMultipleTypes(self):
+    zip_fd, prefix = self.ProcessValuesToZip({
+        rdf_client.StatEntry: [
+            rdf_client.StatEntry(pathspec=rdf_paths.PathSpec(
+                path="/foo/bar", pathtype="OS"))
+        ],
+        rdf_client.Process: [rdf_client.Process(pid=42)]
+    })
+    self.assertEqual(
+        set(zip_fd.namelist()),
+        {"%s/MANIFEST" % prefix,
+         "%s/ExportedFile/from_StatEntry.parquet" % prefix,
+         "%s/ExportedProcess/from_Process.parquet" % prefix})
+
+    parsed_manifest = yaml.load(zip_fd.read("%s/MANIFEST" % prefix))
+    self.assertEqual(parsed_manifest, {
+        "export_stats": {
+            "StatEntry": {
+                "ExportedFile": 1
+            },
+            "Process": {
+                "ExportedProcess": 1
+            }
+        }
+    })
+
+    rows = self.ReadTable(
+        zip_fd,
+        "%s/ExportedProcess/from_Process.parquet" % prefix).to_pydict()
+    self.assertEqual(rows["pid"], [42])
+
+  def testLargeExportIsSplitIntoRowGroups(self):
+    num_rows = 25
+    responses = []
+    for i in range(num_rows):
+      responses.append(
+          rdf_client.StatEntry(pathspec=rdf_paths.PathSpec(
+              path="/foo/bar/%d" % i, pathtype="OS")))
+
+    with utils.Stubber(parquet_plugin.ParquetInstantOutputPlugin,
+                       "ROW_GROUP_SIZE", 10):
+      zip_fd, prefix = self.ProcessValuesToZip({
+          rdf_client.StatEntry: responses
+      })
+
+    parquet_file = parquet.ParquetFile(
+        io.BytesIO(
+            zip_fd.read("%s/ExportedFile/from_StatEntry.parquet" % prefix)))
+    self.assertEqual(parquet_file.num_row_groups, 3)
+
+    rows = parquet_file.read(columns=["urn"]).to_pydict()
+    self.assertEqual(rows["urn"], [
+        self.client_id.Add("/fs/os/foo/bar/%d" % i) for i in range(num_rows)
+    ])
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
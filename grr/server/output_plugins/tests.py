@@ -9,5 +9,11 @@ except ImportError:
 
 from grr.server.output_plugins import csv_plugin_test
 from grr.server.output_plugins import email_plugin_test
+
+try:
+  from grr.server.output_plugins import parquet_plugin_test
+except ImportError:
+  pass
+
 from grr.server.output_plugins import sqlite_plugin_test
 from grr.server.output_plugins import yaml_plugin_test
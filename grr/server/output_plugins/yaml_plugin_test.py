@@ -64,11 +64,9 @@ class YamlInstantOutputPluginTest(test_plugins.InstantOutputPluginTestBase):
         zip_fd.read("%s/ExportedFile/from_StatEntry.yaml" % prefix))
     self.assertEqual(len(parsed_output), 10)
     for i in range(10):
-      # Only the client_urn is filled in by the plugin. Doing lookups for
-      # all the clients metadata is possible but expensive. It doesn't seem to
-      # be worth it.
       self.assertEqual(parsed_output[i]["metadata"]["client_urn"],
                        str(self.client_id))
+      self.assertEqual(parsed_output[i]["metadata"]["hostname"], "Host-0")
       self.assertEqual(parsed_output[i]["metadata"]["source_urn"],
                        str(self.results_urn))
       self.assertEqual(parsed_output[i]["urn"],
@@ -118,9 +116,6 @@ class YamlInstantOutputPluginTest(test_plugins.InstantOutputPluginTestBase):
         zip_fd.read("%s/ExportedFile/from_StatEntry.yaml" % prefix))
     self.assertEqual(len(parsed_output), 1)
 
-    # Only the client_urn is filled in by the plugin. Doing lookups for
-    # all the clients metadata is possible but expensive. It doesn't seem to
-    # be worth it.
     self.assertEqual(parsed_output[0]["metadata"]["client_urn"],
                      str(self.client_id))
     self.assertEqual(parsed_output[0]["metadata"]["source_urn"],
@@ -6,6 +6,7 @@ import logging
 import os
 import random
 import socket
+import threading
 import time
 
 from grr import config
@@ -53,6 +54,195 @@ def _GetClientIdFromQueue(q):
   return str_client_id
 
 
+class _QueueListener(object):
+  """A registration for wakeups of a single client queue."""
+
+  def __init__(self, notifier, queue):
+    self.notifier = notifier
+    self.queue = queue
+    self.event = threading.Event()
+
+  def __enter__(self):
+    self.notifier.Register(self)
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.notifier.Unregister(self)
+
+  def Wait(self, timeout):
+    """Waits until the queue is notified or the timeout passes.
+
+    Args:
+      timeout: The maximum number of seconds to wait.
+
+    Returns:
+      True if the queue was notified since the last call, False on timeout.
+    """
+    notified = self.event.wait(timeout)
+    self.event.clear()
+    return notified
+
+
+class ClientQueueNotifier(object):
+  """Wakes up threads of this process waiting for tasks on client queues.
+
+  Listeners must be registered before the queue is checked for tasks, so
+  that no notification sent in between can be missed:
+
+    with CLIENT_QUEUE_NOTIFIER.Listen(client_id.Queue()) as listener:
+      while not tasks:
+        listener.Wait(timeout)
+        ...
+
+  Notifications are only delivered within a single process. Tasks scheduled
+  by other processes have to be picked up by polling the queue.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.listeners = {}
+    self.callbacks = []
+
+  def Listen(self, queue):
+    return _QueueListener(self, rdfvalue.RDFURN(queue))
+
+  def Register(self, listener):
+    with self.lock:
+      self.listeners.setdefault(listener.queue, set()).add(listener)
+
+  def Unregister(self, listener):
+    with self.lock:
+      listeners = self.listeners.get(listener.queue)
+      if listeners is not None:
+        listeners.discard(listener)
+        if not listeners:
+          del self.listeners[listener.queue]
+
+  def AddCallback(self, callback):
+    """Calls callback with the queues of every notification."""
+    with self.lock:
+      self.callbacks.append(callback)
+
+  def RemoveCallback(self, callback):
+    with self.lock:
+      self.callbacks.remove(callback)
+
+  def Notify(self, queues):
+    """Wakes up all listeners of the given queues."""
+    for callback in self.callbacks:
+      callback(queues)
+
+    if not self.listeners:
+      return
+
+    with self.lock:
+      for queue in queues:
+        for listener in self.listeners.get(queue, ()):
+          listener.event.set()
+
+
+CLIENT_QUEUE_NOTIFIER = ClientQueueNotifier()
+
+
+class EmptyClientQueueCache(object):
+  """Remembers which client queues were found empty.
+
+  Polls of clients whose queue is known to be empty don't need to lease from
+  the queue. Tasks scheduled by this process invalidate their queues through
+  the CLIENT_QUEUE_NOTIFIER. Tasks scheduled by other processes are detected
+  through the version marker QueueManager.Schedule() bumps: an entry is only
+  trusted while the queue's version is the one read before the queue was found
+  empty. Tasks whose lease ran out are only picked up once the entry expires.
+
+  Readers take the time and the queue version before reading a queue and pass
+  them to MarkEmpty(). A queue which was invalidated while it was being read is
+  not marked empty.
+  """
+
+  def __init__(self, ttl, max_size=100000):
+    """Constructor.
+
+    Args:
+      ttl: The number of seconds a queue is considered empty after it was read.
+      max_size: The maximum number of queues to remember.
+    """
+    self.ttl = ttl
+    self.max_size = max_size
+    self.lock = threading.Lock()
+    # Maps queues to the time they were read and found empty and the version
+    # they had at that time.
+    self.empty = {}
+    # Maps queues to the time they were last invalidated.
+    self.invalidated = {}
+    self.next_expiry = time.time() + ttl
+
+  def IsEmpty(self, queue, version=None):
+    """Returns True if the queue is known to be empty.
+
+    Args:
+      queue: The queue to check.
+      version: The current version marker of the queue.
+    """
+    now = time.time()
+    with self.lock:
+      entry = self.empty.get(queue)
+      if entry is None:
+        return False
+
+      read_time, empty_version = entry
+      if read_time + self.ttl < now or empty_version != version:
+        del self.empty[queue]
+        return False
+
+    stats.STATS.IncrementCounter("grr_client_queue_empty_cache_hits")
+    return True
+
+  def MarkEmpty(self, queue, read_time, version=None):
+    """Remembers that the queue was empty.
+
+    Args:
+      queue: The queue which was read.
+      read_time: The time.time() taken before the queue was read.
+      version: The version marker of the queue read before the queue was read.
+    """
+    now = time.time()
+    with self.lock:
+      self._Expire(now)
+
+      if read_time + self.ttl < now:
+        return
+
+      if self.invalidated.get(queue, 0) >= read_time:
+        return
+
+      if len(self.empty) < self.max_size:
+        self.empty[queue] = (read_time, version)
+
+  def Invalidate(self, queues):
+    """Forgets that the queues were empty."""
+    now = time.time()
+    with self.lock:
+      self._Expire(now)
+
+      for queue in queues:
+        self.empty.pop(queue, None)
+        self.invalidated[queue] = now
+
+  def _Expire(self, now):
+    """Drops entries which are older than the ttl, at most once per ttl."""
+    if now < self.next_expiry:
+      return
+
+    self.next_expiry = now + self.ttl
+    deadline = now - self.ttl
+    for queue, (read_time, _) in self.empty.items():
+      if read_time < deadline:
+        del self.empty[queue]
+    for queue, timestamp in self.invalidated.items():
+      if timestamp < deadline:
+        del self.invalidated[queue]
+
+
 class QueueManager(object):
   """This class manages the representation of the flow within the data store.
 
@@ -87,6 +277,8 @@ class QueueManager(object):
 
   TASK_PREDICATE_PREFIX = "task:"
   TASK_PREDICATE_TEMPLATE = TASK_PREDICATE_PREFIX + "%s"
+  # Changes whenever tasks are scheduled on a queue.
+  QUEUE_VERSION_ATTRIBUTE = "metadata:queue_version"
 
   STUCK_PRIORITY = "Flow stuck"
 
@@ -240,6 +432,53 @@ class QueueManager(object):
         if total_size > limit:
           raise MoreDataException()
 
+  def MultiFetchCompletedResponses(self, notifications, limit=10000):
+    """Fetches completed requests and their responses for many flows at once.
+
+    Each flow is read up to the timestamp of its notification, just like the
+    flow runner does. Flows which don't fit into the response limit are left
+    out and have to be read with FetchCompletedResponses().
+
+    Args:
+      notifications: The notifications of the flows to read.
+      limit: The maximum number of responses to read in total.
+
+    Returns:
+      A dict mapping session ids to lists of (request, responses) tuples in
+      ascending order of request ids.
+    """
+    if not notifications:
+      return {}
+
+    completed_requests = self.data_store.MultiReadCompletedRequests(
+        {n.session_id: (0, n.timestamp) for n in notifications},
+        limit=self.request_limit,
+        token=self.token)
+
+    result = {}
+    session_ids = {}
+    request_list = []
+    total_size = 0
+    for notification in notifications:
+      session_id = notification.session_id
+      requests = completed_requests.get(session_id, [])
+      size = sum(status.response_id for _, status in requests)
+      if total_size + size > limit:
+        continue
+
+      total_size += size
+      result[session_id] = []
+      session_ids[utils.SmartUnicode(session_id)] = session_id
+      request_list.extend(request for request, _ in requests)
+
+    if request_list:
+      for request, responses in self.data_store.ReadResponses(
+          request_list, token=self.token):
+        session_id = session_ids[utils.SmartUnicode(request.session_id)]
+        result[session_id].append((request, responses))
+
+    return result
+
   def FetchRequestsAndResponses(self, session_id, timestamp=None):
     """Fetches all outstanding requests and responses for this flow.
 
@@ -323,12 +562,22 @@ class QueueManager(object):
               timestamp=timestamp,
               mutation_pool=mutation_pool)
 
+    # The new client messages are written now, wake up any frontend threads
+    # which are waiting for them.
+    if self.new_client_messages:
+      CLIENT_QUEUE_NOTIFIER.Notify(
+          set(msg.queue for msg, _ in self.new_client_messages))
+
     if self.notifications:
       for notification in self.notifications.itervalues():
         self.NotifyQueue(notification, mutation_pool=mutation_pool)
 
       mutation_pool.Flush()
 
+    self.ClearPending()
+
+  def ClearPending(self):
+    """Drops all the changes which have not been flushed yet."""
     self.request_queue = []
     self.response_queue = []
     self.requests_to_delete = []
@@ -337,6 +586,32 @@ class QueueManager(object):
     self.notifications = {}
     self.new_client_messages = []
 
+  def CountPending(self):
+    """Returns the number of changes which have not been flushed yet."""
+    return (len(self.request_queue) + len(self.response_queue) +
+            len(self.requests_to_delete) + len(self.new_client_messages) +
+            len(self.notifications) +
+            sum(len(x) for x in self.client_messages_to_delete.itervalues()))
+
+  def MergePending(self, other):
+    """Adds the changes pending in another queue manager to this one.
+
+    Args:
+      other: A QueueManager. Its pending changes are not cleared.
+    """
+    self.request_queue.extend(other.request_queue)
+    self.response_queue.extend(other.response_queue)
+    self.requests_to_delete.extend(other.requests_to_delete)
+    self.new_client_messages.extend(other.new_client_messages)
+
+    for client_id, task_ids in other.client_messages_to_delete.iteritems():
+      self.client_messages_to_delete.setdefault(client_id, []).extend(task_ids)
+
+    # Notifications already carry their timestamp, re-queueing them keeps only
+    # the one with the highest last_status per session and timestamp.
+    for notification in other.notifications.itervalues():
+      self.QueueNotification(notification, timestamp=notification.timestamp)
+
   def QueueResponse(self, response, timestamp=None):
     """Queues the message on the flow's state."""
     if timestamp is None:
@@ -433,6 +708,22 @@ class QueueManager(object):
                             for task in queued_tasks])
 
         mutation_pool.MultiSet(queue, to_schedule, timestamp=timestamp)
+        mutation_pool.Set(queue, self.QUEUE_VERSION_ATTRIBUTE,
+                          utils.PRNG.GetULong())
+
+  def GetQueueVersions(self, queues):
+    """Returns a dict mapping the queues to their current version markers."""
+    by_subject = dict((utils.SmartUnicode(queue), queue) for queue in queues)
+    result = dict((queue, None) for queue in queues)
+    for subject, values in self.data_store.MultiResolvePrefix(
+        queues,
+        self.QUEUE_VERSION_ATTRIBUTE,
+        timestamp=self.data_store.NEWEST_TIMESTAMP,
+        token=self.token):
+      for _, version, _ in values:
+        result[by_subject[utils.SmartUnicode(subject)]] = version
+
+    return result
 
   def _SortByPriority(self, notifications, queue, output_dict=None):
     """Sort notifications by priority into output_dict."""
@@ -480,6 +771,25 @@ class QueueManager(object):
 
     return self._SortByPriority(output_dict.values(), queue)
 
+  def GetNotificationsByPriorityForShards(self, queue, shards):
+    """Same as GetNotificationsByPriority but for the given shards only.
+
+    Used by workers which own a fixed subset of the shards.
+
+    Args:
+      queue: usually rdfvalue.RDFURN("aff4:/W")
+      shards: Indexes of the shards to read, 0 being the queue itself.
+    Returns:
+      dict of notifications objects keyed by priority.
+    """
+    all_shards = self.GetAllNotificationShards(queue)
+    output_dict = {}
+    for shard in shards:
+      self._GetUnsortedNotifications(
+          all_shards[shard], notifications_by_session_id=output_dict)
+
+    return self._SortByPriority(output_dict.values(), queue)
+
   def GetNotifications(self, queue):
     """Returns all queue notifications sorted by priority."""
     queue_shard = self.GetNotificationShard(queue)
@@ -657,13 +967,15 @@ class QueueManager(object):
     """Deletes a queue - all tasks will be lost."""
     self.data_store.DeleteSubject(queue, token=self.token)
 
-  def QueryAndOwn(self, queue, lease_seconds=10, limit=1):
+  def QueryAndOwn(self, queue, lease_seconds=10, limit=1, empty_cache=None):
     """Returns a list of Tasks leased for a certain time.
 
     Args:
       queue: The queue to query from.
       lease_seconds: The tasks will be leased for this long.
       limit: Number of values to fetch.
+      empty_cache: An optional EmptyClientQueueCache. Queues known to be empty
+                   are not read and queues found empty are added to it.
     Returns:
         A list of GrrMessage() objects leased.
     """
@@ -672,10 +984,20 @@ class QueueManager(object):
       user = self.token.username
     # Do the real work in a transaction
     try:
+      version = None
+      if empty_cache is not None:
+        version = self.GetQueueVersions([queue])[queue]
+        if empty_cache.IsEmpty(queue, version=version):
+          return []
+
+      read_time = time.time()
       lock = self.data_store.LockRetryWrapper(
           queue, lease_time=lease_seconds, token=self.token)
-      return self._QueryAndOwn(
+      tasks = self._QueryAndOwn(
           lock.subject, lease_seconds=lease_seconds, limit=limit, user=user)
+      if empty_cache is not None and not tasks:
+        empty_cache.MarkEmpty(queue, read_time, version=version)
+      return tasks
     except data_store.DBSubjectLockError:
       # This exception just means that we could not obtain the lock on the queue
       # so we just return an empty list, let the worker sleep and come back to
@@ -685,20 +1007,150 @@ class QueueManager(object):
       logging.warning("Datastore exception: %s", e)
       return []
 
+  def MultiQueryAndOwn(self, queues, lease_seconds=10, limit=1,
+                       empty_cache=None):
+    """Leases tasks from many queues at once.
+
+    This is the batch version of QueryAndOwn(): all the queues are locked with
+    a single MultiDBSubjectLock() call, read with a single MultiResolvePrefix()
+    and the leased tasks are written back with a single ApplyMutations(). Queues
+    which are locked by someone else are skipped.
+
+    Args:
+      queues: The queues to query from.
+      lease_seconds: The tasks will be leased for this long.
+      limit: Number of values to fetch per queue, or a dict mapping each queue
+             to its own limit.
+      empty_cache: An optional EmptyClientQueueCache. Queues known to be empty
+                   are not read and queues found empty are added to it.
+    Returns:
+        A dict mapping each queue to the list of GrrMessage() objects leased
+        from it.
+    """
+    user = ""
+    if self.token:
+      user = self.token.username
+
+    result = dict((queue, []) for queue in queues)
+    versions = {}
+    try:
+      if empty_cache is not None:
+        versions = self.GetQueueVersions(queues)
+        queues = [
+            queue for queue in queues
+            if not empty_cache.IsEmpty(queue, version=versions[queue])
+        ]
+        if not queues:
+          return result
+
+      read_time = time.time()
+      locks = self.data_store.MultiDBSubjectLock(
+          queues, lease_time=lease_seconds, token=self.token)
+    except data_store.Error as e:
+      logging.warning("Datastore exception: %s", e)
+      return result
+
+    if not locks:
+      return result
+
+    try:
+      by_subject = dict((utils.SmartUnicode(queue), queue) for queue in locks)
+      lease = long(lease_seconds * 1e6)
+      mutation_pool = self.data_store.GetMutationPool(token=self.token)
+
+      for subject, values in self.data_store.MultiResolvePrefix(
+          by_subject,
+          self.TASK_PREDICATE_PREFIX,
+          timestamp=(0, self.frozen_timestamp or rdfvalue.RDFDatetime.Now()),
+          token=self.token):
+        queue = by_subject[utils.SmartUnicode(subject)]
+        if isinstance(limit, dict):
+          queue_limit = limit[queue]
+        else:
+          queue_limit = limit
+
+        # ResolvePrefix() returns the tasks ordered by predicate, keep the
+        # same order as QueryAndOwn().
+        tasks, serialized_tasks_dict, delete_attrs = self._LeaseTasks(
+            sorted(values), queue_limit, user)
+        result[queue] = tasks
+
+        if delete_attrs or serialized_tasks_dict:
+          mutation_pool.MultiSet(
+              queue,
+              serialized_tasks_dict,
+              replace=True,
+              timestamp=long(time.time() * 1e6) + lease,
+              to_delete=delete_attrs)
+
+        if delete_attrs:
+          logging.info("TTL exceeded for %d messages on queue %s",
+                       len(delete_attrs), queue)
+
+      if mutation_pool.Size():
+        self.data_store.ApplyMutations(
+            mutation_pool, sync=True, token=self.token)
+
+      if empty_cache is not None:
+        for queue in locks:
+          if not result[queue]:
+            empty_cache.MarkEmpty(
+                queue, read_time, version=versions.get(queue))
+    except data_store.Error as e:
+      logging.warning("Datastore exception: %s", e)
+      return dict((queue, []) for queue in result)
+    finally:
+      self.data_store.ReleaseDBSubjectLocks(locks.values())
+
+    return result
+
   def _QueryAndOwn(self, subject, lease_seconds=100, limit=1, user=""):
     """Does the real work of self.QueryAndOwn()."""
-    tasks = []
-
     lease = long(lease_seconds * 1e6)
 
     # Only grab attributes with timestamps in the past.
+    tasks, serialized_tasks_dict, delete_attrs = self._LeaseTasks(
+        self.data_store.ResolvePrefix(
+            subject,
+            self.TASK_PREDICATE_PREFIX,
+            timestamp=(0, self.frozen_timestamp or rdfvalue.RDFDatetime.Now()),
+            token=self.token), limit, user)
+
+    if delete_attrs or serialized_tasks_dict:
+      # Update the timestamp on claimed tasks to be in the future and decrement
+      # their TTLs, delete tasks with expired ttls.
+      self.data_store.MultiSet(
+          subject,
+          serialized_tasks_dict,
+          replace=True,
+          timestamp=long(time.time() * 1e6) + lease,
+          sync=True,
+          to_delete=delete_attrs,
+          token=self.token)
+
+    if delete_attrs:
+      logging.info("TTL exceeded for %d messages on queue %s",
+                   len(delete_attrs), subject)
+    return tasks
+
+  def _LeaseTasks(self, values, limit, user):
+    """Prepares up to limit tasks from a queue for leasing.
+
+    Args:
+      values: (predicate, serialized task, timestamp) tuples read from the
+              queue.
+      limit: Number of tasks to lease.
+      user: The user leasing the tasks.
+
+    Returns:
+      A tuple (tasks, serialized_tasks_dict, delete_attrs) of the leased tasks,
+      the values to write back and the attributes of tasks with an exhausted
+      ttl which have to be deleted.
+    """
+    tasks = []
     delete_attrs = set()
     serialized_tasks_dict = {}
-    for predicate, task, timestamp in self.data_store.ResolvePrefix(
-        subject,
-        self.TASK_PREDICATE_PREFIX,
-        timestamp=(0, self.frozen_timestamp or rdfvalue.RDFDatetime.Now()),
-        token=self.token):
+    for predicate, task, timestamp in values:
       task = rdf_flows.GrrMessage.FromSerializedString(task)
       task.eta = timestamp
       task.last_lease = "%s@%s:%d" % (user, socket.gethostname(), os.getpid())
@@ -718,22 +1170,7 @@ class QueueManager(object):
         if len(tasks) >= limit:
           break
 
-    if delete_attrs or serialized_tasks_dict:
-      # Update the timestamp on claimed tasks to be in the future and decrement
-      # their TTLs, delete tasks with expired ttls.
-      self.data_store.MultiSet(
-          subject,
-          serialized_tasks_dict,
-          replace=True,
-          timestamp=long(time.time() * 1e6) + lease,
-          sync=True,
-          to_delete=delete_attrs,
-          token=self.token)
-
-    if delete_attrs:
-      logging.info("TTL exceeded for %d messages on queue %s",
-                   len(delete_attrs), subject)
-    return tasks
+    return tasks, serialized_tasks_dict, delete_attrs
 
 
 class WellKnownQueueManager(QueueManager):
@@ -772,6 +1209,7 @@ class QueueManagerInit(registry.InitHook):
     # Counters used by the QueueManager.
     stats.STATS.RegisterCounterMetric("grr_task_retransmission_count")
     stats.STATS.RegisterCounterMetric("grr_task_ttl_expired_count")
+    stats.STATS.RegisterCounterMetric("grr_client_queue_empty_cache_hits")
     stats.STATS.RegisterGaugeMetric(
         "notification_queue_count",
         int,
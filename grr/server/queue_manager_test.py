@@ -70,6 +70,43 @@ class QueueManagerTest(flow_test_lib.FlowTestsBaseclass):
       # Responses contain just the status message.
       self.assertEqual(len(responses), 1)
 
+  def testMultiFetchCompletedResponses(self):
+    session_ids = [rdfvalue.SessionID(flow_name="test%d" % i) for i in range(3)]
+
+    with queue_manager.QueueManager(token=self.token) as manager:
+      for i, session_id in enumerate(session_ids):
+        # Flow i has i completed requests with one response each.
+        for request_id in range(1, i + 1):
+          manager.QueueRequest(
+              rdf_flows.RequestState(
+                  id=request_id,
+                  client_id=self.client_id,
+                  next_state="TestState",
+                  session_id=session_id))
+          manager.QueueResponse(
+              rdf_flows.GrrMessage(
+                  session_id=session_id,
+                  request_id=request_id,
+                  response_id=1,
+                  type=rdf_flows.GrrMessage.Type.STATUS))
+
+    notifications = [
+        rdf_flows.GrrNotification(
+            session_id=session_id, timestamp=rdfvalue.RDFDatetime.Now())
+        for session_id in session_ids
+    ]
+    prefetched = manager.MultiFetchCompletedResponses(notifications)
+
+    self.assertEqual(len(prefetched), 3)
+    for session_id in session_ids:
+      expected = list(manager.FetchCompletedResponses(session_id))
+      self.assertEqual([(r.id, len(rs)) for r, rs in prefetched[session_id]],
+                       [(r.id, len(rs)) for r, rs in expected])
+
+    # Flows which don't fit into the limit are left out.
+    prefetched = manager.MultiFetchCompletedResponses(notifications, limit=2)
+    self.assertEqual(sorted(prefetched), session_ids[:2])
+
   def testDeleteRequest(self):
     """Check that we can efficiently destroy a single flow request."""
     session_id = rdfvalue.SessionID(flow_name="test3")
@@ -354,6 +391,109 @@ class QueueManagerTest(flow_test_lib.FlowTestsBaseclass):
     self.assertEqual([task.priority
                       for task in tasks], [2, 2, 2, 1, 1, 1, 0, 0, 0, 0])
 
+  def testMultiQueryAndOwn(self):
+    queues = [rdfvalue.RDFURN("fooSchedule%d" % i) for i in range(3)]
+
+    manager = queue_manager.QueueManager(token=self.token)
+    with data_store.DB.GetMutationPool(token=self.token) as pool:
+      for i, queue in enumerate(queues):
+        manager.Schedule([
+            rdf_flows.GrrMessage(
+                queue=queue, session_id="aff4:/Test", generate_task_id=True)
+            for _ in range(i + 2)
+        ], pool)
+
+    # The last queue is locked by someone else so it is skipped.
+    with data_store.DB.DBSubjectLock(
+        queues[2], lease_time=100, token=self.token):
+      tasks = manager.MultiQueryAndOwn(
+          queues,
+          lease_seconds=100,
+          limit={queues[0]: 1,
+                 queues[1]: 100,
+                 queues[2]: 100})
+
+    self.assertEqual(len(tasks[queues[0]]), 1)
+    self.assertEqual(len(tasks[queues[1]]), 3)
+    self.assertEqual(tasks[queues[2]], [])
+    for task in tasks[queues[0]] + tasks[queues[1]]:
+      self.assertEqual(task.task_ttl, rdf_flows.GrrMessage.max_ttl - 1)
+
+    # Leased tasks are not handed out again and the queue locks were released.
+    tasks = manager.MultiQueryAndOwn(queues, lease_seconds=100, limit=100)
+    self.assertEqual(len(tasks[queues[0]]), 1)
+    self.assertEqual(len(tasks[queues[1]]), 0)
+    self.assertEqual(len(tasks[queues[2]]), 4)
+
+  def testQueryAndOwnSkipsQueuesKnownToBeEmpty(self):
+    test_queue = rdfvalue.RDFURN("fooSchedule")
+    empty_cache = queue_manager.EmptyClientQueueCache(ttl=100)
+    manager = queue_manager.QueueManager(token=self.token)
+
+    self.assertEqual(
+        manager.QueryAndOwn(test_queue, empty_cache=empty_cache), [])
+    self.assertTrue(empty_cache.IsEmpty(test_queue))
+
+    # Tasks scheduled without a notification, like tasks scheduled by other
+    # processes, bump the queue version which invalidates the entry.
+    with data_store.DB.GetMutationPool(token=self.token) as pool:
+      manager.Schedule([
+          rdf_flows.GrrMessage(
+              queue=test_queue, session_id="aff4:/Test", generate_task_id=True)
+      ], pool)
+    self.assertEqual(
+        len(
+            manager.QueryAndOwn(
+                test_queue, lease_seconds=100, empty_cache=empty_cache)), 1)
+
+    # Entries also expire after the ttl.
+    self.assertEqual(
+        manager.QueryAndOwn(test_queue, empty_cache=empty_cache), [])
+    version = manager.GetQueueVersions([test_queue])[test_queue]
+    self.assertTrue(empty_cache.IsEmpty(test_queue, version=version))
+    self._current_mock_time += 101
+    self.assertFalse(empty_cache.IsEmpty(test_queue, version=version))
+
+  def testMultiQueryAndOwnChecksQueueVersions(self):
+    queues = [rdfvalue.RDFURN("fooSchedule%d" % i) for i in range(2)]
+    empty_cache = queue_manager.EmptyClientQueueCache(ttl=100)
+    manager = queue_manager.QueueManager(token=self.token)
+
+    tasks = manager.MultiQueryAndOwn(queues, empty_cache=empty_cache)
+    self.assertEqual(tasks, {queues[0]: [], queues[1]: []})
+
+    with data_store.DB.GetMutationPool(token=self.token) as pool:
+      manager.Schedule([
+          rdf_flows.GrrMessage(
+              queue=queues[1], session_id="aff4:/Test", generate_task_id=True)
+      ], pool)
+
+    versions = manager.GetQueueVersions(queues)
+    self.assertIsNone(versions[queues[0]])
+    self.assertIsNotNone(versions[queues[1]])
+
+    tasks = manager.MultiQueryAndOwn(queues, empty_cache=empty_cache)
+    self.assertEqual(len(tasks[queues[0]]), 0)
+    self.assertEqual(len(tasks[queues[1]]), 1)
+
+  def testEmptyClientQueueCacheIsInvalidatedByNotifications(self):
+    test_queue = rdfvalue.RDFURN("fooSchedule")
+    empty_cache = queue_manager.EmptyClientQueueCache(ttl=100)
+    empty_cache.MarkEmpty(test_queue, time.time())
+    self.assertTrue(empty_cache.IsEmpty(test_queue))
+
+    queue_manager.CLIENT_QUEUE_NOTIFIER.AddCallback(empty_cache.Invalidate)
+    try:
+      queue_manager.CLIENT_QUEUE_NOTIFIER.Notify([test_queue])
+    finally:
+      queue_manager.CLIENT_QUEUE_NOTIFIER.RemoveCallback(empty_cache.Invalidate)
+
+    self.assertFalse(empty_cache.IsEmpty(test_queue))
+
+    # A read which started before the invalidation must not mark the queue.
+    empty_cache.MarkEmpty(test_queue, time.time() - 1)
+    self.assertFalse(empty_cache.IsEmpty(test_queue))
+
   def testUsesFrozenTimestampWhenDeletingAndFetchingNotifications(self):
     # When used in "with" statement QueueManager uses the frozen timestamp
     # when fetching and deleting data. Test that if we have 2 managers
@@ -457,6 +597,31 @@ class QueueManagerTest(flow_test_lib.FlowTestsBaseclass):
                      queue_manager._GetClientIdFromQueue(
                          MockQueue("/c.ABCDEFABCDEFABCDE/tasks")))
 
+  def testFlushWakesUpClientQueueListeners(self):
+    client_queue = rdfvalue.RDFURN("C.0000000000000001").Add("tasks")
+    other_queue = rdfvalue.RDFURN("C.0000000000000002").Add("tasks")
+    notifier = queue_manager.CLIENT_QUEUE_NOTIFIER
+
+    with notifier.Listen(client_queue) as listener:
+      with notifier.Listen(other_queue) as other_listener:
+        manager = queue_manager.QueueManager(token=self.token)
+        manager.QueueClientMessage(
+            rdf_flows.GrrMessage(
+                queue=client_queue,
+                session_id="aff4:/Test",
+                generate_task_id=True))
+
+        # Listeners are only woken up once the tasks are written.
+        self.assertFalse(listener.Wait(0))
+        manager.Flush()
+
+        self.assertTrue(listener.Wait(0))
+        self.assertFalse(listener.Wait(0))
+        self.assertFalse(other_listener.Wait(0))
+
+    self.assertNotIn(client_queue, notifier.listeners)
+    self.assertNotIn(other_queue, notifier.listeners)
+
 
 class MultiShardedQueueManagerTest(QueueManagerTest):
   """Test for QueueManager with multiple notification shards enabled."""
@@ -540,6 +705,23 @@ class MultiShardedQueueManagerTest(QueueManagerTest):
     notifications = manager.GetNotificationsForAllShards(queues.HUNTS)
     self.assertEqual(len(notifications), 2)
 
+  def testGetNotificationsByPriorityForShards(self):
+    manager = queue_manager.QueueManager(token=self.token)
+    for flow_name in ["42", "43"]:
+      manager.QueueNotification(session_id=rdfvalue.SessionID(
+          base="aff4:/hunts", queue=queues.HUNTS, flow_name=flow_name))
+      manager.Flush()
+
+    # Every notification is found in exactly one of two disjoint shard sets.
+    session_ids = []
+    for shards in [[0, 2, 4], [1, 3]]:
+      by_priority = manager.GetNotificationsByPriorityForShards(
+          queues.HUNTS, shards)
+      for notifications in by_priority.values():
+        session_ids.extend(n.session_id.Basename() for n in notifications)
+
+    self.assertEqual(sorted(session_ids), ["42", "43"])
+
   def testNotificationRequeueing(self):
     with test_lib.ConfigOverrider({"Worker.queue_shards": 1}):
       session_id = rdfvalue.SessionID(
@@ -15,6 +15,45 @@ from grr.lib.rdfvalues import protodict as rdf_protodict
 from grr.server import access_control
 from grr.server import data_store
 
+# Scan modes. By default, Scan() yields the stored values. KEYS_ONLY doesn't
+# transfer the values at all and yields None instead, RAW_BYTES yields the
+# values without decoding them. See also Fields below.
+VALUES = "values"
+KEYS_ONLY = "keys_only"
+RAW_BYTES = "raw_bytes"
+
+
+class Fields(object):
+  """A scan mode which decodes only some top level fields of the values.
+
+  The other fields of the returned values are left unset.
+  """
+
+  def __init__(self, names):
+    self.names = set(names)
+
+  def Decode(self, rdf_type, serialized, timestamp):
+    """Decodes the requested fields of a serialized value."""
+    if not hasattr(rdf_type, "type_infos"):
+      raise ValueError("Fields can only be selected from structs, not %s." %
+                       rdf_type.__name__)
+    unknown = self.names - set(rdf_type.type_infos.descriptor_names)
+    if unknown:
+      raise ValueError("%s has no fields %s." % (rdf_type.__name__,
+                                                 ", ".join(sorted(unknown))))
+
+    # Structs only decode the wire format of a field when it is accessed, so
+    # dropping the other fields here means they are never decoded.
+    rdf_value = rdf_type()
+    rdf_value.ParseFromString(serialized)
+    raw_data = rdf_value.GetRawData()
+    for name in list(raw_data):
+      if name not in self.names:
+        del raw_data[name]
+    rdf_value.SetRawData(raw_data)
+    rdf_value.age = timestamp
+    return rdf_value
+
 
 class SequentialCollection(object):
   """A sequential collection of RDFValues.
@@ -120,7 +159,11 @@ class SequentialCollection(object):
         suffix=suffix,
         mutation_pool=mutation_pool)
 
-  def Scan(self, after_timestamp=None, include_suffix=False, max_records=None):
+  def Scan(self,
+           after_timestamp=None,
+           include_suffix=False,
+           max_records=None,
+           mode=VALUES):
     """Scans for stored records.
 
     Scans through the collection, returning stored values ordered by timestamp.
@@ -136,6 +179,10 @@ class SequentialCollection(object):
       max_records: The maximum number of records to return. Defaults to
         unlimited.
 
+      mode: VALUES to return the stored values, KEYS_ONLY to return None
+        instead, RAW_BYTES to return the serialized values or a Fields object
+        to return values with only the given fields decoded.
+
     Yields:
       Pairs (timestamp, rdf_value), indicating that rdf_value was stored at
       timestamp.
@@ -146,13 +193,26 @@ class SequentialCollection(object):
       suffix = after_timestamp[1]
       after_timestamp = after_timestamp[0]
 
-    for item, timestamp, suffix in data_store.DB.CollectionScanItems(
-        self.collection_id,
-        self.RDF_TYPE,
-        after_timestamp=after_timestamp,
-        after_suffix=suffix,
-        limit=max_records,
-        token=self.token):
+    if mode == KEYS_ONLY:
+      items = ((None, timestamp, suffix)
+               for timestamp, suffix in data_store.DB.CollectionScanKeys(
+                   self.collection_id,
+                   after_timestamp=after_timestamp,
+                   after_suffix=suffix,
+                   limit=max_records,
+                   token=self.token))
+    else:
+      items = data_store.DB.CollectionScanItems(
+          self.collection_id,
+          self.RDF_TYPE if mode == VALUES else None,
+          after_timestamp=after_timestamp,
+          after_suffix=suffix,
+          limit=max_records,
+          token=self.token)
+
+    for item, timestamp, suffix in items:
+      if isinstance(mode, Fields):
+        item = mode.Decode(self.RDF_TYPE, item, timestamp)
       if include_suffix:
         yield ((timestamp, suffix), item)
       else:
@@ -243,6 +303,50 @@ class UpdaterStartHook(registry.InitHook):
     t.start()
 
 
+class RecordCounters(object):
+  """Counts the records this process adds to indexed collections.
+
+  Records are counted per collection and per bucket of their timestamps. Each
+  count is written to a counter cell ("shard") of the collection that no other
+  process writes to, so the running total can be written without reading the
+  cell first. Evicted counts are never overwritten since counting starts over
+  in a new shard.
+  """
+
+  MAX_COUNTERS = 10000
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.counters = collections.OrderedDict()
+
+  def Add(self, collection_urn, bucket):
+    """Counts a record, returns the (shard, count) pair to write."""
+    key = (collection_urn, bucket)
+    with self.lock:
+      try:
+        shard, count = self.counters.pop(key)
+      except KeyError:
+        shard, count = "%012x" % random.getrandbits(48), 0
+        while len(self.counters) >= self.MAX_COUNTERS:
+          self.counters.popitem(last=False)
+      self.counters[key] = (shard, count + 1)
+      return shard, count + 1
+
+  def Forget(self, collection_urn):
+    """Drops the counts of a collection, e.g. because it was deleted."""
+    with self.lock:
+      for key in list(self.counters):
+        if key[0] == collection_urn:
+          del self.counters[key]
+
+  def Clear(self):
+    with self.lock:
+      self.counters.clear()
+
+
+RECORD_COUNTERS = RecordCounters()
+
+
 class IndexedSequentialCollection(SequentialCollection):
   """An indexed sequential collection of RDFValues.
 
@@ -271,6 +375,12 @@ class IndexedSequentialCollection(SequentialCollection):
 
   INDEX_WRITE_DELAY = rdfvalue.Duration("3m")
 
+  # Records are counted in buckets of their timestamps. Counts of buckets older
+  # than INDEX_WRITE_DELAY are replaced by an exact count when the collection
+  # is reconciled.
+
+  COUNTER_BUCKET = rdfvalue.Duration("3m")
+
   def __init__(self, *args, **kwargs):
     super(IndexedSequentialCollection, self).__init__(*args, **kwargs)
     self._index = None
@@ -296,7 +406,7 @@ class IndexedSequentialCollection(SequentialCollection):
         self._index[i] = ts
         self._max_indexed = max(i, self._max_indexed)
 
-  def _IndexedScan(self, i, max_records=None):
+  def _IndexedScan(self, i, max_records=None, mode=VALUES):
     """Scan records starting with index i."""
     self._ReadIndex()
 
@@ -324,7 +434,8 @@ class IndexedSequentialCollection(SequentialCollection):
       for (ts, value) in self.Scan(
           after_timestamp=start_ts,
           max_records=max_records,
-          include_suffix=True):
+          include_suffix=True,
+          mode=mode):
         self._MaybeWriteIndex(idx, ts, mutation_pool)
         if idx >= i:
           yield (idx, ts, value)
@@ -343,21 +454,70 @@ class IndexedSequentialCollection(SequentialCollection):
       raise RuntimeError("Index must be >= 0")
 
   def CalculateLength(self):
+    """Returns the number of records from the stored counters."""
+    count, timestamp, counters = data_store.DB.CollectionReadCounters(
+        self.collection_id, token=self.token)
+    if count is None:
+      # The collection was never reconciled, e.g. because it was written
+      # before records were counted.
+      return self.ReconcileLength()
+    for bucket, _, bucket_count in counters:
+      if bucket >= timestamp:
+        count += bucket_count
+    return count
+
+  def ReconcileLength(self):
+    """Counts the records and stores the exact count of the older ones.
+
+    The counts of buckets older than INDEX_WRITE_DELAY are replaced with the
+    exact number of records before them. Counting scans the collection from
+    the index entry before these buckets to the end, which also updates the
+    index.
+
+    Returns:
+      The number of records in the collection.
+    """
+    _, _, counters = data_store.DB.CollectionReadCounters(
+        self.collection_id, token=self.token)
+
+    bucket_size = self.COUNTER_BUCKET.microseconds
+    reconciled = (rdfvalue.RDFDatetime.Now() -
+                  self.INDEX_WRITE_DELAY).AsMicroSecondsFromEpoch()
+    reconciled -= reconciled % bucket_size
+
     self._ReadIndex()
-    highest_index = None
-    for (i, _, _) in self._IndexedScan(self._max_indexed):
-      highest_index = i
-    if highest_index is None:
-      return 0
-    return highest_index + 1
+    start = max(i for i, (ts, _) in self._index.items() if ts < reconciled)
+    length = start
+    older = None
+    for (i, ts, _) in self._IndexedScan(start, mode=KEYS_ONLY):
+      if older is None and ts[0] >= reconciled:
+        older = i
+      length = i + 1
+    if older is None:
+      older = length
+
+    with data_store.DB.GetMutationPool(token=self.token) as mutation_pool:
+      mutation_pool.CollectionSetCount(
+          self.collection_id, older, reconciled,
+          [(bucket, shard) for bucket, shard, _ in counters
+           if bucket < reconciled])
+    return length
 
   def __len__(self):
     return self.CalculateLength()
 
   def UpdateIndex(self):
-    self._ReadIndex()
-    for _ in self._IndexedScan(self._max_indexed):
-      pass
+    """Updates the index and reconciles the record counters."""
+    self.ReconcileLength()
+
+  def Delete(self):
+    super(IndexedSequentialCollection, self).Delete()
+    RECORD_COUNTERS.Forget(str(self.collection_id))
+    _, _, counters = data_store.DB.CollectionReadCounters(
+        self.collection_id, token=self.token)
+    with data_store.DB.GetMutationPool(token=self.token) as mutation_pool:
+      mutation_pool.CollectionDeleteCounters(
+          self.collection_id, [(bucket, shard) for bucket, shard, _ in counters])
 
   @classmethod
   def StaticAdd(cls,
@@ -372,6 +532,13 @@ class IndexedSequentialCollection(SequentialCollection):
         timestamp=timestamp,
         suffix=suffix,
         mutation_pool=mutation_pool)
+
+    if not isinstance(collection_urn, rdfvalue.RDFURN):
+      collection_urn = rdfvalue.RDFURN(collection_urn)
+    bucket = r[0] - r[0] % cls.COUNTER_BUCKET.microseconds
+    shard, count = RECORD_COUNTERS.Add(str(collection_urn), bucket)
+    mutation_pool.CollectionUpdateCounter(collection_urn, bucket, shard, count)
+
     if random.randint(0, cls.INDEX_SPACING) == 0:
       BACKGROUND_INDEX_UPDATER.AddIndexToUpdate(cls, collection_urn)
     return r
@@ -398,10 +565,12 @@ class GeneralIndexedCollection(IndexedSequentialCollection):
         suffix=suffix,
         mutation_pool=mutation_pool)
 
-  def Scan(self, **kwargs):
+  def Scan(self, mode=VALUES, **kwargs):
     for (timestamp, rdf_value) in super(GeneralIndexedCollection, self).Scan(
-        **kwargs):
-      yield (timestamp, rdf_value.payload)
+        mode=mode, **kwargs):
+      if mode == VALUES:
+        rdf_value = rdf_value.payload
+      yield (timestamp, rdf_value)
 
 
 class GrrMessageCollection(IndexedSequentialCollection):
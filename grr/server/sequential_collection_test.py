@@ -75,6 +75,53 @@ class SequentialCollectionTest(aff4_test_lib.AFF4ObjectTest):
     self.assertEqual(even_results[0], 0)
     self.assertEqual(even_results[49], 98)
 
+  def testScanModes(self):
+    collection = self._TestCollection(
+        "aff4:/sequential_collection/testScanModes")
+    with data_store.DB.GetMutationPool(token=self.token) as pool:
+      for i in range(10):
+        collection.Add(rdfvalue.RDFInteger(i), mutation_pool=pool)
+
+    values = list(collection.Scan(include_suffix=True))
+    self.assertEqual(len(values), 10)
+
+    keys = list(
+        collection.Scan(
+            include_suffix=True, mode=sequential_collection.KEYS_ONLY))
+    self.assertEqual(keys, [(ts, None) for ts, _ in values])
+
+    raw = list(
+        collection.Scan(
+            include_suffix=True, mode=sequential_collection.RAW_BYTES))
+    self.assertEqual(raw, [(ts, v.SerializeToString()) for ts, v in values])
+
+    keys = list(
+        collection.Scan(
+            after_timestamp=values[4][0],
+            max_records=3,
+            mode=sequential_collection.KEYS_ONLY))
+    self.assertEqual(keys, [(ts[0], None) for ts, _ in values[5:8]])
+
+  def testScanFields(self):
+    collection = sequential_collection.GrrMessageCollection(
+        rdfvalue.RDFURN("aff4:/sequential_collection/testScanFields"),
+        token=self.token)
+    with data_store.DB.GetMutationPool(token=self.token) as pool:
+      for i in range(10):
+        collection.AddAsMessage(
+            rdfvalue.RDFInteger(i),
+            "aff4:/C.%016X" % i,
+            mutation_pool=pool)
+
+    mode = sequential_collection.Fields(["source"])
+    for i, (ts, msg) in enumerate(collection.Scan(mode=mode)):
+      self.assertEqual(msg.source, "aff4:/C.%016X" % i)
+      self.assertEqual(msg.age, ts)
+      self.assertFalse(msg.HasField("args"))
+
+    with self.assertRaises(ValueError):
+      list(collection.Scan(mode=sequential_collection.Fields(["nonexistent"])))
+
   def testDelete(self):
     collection = self._TestCollection("aff4:/sequential_collection/testDelete")
     with data_store.DB.GetMutationPool(token=self.token) as pool:
@@ -160,13 +207,15 @@ class IndexedSequentialCollectionTest(aff4_test_lib.AFF4ObjectTest):
     now = time.time() * 1e6
     ten_seconds_ago = (time.time() - 10) * 1e6
 
-    # Push the clock forward 10m, and we should build an index on access.
+    # Push the clock forward 10m, and we should build an index when the
+    # collection is updated.
     with test_lib.FakeTime(rdfvalue.RDFDatetime.Now() +
                            rdfvalue.Duration("10m")):
       # Read from start doesn't rebuild index (lazy rebuild)
       _ = collection[0]
       self.assertEqual(sorted(collection._index.keys()), [0])
 
+      collection.UpdateIndex()
       self.assertEqual(collection.CalculateLength(), 10 * 1024)
       self.assertEqual(
           sorted(collection._index.keys()),
@@ -230,6 +279,64 @@ class IndexedSequentialCollectionTest(aff4_test_lib.AFF4ObjectTest):
       # for calculating the length.
       self.assertEqual(scan.call_count, 2)
 
+  def testLengthIsReadFromCounters(self):
+    urn = "aff4:/sequential_collection/testLengthIsReadFromCounters"
+    collection = self._TestCollection(urn)
+    with data_store.DB.GetMutationPool(token=self.token) as pool:
+      for i in range(100):
+        collection.Add(rdfvalue.RDFInteger(i), mutation_pool=pool)
+    self.assertEqual(collection.CalculateLength(), 100)
+
+    with data_store.DB.GetMutationPool(token=self.token) as pool:
+      for i in range(50):
+        collection.Add(rdfvalue.RDFInteger(i), mutation_pool=pool)
+
+    with test_lib.Instrument(sequential_collection.SequentialCollection,
+                             "Scan") as scan:
+      self.assertEqual(len(self._TestCollection(urn)), 150)
+      self.assertEqual(scan.call_count, 0)
+
+  def testReconcileLength(self):
+    urn = "aff4:/sequential_collection/testReconcileLength"
+    collection = self._TestCollection(urn)
+    with data_store.DB.GetMutationPool(token=self.token) as pool:
+      for i in range(100):
+        collection.Add(rdfvalue.RDFInteger(i), mutation_pool=pool)
+
+    with test_lib.FakeTime(rdfvalue.RDFDatetime.Now() +
+                           rdfvalue.Duration("10m")):
+      self.assertEqual(collection.ReconcileLength(), 100)
+      # The counters of the old records were replaced by the exact count.
+      count, _, counters = data_store.DB.CollectionReadCounters(
+          collection.collection_id, token=self.token)
+      self.assertEqual(count, 100)
+      self.assertEqual(counters, [])
+
+      with data_store.DB.GetMutationPool(token=self.token) as pool:
+        for i in range(10):
+          collection.Add(rdfvalue.RDFInteger(i), mutation_pool=pool)
+
+      with test_lib.Instrument(sequential_collection.SequentialCollection,
+                               "Scan") as scan:
+        self.assertEqual(collection.CalculateLength(), 110)
+        self.assertEqual(scan.call_count, 0)
+
+  def testDeleteResetsLength(self):
+    urn = "aff4:/sequential_collection/testDeleteResetsLength"
+    collection = self._TestCollection(urn)
+    with data_store.DB.GetMutationPool(token=self.token) as pool:
+      for i in range(100):
+        collection.Add(rdfvalue.RDFInteger(i), mutation_pool=pool)
+    self.assertEqual(collection.CalculateLength(), 100)
+
+    collection.Delete()
+    self.assertEqual(collection.CalculateLength(), 0)
+
+    with data_store.DB.GetMutationPool(token=self.token) as pool:
+      for i in range(5):
+        collection.Add(rdfvalue.RDFInteger(i), mutation_pool=pool)
+    self.assertEqual(collection.CalculateLength(), 5)
+
   def testAutoIndexing(self):
 
     indexing_done = threading.Event()
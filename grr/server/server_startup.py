@@ -31,6 +31,17 @@ def DropPrivileges():
       raise
 
 
+def ConfigInit():
+  """Parses the configuration and sets up logging.
+
+  Unlike Init() this runs no initialization hooks, so the process can still
+  safely fork afterwards. Forked processes need to call Init().
+  """
+  config_lib.SetPlatformArchContext()
+  config_lib.ParseConfigCommandLine()
+  server_logging.ServerLoggingStartupInit()
+
+
 # Make sure we do not reinitialize multiple times.
 INIT_RAN = False
 
@@ -23,6 +23,7 @@ Example usage:
 """
 
 
+import collections
 import itertools
 import logging
 import os
@@ -531,3 +532,122 @@ class BatchConverter(object):
 
     finally:
       pool.Stop()
+
+
+class BatchPrefetcher(object):
+  """Fetches batches ahead of their consumer using a thread pool.
+
+  Batches are fetched in parallel but yielded in their original order, so
+  the consumer can work on one batch while the following ones are being
+  fetched. No new fetches are started while more than max_pending_bytes of
+  fetched data are waiting to be consumed.
+  """
+
+  def __init__(self,
+               fetch_fn,
+               threadpool_prefix="batch_prefetcher",
+               threadpool_size=4,
+               max_pending_bytes=128 * 1024 * 1024):
+    """BatchPrefetcher constructor.
+
+    Args:
+      fetch_fn: A callable taking a batch and returning a tuple (result,
+                size), where size is the number of bytes result holds.
+      threadpool_prefix: Name of the thread pool to use. The pool is shared
+                         by all prefetchers with the same name.
+      threadpool_size: Number of batches fetched in parallel. If 0, batches
+                       are fetched in the current thread when needed.
+      max_pending_bytes: Fetching pauses while fetched results of more than
+                         this many bytes have not been consumed yet.
+    """
+    super(BatchPrefetcher, self).__init__()
+    self.fetch_fn = fetch_fn
+    self.threadpool_prefix = threadpool_prefix
+    self.threadpool_size = threadpool_size
+    self.max_pending_bytes = max_pending_bytes
+
+  def Fetch(self, batches):
+    """Fetches the batches and yields (batch, result) tuples in order.
+
+    Args:
+      batches: An iterable of batches, consumed in the calling thread.
+
+    Yields:
+      Tuples (batch, result) where result was returned by fetch_fn.
+
+    Raises:
+      Any exception raised by fetch_fn, once its batch is reached.
+    """
+    if not self.threadpool_size:
+      for batch in batches:
+        result, _ = self.fetch_fn(batch)
+        yield batch, result
+      return
+
+    pool = ThreadPool.Factory(
+        self.threadpool_prefix,
+        min_threads=self.threadpool_size,
+        max_threads=self.threadpool_size)
+    pool.Start()
+
+    condition = threading.Condition()
+    # Maps the batch index to a (result, size, exception) tuple.
+    done = {}
+    state = {"in_flight": 0, "pending_bytes": 0}
+
+    def FetchBatch(index, batch):
+      result, size, exception = None, 0, None
+      try:
+        result, size = self.fetch_fn(batch)
+      except Exception as e:  # pylint: disable=broad-except
+        exception = e
+
+      with condition:
+        done[index] = (result, size, exception)
+        state["in_flight"] -= 1
+        state["pending_bytes"] += size
+        condition.notify_all()
+
+    batches_iter = enumerate(batches)
+    scheduled = collections.deque()
+    exhausted = False
+
+    while True:
+      # Schedule as many fetches as the pool size and byte budget allow.
+      while not exhausted:
+        with condition:
+          if (state["in_flight"] >= self.threadpool_size or
+              state["pending_bytes"] >= self.max_pending_bytes):
+            break
+
+        try:
+          index, batch = next(batches_iter)
+        except StopIteration:
+          exhausted = True
+          break
+
+        scheduled.append((index, batch))
+        with condition:
+          state["in_flight"] += 1
+
+        pool.AddTask(
+            target=FetchBatch,
+            args=(index, batch),
+            name="%s_%d" % (self.threadpool_prefix, index),
+            inline=False)
+
+      if not scheduled:
+        return
+
+      index, batch = scheduled.popleft()
+      with condition:
+        while index not in done:
+          condition.wait()
+
+        result, size, exception = done.pop(index)
+        state["pending_bytes"] -= size
+
+      if exception is not None:
+        raise exception
+
+      yield batch, result
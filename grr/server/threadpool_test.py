@@ -306,6 +306,81 @@ class ThreadPoolTest(test_lib.GRRBaseTest):
     pool.Stop()
 
 
+class BatchPrefetcherTest(test_lib.GRRBaseTest):
+  """BatchPrefetcher tests."""
+
+  def _Fetch(self, batch):
+    # Later batches finish first to check that the order is preserved.
+    time.sleep(0.01 * (10 - batch[0]))
+    with self.lock:
+      self.threads.add(threading.current_thread().ident)
+    return [x * 2 for x in batch], len(batch)
+
+  def setUp(self):
+    super(BatchPrefetcherTest, self).setUp()
+    self.lock = threading.Lock()
+    self.threads = set()
+
+  def testYieldsBatchesInOrder(self):
+    prefetcher = threadpool.BatchPrefetcher(
+        self._Fetch, threadpool_prefix="prefetcher_order", threadpool_size=5)
+
+    batches = [[i] for i in range(10)]
+    results = list(prefetcher.Fetch(batches))
+
+    self.assertEqual(results, [([i], [i * 2]) for i in range(10)])
+    self.assertGreater(len(self.threads), 1)
+    self.assertNotIn(threading.current_thread().ident, self.threads)
+
+  def testSingleThreadedPrefetcher(self):
+    prefetcher = threadpool.BatchPrefetcher(self._Fetch, threadpool_size=0)
+
+    batches = [[i] for i in range(10)]
+    results = list(prefetcher.Fetch(batches))
+
+    self.assertEqual(results, [([i], [i * 2]) for i in range(10)])
+    self.assertEqual(self.threads, set([threading.current_thread().ident]))
+
+  def testStopsFetchingWhenPendingBytesExceedLimit(self):
+    fetched = []
+
+    def Fetch(batch):
+      fetched.append(batch)
+      return batch, 10
+
+    prefetcher = threadpool.BatchPrefetcher(
+        Fetch,
+        threadpool_prefix="prefetcher_backpressure",
+        threadpool_size=2,
+        max_pending_bytes=20)
+
+    results = prefetcher.Fetch([[i] for i in range(10)])
+    self.assertEqual(next(results), ([0], [0]))
+
+    # Give the pool a chance to fetch more than it should.
+    time.sleep(0.2)
+    # At most two batches of 10 bytes wait, one more can be in flight.
+    self.assertLessEqual(len(fetched), 4)
+
+    self.assertEqual(len(list(results)), 9)
+    self.assertEqual(len(fetched), 10)
+
+  def testRaisesFetchErrors(self):
+
+    def Fetch(batch):
+      if batch == [3]:
+        raise IOError("Fetch failed")
+      return batch, 1
+
+    prefetcher = threadpool.BatchPrefetcher(
+        Fetch, threadpool_prefix="prefetcher_errors", threadpool_size=2)
+
+    results = prefetcher.Fetch([[i] for i in range(10)])
+    for i in range(3):
+      self.assertEqual(next(results), ([i], [i]))
+    self.assertRaises(IOError, next, results)
+
+
 class DummyConverter(threadpool.BatchConverter):
 
   def __init__(self, **kwargs):
@@ -2,8 +2,14 @@
 """Module with GRRWorker implementation."""
 
 
+import errno
+import fcntl
 import logging
+import os
 import pdb
+import select
+import signal
+import threading
 import time
 import traceback
 
@@ -16,6 +22,7 @@ from grr.lib import stats
 from grr.lib import utils
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.server import aff4
+from grr.server import data_store
 from grr.server import flow
 from grr.server import master
 from grr.server import queue_manager as queue_manager_lib
@@ -57,7 +64,8 @@ class GRRWorker(object):
                queues=queues_config.WORKER_LIST,
                threadpool_prefix="grr_threadpool",
                threadpool_size=None,
-               token=None):
+               token=None,
+               notification_shards=None):
     """Constructor.
 
     Args:
@@ -65,12 +73,16 @@ class GRRWorker(object):
       threadpool_prefix: A name for the thread pool used by this worker.
       threadpool_size: The number of workers to start in this thread pool.
       token: The token to use for the worker.
+      notification_shards: If set, the indexes of the notification shards this
+        worker owns. Only notifications in these shards are processed. By
+        default the worker reads a different shard on every run.
 
     Raises:
       RuntimeError: If the token is not provided.
     """
     logging.info("started worker with queues: " + str(queues))
     self.queues = queues
+    self.notification_shards = notification_shards
 
     # self.queued_flows is a timed cache of locked flows. If this worker
     # encounters a lock failure on a flow, it will not attempt to grab this flow
@@ -92,36 +104,72 @@ class GRRWorker(object):
 
     self.token = token
     self.last_active = 0
+    self.stopping = False
+
+    # Queue shards the notification wakeup signalled since the last run.
+    self.woken_shards = set()
+
+    # Number of flows this worker finished processing, used to report the
+    # throughput of supervised worker processes.
+    self.processed_flows = 0
+    self.processed_flows_lock = threading.Lock()
 
     # Well known flows are just instantiated.
     self.well_known_flows = flow.WellKnownFlow.GetAllWellKnownFlows(token=token)
 
+    # Regular flows are locked and loaded in batches of this size.
+    self.flow_batch_size = config.CONFIG["Worker.flow_batch_size"]
+
   def Run(self):
-    """Event loop."""
+    """Event loop.
+
+    Runs until Stop() is called. Flows that were already handed to the thread
+    pool are processed before this returns.
+    """
     try:
-      while 1:
-        if master.MASTER_WATCHER.IsMaster():
-          processed = self.RunOnce()
-        else:
-          processed = 0
-
-        if processed == 0:
-          logger = logging.getLogger()
-          for h in logger.handlers:
-            h.flush()
-
-          if time.time() - self.last_active > self.SHORT_POLL_TIME:
-            interval = self.POLLING_INTERVAL
+      with data_store.NOTIFICATION_WAKEUP.Listen(
+          self._GetListenedShards(), token=self.token) as listener:
+        while not self.stopping:
+          if master.MASTER_WATCHER.IsMaster():
+            processed = self.RunOnce()
           else:
-            interval = self.SHORT_POLLING_INTERVAL
+            processed = 0
+
+          if processed == 0:
+            logger = logging.getLogger()
+            for h in logger.handlers:
+              h.flush()
 
-          time.sleep(interval)
-        else:
-          self.last_active = time.time()
+            if time.time() - self.last_active > self.SHORT_POLL_TIME:
+              interval = self.POLLING_INTERVAL
+            else:
+              interval = self.SHORT_POLLING_INTERVAL
+
+            # New notifications wake us up early.
+            self.woken_shards = listener.Wait(interval)
+          else:
+            self.last_active = time.time()
 
     except KeyboardInterrupt:
       logging.info("Caught interrupt, exiting.")
-      self.__class__.thread_pool.Join()
+
+    self.__class__.thread_pool.Join()
+
+  def Stop(self):
+    """Makes Run() return once the flows it leased are processed."""
+    self.stopping = True
+
+  def _GetListenedShards(self):
+    """Returns the queue shards this worker reads notifications from."""
+    queue_manager = queue_manager_lib.QueueManager(token=self.token)
+    result = []
+    for queue in self.queues:
+      shards = queue_manager.GetAllNotificationShards(queue)
+      if self.notification_shards is None:
+        result.extend(shards)
+      else:
+        result.extend(shards[i] for i in self.notification_shards)
+    return result
 
   def RunOnce(self):
     """Processes one set of messages from Task Scheduler.
@@ -134,6 +182,7 @@ class GRRWorker(object):
     """
     start_time = time.time()
     processed = 0
+    woken_shards, self.woken_shards = self.woken_shards, set()
 
     queue_manager = queue_manager_lib.QueueManager(token=self.token)
     for queue in self.queues:
@@ -142,8 +191,22 @@ class GRRWorker(object):
       queue_manager.FreezeTimestamp()
 
       fetch_messages_start = time.time()
-      notifications_by_priority = queue_manager.GetNotificationsByPriority(
-          queue)
+      all_shards = queue_manager.GetAllNotificationShards(queue)
+      queue_woken_shards = [
+          i for i, shard in enumerate(all_shards) if shard in woken_shards
+      ]
+      if self.notification_shards is None and queue_woken_shards:
+        # Read the shards we were woken up for rather than the next one.
+        notifications_by_priority = (
+            queue_manager.GetNotificationsByPriorityForShards(
+                queue, queue_woken_shards))
+      elif self.notification_shards is None:
+        notifications_by_priority = queue_manager.GetNotificationsByPriority(
+            queue)
+      else:
+        notifications_by_priority = (
+            queue_manager.GetNotificationsByPriorityForShards(
+                queue, self.notification_shards))
       stats.STATS.RecordEvent("worker_time_to_retrieve_notifications",
                               time.time() - fetch_messages_start)
 
@@ -228,6 +291,7 @@ class GRRWorker(object):
     """
     now = time.time()
     processed = 0
+    batch = []
     for notification in active_notifications:
       if notification.session_id not in self.queued_flows:
         if time_limit and time.time() - now > time_limit:
@@ -235,14 +299,81 @@ class GRRWorker(object):
 
         processed += 1
         self.queued_flows.Put(notification.session_id, 1)
+
+        # Well known flows don't hold state, they are always processed one by
+        # one.
+        if (self.flow_batch_size > 1 and notification.session_id.FlowName()
+            not in self.well_known_flows):
+          batch.append(notification)
+          if len(batch) >= self.flow_batch_size:
+            self._ProcessBatch(batch, queue_manager)
+            batch = []
+          continue
+
         self.__class__.thread_pool.AddTask(
             target=self._ProcessMessages,
             args=(notification, queue_manager.Copy()),
             name=self.__class__.__name__)
 
+    if batch:
+      self._ProcessBatch(batch, queue_manager)
+
     return processed
 
-  def _ProcessRegularFlowMessages(self, flow_obj, notification):
+  def _ProcessBatch(self, notifications, queue_manager):
+    """Locks and loads a batch of flows, then processes them in the pool.
+
+    All flows are locked and opened with a single MultiOpenWithLock call and
+    their completed requests and responses are read with one more query, so
+    each flow step does not need its own data store round trips.
+
+    Args:
+      notifications: The notifications of the flows to process.
+      queue_manager: QueueManager object used to manage notifications,
+                     requests and responses.
+    """
+    try:
+      flow_objs = aff4.FACTORY.MultiOpenWithLock(
+          [notification.session_id for notification in notifications],
+          lease_time=self.flow_lease_time,
+          token=self.token)
+    except Exception as e:  # pylint: disable=broad-except
+      # Let the single flow processing deal with whatever went wrong.
+      logging.warning("Error loading a batch of flows, processing them one by "
+                      "one: %s", e)
+      for notification in notifications:
+        self.__class__.thread_pool.AddTask(
+            target=self._ProcessMessages,
+            args=(notification, queue_manager.Copy()),
+            name=self.__class__.__name__)
+      return
+
+    flow_objs_by_urn = {flow_obj.urn: flow_obj for flow_obj in flow_objs}
+    locked_notifications = []
+    for notification in notifications:
+      if notification.session_id in flow_objs_by_urn:
+        locked_notifications.append(notification)
+      else:
+        stats.STATS.IncrementCounter("worker_flow_lock_error")
+
+    try:
+      prefetched = queue_manager.MultiFetchCompletedResponses(
+          [n for n in locked_notifications
+           if isinstance(flow_objs_by_urn[n.session_id], flow.FlowBase)])
+    except Exception as e:  # pylint: disable=broad-except
+      logging.warning("Error prefetching flow responses: %s", e)
+      prefetched = {}
+
+    for notification in locked_notifications:
+      self.__class__.thread_pool.AddTask(
+          target=self._ProcessMessages,
+          args=(notification, queue_manager.Copy(),
+                flow_objs_by_urn[notification.session_id],
+                prefetched.get(notification.session_id)),
+          name=self.__class__.__name__)
+
+  def _ProcessRegularFlowMessages(self, flow_obj, notification,
+                                  prefetched=None):
     """Processes messages for a given flow."""
     session_id = notification.session_id
     if not isinstance(flow_obj, flow.FlowBase):
@@ -255,7 +386,8 @@ class GRRWorker(object):
 
     runner = flow_obj.GetRunner()
     try:
-      runner.ProcessCompletedRequests(notification, self.__class__.thread_pool)
+      runner.ProcessCompletedRequests(
+          notification, self.__class__.thread_pool, prefetched=prefetched)
     except Exception as e:  # pylint: disable=broad-except
       # Something went wrong - log it in the flow.
       runner.context.state = rdf_flows.FlowContext.State.ERROR
@@ -263,15 +395,32 @@ class GRRWorker(object):
       logging.error("Flow %s: %s", flow_obj, e)
       raise FlowProcessingError(e)
 
-  def _ProcessMessages(self, notification, queue_manager):
-    """Does the real work with a single flow."""
-    flow_obj = None
+  def _ProcessMessages(self,
+                       notification,
+                       queue_manager,
+                       flow_obj=None,
+                       prefetched=None):
+    """Does the real work with a single flow.
+
+    Args:
+      notification: The notification of the flow to process.
+      queue_manager: QueueManager object used to manage notifications,
+                     requests and responses.
+      flow_obj: The flow, if it was already opened with a lock.
+      prefetched: The completed requests and responses of the flow, as
+                  returned by QueueManager.MultiFetchCompletedResponses().
+    """
     session_id = notification.session_id
 
     try:
       # Take a lease on the flow:
       flow_name = session_id.FlowName()
-      if flow_name in self.well_known_flows:
+      if flow_obj is not None:
+        # Locked by _ProcessBatch but the lease ran down while the flow was
+        # waiting in the thread pool queue. This raises a LockError if it
+        # expired already, another worker might be processing the flow now.
+        flow_obj.UpdateLease(self.flow_lease_time)
+      elif flow_name in self.well_known_flows:
         # Well known flows are not necessarily present in the data store so
         # we need to create them instead of opening.
         expected_flow = self.well_known_flows[flow_name].__class__
@@ -312,7 +461,8 @@ class GRRWorker(object):
 
       else:
         with flow_obj:
-          self._ProcessRegularFlowMessages(flow_obj, notification)
+          self._ProcessRegularFlowMessages(
+              flow_obj, notification, prefetched=prefetched)
 
       elapsed = time.time() - now
       logging.debug("Done processing %s: %s sec", session_id, elapsed)
@@ -322,6 +472,9 @@ class GRRWorker(object):
       # Everything went well -> session can be run again.
       self.queued_flows.ExpireObject(session_id)
 
+      with self.processed_flows_lock:
+        self.processed_flows += 1
+
     except aff4.LockError:
       # Another worker is dealing with this flow right now, we just skip it.
       # We expect lots of these when there are few messages (the system isn't
@@ -346,6 +499,252 @@ class GRRWorker(object):
       queue_manager.DeleteNotification(session_id)
 
 
+class WorkerSupervisor(object):
+  """Runs GRRWorkers in forked child processes.
+
+  Every child owns a disjoint set of notification shards, so the children never
+  compete for the same notifications. Children that die are restarted with the
+  same shards. The parent only supervises: it logs how many flows each child
+  processed and, on SIGTERM or SIGINT, asks the children to stop and waits for
+  them to finish the flows they hold leases on.
+  """
+
+  # Minimum number of seconds between two starts of the same child.
+  RESTART_DELAY = 5
+
+  # How often children report the number of processed flows to the parent.
+  STATUS_INTERVAL = 5
+
+  def __init__(self,
+               worker_factory,
+               num_processes,
+               num_shards,
+               report_interval=60,
+               shutdown_timeout=600):
+    """Constructor.
+
+    Args:
+      worker_factory: Called in each child with the list of shards the child
+        owns, must return the GRRWorker to run. Everything which must not be
+        shared between processes (data store connections, thread pools) has
+        to be set up by this function.
+      num_processes: The number of children to run.
+      num_shards: The number of notification shards, Worker.queue_shards.
+      report_interval: How often in seconds to log the children's throughput.
+      shutdown_timeout: How long in seconds to wait for children to exit on
+        shutdown before killing them.
+
+    Raises:
+      ValueError: There are more processes than shards.
+    """
+    if num_processes > num_shards:
+      raise ValueError("Can't run %d worker processes on %d notification "
+                       "shards." % (num_processes, num_shards))
+
+    self.worker_factory = worker_factory
+    self.shard_assignment = self.AssignShards(num_shards, num_processes)
+    self.report_interval = report_interval
+    self.shutdown_timeout = shutdown_timeout
+    self.stopping = False
+
+    # Child state, indexed like shard_assignment.
+    self.pids = [None] * num_processes
+    self.status_fds = [None] * num_processes
+    self.status_buffers = [""] * num_processes
+    self.start_times = [0] * num_processes
+    self.processed_flows = [0] * num_processes
+    self.reported_flows = [0] * num_processes
+    self.restarts = [0] * num_processes
+    self.last_report = time.time()
+
+  @staticmethod
+  def AssignShards(num_shards, num_processes):
+    """Splits the shard indexes round robin into num_processes lists."""
+    return [
+        range(index, num_shards, num_processes)
+        for index in range(num_processes)
+    ]
+
+  def Run(self):
+    """Starts the children and supervises them until asked to stop."""
+    signal.signal(signal.SIGTERM, self._HandleStopSignal)
+    signal.signal(signal.SIGINT, self._HandleStopSignal)
+
+    for index in range(len(self.shard_assignment)):
+      self._StartChild(index)
+
+    self.last_report = time.time()
+    while not self.stopping:
+      self._ReadStatus(timeout=1)
+      self._ReapChildren()
+
+      now = time.time()
+      for index, pid in enumerate(self.pids):
+        if (pid is None and not self.stopping and
+            now - self.start_times[index] >= self.RESTART_DELAY):
+          self.restarts[index] += 1
+          self._StartChild(index)
+
+      if now - self.last_report >= self.report_interval:
+        self._ReportThroughput()
+
+    self._Shutdown()
+
+  def _HandleStopSignal(self, signum, frame):
+    del frame  # Unused.
+    logging.info("Worker supervisor got signal %d, shutting down.", signum)
+    self.stopping = True
+
+  def _StartChild(self, index):
+    """Forks the child owning the shards at shard_assignment[index]."""
+    read_fd, write_fd = os.pipe()
+    self.start_times[index] = time.time()
+
+    pid = os.fork()
+    if pid == 0:
+      os.close(read_fd)
+      self._RunChild(index, write_fd)
+
+    os.close(write_fd)
+    self.pids[index] = pid
+    self.status_fds[index] = read_fd
+    self.status_buffers[index] = ""
+    self.reported_flows[index] = 0
+    logging.info("Started worker process %d with notification shards %s.", pid,
+                 self.shard_assignment[index])
+
+  def _RunChild(self, index, status_fd):
+    """Runs the worker in the child process. Never returns."""
+    exit_code = 1
+    try:
+      # The parent handles interrupts and tells the children to stop.
+      signal.signal(signal.SIGINT, signal.SIG_IGN)
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      for fd in self.status_fds:
+        if fd is not None:
+          os.close(fd)
+
+      worker_obj = self.worker_factory(self.shard_assignment[index])
+      signal.signal(signal.SIGTERM, lambda signum, frame: worker_obj.Stop())
+
+      flags = fcntl.fcntl(status_fd, fcntl.F_GETFL)
+      fcntl.fcntl(status_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+      status_thread = threading.Thread(
+          target=self._SendStatus,
+          args=(worker_obj, status_fd),
+          name="WorkerStatus")
+      status_thread.daemon = True
+      status_thread.start()
+
+      worker_obj.Run()
+      exit_code = 0
+    except Exception:  # pylint: disable=broad-except
+      logging.exception("Worker process died.")
+    finally:
+      logging.shutdown()
+      os._exit(exit_code)  # pylint: disable=protected-access
+
+  def _SendStatus(self, worker_obj, status_fd):
+    """Periodically sends the number of processed flows to the parent."""
+    while True:
+      try:
+        os.write(status_fd, "%d\n" % worker_obj.processed_flows)
+      except OSError as e:
+        # The parent is busy or gone, it will get the next update.
+        if e.errno not in (errno.EAGAIN, errno.EPIPE):
+          raise
+      time.sleep(self.STATUS_INTERVAL)
+
+  def _ReadStatus(self, timeout):
+    """Reads the status updates sent by the children."""
+    fds = [fd for fd in self.status_fds if fd is not None]
+    try:
+      readable, _, _ = select.select(fds, [], [], timeout)
+    except select.error as e:
+      # A signal interrupted the wait.
+      if e.args[0] == errno.EINTR:
+        return
+      raise
+
+    for fd in readable:
+      index = self.status_fds.index(fd)
+      data = os.read(fd, 4096)
+      if not data:
+        # The child closed its end, it is exiting.
+        self._CloseStatus(index)
+        continue
+
+      lines = (self.status_buffers[index] + data).split("\n")
+      self.status_buffers[index] = lines.pop()
+      if lines:
+        processed = int(lines[-1])
+        self.processed_flows[index] += processed - self.reported_flows[index]
+        self.reported_flows[index] = processed
+
+  def _CloseStatus(self, index):
+    if self.status_fds[index] is not None:
+      os.close(self.status_fds[index])
+      self.status_fds[index] = None
+
+  def _ReapChildren(self):
+    """Collects the children which exited."""
+    for index, pid in enumerate(self.pids):
+      if pid is None:
+        continue
+
+      try:
+        waited_pid, status = os.waitpid(pid, os.WNOHANG)
+      except OSError as e:
+        if e.errno == errno.EINTR:
+          continue
+        raise
+
+      if waited_pid == 0:
+        continue
+
+      self.pids[index] = None
+      self._CloseStatus(index)
+      if not self.stopping:
+        logging.error("Worker process %d with notification shards %s exited "
+                      "with status %d, restarting it.", pid,
+                      self.shard_assignment[index], status)
+
+  def _ReportThroughput(self):
+    """Logs the flows each child processed since the last report."""
+    now = time.time()
+    elapsed = max(now - self.last_report, 1e-6)
+    self.last_report = now
+
+    for index, shards in enumerate(self.shard_assignment):
+      logging.info("Worker process %s with notification shards %s: %d flows "
+                   "processed (%.2f/s), %d restarts.", self.pids[index], shards,
+                   self.processed_flows[index],
+                   self.processed_flows[index] / elapsed, self.restarts[index])
+      self.processed_flows[index] = 0
+
+  def _Shutdown(self):
+    """Stops all children, killing the ones that don't exit in time."""
+    for pid in self.pids:
+      if pid is not None:
+        os.kill(pid, signal.SIGTERM)
+
+    deadline = time.time() + self.shutdown_timeout
+    while any(self.pids) and time.time() < deadline:
+      self._ReadStatus(timeout=0.5)
+      self._ReapChildren()
+
+    for index, pid in enumerate(self.pids):
+      if pid is not None:
+        logging.warning("Worker process %d did not stop in time, killing it.",
+                        pid)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        self.pids[index] = None
+        self._CloseStatus(index)
+
+    self._ReportThroughput()
+
+
 class WorkerInit(registry.InitHook):
   """Registers worker stats variables."""
 
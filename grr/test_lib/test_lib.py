@@ -44,6 +44,7 @@ from grr.server import client_index
 from grr.server import data_store
 from grr.server import email_alerts
 from grr.server import flow
+from grr.server import sequential_collection
 from grr.server.aff4_objects import aff4_grr
 from grr.server.aff4_objects import filestore
 from grr.server.aff4_objects import users
@@ -129,6 +130,7 @@ class GRRBaseTest(unittest.TestCase):
     self.last_start_time = time.time()
 
     data_store.DB.ClearTestDB()
+    sequential_collection.RECORD_COUNTERS.Clear()
 
     aff4.FACTORY.Flush()
 
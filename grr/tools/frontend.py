@@ -3,14 +3,20 @@
 
 
 
+import asynchat
+import asyncore
 import BaseHTTPServer
 import cgi
+import collections
 import cStringIO
 import logging
+import mimetools
 import pdb
 import socket
 import SocketServer
+import tempfile
 import threading
+import time
 
 
 import ipaddr
@@ -33,6 +39,7 @@ from grr.server import front_end
 from grr.server import master
 from grr.server import server_logging
 from grr.server import server_startup
+from grr.server import threadpool
 
 
 class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
@@ -311,30 +318,507 @@ class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
     stats.STATS.SetGaugeValue("frontend_max_active_count",
                               self.request_queue_size)
 
-    if frontend:
-      self.frontend = frontend
-    else:
-      self.frontend = front_end.FrontEndServer(
-          certificate=config.CONFIG["Frontend.certificate"],
-          private_key=config.CONFIG["PrivateKeys.server_key"],
-          max_queue_size=config.CONFIG["Frontend.max_queue_size"],
-          message_expiry_time=config.CONFIG["Frontend.message_expiry_time"],
-          max_retransmission_time=config.CONFIG[
-              "Frontend.max_retransmission_time"])
+    self.frontend = frontend or CreateFrontEnd()
     self.server_cert = config.CONFIG["Frontend.certificate"]
-
-    (address, _) = server_address
-    version = ipaddr.IPAddress(address).version
-    if version == 4:
-      self.address_family = socket.AF_INET
-    elif version == 6:
-      self.address_family = socket.AF_INET6
+    self.address_family = GetAddressFamily(server_address)
 
     logging.info("Will attempt to listen on %s", server_address)
     BaseHTTPServer.HTTPServer.__init__(self, server_address, handler, *args,
                                        **kwargs)
 
 
+def CreateFrontEnd():
+  """Creates the FrontEndServer the HTTP servers hand requests to."""
+  return front_end.FrontEndServer(
+      certificate=config.CONFIG["Frontend.certificate"],
+      private_key=config.CONFIG["PrivateKeys.server_key"],
+      max_queue_size=config.CONFIG["Frontend.max_queue_size"],
+      message_expiry_time=config.CONFIG["Frontend.message_expiry_time"],
+      max_retransmission_time=config.CONFIG["Frontend.max_retransmission_time"])
+
+
+def GetAddressFamily(server_address):
+  (address, _) = server_address
+  version = ipaddr.IPAddress(address).version
+  if version == 4:
+    return socket.AF_INET
+
+  return socket.AF_INET6
+
+
+class BufferedRequestHandler(GRRHTTPServerHandler):
+  """Runs the GRRHTTPServerHandler endpoints on a fully read request.
+
+  The event loop reads the whole request before handing it to a worker thread,
+  so rfile is the spooled request body. The response is collected in wfile and
+  written out by the event loop.
+  """
+
+  # pylint: disable=super-init-not-called
+  def __init__(self, server, client_address, command, path, request_version,
+               headers, body, keep_alive):
+    # We do not call the base class constructor since it serves a socket.
+    self.server = server
+    self.client_address = client_address
+    self.command = command
+    self.path = path
+    self.request_version = request_version
+    self.headers = headers
+    if isinstance(body, basestring):
+      body = cStringIO.StringIO(body)
+    self.rfile = body
+    self.wfile = cStringIO.StringIO()
+    self.keep_alive = keep_alive
+    self.responses = 0
+
+  # pylint: enable=super-init-not-called
+
+  def Send(self, data, status=200, additional_headers=None, **kwargs):
+    self.responses += 1
+    if self.keep_alive:
+      additional_headers = dict(additional_headers or {})
+      additional_headers["Connection"] = "keep-alive"
+
+    # BaseHTTPRequestHandler is an old style class so we can not use super().
+    GRRHTTPServerHandler.Send(
+        self,
+        data,
+        status=status,
+        additional_headers=additional_headers,
+        **kwargs)
+
+  def Handle(self):
+    """Serves the request.
+
+    Returns:
+      A tuple of the response data and whether the connection can be reused.
+    """
+    if self.command == "GET":
+      self.do_GET()
+    elif self.command == "POST":
+      self.do_POST()
+
+    # Some endpoints send more than one response, the client can only tell
+    # where they end when the connection is closed.
+    return self.wfile.getvalue(), self.keep_alive and self.responses == 1
+
+
+class _AsyncHTTPChannel(asynchat.async_chat):
+  """A single client connection served by the GRRAsyncHTTPServer event loop."""
+
+  MAX_HEADER_SIZE = 64 * 1024
+
+  def __init__(self, server, sock, client_address):
+    asynchat.async_chat.__init__(self, sock=sock, map=server.socket_map)
+    self.server = server
+    self.client_address = client_address
+    self.last_activity = time.time()
+    self._StartRequest()
+
+  def _StartRequest(self):
+    self.state = "headers"
+    self.header_data = []
+    self.header_size = 0
+    self.line = []
+    self.body = None
+    self.body_size = 0
+    self.max_body_size = None
+    self.chunked = False
+    self.request = None
+    self.discarded_input = False
+    self.set_terminator("\r\n\r\n")
+
+  def close(self):
+    self.state = "closed"
+    if self.body is not None:
+      self.body.close()
+      self.body = None
+    asynchat.async_chat.close(self)
+
+  def readable(self):
+    # We do not read the next request before the current one is answered.
+    return self.state != "processing"
+
+  def handle_write(self):
+    self.last_activity = time.time()
+    asynchat.async_chat.handle_write(self)
+
+  def handle_error(self):
+    logging.exception("Error serving %s", self.client_address[0])
+    self.close()
+
+  def collect_incoming_data(self, data):
+    self.last_activity = time.time()
+    if self.state == "headers":
+      self.header_data.append(data)
+      self.header_size += len(data)
+      if self.header_size > self.MAX_HEADER_SIZE:
+        self.close()
+
+    elif self.state == "line":
+      self.line.append(data)
+
+    elif self.state == "data":
+      self._WriteBody(data)
+
+    elif self.state == "processing":
+      # Pipelined requests are not supported, the client has to resend them.
+      self.discarded_input = True
+
+    elif self.state == "rejected":
+      # The rest of a rejected body is read and dropped so the client gets to
+      # see the response, but no more than twice max_request_size in total.
+      self.body_size += len(data)
+      if self.body_size > 2 * self.server.max_request_size:
+        self.close()
+
+  def found_terminator(self):
+    if self.state == "headers":
+      self._ParseHeaders()
+
+    elif self.state == "line":
+      self._ParseChunkLine()
+
+    elif self.state == "data":
+      if self.chunked:
+        self.state = "line"
+        self.set_terminator("\r\n")
+      else:
+        self._Dispatch()
+
+  def _ParseHeaders(self):
+    lines = "".join(self.header_data).split("\r\n")
+
+    # Empty lines before the request line are allowed (RFC 2616 4.1).
+    while lines and not lines[0]:
+      lines.pop(0)
+
+    try:
+      command, path, request_version = lines[0].split()
+    except (IndexError, ValueError):
+      self.close()
+      return
+
+    headers = mimetools.Message(
+        cStringIO.StringIO("\r\n".join(lines[1:]) + "\r\n\r\n"), 0)
+
+    connection = headers.get("Connection", "").lower()
+    if request_version == "HTTP/1.1":
+      keep_alive = connection != "close"
+    else:
+      keep_alive = connection == "keep-alive"
+
+    self.request = [command, path, request_version, headers, None, keep_alive]
+
+    # Bodies are spooled to disk once they get large. File uploads have no
+    # size limit, their bodies are streamed into the file store by the
+    # handler.
+    self.body = tempfile.SpooledTemporaryFile(
+        max_size=self.server.request_spool_size)
+    if not path.startswith("/upload"):
+      self.max_body_size = self.server.max_request_size
+
+    if headers.get("Transfer-Encoding", "").lower() == "chunked":
+      self.chunked = True
+      self.state = "line"
+      self.set_terminator("\r\n")
+      return
+
+    try:
+      content_length = int(headers.getheader("content-length") or 0)
+    except ValueError:
+      self.close()
+      return
+
+    if self.max_body_size is not None and content_length > self.max_body_size:
+      self._Reject()
+    elif content_length > 0:
+      self.state = "data"
+      self.set_terminator(content_length)
+    else:
+      self._Dispatch()
+
+  def _ParseChunkLine(self):
+    """Reads a chunk size line or a trailer of a chunked request body."""
+    line = "".join(self.line)
+    self.line = []
+
+    # The handlers parse the chunked encoding themselves so we keep it intact.
+    self._WriteBody(line + "\r\n")
+    if self.state == "rejected":
+      return
+
+    if self.chunked == "trailer":
+      if not line:
+        self._Dispatch()
+      return
+
+    try:
+      chunk_size = int(line.split(";")[0], 16)
+    except ValueError:
+      self.close()
+      return
+
+    if chunk_size == 0:
+      self.chunked = "trailer"
+    else:
+      # The chunk data is followed by \r\n.
+      self.state = "data"
+      self.set_terminator(chunk_size + 2)
+
+  def _WriteBody(self, data):
+    self.body_size += len(data)
+    if self.max_body_size is not None and self.body_size > self.max_body_size:
+      self._Reject()
+      return
+
+    self.body.write(data)
+
+  def _Reject(self):
+    """Answers a request whose body is too large and closes the connection."""
+    stats.STATS.IncrementCounter("frontend_rejected_requests")
+    self.state = "rejected"
+    self.set_terminator(None)
+    self.body.close()
+    self.body = None
+    # The client closes the connection once it has sent the whole request,
+    # otherwise it expires like an idle connection.
+    self.push("HTTP/1.0 413 Request Entity Too Large\r\n"
+              "Content-Length: 0\r\nConnection: close\r\n\r\n")
+
+  def _Dispatch(self):
+    self.state = "processing"
+    self.set_terminator(None)
+
+    # The handler owns the body from now on.
+    self.body.seek(0)
+    self.request[4] = self.body
+    self.body = None
+    self.server.Dispatch(self, self.request)
+
+  def Respond(self, response, keep_alive):
+    """Sends the response to the client. Called by the event loop thread."""
+    if not self.connected:
+      return
+
+    self.last_activity = time.time()
+    if response:
+      self.push(response)
+
+    if response and keep_alive and not self.discarded_input:
+      self._StartRequest()
+    else:
+      self.close_when_done()
+
+  def IsIdle(self, now, timeout):
+    return (self.state != "processing" and not self.producer_fifo and
+            now - self.last_activity > timeout)
+
+
+class _LoopWaker(asyncore.dispatcher):
+  """Wakes up the event loop from other threads."""
+
+  def __init__(self, socket_map):
+    reader, self.writer = socket.socketpair()
+    self.writer.setblocking(0)
+    asyncore.dispatcher.__init__(self, sock=reader, map=socket_map)
+
+  def Wake(self):
+    try:
+      self.writer.send("x")
+    except socket.error:
+      # The socket buffer is full, the loop is going to wake up anyway.
+      pass
+
+  def writable(self):
+    return False
+
+  def handle_read(self):
+    try:
+      self.recv(4096)
+    except socket.error:
+      pass
+
+  def close(self):
+    asyncore.dispatcher.close(self)
+    self.writer.close()
+
+
+class GRRAsyncHTTPServer(asyncore.dispatcher):
+  """An event loop based GRR HTTP frontend server.
+
+  Unlike GRRHTTPServer which uses a thread per connection, all connections are
+  served by a single poll() based event loop. Only complete requests are handed
+  to a fixed size thread pool which runs the GRRHTTPServerHandler endpoints, so
+  idle keep-alive connections and clients slowly sending their data do not tie
+  up any threads. Large request bodies are spooled to temporary files while
+  they are received, requests other than file uploads larger than
+  max_request_size are answered with a 413.
+  """
+
+  request_queue_size = 500
+
+  def __init__(self,
+               server_address,
+               frontend=None,
+               worker_threads=None,
+               max_connections=None,
+               keep_alive_timeout=None,
+               max_request_size=None,
+               request_spool_size=None):
+    self.socket_map = {}
+    asyncore.dispatcher.__init__(self, map=self.socket_map)
+
+    if worker_threads is None:
+      worker_threads = config.CONFIG["Frontend.async_worker_threads"]
+    if max_connections is None:
+      max_connections = config.CONFIG["Frontend.async_max_connections"]
+    if keep_alive_timeout is None:
+      keep_alive_timeout = config.CONFIG["Frontend.async_keep_alive_timeout"]
+    if max_request_size is None:
+      max_request_size = config.CONFIG["Frontend.async_max_request_size"]
+    if request_spool_size is None:
+      request_spool_size = config.CONFIG["Frontend.async_request_spool_size"]
+
+    self.max_connections = max_connections
+    self.keep_alive_timeout = keep_alive_timeout
+    self.max_request_size = max_request_size
+    self.request_spool_size = request_spool_size
+
+    stats.STATS.SetGaugeValue("frontend_max_active_count", worker_threads)
+
+    self.frontend = frontend or CreateFrontEnd()
+    self.server_cert = config.CONFIG["Frontend.certificate"]
+
+    logging.info("Will attempt to listen on %s", server_address)
+    self.create_socket(GetAddressFamily(server_address), socket.SOCK_STREAM)
+    try:
+      self.set_reuse_addr()
+      self.bind(server_address)
+      self.listen(self.request_queue_size)
+    except socket.error:
+      self.close()
+      raise
+
+    self.server_address = self.socket.getsockname()
+
+    self.waker = _LoopWaker(self.socket_map)
+
+    # Requests waiting for a worker and responses waiting to be sent. Workers
+    # only ever append to completed.
+    self.pending = collections.deque()
+    self.completed = collections.deque()
+
+    # The pool does not grow, the queue size therefore limits how many requests
+    # are handed to it at a time.
+    self.thread_pool = threadpool.ThreadPool.Factory(
+        "grr_async_frontend",
+        min_threads=worker_threads,
+        max_threads=worker_threads)
+    self.thread_pool.Start()
+
+    self.last_expiry = time.time()
+    self.shutdown_requested = threading.Event()
+    self.stopped = threading.Event()
+
+  def writable(self):
+    return False
+
+  def handle_accept(self):
+    pair = self.accept()
+    if pair is None:
+      return
+
+    sock, client_address = pair
+
+    # The listening socket and the waker are in the map as well.
+    if len(self.socket_map) - 2 >= self.max_connections:
+      stats.STATS.IncrementCounter("frontend_rejected_connections")
+      sock.close()
+      return
+
+    _AsyncHTTPChannel(self, sock, client_address)
+
+  def handle_error(self):
+    logging.exception("Error accepting connection.")
+
+  def Dispatch(self, channel, request):
+    """Queues a complete request for the worker threads."""
+    self.pending.append((channel, request))
+    self._DispatchPending()
+
+  def _DispatchPending(self):
+    while self.pending:
+      try:
+        self.thread_pool.AddTask(
+            self._HandleRequest,
+            self.pending[0],
+            name="HandleRequest",
+            blocking=False,
+            inline=False)
+      except threadpool.Full:
+        return
+
+      self.pending.popleft()
+
+  def _HandleRequest(self, channel, request):
+    """Runs in a worker thread."""
+    try:
+      handler = BufferedRequestHandler(self, channel.client_address, *request)
+      response, keep_alive = handler.Handle()
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Error handling request: %s", e)
+      response, keep_alive = "", False
+    finally:
+      request[4].close()
+
+    self.completed.append((channel, response, keep_alive))
+    self.waker.Wake()
+
+  def _SendCompleted(self):
+    while self.completed:
+      channel, response, keep_alive = self.completed.popleft()
+      channel.Respond(response, keep_alive)
+
+  def _ExpireIdleConnections(self):
+    now = time.time()
+    if now - self.last_expiry < 1:
+      return
+
+    self.last_expiry = now
+    channels = [
+        x for x in self.socket_map.values() if isinstance(x, _AsyncHTTPChannel)
+    ]
+    for channel in channels:
+      if channel.IsIdle(now, self.keep_alive_timeout):
+        channel.close()
+
+    stats.STATS.SetGaugeValue("frontend_open_connections", len(channels))
+
+  def serve_forever(self, poll_interval=0.5):
+    """Runs the event loop until shutdown() is called."""
+    self.stopped.clear()
+    try:
+      while not self.shutdown_requested.is_set():
+        asyncore.loop(
+            timeout=poll_interval, use_poll=True, map=self.socket_map, count=1)
+
+        self._SendCompleted()
+        self._DispatchPending()
+        self._ExpireIdleConnections()
+    finally:
+      self.stopped.set()
+
+  def shutdown(self):
+    """Stops serve_forever() and waits for it to return."""
+    self.shutdown_requested.set()
+    self.waker.Wake()
+    self.stopped.wait()
+
+  def server_close(self):
+    asyncore.close_all(map=self.socket_map)
+
+
 def CreateServer(frontend=None):
   """Start frontend http server."""
   max_port = config.CONFIG.Get("Frontend.port_max",
@@ -344,8 +828,11 @@ def CreateServer(frontend=None):
 
     server_address = (config.CONFIG["Frontend.bind_address"], port)
     try:
-      httpd = GRRHTTPServer(
-          server_address, GRRHTTPServerHandler, frontend=frontend)
+      if config.CONFIG["Frontend.server_mode"] == "async":
+        httpd = GRRAsyncHTTPServer(server_address, frontend=frontend)
+      else:
+        httpd = GRRHTTPServer(
+            server_address, GRRHTTPServerHandler, frontend=frontend)
       break
     except socket.error as e:
       if e.errno == socket.errno.EADDRINUSE and port < max_port:
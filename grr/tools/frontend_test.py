@@ -42,6 +42,10 @@ from grr.tools import frontend
 class GRRHTTPServerTest(test_lib.GRRBaseTest):
   """Test the http server."""
 
+  @classmethod
+  def CreateHTTPServer(cls, server_address):
+    return frontend.GRRHTTPServer(server_address, frontend.GRRHTTPServerHandler)
+
   @classmethod
   def setUpClass(cls):
     super(GRRHTTPServerTest, cls).setUpClass()
@@ -58,8 +62,7 @@ class GRRHTTPServerTest(test_lib.GRRBaseTest):
     # Bring up a local server for testing.
     port = portpicker.PickUnusedPort()
     ip = utils.ResolveHostnameToIP("localhost", port)
-    cls.httpd = frontend.GRRHTTPServer((ip, port),
-                                       frontend.GRRHTTPServerHandler)
+    cls.httpd = cls.CreateHTTPServer((ip, port))
 
     if ipaddr.IPAddress(ip).version == 6:
       cls.address_family = socket.AF_INET6
@@ -75,6 +78,7 @@ class GRRHTTPServerTest(test_lib.GRRBaseTest):
   @classmethod
   def tearDownClass(cls):
     cls.httpd.shutdown()
+    cls.httpd.server_close()
     cls.config_overrider.Stop()
 
   def setUp(self):
@@ -398,6 +402,56 @@ class GRRHTTPServerTest(test_lib.GRRBaseTest):
     self.assertEqual(profile.data[:2], "\x1f\x8b")
 
 
+class GRRAsyncHTTPServerTest(GRRHTTPServerTest):
+  """Runs the http server tests against the event loop based server."""
+
+  @classmethod
+  def CreateHTTPServer(cls, server_address):
+    # A small spool size makes uploads go through temporary files.
+    return frontend.GRRAsyncHTTPServer(
+        server_address,
+        worker_threads=4,
+        keep_alive_timeout=1,
+        max_request_size=64 * 1024,
+        request_spool_size=16)
+
+  def testKeepAlive(self):
+    with requests.Session() as session:
+      for _ in range(3):
+        req = session.get(self.base_url + "server.pem")
+        self.assertEqual(req.status_code, 200)
+        self.assertEqual(req.headers["Connection"], "keep-alive")
+        self.assertTrue("BEGIN CERTIFICATE" in req.content)
+
+  def testIdleConnectionsDoNotBlockRequests(self):
+    address = self.base_url.split("//")[1].rstrip("/")
+    host, port = address.rsplit(":", 1)
+
+    # Far more idle connections than there are worker threads.
+    idle = [
+        socket.create_connection((host.strip("[]"), int(port)))
+        for _ in range(50)
+    ]
+    try:
+      # A client which sent only part of its request does not hold up anyone.
+      idle[0].sendall("POST /control HTTP/1.1\r\nContent-Length: 100\r\n\r\n")
+
+      req = requests.get(self.base_url + "server.pem")
+      self.assertEqual(req.status_code, 200)
+    finally:
+      for sock in idle:
+        sock.close()
+
+  def testLargeRequestsAreRejected(self):
+    req = requests.post(self.base_url + "control", data="x" * 65 * 1024)
+    self.assertEqual(req.status_code, 413)
+
+    # Chunked bodies do not announce their size.
+    req = requests.post(
+        self.base_url + "control", data=iter(["x" * 1024] * 65))
+    self.assertEqual(req.status_code, 413)
+
+
 def main(args):
   test_lib.main(args)
 
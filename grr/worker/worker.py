@@ -18,19 +18,35 @@ from grr.server import server_startup
 from grr.server import worker
 
 
+def CreateWorker(notification_shards=None):
+  """Initializes the server and returns a worker for the given shards."""
+  # Initialise flows and config_lib
+  server_startup.Init()
+
+  token = access_control.ACLToken(username="GRRWorker").SetUID()
+  return worker.GRRWorker(token=token, notification_shards=notification_shards)
+
+
 def main(argv):
   """Main."""
   del argv  # Unused.
   config.CONFIG.AddContext(contexts.WORKER_CONTEXT,
                            "Context applied when running a worker.")
 
-  # Initialise flows and config_lib
-  server_startup.Init()
-
-
-  token = access_control.ACLToken(username="GRRWorker").SetUID()
-  worker_obj = worker.GRRWorker(token=token)
-  worker_obj.Run()
+  # Children of a multi-process worker initialize after forking, so we only
+  # read the config here.
+  server_startup.ConfigInit()
+
+  if config.CONFIG["Worker.processes"] > 1:
+    supervisor = worker.WorkerSupervisor(
+        CreateWorker,
+        config.CONFIG["Worker.processes"],
+        config.CONFIG["Worker.queue_shards"],
+        report_interval=config.CONFIG["Worker.throughput_report_interval"],
+        shutdown_timeout=config.CONFIG["Worker.shutdown_timeout"])
+    supervisor.Run()
+  else:
+    CreateWorker().Run()
 
 
 if __name__ == "__main__":
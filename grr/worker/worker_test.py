@@ -665,6 +665,107 @@ class GrrWorkerTest(flow_test_lib.FlowTestsBaseclass):
     notifications = user.Get(user.Schema.PENDING_NOTIFICATIONS)
     self.assertIsNone(notifications)
 
+  def testWorkerOnlyProcessesOwnedShards(self):
+    # Notifications are written to the shards round robin, so the two flows
+    # end up in different shards.
+    session_ids = []
+    for data in ["Hello1", "Hello2"]:
+      flow_obj = self.FlowSetup("WorkerSendingTestFlow2")
+      session_ids.append(flow_obj.session_id)
+      flow_obj.Close()
+      self.SendResponse(flow_obj.session_id, data)
+
+    manager = queue_manager.QueueManager(token=self.token)
+    first_flow_shards = []
+    for shard in range(manager.num_notification_shards):
+      by_priority = manager.GetNotificationsByPriorityForShards(
+          queues.FLOWS, [shard])
+      notifications = sum(by_priority.values(), [])
+      if session_ids[0] in [n.session_id for n in notifications]:
+        self.assertNotIn(session_ids[1], [n.session_id for n in notifications])
+        first_flow_shards.append(shard)
+    self.assertEqual(len(first_flow_shards), 1)
+
+    worker_obj = worker.GRRWorker(
+        token=self.token, notification_shards=first_flow_shards)
+    worker_obj.RunOnce()
+    worker_obj.thread_pool.Join()
+    self.assertEqual(RESULTS, ["Hello1"])
+    self.assertEqual(worker_obj.processed_flows, 1)
+
+    other_shards = [
+        shard for shard in range(manager.num_notification_shards)
+        if shard not in first_flow_shards
+    ]
+    worker_obj = worker.GRRWorker(
+        token=self.token, notification_shards=other_shards)
+    worker_obj.RunOnce()
+    worker_obj.thread_pool.Join()
+    self.assertEqual(RESULTS, ["Hello1", "Hello2"])
+
+  def testFlowsAreLockedAndLoadedInBatches(self):
+    session_ids = []
+    for data in ["Hello1", "Hello2"]:
+      flow_obj = self.FlowSetup("WorkerSendingTestFlow2")
+      session_ids.append(flow_obj.session_id)
+      flow_obj.Close()
+      self.SendResponse(flow_obj.session_id, data)
+
+    # The second flow is locked by someone else.
+    with aff4.FACTORY.OpenWithLock(
+        session_ids[1], lease_time=100, token=self.token):
+      worker_obj = worker.GRRWorker(token=self.token)
+      with mock.patch.object(
+          aff4.FACTORY, "OpenWithLock", side_effect=AssertionError):
+        worker_obj.RunOnce()
+        worker_obj.thread_pool.Join()
+
+    self.assertEqual(RESULTS, ["Hello1"])
+
+    with test_lib.ConfigOverrider({"Worker.flow_batch_size": 1}):
+      worker_obj = worker.GRRWorker(token=self.token)
+    worker_obj.RunOnce()
+    worker_obj.thread_pool.Join()
+    self.assertEqual(RESULTS, ["Hello1", "Hello2"])
+
+  def testBatchedFlowsWithExpiredLeasesAreSkipped(self):
+    flow_obj = self.FlowSetup("WorkerSendingTestFlow2")
+    flow_obj.Close()
+    self.SendResponse(flow_obj.session_id, "Hello1")
+
+    worker_obj = worker.GRRWorker(token=self.token)
+    tasks = []
+    with mock.patch.object(
+        worker_obj.thread_pool,
+        "AddTask",
+        side_effect=lambda **kwargs: tasks.append(kwargs)):
+      worker_obj.RunOnce()
+    self.assertEqual(len(tasks), 1)
+
+    # The flow waited in the thread pool queue for longer than its lease.
+    expired = time.time() + worker_obj.flow_lease_time + 1
+    with utils.Stubber(time, "time", lambda: expired):
+      tasks[0]["target"](*tasks[0]["args"])
+    self.assertEqual(RESULTS, [])
+
+  def testStoppedWorkerExits(self):
+    worker_obj = worker.GRRWorker(token=self.token)
+    worker_obj.Stop()
+    with mock.patch.object(worker_obj, "RunOnce") as run_once:
+      worker_obj.Run()
+    self.assertFalse(run_once.called)
+
+  def testSupervisorAssignsDisjointShards(self):
+    assignment = worker.WorkerSupervisor.AssignShards(5, 2)
+    self.assertEqual(assignment, [[0, 2, 4], [1, 3]])
+
+    assignment = worker.WorkerSupervisor.AssignShards(32, 32)
+    self.assertEqual(sorted(sum(assignment, [])), range(32))
+    self.assertTrue(all(len(shards) == 1 for shards in assignment))
+
+    with self.assertRaises(ValueError):
+      worker.WorkerSupervisor(None, 6, 5)
+
   def testWellKnownFlowResponsesAreProcessedOnlyOnce(self):
     worker_obj = worker.GRRWorker(token=self.token)
 